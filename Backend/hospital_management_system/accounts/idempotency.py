@@ -0,0 +1,192 @@
+"""
+Idempotency-Key support for write endpoints
+"""
+import functools
+import hashlib
+import json
+import logging
+import time
+from datetime import timedelta
+from typing import Optional, Tuple
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+
+
+def _principal(user) -> Optional[str]:
+    if hasattr(user, 'patient_id'):
+        return f"patient:{user.patient_id}"
+    if hasattr(user, 'staff_id'):
+        return f"staff:{user.staff_id}"
+    return None
+
+
+def _fingerprint(request) -> str:
+    try:
+        body = json.dumps(request.data, sort_keys=True, default=str)
+    except Exception:
+        body = repr(request.data)
+    return hashlib.sha256(f"{request.method} {request.path}\n{body}".encode('utf-8')).hexdigest()
+
+
+class IdempotencyService:
+    """
+    Stores the first response for each (principal, key) and replays it.
+
+    The first request claims the key by inserting an in-progress row, which
+    the unique constraint makes atomic, so exactly one of several concurrent
+    duplicates runs the view. The others poll the row until it is completed
+    and replay the stored response, or get 409 if it takes longer than
+    IDEMPOTENCY_WAIT_SECONDS. Server errors and exceptions release the key so
+    the client can retry; other responses are kept for IDEMPOTENCY_KEY_TTL_HOURS.
+    A claim left behind by a crashed worker is taken over after
+    IDEMPOTENCY_LOCK_SECONDS.
+    """
+
+    def __init__(self):
+        self.ttl = timedelta(hours=getattr(settings, 'IDEMPOTENCY_KEY_TTL_HOURS', 24))
+        self.lock_timeout = timedelta(seconds=getattr(settings, 'IDEMPOTENCY_LOCK_SECONDS', 60))
+        self.wait_seconds = getattr(settings, 'IDEMPOTENCY_WAIT_SECONDS', 10)
+        self.poll_interval = 0.1
+
+    def claim(self, principal: str, key: str, fingerprint: str) -> Tuple[IdempotencyKey, bool]:
+        """
+        Claim a key for this request
+
+        Returns:
+            (record, True) if this request should run, (existing record, False) otherwise
+        """
+        while True:
+            now = timezone.now()
+            try:
+                with transaction.atomic():
+                    record = IdempotencyKey.objects.create(
+                        principal=principal,
+                        key=key,
+                        request_fingerprint=fingerprint,
+                        locked_until=now + self.lock_timeout,
+                        expires_at=now + self.ttl
+                    )
+                return record, True
+            except IntegrityError:
+                pass
+
+            record = IdempotencyKey.objects.filter(principal=principal, key=key).first()
+            if record is None:
+                continue  # Released in the meantime
+            stale = record.expires_at <= now or (
+                record.status == IdempotencyKey.IN_PROGRESS and record.locked_until <= now
+            )
+            if not stale:
+                return record, False
+            if record.status == IdempotencyKey.IN_PROGRESS:
+                logger.warning(f"Taking over abandoned idempotency key {key} of {principal}")
+            # Only the request that sees this exact row removes it; then everyone races to claim again
+            IdempotencyKey.objects.filter(pk=record.pk, status=record.status, locked_until=record.locked_until).delete()
+
+    def wait(self, record: IdempotencyKey) -> Optional[IdempotencyKey]:
+        """Wait for an in-progress request to finish; None if it did not in time or gave up its claim"""
+        deadline = time.monotonic() + self.wait_seconds
+        while record.status == IdempotencyKey.IN_PROGRESS:
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+            record = IdempotencyKey.objects.filter(pk=record.pk).first()
+            if record is None:
+                return None
+        return record
+
+    def complete(self, record: IdempotencyKey, response) -> bool:
+        """Store the response of a claimed key; returns False if it cannot be replayed and the key was released"""
+        try:
+            body = json.loads(json.dumps(response.data, default=str))
+        except (AttributeError, TypeError, ValueError):
+            self.release(record)
+            return False
+        IdempotencyKey.objects.filter(pk=record.pk).update(
+            status=IdempotencyKey.COMPLETED,
+            response_status=response.status_code,
+            response_body=body,
+            expires_at=timezone.now() + self.ttl
+        )
+        return True
+
+    @staticmethod
+    def release(record: IdempotencyKey):
+        IdempotencyKey.objects.filter(pk=record.pk).delete()
+
+    @staticmethod
+    def replay(record: IdempotencyKey) -> Response:
+        return Response(record.response_body, status=record.response_status, headers={REPLAYED_HEADER: 'true'})
+
+    def purge_expired(self) -> int:
+        deleted, _ = IdempotencyKey.objects.filter(expires_at__lte=timezone.now()).delete()
+        return deleted
+
+
+idempotency = IdempotencyService()
+
+
+def idempotent(handler):
+    """
+    Make an APIView handler (post, put, patch, delete) idempotent for requests
+    that carry an Idempotency-Key header. Requests without the header, or from
+    unauthenticated users, run as usual.
+    """
+    @functools.wraps(handler)
+    def wrapper(view, request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        principal = _principal(request.user)
+        if not key or principal is None:
+            return handler(view, request, *args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return Response({"error": f"{HEADER} must be at most {MAX_KEY_LENGTH} characters"}, status=400)
+
+        fingerprint = _fingerprint(request)
+        record, claimed = idempotency.claim(principal, key, fingerprint)
+        if not claimed:
+            if record.request_fingerprint != fingerprint:
+                return Response({"error": f"{HEADER} was already used for a different request"}, status=422)
+            record = idempotency.wait(record)
+            if record is None:
+                return Response({"error": f"A request with this {HEADER} is still being processed"}, status=409)
+            return idempotency.replay(record)
+
+        try:
+            response = handler(view, request, *args, **kwargs)
+        except Exception:
+            idempotency.release(record)
+            raise
+        if response.status_code >= 500:
+            idempotency.release(record)
+        else:
+            idempotency.complete(record, response)
+        return response
+
+    wrapper._idempotent = True
+    return wrapper
+
+
+class IdempotentMixin:
+    """
+    APIView mixin applying @idempotent to every write handler the view defines
+    (listed in idempotent_methods)
+    """
+    idempotent_methods = ('post', 'put', 'patch', 'delete')
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name in cls.idempotent_methods:
+            handler = cls.__dict__.get(name)
+            if handler is not None and not getattr(handler, '_idempotent', False):
+                setattr(cls, name, idempotent(handler))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from accounts.idempotency import idempotency
+
+
+class Command(BaseCommand):
+    help = "Delete stored Idempotency-Key responses that are past their TTL"
+
+    def handle(self, *args, **options):
+        purged = idempotency.purge_expired()
+        self.stdout.write(self.style.SUCCESS(f"Purged {purged} expired idempotency keys"))
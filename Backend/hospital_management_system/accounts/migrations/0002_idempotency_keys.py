@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('principal', models.CharField(help_text='Who sent the request, e.g. patient:12', max_length=100)),
+                ('key', models.CharField(max_length=255)),
+                ('request_fingerprint', models.CharField(help_text='Hash of method, path and body', max_length=64)),
+                ('status', models.CharField(choices=[('in_progress', 'In progress'), ('completed', 'Completed')], default='in_progress', max_length=20)),
+                ('response_status', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('response_body', models.JSONField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('locked_until', models.DateTimeField(help_text='While in progress: after this the request is presumed dead')),
+                ('expires_at', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['expires_at'], name='idempotency_expiry_idx')],
+                'unique_together': {('principal', 'key')},
+            },
+        ),
+    ]
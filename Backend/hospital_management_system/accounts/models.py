@@ -16,4 +16,35 @@ class EmailOTP(models.Model):
         unique_together = ['email', 'user_type']
     
     def __str__(self):
-        return f"{self.email} ({self.user_type})"
\ No newline at end of file
+        return f"{self.email} ({self.user_type})"
+
+class IdempotencyKey(models.Model):
+    """
+    The outcome of a write request sent with an Idempotency-Key header, kept
+    so a retry with the same key gets the same response instead of running
+    the request again (see accounts.idempotency).
+    """
+    IN_PROGRESS = 'in_progress'
+    COMPLETED = 'completed'
+
+    principal = models.CharField(max_length=100, help_text='Who sent the request, e.g. patient:12')
+    key = models.CharField(max_length=255)
+    request_fingerprint = models.CharField(max_length=64, help_text='Hash of method, path and body')
+    status = models.CharField(max_length=20, choices=[
+        (IN_PROGRESS, 'In progress'),
+        (COMPLETED, 'Completed')
+    ], default=IN_PROGRESS)
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    locked_until = models.DateTimeField(help_text='While in progress: after this the request is presumed dead')
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ['principal', 'key']
+        indexes = [
+            models.Index(fields=['expires_at'], name='idempotency_expiry_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.principal} {self.key} ({self.status})"
@@ -1,3 +1,88 @@
+from datetime import date, timedelta
+from unittest import mock
+
 from django.test import TestCase
+from django.utils import timezone
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory, force_authenticate
+from rest_framework.views import APIView
+
+from hospital.models import Role, Staff
+from .idempotency import HEADER, REPLAYED_HEADER, IdempotentMixin, idempotency
+from .models import IdempotencyKey
+
+
+class PaymentView(IdempotentMixin, APIView):
+    calls = []
+
+    def post(self, request):
+        self.calls.append(request.data)
+        if request.data.get('fail'):
+            return Response({"error": "Gateway unavailable"}, status=502)
+        return Response({"payment": len(self.calls), "amount": request.data.get('amount')}, status=201)
+
+
+class IdempotencyTests(TestCase):
+    def setUp(self):
+        PaymentView.calls = []
+        role = Role.objects.create(role_name='receptionist', role_permissions={})
+        self.staff = Staff.objects.create(
+            staff_id='REC001', staff_name='Receptionist', role=role, created_at=date(2025, 1, 1),
+            staff_email='reception@example.com', staff_mobile='5555555555'
+        )
+        self.factory = APIRequestFactory()
+        self.view = PaymentView.as_view()
+
+    def _post(self, data, key='key-1', user=None):
+        headers = {HEADER: key} if key else {}
+        request = self.factory.post('/payments/', data, format='json', headers=headers)
+        force_authenticate(request, user=user or self.staff)
+        return self.view(request)
+
+    def test_retry_replays_the_first_response(self):
+        first = self._post({'amount': '100.00'})
+        second = self._post({'amount': '100.00'})
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual((second.status_code, second.data), (201, {'payment': 1, 'amount': '100.00'}))
+        self.assertEqual(second[REPLAYED_HEADER], 'true')
+        self.assertFalse(first.has_header(REPLAYED_HEADER))
+        self.assertEqual(len(PaymentView.calls), 1)
+
+    def test_key_reused_with_a_different_body_is_rejected(self):
+        self._post({'amount': '100.00'})
+        response = self._post({'amount': '250.00'})
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(len(PaymentView.calls), 1)
+
+    def test_keys_are_per_principal(self):
+        other = Staff.objects.create(
+            staff_id='REC002', staff_name='Receptionist', role=self.staff.role, created_at=date(2025, 1, 1),
+            staff_email='reception2@example.com', staff_mobile='5555555556'
+        )
+        self._post({'amount': '100.00'})
+        response = self._post({'amount': '100.00'}, user=other)
+        self.assertEqual(response.data['payment'], 2)
+        self.assertFalse(response.has_header(REPLAYED_HEADER))
+
+    def test_server_error_releases_the_key(self):
+        self.assertEqual(self._post({'amount': '100.00', 'fail': True}).status_code, 502)
+        self.assertFalse(IdempotencyKey.objects.exists())
+        self.assertEqual(self._post({'amount': '100.00', 'fail': True}).status_code, 502)
+        self.assertEqual(len(PaymentView.calls), 2)
+
+    def test_request_still_in_progress_gets_409(self):
+        self._post({'amount': '100.00'})
+        # As if the first request had not finished yet
+        IdempotencyKey.objects.update(
+            status=IdempotencyKey.IN_PROGRESS, locked_until=timezone.now() + timedelta(minutes=1)
+        )
+        with mock.patch.object(idempotency, 'wait_seconds', 0):
+            response = self._post({'amount': '100.00'})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(len(PaymentView.calls), 1)
 
-# Create your tests here.
+    def test_requests_without_a_key_always_run(self):
+        self._post({'amount': '100.00'}, key=None)
+        self._post({'amount': '100.00'}, key=None)
+        self.assertEqual(len(PaymentView.calls), 2)
+        self.assertFalse(IdempotencyKey.objects.exists())
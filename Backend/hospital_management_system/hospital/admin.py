@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Patient, PatientDetails, PatientVitals, Role, Staff, StaffDetails, LabTechnicianDetails, DoctorType, DoctorDetails
+from .models import Patient, PatientDetails, PatientVitals, Role, Staff, StaffDetails, LabTechnicianDetails, DoctorType, DoctorDetails, ReferenceRange
 
 admin.site.register(Patient)
 admin.site.register(PatientDetails)
@@ -10,4 +10,5 @@ admin.site.register(Staff)
 admin.site.register(StaffDetails)
 admin.site.register(LabTechnicianDetails)
 admin.site.register(DoctorType)
-admin.site.register(DoctorDetails)
\ No newline at end of file
+admin.site.register(DoctorDetails)
+admin.site.register(ReferenceRange)
@@ -0,0 +1,187 @@
+"""
+Per-patient analyte history: one row per measured value, for trends and delta checks
+"""
+import logging
+from datetime import datetime
+from itertools import groupby
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+
+from .lab_results_service import numeric_value, schema_registry
+from .models import AnalyteObservation, LabTest
+
+logger = logging.getLogger(__name__)
+
+
+def analyte_key(analyte: str) -> str:
+    """Case-insensitive form of an analyte name, stored with each observation"""
+    return analyte.strip().lower()
+
+
+def extract_observations(lab_tests: Iterable[LabTest]) -> List[AnalyteObservation]:
+    """
+    Turn saved results into unsaved AnalyteObservation rows
+
+    Args:
+        lab_tests: Lab tests with test_type loaded
+
+    Returns:
+        One observation per schema analyte with a value; free-text notes are skipped
+    """
+    lab_tests = [lab_test for lab_test in lab_tests if isinstance(lab_test.test_result, dict)]
+    if not lab_tests:
+        return []
+    patient_ids = dict(
+        LabTest.objects.filter(
+            lab_test_id__in=[lab_test.lab_test_id for lab_test in lab_tests]
+        ).values_list('lab_test_id', 'appointment__patient_id')
+    )
+
+    observations = []
+    for lab_test in lab_tests:
+        schema = schema_registry.get(lab_test.test_type)
+        for key, raw in lab_test.test_result.items():
+            analyte = schema.analyte(key)
+            if analyte is None or raw is None or raw == '':
+                continue
+            value = numeric_value(raw)
+            observations.append(AnalyteObservation(
+                patient_id=patient_ids[lab_test.lab_test_id],
+                test_type_id=lab_test.test_type_id,
+                lab_test_id=lab_test.lab_test_id,
+                analyte=analyte,
+                analyte_key=analyte_key(analyte),
+                value=value,
+                value_text=None if value is not None else str(raw)[:255],
+                unit=schema.unit(key),
+                observed_at=lab_test.test_datetime,
+            ))
+    return observations
+
+
+def record_observations(lab_tests: Iterable[LabTest], batch_size: int = 1000) -> int:
+    """Replace the observations of a batch of lab tests with their current results"""
+    lab_tests = list(lab_tests)
+    if not lab_tests:
+        return 0
+    observations = extract_observations(lab_tests)
+    with transaction.atomic():
+        AnalyteObservation.objects.filter(lab_test__in=[lab_test.lab_test_id for lab_test in lab_tests]).delete()
+        AnalyteObservation.objects.bulk_create(observations, batch_size=batch_size)
+    return len(observations)
+
+
+def delta_check(analyte: str, values: np.ndarray, observed_at: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Change of each value from the previous one of the same series
+
+    A change is flagged when it exceeds the analyte's absolute limit in
+    LAB_DELTA_CHECK_LIMITS or, without one, LAB_DELTA_CHECK_PERCENT of the
+    previous value, and the previous value is no older than
+    LAB_DELTA_CHECK_WINDOW_DAYS.
+
+    Args:
+        analyte: Analyte name, used to look up an absolute limit
+        values: Values in observation order
+        observed_at: Matching datetime64 array
+
+    Returns:
+        Dict of delta, delta_percent and delta_flag arrays (NaN / False for the first value)
+    """
+    limits = getattr(settings, 'LAB_DELTA_CHECK_LIMITS', {})
+    percent_limit = getattr(settings, 'LAB_DELTA_CHECK_PERCENT', 25)
+    window = np.timedelta64(getattr(settings, 'LAB_DELTA_CHECK_WINDOW_DAYS', 30), 'D')
+
+    delta = np.full(values.shape, np.nan)
+    delta_percent = np.full(values.shape, np.nan)
+    flagged = np.zeros(values.shape, dtype=bool)
+    if values.size < 2:
+        return {"delta": delta, "delta_percent": delta_percent, "delta_flag": flagged}
+
+    previous = values[:-1]
+    delta[1:] = values[1:] - previous
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta_percent[1:] = np.where(previous != 0, delta[1:] / np.abs(previous) * 100, np.nan)
+
+    recent = np.zeros(values.shape, dtype=bool)
+    recent[1:] = (observed_at[1:] - observed_at[:-1]) <= window
+    with np.errstate(invalid='ignore'):
+        if analyte in limits:
+            flagged = recent & (np.abs(delta) > limits[analyte])
+        else:
+            flagged = recent & (np.abs(delta_percent) > percent_limit)
+    return {"delta": delta, "delta_percent": delta_percent, "delta_flag": flagged}
+
+
+def _rounded(value: float) -> Optional[float]:
+    return None if np.isnan(value) else round(float(value), 4)
+
+
+def analyte_series(patient_id: int, test_type_id: int = None, analyte: str = None,
+                   since: datetime = None) -> List[Dict]:
+    """
+    A patient's analyte series with delta checks
+
+    Rows are read in (test_type, analyte_key, observed_at) order for one
+    patient, which is the order of observation_series_idx, so the whole history
+    (or one analyte of it, matched by plain equality on analyte_key) is one
+    index range scan.
+
+    Args:
+        patient_id: Patient to read
+        test_type_id: Optional test type filter
+        analyte: Optional analyte filter (case-insensitive)
+        since: Optional lower bound on observed_at
+
+    Returns:
+        List of series dicts, each with its points in time order
+    """
+    rows = AnalyteObservation.objects.filter(patient_id=patient_id)
+    if test_type_id:
+        rows = rows.filter(test_type_id=test_type_id)
+    if analyte:
+        rows = rows.filter(analyte_key=analyte_key(analyte))
+    if since:
+        rows = rows.filter(observed_at__gte=since)
+    rows = rows.order_by('test_type_id', 'analyte_key', 'observed_at').values_list(
+        'test_type_id', 'test_type__test_name', 'analyte_key', 'unit',
+        'value', 'value_text', 'observed_at', 'lab_test_id', 'analyte'
+    )
+
+    series = []
+    for (type_id, test_name, _), points in groupby(rows, key=lambda row: row[:3]):
+        points = list(points)
+        # Shown as most recently spelled
+        name = points[-1][8]
+        numeric = [point for point in points if point[4] is not None]
+        checks = {}
+        if numeric:
+            values = np.array([point[4] for point in numeric])
+            times = np.array([point[6].replace(tzinfo=None) for point in numeric], dtype='datetime64[s]')
+            result = delta_check(name, values, times)
+            checks = {
+                point[7]: (result["delta"][i], result["delta_percent"][i], bool(result["delta_flag"][i]))
+                for i, point in enumerate(numeric)
+            }
+
+        series.append({
+            "test_type_id": type_id,
+            "test_type": test_name,
+            "analyte": name,
+            "unit": next((point[3] for point in points if point[3]), None),
+            "points": [
+                {
+                    "lab_test_id": point[7],
+                    "observed_at": point[6].isoformat(),
+                    "value": point[4] if point[4] is not None else point[5],
+                    "delta": _rounded(checks[point[7]][0]) if point[7] in checks else None,
+                    "delta_percent": _rounded(checks[point[7]][1]) if point[7] in checks else None,
+                    "delta_flag": checks[point[7]][2] if point[7] in checks else False,
+                }
+                for point in points
+            ],
+        })
+    return series
@@ -5,19 +5,31 @@ from rest_framework import status
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 from django.shortcuts import get_object_or_404
 from accounts.authentication import JWTAuthentication
+from accounts.idempotency import IdempotentMixin
 from rest_framework.permissions import IsAuthenticated
 from .models import (LabType, Staff, StaffDetails, DoctorDetails, LabTechnicianDetails, Role, DoctorType, 
                      Schedule, Appointment, Slot, PatientDetails, Patient, PatientVitals,
                      PrescribedMedicine, Prescription, Shift, Diagnosis, Medicine,
-                     TargetOrgan, AppointmentCharge, LabTestType, LabTest, Lab, LabTestCharge)
+                     TargetOrgan, AppointmentCharge, LabTestType, LabTest, Lab, LabTestCharge, LabResultFlag)
 from .permissions import IsAdminStaff
 import uuid
 import datetime
 from django.utils.dateparse import parse_datetime
-from transactions.models import Transaction, PaymentMethod, TransactionType, Unit, InvoiceType, Invoice
+from django.conf import settings
+from django.db import IntegrityError, transaction as db_transaction
+from transactions.models import Transaction, PaymentMethod, TransactionType, Unit, InvoiceType, Invoice, InvoiceLineItem
+import csv
 import json
 import traceback
 from .serializers import LabTestSerializer, LabSerializer, RecommendedLabTestSerializer, AssignedPatientSerializer
+from .lab_scheduling_service import lab_scheduler, LabCapacityError
+from .lab_worklist_service import resolve_lab_ids, sla_deadline_for, worklist_queryset, wait_for_paid_tests
+from .price_book_service import price_book
+from .lab_results_service import validate_test_result, parse_result_rows, import_results, process_saved_results
+from .analyte_history_service import analyte_series
+from .tile_service import tile_service, TileNotFound
+from django.http import HttpResponse
+from django.utils.http import parse_etags, quote_etag
 class DoctorListView(APIView):
     authentication_classes = [JWTAuthentication]
     permission_classes = [IsAuthenticated]
@@ -241,7 +253,7 @@ class BookAppointmentView(APIView):
 #             "transaction_id": transaction.transaction_id
 #         }, status=201)
 
-class BookAppointmentWithPaymentView(APIView):
+class BookAppointmentWithPaymentView(IdempotentMixin, APIView):
     authentication_classes = [JWTAuthentication]
     permission_classes = [IsAuthenticated]
 
@@ -289,26 +301,30 @@ class BookAppointmentWithPaymentView(APIView):
             return Response({"error": "Transaction reference already used"}, status=400)
 
         # Get appointment charge for this doctor
-        try:
-            charge = AppointmentCharge.objects.get(doctor=staff, is_active=True)
-        except AppointmentCharge.DoesNotExist:
+        charge = price_book.appointment_charge(staff.staff_id)
+        if charge is None:
             return Response({"error": "No appointment charge set for this doctor"}, status=400)
 
-        # Create transaction with the provided reference
-        transaction = Transaction.objects.create(
-            transaction_reference=transaction_reference,
-            transaction_type=transaction_type,
-            payment_method=payment_method,
-            transaction_amount=charge.charge_amount,
-            transaction_unit=charge.charge_unit,
-            transaction_status="completed",  # Assuming payment is successful
-            patient=patient,
-            transaction_details={
-                "appointment_date": date, 
-                "doctor": staff.staff_name,
-                "payment_gateway_response": data.get("payment_gateway_response", {})  # Optional additional payment details
-            }
-        )
+        # Create transaction with the provided reference; the unique constraint
+        # catches a concurrent request that passed the check above
+        try:
+            with db_transaction.atomic():
+                transaction = Transaction.objects.create(
+                    transaction_reference=transaction_reference,
+                    transaction_type=transaction_type,
+                    payment_method=payment_method,
+                    transaction_amount=charge.charge_amount,
+                    transaction_unit=charge.charge_unit,
+                    transaction_status="completed",  # Assuming payment is successful
+                    patient=patient,
+                    transaction_details={
+                        "appointment_date": date, 
+                        "doctor": staff.staff_name,
+                        "payment_gateway_response": data.get("payment_gateway_response", {})  # Optional additional payment details
+                    }
+                )
+        except IntegrityError:
+            return Response({"error": "Transaction reference already used"}, status=400)
 
         # Create appointment
         appointment = Appointment.objects.create(
@@ -333,18 +349,20 @@ class BookAppointmentWithPaymentView(APIView):
             total = subtotal + tax
             
             # Create invoice
-            invoice = Invoice.objects.create(
-                tran=transaction,
-                invoice_type=invoice_type,
-                patient=patient,
-                invoice_items=[appointment.appointment_id],
-                invoice_subtotal=subtotal,
-                invoice_tax=tax,
-                invoice_total=total,
-                invoice_unit=charge.charge_unit,
-                invoice_status='paid',
-                invoice_remark=f"Invoice for appointment on {appointment_date.isoformat()}"
-            )
+            with db_transaction.atomic():
+                invoice = Invoice.objects.create(
+                    tran=transaction,
+                    invoice_type=invoice_type,
+                    patient=patient,
+                    invoice_items=[appointment.appointment_id],
+                    invoice_subtotal=subtotal,
+                    invoice_tax=tax,
+                    invoice_total=total,
+                    invoice_unit=charge.charge_unit,
+                    invoice_status='paid',
+                    invoice_remark=f"Invoice for appointment on {appointment_date.isoformat()}"
+                )
+                InvoiceLineItem.for_appointment(appointment, charge, invoice=invoice).save()
             
             return Response({
                 "message": "Appointment booked and payment processed", 
@@ -801,7 +819,8 @@ class AllAppointmentsView(APIView):
                 "staff_id": app.staff.staff_id,
                 "patient_id": app.patient.patient_id,
                 "status": app.status,
-                "reason": app.reason
+                "reason": app.reason,
+                "no_show_risk": app.no_show_risk
             }
             for app in appointments
         ]
@@ -1523,55 +1542,48 @@ class RecommendLabTestsView(APIView):
                 lab_type_to_tests[lab_type] = [test_type]
         
         created_tests = []
-        
-        # Process each lab type separately
-        for lab_type, tests_for_lab_type in lab_type_to_tests.items():
-            # Find an available lab of this type
-            available_labs = Lab.objects.filter(lab_type=lab_type, functional=True)
-            
-            if not available_labs.exists():
-                return Response({"error": f"No functional labs available for type: {lab_type.lab_type_name}"}, status=400)
-                
-            # Simple load balancing - get the lab with the fewest tests scheduled for that time
-            lab_loads = {}
-            for lab in available_labs:
-                # Count tests scheduled within 1 hour of the requested time
-                time_window_start = test_datetime - timedelta(hours=1)
-                time_window_end = test_datetime + timedelta(hours=1)
-                
-                test_count = LabTest.objects.filter(
-                    lab=lab,
-                    test_datetime__gte=time_window_start,
-                    test_datetime__lte=time_window_end
-                ).count()
+        reserved = []
+        test_datetime = timezone.make_aware(test_datetime)
+        
+        # Process each lab type separately; all reservations succeed or none do
+        with db_transaction.atomic():
+            for lab_type, tests_for_lab_type in lab_type_to_tests.items():
+                # Find an available lab of this type
+                available_labs = list(Lab.objects.filter(lab_type=lab_type, functional=True))
+            
+                if not available_labs:
+                    # Undo the reservations already made for other lab types
+                    db_transaction.set_rollback(True)
+                    return Response({"error": f"No functional labs available for type: {lab_type.lab_type_name}"}, status=400)
                 
-                lab_loads[lab.lab_id] = test_count
+                # Reserve lab time for each test, keeping the group in one lab when it has room
+                selected_lab = None
+                for test_type in tests_for_lab_type:
+                    try:
+                        lab_test = lab_scheduler.schedule(
+                            available_labs,
+                            test_type,
+                            test_datetime,
+                            priority=priority,
+                            preferred_lab=selected_lab,
+                            held=reserved,
+                            appointment=appointment,
+                            test_result=None  # Will be filled by lab technician
+                        )
+                    except LabCapacityError as e:
+                        db_transaction.set_rollback(True)
+                        return Response({"error": str(e)}, status=409)
+                    selected_lab = lab_test.lab
+                    reserved.append(lab_test)
                 
-            # Find the lab with the minimum load
-            if lab_loads:
-                min_load_lab_id = min(lab_loads, key=lab_loads.get)
-                selected_lab = Lab.objects.get(lab_id=min_load_lab_id)
-            else:
-                # If no load data, just pick the first available lab
-                selected_lab = available_labs.first()
-                
-            # Create lab tests for this lab type
-            for test_type in tests_for_lab_type:
-                lab_test = LabTest.objects.create(
-                    lab=selected_lab,
-                    test_datetime=test_datetime,
-                    test_result=None,  # Will be filled by lab technician
-                    test_type=test_type,
-                    appointment=appointment,
-                    priority=priority
-                )
-                
-                created_tests.append({
-                    "lab_test_id": lab_test.lab_test_id,
-                    "test_type": test_type.test_name,
-                    "lab_name": selected_lab.lab_name,
-                    "lab_type": lab_type.lab_type_name
-                })
+                    created_tests.append({
+                        "lab_test_id": lab_test.lab_test_id,
+                        "test_type": test_type.test_name,
+                        "lab_name": selected_lab.lab_name,
+                        "lab_type": lab_type.lab_type_name,
+                        "test_datetime": lab_test.test_datetime.isoformat(),
+                        "reserved_until": lab_test.reserved_until.isoformat()
+                    })
         
         # Update diagnosis to indicate lab tests are required
         diagnosis = appointment.diagnoses.first()
@@ -1651,7 +1663,7 @@ class RecommendLabTestsView(APIView):
 #             "amount": f"{transaction.transaction_amount} {transaction.transaction_unit.unit_symbol}"
 #         }, status=201)
 
-class PayForLabTestsView(APIView):
+class PayForLabTestsView(IdempotentMixin, APIView):
     authentication_classes = [JWTAuthentication]
     permission_classes = [IsAuthenticated]
 
@@ -1696,31 +1708,36 @@ class PayForLabTestsView(APIView):
             return Response({"error": "Invalid payment method or transaction type"}, status=400)
             
         # Get lab test charge
-        try:
-            charge = LabTestCharge.objects.get(test=lab_test.test_type, is_active=True)
-        except LabTestCharge.DoesNotExist:
+        charge = price_book.lab_test_charge(lab_test.test_type_id)
+        if charge is None:
             return Response({"error": "No charge found for this lab test"}, status=400)
             
-        # Create transaction with the provided reference
-        transaction = Transaction.objects.create(
-            transaction_reference=transaction_reference,
-            transaction_type=transaction_type,
-            payment_method=payment_method,
-            transaction_amount=charge.charge_amount,
-            transaction_unit=charge.charge_unit,
-            transaction_status="completed",  # Assuming payment is successful
-            patient=patient,
-            transaction_details={
-                "lab_test_id": lab_test.lab_test_id,
-                "test_type": lab_test.test_type.test_name,
-                "lab": lab_test.lab.lab_name,
-                "payment_gateway_response": request.data.get("payment_gateway_response", {})  # Optional additional payment details
-            }
-        )
+        # Create transaction with the provided reference; the unique constraint
+        # catches a concurrent request that passed the check above
+        try:
+            with db_transaction.atomic():
+                transaction = Transaction.objects.create(
+                    transaction_reference=transaction_reference,
+                    transaction_type=transaction_type,
+                    payment_method=payment_method,
+                    transaction_amount=charge.charge_amount,
+                    transaction_unit=charge.charge_unit,
+                    transaction_status="completed",  # Assuming payment is successful
+                    patient=patient,
+                    transaction_details={
+                        "lab_test_id": lab_test.lab_test_id,
+                        "test_type": lab_test.test_type.test_name,
+                        "lab": lab_test.lab.lab_name,
+                        "payment_gateway_response": request.data.get("payment_gateway_response", {})  # Optional additional payment details
+                    }
+                )
+        except IntegrityError:
+            return Response({"error": "Transaction reference already used"}, status=400)
         
         # Update lab test with transaction
         lab_test.tran = transaction
         lab_test.status = LabTest.Status.PAID  # Update status to paid
+        lab_test.sla_deadline = sla_deadline_for(lab_test.priority, transaction.transaction_datetime)
         lab_test.save()
         
         # Generate invoice for the lab test and change status to paid
@@ -1737,18 +1754,20 @@ class PayForLabTestsView(APIView):
 
             # Then use invoice_remark in your Invoice.objects.create()
 
-            invoice = Invoice.objects.create(
-                tran=transaction,
-                invoice_type=invoice_type,
-                patient=patient,
-                invoice_items=[lab_test.lab_test_id],
-                invoice_subtotal=subtotal,
-                invoice_tax=tax,
-                invoice_total=total,
-                invoice_unit=charge.charge_unit,
-                invoice_status='paid',
-                invoice_remark="Invoice for {lab_test.test_type.test_name} on {lab_test.test_datetime.strftime('%Y-%m-%d') if lab_test.test_datetime else 'Unknown Date'}"
-            )
+            with db_transaction.atomic():
+                invoice = Invoice.objects.create(
+                    tran=transaction,
+                    invoice_type=invoice_type,
+                    patient=patient,
+                    invoice_items=[lab_test.lab_test_id],
+                    invoice_subtotal=subtotal,
+                    invoice_tax=tax,
+                    invoice_total=total,
+                    invoice_unit=charge.charge_unit,
+                    invoice_status='paid',
+                    invoice_remark="Invoice for {lab_test.test_type.test_name} on {lab_test.test_datetime.strftime('%Y-%m-%d') if lab_test.test_datetime else 'Unknown Date'}"
+                )
+                InvoiceLineItem.for_lab_test(lab_test, charge, invoice=invoice).save()
             
             return Response({
                 "message": "Payment for lab test processed successfully",
@@ -1798,24 +1817,230 @@ class AddLabTestResultsView(APIView):
                 test_result = json.loads(test_result)
             except json.JSONDecodeError:
                 return Response({"error": "Invalid JSON in test_result"}, status=400)
+
+        # Validate against the test type's schema; unknown keys are only rejected in strict mode
+        strict = request.data.get('strict_schema', request.query_params.get('strict_schema'))
+        if strict is not None:
+            strict = str(strict).lower() in ('true', '1')
+        test_result, errors = validate_test_result(lab_test.test_type, test_result, strict=strict)
+        if errors:
+            return Response({"error": "test_result does not match the test schema", "details": errors}, status=400)
                 
-        # Handle test image if provided
+        # Handle test image if provided (large images may already be attached by a chunked upload)
         test_image = request.FILES.get('test_image')
-        if lab_test.test_type.image_required and not test_image:
+        if lab_test.test_type.image_required and not test_image and not lab_test.test_image:
             return Response({"error": "Test image is required for this test type"}, status=400)
             
-        # Update lab test
-        lab_test.test_result = test_result
-        if test_image:
-            lab_test.test_image = test_image
-        lab_test.status = LabTest.Status.COMPLETED  # Update status to completed
-        lab_test.save()
+        # Save the result together with its flags and history: if flagging fails, nothing is committed
+        with db_transaction.atomic():
+            lab_scheduler.release(lab_test)
+            lab_test.test_result = test_result
+            if test_image:
+                lab_test.test_image = test_image
+            lab_test.status = LabTest.Status.COMPLETED  # Update status to completed
+            lab_test.save()
+
+            # Flag values outside their reference ranges and add them to the patient's history
+            flags = process_saved_results([lab_test])
         
         return Response({
             "message": "Lab test results added successfully",
-            "lab_test_id": lab_test.lab_test_id
+            "lab_test_id": lab_test.lab_test_id,
+            "flags": [
+                {"analyte": flag.analyte, "value": flag.value, "flag": flag.flag}
+                for flag in flags
+            ]
         }, status=200)
 
+class BulkLabTestResultsView(APIView):
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+    parser_classes = [MultiPartParser, FormParser]
+
+    def post(self, request):
+        # Check if user is a lab technician
+        if not hasattr(request.user, 'staff_id'):
+            return Response({"error": "Only staff can add lab test results"}, status=403)
+
+        try:
+            assigned_lab = request.user.lab_tech_details.assigned_lab
+        except (AttributeError, LabTechnicianDetails.DoesNotExist):
+            return Response({"error": "Only lab technicians can add lab test results"}, status=403)
+
+        lab_ids = resolve_lab_ids(assigned_lab)
+        if not lab_ids:
+            return Response({"error": f"Assigned lab '{assigned_lab}' not found"}, status=404)
+
+        upload = request.FILES.get('file')
+        if not upload:
+            return Response({"error": "An analyzer export is required in 'file'"}, status=400)
+
+        file_format = request.data.get('format') or request.query_params.get('format')
+        try:
+            rows = parse_result_rows(upload, file_format)
+            report = import_results(rows, lab_ids)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=400)
+        except csv.Error as e:
+            return Response({"error": f"Malformed CSV: {e}"}, status=400)
+
+        return Response(report, status=status.HTTP_200_OK)
+
+class LabResultFlagListView(APIView):
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        if not hasattr(request.user, 'staff_id'):
+            return Response({"error": "Only staff can view flagged lab results"}, status=403)
+
+        severity = request.query_params.get('severity', 'critical')
+        if severity not in ('critical', 'abnormal'):
+            return Response({"error": "severity must be 'critical' or 'abnormal'"}, status=400)
+
+        date_str = request.query_params.get('date')
+        try:
+            day = datetime.strptime(date_str, "%Y-%m-%d").date() if date_str else timezone.localdate()
+        except ValueError:
+            return Response({"error": "Invalid date format. Use YYYY-MM-DD"}, status=400)
+        start = timezone.make_aware(datetime.combine(day, datetime.min.time()))
+
+        # Range scan on the (flag, observed_at) index
+        flags = LabResultFlag.objects.filter(
+            flag__in=LabResultFlag.CRITICAL if severity == 'critical' else LabResultFlag.Flag.values,
+            observed_at__gte=start,
+            observed_at__lt=start + timedelta(days=1)
+        ).select_related(
+            'lab_test__test_type', 'lab_test__appointment__patient', 'reference_range'
+        ).order_by('observed_at')
+
+        # Doctors see their own patients, lab technicians their own lab
+        if hasattr(request.user, 'doctor_details'):
+            flags = flags.filter(lab_test__appointment__staff=request.user)
+        elif hasattr(request.user, 'lab_tech_details'):
+            flags = flags.filter(lab_test__lab_id__in=resolve_lab_ids(request.user.lab_tech_details.assigned_lab))
+
+        results = []
+        for flag in flags:
+            reference_range = flag.reference_range
+            results.append({
+                "lab_test_id": flag.lab_test_id,
+                "test_type": flag.lab_test.test_type.test_name,
+                "patient_id": flag.lab_test.appointment.patient.patient_id,
+                "patient_name": flag.lab_test.appointment.patient.patient_name,
+                "analyte": flag.analyte,
+                "value": flag.value,
+                "flag": flag.flag,
+                "reference_low": reference_range.low if reference_range else None,
+                "reference_high": reference_range.high if reference_range else None,
+                "unit": reference_range.unit if reference_range else None,
+                "observed_at": flag.observed_at.isoformat()
+            })
+
+        return Response({"date": day.isoformat(), "severity": severity, "results": results}, status=status.HTTP_200_OK)
+
+class PatientAnalyteHistoryView(APIView):
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, patient_id):
+        if hasattr(request.user, 'patient_id'):
+            if request.user.patient_id != patient_id:
+                return Response({"error": "You can only view your own lab history"}, status=403)
+        elif not hasattr(request.user, 'staff_id'):
+            return Response({"error": "Unauthorized"}, status=403)
+        get_object_or_404(Patient, patient_id=patient_id)
+
+        test_type_id = request.query_params.get('test_type_id')
+        if test_type_id and not test_type_id.isdigit():
+            return Response({"error": "test_type_id must be an integer"}, status=400)
+
+        since = None
+        since_str = request.query_params.get('since')
+        if since_str:
+            try:
+                since = timezone.make_aware(datetime.combine(
+                    datetime.strptime(since_str, "%Y-%m-%d").date(), datetime.min.time()
+                ))
+            except ValueError:
+                return Response({"error": "Invalid since format. Use YYYY-MM-DD"}, status=400)
+
+        series = analyte_series(
+            patient_id,
+            test_type_id=int(test_type_id) if test_type_id else None,
+            analyte=request.query_params.get('analyte'),
+            since=since
+        )
+        return Response({"patient_id": patient_id, "series": series}, status=status.HTTP_200_OK)
+
+def _tiled_lab_test(request, lab_test_id):
+    """The lab test if the user may see its image, else an error Response"""
+    lab_test = get_object_or_404(LabTest.objects.select_related('appointment'), lab_test_id=lab_test_id)
+    if hasattr(request.user, 'patient_id') and lab_test.appointment.patient_id != request.user.patient_id:
+        return None, Response({"error": "You can only view your own lab test images"}, status=403)
+    if not lab_test.test_image:
+        return None, Response({"error": "This lab test has no image"}, status=404)
+    return lab_test, None
+
+class LabTestImageTilesView(APIView):
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, lab_test_id):
+        lab_test, error = _tiled_lab_test(request, lab_test_id)
+        if error:
+            return error
+        image_name = lab_test.test_image.name
+        container = tile_service.container(lab_test_id, image_name)
+        if container is None:
+            # Images attached before tiling existed are tiled on first view
+            if not tile_service.is_pending(lab_test_id, image_name):
+                tile_service.schedule(lab_test_id, image_name)
+            return Response({"lab_test_id": lab_test_id, "status": "pending"}, status=status.HTTP_202_ACCEPTED)
+        return Response({
+            "lab_test_id": lab_test_id,
+            "status": "ready",
+            "version": tile_service.version(image_name),
+            "format": "jpeg",
+            **container.metadata()
+        }, status=status.HTTP_200_OK)
+
+class LabTestImageTileView(APIView):
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, lab_test_id, level, x, y, version=None):
+        lab_test, error = _tiled_lab_test(request, lab_test_id)
+        if error:
+            return error
+        image_name = lab_test.test_image.name
+        current_version = tile_service.version(image_name)
+        if version is not None and version != current_version:
+            return Response({"error": "The image was replaced; reload the tile layout", "version": current_version}, status=404)
+        container = tile_service.container(lab_test_id, image_name)
+        if container is None:
+            return Response({"error": "Tiles for this image are not ready yet"}, status=404)
+
+        etag = quote_etag(f"{current_version}-{level}-{x}-{y}")
+        if version is not None:
+            # The URL names the image version, so its content can never change
+            cache_control = f"private, max-age={getattr(settings, 'TILE_CACHE_MAX_AGE', 86400)}, immutable"
+        else:
+            # Same URL after the image is replaced: revalidate with the ETag every time
+            cache_control = "private, no-cache"
+        # Weak comparison, as If-None-Match requires
+        if_none_match = parse_etags(request.headers.get('If-None-Match', ''))
+        if '*' in if_none_match or etag in {tag.removeprefix('W/') for tag in if_none_match}:
+            response = HttpResponse(status=304)
+        else:
+            try:
+                response = HttpResponse(container.tile(level, x, y), content_type='image/jpeg')
+            except TileNotFound as e:
+                return Response({"error": str(e)}, status=404)
+        response['ETag'] = etag
+        response['Cache-Control'] = cache_control
+        return response
+
 class LabListView(APIView):
     authentication_classes = [JWTAuthentication]
     permission_classes = [IsAuthenticated]
@@ -1907,11 +2132,14 @@ class PatientRecommendedLabTestsView(APIView):
         status_filter = request.query_params.get('status')
         
         # Get recommended lab tests for this patient
-        lab_tests = LabTest.objects.filter(appointment__patient=patient).order_by('-test_datetime')
+        lab_tests = LabTest.objects.filter(
+            appointment__patient=patient
+        ).select_related('lab', 'test_type', 'tran').order_by('-test_datetime')
         
         # Apply status filter if provided
         if status_filter:
             lab_tests = lab_tests.filter(status=status_filter)
+        lab_tests = list(lab_tests)
             
         # Group by status for summary
         # status_counts = {
@@ -1923,7 +2151,10 @@ class PatientRecommendedLabTestsView(APIView):
         #     'total': lab_tests.count()
         # }
         
-        serializer = RecommendedLabTestSerializer(lab_tests, many=True)
+        serializer = RecommendedLabTestSerializer(
+            lab_tests, many=True,
+            context={'lab_test_charges': price_book.charges_for_lab_tests(lab_tests)}
+        )
         
         # response_data = {
         #     'status_summary': status_counts,
@@ -1994,9 +2225,9 @@ class LabTechnicianAssignedPatientsView(APIView):
 
         # Get lab tests for the assigned lab that are paid or completed
         lab_tests = LabTest.objects.filter(
-            lab__lab_name=assigned_lab,
+            lab_id__in=resolve_lab_ids(assigned_lab),
             status__in=[LabTest.Status.PAID, LabTest.Status.COMPLETED]
-        )
+        ).select_related('test_type')
 
         if start_datetime_str:
             start_datetime = parse_datetime(start_datetime_str)
@@ -2010,7 +2241,9 @@ class LabTechnicianAssignedPatientsView(APIView):
 
         # Get distinct appointments from lab tests
         appointment_ids = lab_tests.values_list('appointment_id', flat=True).distinct()
-        appointments = Appointment.objects.filter(appointment_id__in=appointment_ids)
+        appointments = Appointment.objects.filter(
+            appointment_id__in=appointment_ids
+        ).select_related('patient', 'staff', 'slot')
 
         # Create a map of appointment_id to lab tests
         from collections import defaultdict
@@ -2024,7 +2257,7 @@ class LabTechnicianAssignedPatientsView(APIView):
                 "priority": lab_test.priority,
                 "test_result": lab_test.test_result,
                 "status": lab_test.status,  # Include status in the response
-                "is_paid": lab_test.tran is not None
+                "is_paid": lab_test.tran_id is not None
             })
 
         # Serialize appointments
@@ -2036,6 +2269,71 @@ class LabTechnicianAssignedPatientsView(APIView):
             
         return Response(appointment_data, status=status.HTTP_200_OK)
 
+class LabTechnicianWorklistView(APIView):
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        user = request.user
+        if not hasattr(user, 'staff_id'):
+            return Response({"error": "Only staff can access this endpoint"}, status=403)
+
+        try:
+            assigned_lab = user.lab_tech_details.assigned_lab
+        except (AttributeError, LabTechnicianDetails.DoesNotExist):
+            return Response({"error": "Lab technician details not found"}, status=404)
+
+        lab_ids = resolve_lab_ids(assigned_lab)
+        if not lab_ids:
+            return Response({"error": f"Assigned lab '{assigned_lab}' not found"}, status=404)
+
+        # Long-poll: with `since`, hold the request until a newer paid test arrives
+        since_str = request.query_params.get('since')
+        if since_str:
+            since = parse_datetime(since_str)
+            if since is None:
+                return Response({"error": "Invalid since datetime. Use ISO 8601"}, status=400)
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+            try:
+                wait = float(request.query_params.get('wait', settings.LAB_WORKLIST_MAX_WAIT_SECONDS))
+            except ValueError:
+                return Response({"error": "wait must be a number of seconds"}, status=400)
+            wait = min(max(wait, 0), settings.LAB_WORKLIST_MAX_WAIT_SECONDS)
+            if not wait_for_paid_tests(lab_ids, since, wait):
+                # Nothing new before the wait ran out
+                return Response(status=status.HTTP_204_NO_CONTENT)
+
+        cursor = timezone.now()
+        tests = []
+        for lab_test in worklist_queryset(lab_ids):
+            appointment = lab_test.appointment
+            tests.append({
+                "lab_test_id": lab_test.lab_test_id,
+                "test_type_id": lab_test.test_type_id,
+                "test_type": lab_test.test_type.test_name,
+                "image_required": lab_test.test_type.image_required,
+                "priority": lab_test.priority,
+                "status": lab_test.status,
+                "test_datetime": lab_test.test_datetime.isoformat(),
+                "reserved_until": lab_test.reserved_until.isoformat() if lab_test.reserved_until else None,
+                "sla_deadline": lab_test.sla_deadline.isoformat() if lab_test.sla_deadline else None,
+                "paid_at": lab_test.tran.transaction_datetime.isoformat() if lab_test.tran else None,
+                "appointment_id": appointment.appointment_id,
+                "patient_id": appointment.patient.patient_id,
+                "patient_name": appointment.patient.patient_name,
+                "doctor_id": appointment.staff.staff_id,
+                "doctor_name": appointment.staff.staff_name,
+                "slot_start_time": appointment.slot.slot_start_time.strftime('%H:%M:%S')
+            })
+
+        return Response({
+            "lab_ids": lab_ids,
+            "lab_name": assigned_lab,
+            "cursor": cursor.isoformat(),
+            "tests": tests
+        }, status=status.HTTP_200_OK)
+
 class UpdateLabTestStatusView(APIView):
     authentication_classes = [JWTAuthentication]
     permission_classes = [IsAuthenticated]
@@ -2066,6 +2364,7 @@ class UpdateLabTestStatusView(APIView):
             return Response({"error": "Invalid status. Can only update to 'missed' or 'failed'"}, status=400)
             
         # Update lab test status
+        lab_scheduler.release(lab_test)
         lab_test.status = new_status
         
         # Add reason to test_result if provided
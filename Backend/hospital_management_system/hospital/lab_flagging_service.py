@@ -0,0 +1,230 @@
+"""
+Reference-range flagging of lab results (low, high and critical values)
+"""
+import logging
+import re
+import threading
+import time
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+
+from .lab_results_service import analyte_name, numeric_value, schema_registry
+from .models import LabResultFlag, LabTest, ReferenceRange
+
+logger = logging.getLogger(__name__)
+
+SEX_CODES = {ReferenceRange.Sex.ANY: 0, ReferenceRange.Sex.MALE: 1, ReferenceRange.Sex.FEMALE: 2}
+
+_RANGE = re.compile(r'^\s*([+-]?\d+(?:\.\d+)?)\s*-\s*([+-]?\d+(?:\.\d+)?)\s*$')
+_BOUND = re.compile(r'^\s*([<>]=?)\s*([+-]?\d+(?:\.\d+)?)\s*$')
+_SEX_QUALIFIER = re.compile(r'\((male|female)\)', re.IGNORECASE)
+
+
+def parse_range(text: str) -> Optional[Tuple[Optional[float], Optional[float]]]:
+    """
+    Parse a schema range string into (low, high)
+
+    Understands "13-17", "<140" / "<=140" and ">60" / ">=60". Returns None for
+    anything else.
+    """
+    if not isinstance(text, str):
+        return None
+    match = _RANGE.match(text)
+    if match:
+        return float(match.group(1)), float(match.group(2))
+    match = _BOUND.match(text)
+    if match:
+        value = float(match.group(2))
+        return (None, value) if match.group(1).startswith('<') else (value, None)
+    return None
+
+
+def ranges_from_schema(test_type) -> List[dict]:
+    """Reference ranges implied by a test type's schema (no critical limits)"""
+    schema = schema_registry.get(test_type)
+    ranges = []
+    for name, rule in schema.parameters().items():
+        bounds = parse_range(rule.range)
+        if rule.kind != 'number' or bounds is None:
+            continue
+        sex = _SEX_QUALIFIER.search(name)
+        ranges.append({
+            "analyte": analyte_name(name),
+            "sex": sex.group(1).lower() if sex else ReferenceRange.Sex.ANY,
+            "low": bounds[0],
+            "high": bounds[1],
+            "unit": rule.unit,
+        })
+    return ranges
+
+
+def _float(value) -> float:
+    return np.nan if value is None else float(value)
+
+
+class _RangeGroup:
+    """All ranges of one (test type, analyte) as parallel arrays"""
+
+    def __init__(self, rows: List[ReferenceRange]):
+        self.ids = np.array([row.reference_range_id for row in rows], dtype=np.int64)
+        self.sex = np.array([SEX_CODES.get(row.sex, 0) for row in rows], dtype=np.int8)
+        self.age_min = np.array([-np.inf if row.age_min_years is None else row.age_min_years for row in rows])
+        self.age_max = np.array([np.inf if row.age_max_years is None else row.age_max_years for row in rows])
+        self.low = np.array([_float(row.low) for row in rows])
+        self.high = np.array([_float(row.high) for row in rows])
+        self.critical_low = np.array([_float(row.critical_low) for row in rows])
+        self.critical_high = np.array([_float(row.critical_high) for row in rows])
+        self.unbounded_age = np.isinf(self.age_min) & np.isinf(self.age_max)
+        # Prefer sex-specific over generic and age-banded over open ranges
+        self.specificity = (self.sex != 0) * 2 + (~self.unbounded_age) * 1 + 1
+
+    def select(self, sex: np.ndarray, age: np.ndarray) -> np.ndarray:
+        """Index of the most specific matching range per observation, -1 where none applies"""
+        sex_ok = (self.sex[None, :] == 0) | (self.sex[None, :] == sex[:, None])
+        with np.errstate(invalid='ignore'):
+            age_ok = (age[:, None] >= self.age_min[None, :]) & (age[:, None] < self.age_max[None, :])
+        # An unknown age only matches ranges without an age band
+        age_ok |= self.unbounded_age[None, :]
+        score = (sex_ok & age_ok) * self.specificity[None, :]
+        choice = score.argmax(axis=1)
+        return np.where(score.max(axis=1) > 0, choice, -1)
+
+
+class ReferenceRangeTable:
+    """
+    In-process copy of every reference range, grouped by (test type, analyte)
+    into NumPy arrays. Rebuilt when a range changes here and every
+    REFERENCE_RANGE_REFRESH_SECONDS for changes made elsewhere.
+    """
+
+    def __init__(self):
+        self.refresh_seconds = getattr(settings, 'REFERENCE_RANGE_REFRESH_SECONDS', 300)
+        self._groups: Dict[Tuple[int, str], _RangeGroup] = {}
+        self._loaded_at = None
+        self._lock = threading.RLock()
+
+    def _is_fresh(self) -> bool:
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.refresh_seconds
+
+    def groups(self) -> Dict[Tuple[int, str], _RangeGroup]:
+        if not self._is_fresh():
+            with self._lock:
+                if not self._is_fresh():
+                    rows: Dict[Tuple[int, str], List[ReferenceRange]] = {}
+                    for row in ReferenceRange.objects.order_by('pk'):
+                        rows.setdefault((row.test_type_id, row.analyte.lower()), []).append(row)
+                    self._groups = {key: _RangeGroup(group) for key, group in rows.items()}
+                    self._loaded_at = time.monotonic()
+        return self._groups
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+
+reference_ranges = ReferenceRangeTable()
+
+
+def _demographics(lab_test_ids: List[int]) -> Dict[int, Tuple[Optional[date], Optional[bool]]]:
+    rows = LabTest.objects.filter(lab_test_id__in=lab_test_ids).values_list(
+        'lab_test_id',
+        'appointment__patient__details__patient_dob',
+        'appointment__patient__details__patient_gender'
+    )
+    return {lab_test_id: (dob, gender) for lab_test_id, dob, gender in rows}
+
+
+def evaluate(lab_tests: Iterable[LabTest]) -> List[LabResultFlag]:
+    """
+    Flag every numeric analyte of a batch of lab tests against its reference range
+
+    Values are pulled out of test_result into flat arrays and grouped per
+    (test type, analyte); each group is matched to its ranges and compared in
+    one vectorized pass, so a day's results cost one demographics query plus
+    array work.
+
+    Args:
+        lab_tests: Lab tests with test_type loaded
+
+    Returns:
+        Unsaved LabResultFlag objects for values outside their range
+    """
+    lab_tests = [lab_test for lab_test in lab_tests if isinstance(lab_test.test_result, dict)]
+    if not lab_tests:
+        return []
+    groups = reference_ranges.groups()
+    demographics = _demographics([lab_test.lab_test_id for lab_test in lab_tests])
+
+    # Extract observations: group key -> parallel lists
+    observations: Dict[Tuple[int, str], Dict[str, list]] = {}
+    for lab_test in lab_tests:
+        schema = schema_registry.get(lab_test.test_type)
+        dob, gender = demographics.get(lab_test.lab_test_id, (None, None))
+        sex = 0 if gender is None else (1 if gender else 2)
+        observed = lab_test.test_datetime.date()
+        age = (observed - dob).days / 365.25 if dob else np.nan
+        for key, raw in lab_test.test_result.items():
+            value = numeric_value(raw)
+            analyte = schema.analyte(key)
+            if value is None or analyte is None:
+                continue
+            group_key = (lab_test.test_type_id, analyte.lower())
+            if group_key not in groups:
+                continue
+            columns = observations.setdefault(
+                group_key, {"value": [], "sex": [], "age": [], "lab_test": [], "analyte": []}
+            )
+            columns["value"].append(value)
+            columns["sex"].append(sex)
+            columns["age"].append(age)
+            columns["lab_test"].append(lab_test)
+            columns["analyte"].append(analyte)
+
+    flags = []
+    for group_key, columns in observations.items():
+        group = groups[group_key]
+        values = np.array(columns["value"])
+        choice = group.select(np.array(columns["sex"], dtype=np.int8), np.array(columns["age"]))
+        matched = choice >= 0
+        index = np.where(matched, choice, 0)
+
+        with np.errstate(invalid='ignore'):
+            critical_low = matched & (values <= group.critical_low[index])
+            critical_high = matched & (values >= group.critical_high[index])
+            low = matched & (values < group.low[index])
+            high = matched & (values > group.high[index])
+
+        # Critical outranks plain high/low
+        codes = np.select(
+            [critical_low, critical_high, low, high],
+            [LabResultFlag.Flag.CRITICAL_LOW, LabResultFlag.Flag.CRITICAL_HIGH,
+             LabResultFlag.Flag.LOW, LabResultFlag.Flag.HIGH],
+            default=''
+        )
+        for position in np.flatnonzero(codes != ''):
+            lab_test = columns["lab_test"][position]
+            flags.append(LabResultFlag(
+                lab_test=lab_test,
+                analyte=columns["analyte"][position],
+                value=float(values[position]),
+                flag=str(codes[position]),
+                reference_range_id=int(group.ids[index[position]]),
+                observed_at=lab_test.test_datetime,
+            ))
+    return flags
+
+
+def flag_lab_tests(lab_tests: Iterable[LabTest], batch_size: int = 1000) -> List[LabResultFlag]:
+    """Recompute and store the flags of a batch of lab tests, replacing any previous ones"""
+    lab_tests = list(lab_tests)
+    if not lab_tests:
+        return []
+    flags = evaluate(lab_tests)
+    with transaction.atomic():
+        LabResultFlag.objects.filter(lab_test__in=[lab_test.lab_test_id for lab_test in lab_tests]).delete()
+        LabResultFlag.objects.bulk_create(flags, batch_size=batch_size)
+    return flags
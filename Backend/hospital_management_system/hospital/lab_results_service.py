@@ -0,0 +1,406 @@
+"""
+Lab test result validation against LabTestType.test_schema, and bulk result
+import from lab analyzer exports (CSV or NDJSON)
+"""
+import copy
+import csv
+import io
+import json
+import logging
+import math
+import re
+import threading
+from typing import Collection, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .lab_scheduling_service import lab_scheduler
+from .models import LabTest, LabTestType
+
+logger = logging.getLogger(__name__)
+
+# Free-text keys accepted alongside the schema parameters of any test
+FREE_TEXT_KEYS = {'notes', 'note', 'remarks', 'comment', 'comments'}
+
+# Statuses an analyzer row may set; anything else is rejected
+BULK_RESULT_STATUSES = {LabTest.Status.COMPLETED, LabTest.Status.FAILED}
+
+_QUALIFIER = re.compile(r'\s*\(.*?\)\s*')
+_NOT_ALNUM = re.compile(r'[^a-z0-9]')
+
+
+def _normalize(name: str) -> str:
+    return _NOT_ALNUM.sub('', str(name).lower())
+
+
+def analyte_name(parameter: str) -> str:
+    """Parameter name without its qualifier ("ESR (Male)" becomes "ESR")"""
+    return _QUALIFIER.sub(' ', parameter).strip()
+
+
+def numeric_value(value) -> Optional[float]:
+    """Float value of a stored result, or None for text and booleans"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value.strip())
+        except ValueError:
+            return None
+    return None
+
+
+class ParameterRule:
+    """Type and allowed values of one schema parameter"""
+
+    __slots__ = ('name', 'kind', 'options', 'unit', 'range')
+
+    def __init__(self, name: str, definition: dict):
+        self.name = name
+        self.kind = definition.get('type', 'text')
+        self.unit = definition.get('unit')
+        self.range = definition.get('range')
+        options = definition.get('options')
+        self.options = {_normalize(option): option for option in options} if options else None
+
+    def clean(self, value):
+        """Return (cleaned value, error message or None)"""
+        if self.kind == 'number':
+            if isinstance(value, bool):
+                return value, f"{self.name} must be a number"
+            if isinstance(value, (int, float)):
+                number = value
+            else:
+                text = str(value).strip()
+                try:
+                    number = int(text) if re.fullmatch(r'[+-]?\d+', text) else float(text)
+                except ValueError:
+                    return value, f"{self.name} must be a number, got {value!r}"
+            if isinstance(number, float) and not math.isfinite(number):
+                return value, f"{self.name} must be a finite number"
+            return number, None
+
+        if not isinstance(value, str):
+            return value, f"{self.name} must be text"
+        if self.options is not None:
+            option = self.options.get(_normalize(value))
+            if option is None:
+                return value, f"{self.name} must be one of {', '.join(self.options.values())}"
+            return option, None
+        return value, None
+
+
+class CompiledSchema:
+    """
+    A test_schema turned into a lookup of parameter rules.
+
+    Result keys are matched to parameters ignoring case and punctuation, so
+    "hemoglobin", "Hemoglobin" and "HEMOGLOBIN" all hit the same rule. A
+    parameter also answers to its name without a parenthesised qualifier
+    ("ESR (Male)" -> "esr") and with a "count" suffix ("WBC" -> "wbc_count"),
+    which is how the mobile client and most analyzers name them.
+    """
+
+    def __init__(self, schema):
+        self.rules: Optional[Dict[str, ParameterRule]] = None
+        self._parameters: Dict[str, ParameterRule] = {}
+        definition = self._definition(schema)
+        if definition is None:
+            return
+
+        self.rules = {}
+        aliases = {}
+        for name, parameter in definition.items():
+            rule = ParameterRule(name, parameter if isinstance(parameter, dict) else {})
+            self._parameters[name] = rule
+            self.rules[_normalize(name)] = rule
+            base = _normalize(_QUALIFIER.sub(' ', name))
+            for alias in (base, f'{base}count', f'{_normalize(name)}count'):
+                aliases.setdefault(alias, rule)
+        for alias, rule in aliases.items():
+            self.rules.setdefault(alias, rule)
+
+    def parameters(self) -> Dict[str, ParameterRule]:
+        """Rules by their schema name, without aliases"""
+        return self._parameters
+
+    def analyte(self, key: str) -> Optional[str]:
+        """
+        Analyte a result key refers to, without sex/age qualifiers. Free-text
+        and unknown keys give None; with no schema the key itself is used.
+        """
+        normalized = _normalize(key)
+        if normalized in FREE_TEXT_KEYS:
+            return None
+        if self.rules is None:
+            return str(key)
+        rule = self.rules.get(normalized)
+        return analyte_name(rule.name) if rule else None
+
+    def unit(self, key: str) -> Optional[str]:
+        rule = self.rules.get(_normalize(key)) if self.rules else None
+        return rule.unit if rule else None
+
+    @staticmethod
+    def _definition(schema) -> Optional[dict]:
+        # Schemas are stored as {"<test name>": {"sample_collected": ..., "parameters": {...}}}
+        if not isinstance(schema, dict):
+            return None
+        if isinstance(schema.get('parameters'), dict):
+            return schema['parameters']
+        for value in schema.values():
+            if isinstance(value, dict) and isinstance(value.get('parameters'), dict):
+                return value['parameters']
+        return None
+
+    def validate(self, result, strict: bool = True) -> Tuple[dict, List[str]]:
+        """
+        Validate and coerce one result.
+
+        Args:
+            result: Mapping of parameter name to value as submitted; None values
+                are treated as not measured
+            strict: Reject keys that name no schema parameter; otherwise they
+                are kept unvalidated, as before schemas were enforced
+
+        Returns:
+            (cleaned result with the submitted keys, list of error messages)
+        """
+        if not isinstance(result, dict):
+            return {}, ["test_result must be an object"]
+
+        cleaned, errors = {}, []
+        for key, value in result.items():
+            if value is None or value == '':
+                continue
+            normalized = _normalize(key)
+            if normalized in FREE_TEXT_KEYS or self.rules is None:
+                cleaned[key] = value
+                continue
+            rule = self.rules.get(normalized)
+            if rule is None:
+                if strict:
+                    errors.append(f"Unknown parameter {key!r}")
+                else:
+                    cleaned[key] = value
+                continue
+            value, error = rule.clean(value)
+            if error:
+                errors.append(error)
+            cleaned[key] = value
+        return cleaned, errors
+
+
+class SchemaRegistry:
+    """
+    Compiled schemas per LabTestType, compiled on first use. Each entry keeps
+    a private copy of the schema it was built from, so an edited schema is
+    picked up by every worker without a restart; checking it is a plain dict
+    comparison, not a re-serialization of the schema per result.
+    """
+
+    def __init__(self):
+        self._compiled: Dict[int, Tuple[object, CompiledSchema]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, test_type: LabTestType) -> CompiledSchema:
+        entry = self._compiled.get(test_type.test_type_id)
+        if entry is None or entry[0] != test_type.test_schema:
+            entry = (copy.deepcopy(test_type.test_schema), CompiledSchema(test_type.test_schema))
+            with self._lock:
+                self._compiled[test_type.test_type_id] = entry
+        return entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._compiled.clear()
+
+
+schema_registry = SchemaRegistry()
+
+
+def validate_test_result(test_type: LabTestType, result, strict: bool = None) -> Tuple[dict, List[str]]:
+    """
+    Validate a result against the compiled schema of its test type. Unknown
+    keys are rejected only in strict mode (LAB_RESULTS_STRICT_SCHEMA_KEYS
+    unless `strict` is given).
+    """
+    if strict is None:
+        strict = getattr(settings, 'LAB_RESULTS_STRICT_SCHEMA_KEYS', False)
+    return schema_registry.get(test_type).validate(result, strict=strict)
+
+
+def process_saved_results(lab_tests: List[LabTest]) -> list:
+    """
+    Derived data for freshly saved results: reference-range flags and the
+    patient's analyte history. Returns the flags.
+    """
+    from .analyte_history_service import record_observations
+    from .lab_flagging_service import flag_lab_tests
+
+    record_observations(lab_tests)
+    return flag_lab_tests(lab_tests)
+
+
+# ----------------------------------------------------------------------
+# Bulk import
+# ----------------------------------------------------------------------
+
+def _csv_rows(stream: io.TextIOBase) -> Iterator[dict]:
+    # Wide format: lab_test_id, optional status, one column per parameter
+    for row in csv.DictReader(stream):
+        yield {key.strip(): value for key, value in row.items() if key is not None}
+
+
+def _ndjson_rows(stream: io.TextIOBase) -> Iterator[dict]:
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError as e:
+            row = {'__error__': f"Invalid JSON: {e.msg}"}
+        yield row if isinstance(row, dict) else {'__error__': "Row must be a JSON object"}
+
+
+def parse_result_rows(uploaded_file, file_format: str = None) -> Iterator[dict]:
+    """
+    Stream rows out of an analyzer export without reading it into memory
+
+    Args:
+        uploaded_file: Binary file-like object (an UploadedFile)
+        file_format: 'csv' or 'ndjson'; detected from the file name when omitted
+
+    Returns:
+        Iterator of row dicts
+    """
+    if not file_format:
+        name = getattr(uploaded_file, 'name', '') or ''
+        file_format = 'ndjson' if name.lower().endswith(('.ndjson', '.jsonl', '.json')) else 'csv'
+    if file_format not in ('csv', 'ndjson'):
+        raise ValueError("format must be 'csv' or 'ndjson'")
+
+    stream = io.TextIOWrapper(getattr(uploaded_file, 'file', uploaded_file), encoding='utf-8-sig', newline='')
+    return _csv_rows(stream) if file_format == 'csv' else _ndjson_rows(stream)
+
+
+def _chunks(rows: Iterable[dict], size: int) -> Iterator[List[Tuple[int, dict]]]:
+    chunk = []
+    for number, row in enumerate(rows, start=1):
+        chunk.append((number, row))
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _split_row(row: dict) -> Tuple[Optional[int], str, dict, Optional[str]]:
+    """Pull lab_test_id, status and the result values out of one row"""
+    if '__error__' in row:
+        return None, '', {}, row['__error__']
+    values = dict(row)
+    raw_id = values.pop('lab_test_id', None)
+    status = str(values.pop('status', '') or '').strip().lower() or LabTest.Status.COMPLETED
+    result = values.pop('test_result', values)
+    try:
+        lab_test_id = int(str(raw_id).strip())
+    except (TypeError, ValueError):
+        return None, status, result, "lab_test_id is missing or not an integer"
+    return lab_test_id, status, result, None
+
+
+def _apply_chunk(parsed, lab_tests, lab_ids, seen, reject) -> int:
+    """Validate one chunk of parsed rows and bulk-save the valid ones; returns rows saved"""
+    updates, schemas = [], {}
+    for number, lab_test_id, status, result, error in parsed:
+        if error:
+            reject(number, lab_test_id, [error])
+            continue
+        lab_test = lab_tests.get(lab_test_id)
+        if lab_test is None or (lab_ids is not None and lab_test.lab_id not in lab_ids):
+            reject(number, lab_test_id, ["Lab test not found in your lab"])
+            continue
+        if lab_test_id in seen:
+            reject(number, lab_test_id, ["Lab test appears more than once in this upload"])
+            continue
+        seen.add(lab_test_id)
+        if lab_test.status != LabTest.Status.PAID:
+            reject(number, lab_test_id, [f"Lab test is {lab_test.status}, only paid tests accept results"])
+            continue
+        if status not in BULK_RESULT_STATUSES:
+            reject(number, lab_test_id, [f"status must be one of {', '.join(sorted(BULK_RESULT_STATUSES))}"])
+            continue
+
+        schema = schemas.get(lab_test.test_type_id)
+        if schema is None:
+            schema = schemas[lab_test.test_type_id] = schema_registry.get(lab_test.test_type)
+        cleaned, errors = schema.validate(result)
+        if status == LabTest.Status.COMPLETED:
+            if not cleaned:
+                errors.append("No result values")
+            if lab_test.test_type.image_required:
+                errors.append("Test type requires an image; upload it through the single-test endpoint")
+        if errors:
+            reject(number, lab_test_id, errors)
+            continue
+
+        updates.append((lab_test, cleaned, status))
+
+    if updates:
+        lab_scheduler.release_many([lab_test for lab_test, _, _ in updates])
+        now = timezone.now()
+        for lab_test, cleaned, status in updates:
+            lab_test.test_result = cleaned
+            lab_test.status = status
+            lab_test.updated_at = now
+        LabTest.objects.bulk_update([lab_test for lab_test, _, _ in updates], ['test_result', 'status', 'updated_at'])
+        process_saved_results([lab_test for lab_test, _, status in updates if status == LabTest.Status.COMPLETED])
+    return len(updates)
+
+
+def import_results(rows: Iterable[dict], lab_ids: Optional[Collection[int]], chunk_size: int = None) -> Dict:
+    """
+    Validate analyzer rows and write results in chunks
+
+    Each chunk loads its lab tests in one query, validates every row against the
+    compiled schema of its test type and saves the valid rows with one
+    bulk_update. Rows are independent: a bad row is reported and skipped, the
+    rest of the file is still written.
+
+    Args:
+        rows: Row dicts with lab_test_id, optional status ('completed' or
+            'failed') and either a test_result object or one key per parameter
+        lab_ids: Only tests in these labs may be updated (None allows any lab)
+        chunk_size: Rows per query/bulk_update (LAB_RESULTS_BULK_CHUNK_SIZE)
+
+    Returns:
+        Dict with total_rows, updated, failed and a per-row errors list
+    """
+    chunk_size = chunk_size or getattr(settings, 'LAB_RESULTS_BULK_CHUNK_SIZE', 500)
+    report = {"total_rows": 0, "updated": 0, "failed": 0, "errors": []}
+    seen = set()
+
+    def reject(number, lab_test_id, messages):
+        report["failed"] += 1
+        report["errors"].append({"row": number, "lab_test_id": lab_test_id, "errors": messages})
+
+    for chunk in _chunks(rows, chunk_size):
+        report["total_rows"] += len(chunk)
+        parsed = [(number, *_split_row(row)) for number, row in chunk]
+        ids = [lab_test_id for _, lab_test_id, _, _, error in parsed if lab_test_id is not None]
+        with transaction.atomic():
+            # Lock the chunk's tests so a parallel upload cannot complete them twice
+            lab_tests = LabTest.objects.select_for_update().select_related('test_type').in_bulk(ids)
+            report["updated"] += _apply_chunk(parsed, lab_tests, lab_ids, seen, reject)
+
+    logger.info(
+        f"Bulk lab results: {report['updated']} updated, {report['failed']} failed "
+        f"of {report['total_rows']} rows"
+    )
+    return report
@@ -0,0 +1,298 @@
+"""
+Capacity-aware lab scheduling for recommended lab tests
+"""
+import logging
+import math
+import threading
+import time
+from array import array
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Lab, LabTest, LabTestType
+
+logger = logging.getLogger(__name__)
+
+# Tests in these states hold lab time; completed, missed and failed tests release it
+ACTIVE_STATUSES = [LabTest.Status.RECOMMENDED, LabTest.Status.PAID]
+
+
+class LabCapacityError(Exception):
+    """Raised when no lab has room for a test within the search horizon"""
+
+
+class LabScheduler:
+    """
+    Reserves concrete lab time for lab tests.
+
+    Time is cut into fixed buckets (LAB_SCHEDULE_BUCKET_MINUTES). Each lab can run
+    `capacity` tests per bucket, of which `high_priority_reserve` is kept free for
+    HIGH priority tests so they can jump ahead of routine work. Occupancy is held
+    in memory as one array of per-bucket counts per (lab, day) and is rebuilt from
+    the database the first time a process schedules a test (and every
+    LAB_SCHEDULE_REBUILD_SECONDS after that). Every reservation is re-checked
+    against the database under a row lock on the lab and the checked window is
+    written back, so workers with a stale view resync instead of overbooking.
+    A new reservation only reaches the in-memory occupancy once the caller's
+    transaction commits, so a rolled-back request leaves no phantom bookings.
+    """
+
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, bucket_minutes: int = None, search_hours: int = None):
+        self.bucket_minutes = bucket_minutes or getattr(settings, 'LAB_SCHEDULE_BUCKET_MINUTES', 15)
+        self.search_hours = search_hours or getattr(settings, 'LAB_SCHEDULE_SEARCH_HOURS', 24)
+        self.rebuild_seconds = getattr(settings, 'LAB_SCHEDULE_REBUILD_SECONDS', 300)
+        self.bucket_seconds = self.bucket_minutes * 60
+        self.buckets_per_day = (24 * 60) // self.bucket_minutes
+        self._occupancy: Dict[Tuple[int, int], array] = {}
+        self._lock = threading.RLock()
+        self._loaded_at = None
+
+    # ------------------------------------------------------------------
+    # Bucket arithmetic (absolute bucket numbers since the UNIX epoch, UTC)
+    # ------------------------------------------------------------------
+
+    def _bucket(self, moment: datetime) -> int:
+        return int(moment.timestamp()) // self.bucket_seconds
+
+    def _bucket_start(self, bucket: int) -> datetime:
+        return datetime.fromtimestamp(bucket * self.bucket_seconds, tz=dt_timezone.utc)
+
+    def _span(self, start: datetime, end: datetime) -> Tuple[int, int]:
+        """Half-open range of buckets touched by [start, end)"""
+        first = self._bucket(start)
+        last = self._bucket(end - timedelta(microseconds=1))
+        return first, max(last, first) + 1
+
+    # ------------------------------------------------------------------
+    # In-memory occupancy
+    # ------------------------------------------------------------------
+
+    def _day_counts(self, lab_id: int, day: int, create: bool = False) -> Optional[array]:
+        key = (lab_id, day)
+        counts = self._occupancy.get(key)
+        if counts is None and create:
+            counts = array('H', bytes(2 * self.buckets_per_day))
+            self._occupancy[key] = counts
+        return counts
+
+    def _add(self, lab_id: int, first: int, stop: int, delta: int):
+        with self._lock:
+            for bucket in range(first, stop):
+                day, offset = divmod(bucket, self.buckets_per_day)
+                counts = self._day_counts(lab_id, day, create=delta > 0)
+                if counts is not None:
+                    counts[offset] = min(max(counts[offset] + delta, 0), 0xFFFF)
+
+    def _counts(self, lab_id: int, first: int, stop: int) -> List[int]:
+        result = []
+        for bucket in range(first, stop):
+            day, offset = divmod(bucket, self.buckets_per_day)
+            counts = self._day_counts(lab_id, day)
+            result.append(counts[offset] if counts is not None else 0)
+        return result
+
+    def _store(self, lab_id: int, first: int, counts: List[int]):
+        with self._lock:
+            for bucket, count in enumerate(counts, start=first):
+                day, offset = divmod(bucket, self.buckets_per_day)
+                self._day_counts(lab_id, day, create=True)[offset] = min(count, 0xFFFF)
+
+    def rebuild(self):
+        """Reload occupancy for every lab from active, not yet finished reservations"""
+        now = timezone.now()
+        occupancy: Dict[Tuple[int, int], array] = {}
+        rows = LabTest.objects.filter(
+            status__in=ACTIVE_STATUSES,
+            reserved_until__gt=now
+        ).values_list('lab_id', 'test_datetime', 'reserved_until')
+
+        for lab_id, start, end in rows.iterator(chunk_size=2000):
+            first, stop = self._span(start, end)
+            for bucket in range(first, stop):
+                day, offset = divmod(bucket, self.buckets_per_day)
+                counts = occupancy.get((lab_id, day))
+                if counts is None:
+                    counts = array('H', bytes(2 * self.buckets_per_day))
+                    occupancy[(lab_id, day)] = counts
+                counts[offset] = min(counts[offset] + 1, 0xFFFF)
+
+        with self._lock:
+            self._occupancy = occupancy
+            self._loaded_at = time.monotonic()
+        logger.info(f"Rebuilt lab occupancy for {len(occupancy)} lab-days")
+
+    def _is_fresh(self) -> bool:
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.rebuild_seconds
+
+    def ensure_loaded(self):
+        if not self._is_fresh():
+            with self._lock:
+                if not self._is_fresh():
+                    self.rebuild()
+
+    def _prune(self):
+        """Drop lab-days that are entirely in the past"""
+        today = self._bucket(timezone.now()) // self.buckets_per_day
+        with self._lock:
+            for key in [key for key in self._occupancy if key[1] < today]:
+                del self._occupancy[key]
+
+    # ------------------------------------------------------------------
+    # Scheduling
+    # ------------------------------------------------------------------
+
+    def _limit(self, lab: Lab, priority: str) -> int:
+        if priority == LabTest.Priority.HIGH:
+            return lab.capacity
+        return max(lab.capacity - lab.high_priority_reserve, 1)
+
+    def _db_counts(self, lab_id: int, first: int, stop: int) -> List[int]:
+        window_start, window_end = self._bucket_start(first), self._bucket_start(stop)
+        counts = [0] * (stop - first)
+        rows = LabTest.objects.filter(
+            lab_id=lab_id,
+            status__in=ACTIVE_STATUSES,
+            test_datetime__lt=window_end,
+            reserved_until__gt=window_start
+        ).values_list('test_datetime', 'reserved_until')
+
+        for start, end in rows:
+            row_first, row_stop = self._span(start, end)
+            for bucket in range(max(row_first, first), min(row_stop, stop)):
+                counts[bucket - first] += 1
+        return counts
+
+    def _held_counts(self, held: List[LabTest], lab_id: int, first: int, stop: int) -> List[int]:
+        """Buckets of [first, stop) taken by reservations of the current transaction, not yet in memory"""
+        counts = [0] * (stop - first)
+        for lab_test in held:
+            if lab_test.lab_id != lab_id:
+                continue
+            held_first, held_stop = self._span(lab_test.test_datetime, lab_test.reserved_until)
+            for bucket in range(max(held_first, first), min(held_stop, stop)):
+                counts[bucket - first] += 1
+        return counts
+
+    def _find(self, labs: List[Lab], requested_start: datetime, duration: timedelta,
+              priority: str, preferred_lab: Lab = None, held: List[LabTest] = ()) -> Optional[Tuple[Lab, datetime]]:
+        """Earliest start at or after requested_start with room in some lab"""
+        first_bucket = self._bucket(requested_start)
+        horizon = math.ceil(self.search_hours * 60 / self.bucket_minutes)
+
+        for bucket in range(first_bucket, first_bucket + horizon):
+            start = requested_start if bucket == first_bucket else self._bucket_start(bucket)
+            span_first, span_stop = self._span(start, start + duration)
+            best = None
+            for lab in labs:
+                peak = max(
+                    count + own for count, own in zip(
+                        self._counts(lab.lab_id, span_first, span_stop),
+                        self._held_counts(held, lab.lab_id, span_first, span_stop)
+                    )
+                )
+                if peak >= self._limit(lab, priority):
+                    continue
+                if lab == preferred_lab:
+                    return lab, start
+                if best is None or peak < best[0]:
+                    best = (peak, lab)
+            if best is not None:
+                return best[1], start
+        return None
+
+    def schedule(self, labs: Iterable[Lab], test_type: LabTestType, requested_start: datetime,
+                 priority: str = LabTest.Priority.MEDIUM, preferred_lab: Lab = None,
+                 held: Iterable[LabTest] = (), **lab_test_fields) -> LabTest:
+        """
+        Reserve the earliest lab time at or after requested_start and create the LabTest
+
+        Args:
+            labs: Functional labs able to run the test
+            test_type: Type of test, which determines the reserved duration
+            requested_start: Timezone-aware datetime requested by the doctor
+            priority: LabTest.Priority value
+            preferred_lab: Lab tried first when several have room (keeps a
+                patient's tests together)
+            held: Tests already reserved in the caller's still open transaction,
+                which the in-memory occupancy does not include until it commits
+            **lab_test_fields: Remaining LabTest fields (appointment, test_result, ...)
+
+        Returns:
+            The created LabTest, with test_datetime/reserved_until set to the reservation
+
+        Raises:
+            LabCapacityError: when no lab has room within LAB_SCHEDULE_SEARCH_HOURS
+        """
+        self.ensure_loaded()
+        labs = list(labs)
+        held = list(held)
+        duration = timedelta(minutes=test_type.expected_duration_minutes)
+
+        for _ in range(self.MAX_ATTEMPTS):
+            candidate = self._find(labs, requested_start, duration, priority, preferred_lab, held)
+            if candidate is None:
+                break
+            lab, start = candidate
+            end = start + duration
+            first, stop = self._span(start, end)
+
+            with transaction.atomic():
+                # Serialize reservations on this lab across workers
+                Lab.objects.select_for_update().filter(lab_id=lab.lab_id).first()
+                db_counts = self._db_counts(lab.lab_id, first, stop)
+                if max(db_counts) < self._limit(lab, priority):
+                    lab_test = LabTest.objects.create(
+                        lab=lab,
+                        test_type=test_type,
+                        test_datetime=start,
+                        reserved_until=end,
+                        priority=priority,
+                        **lab_test_fields
+                    )
+                    # Counted in memory only if the caller's transaction commits
+                    transaction.on_commit(lambda: self._add(lab.lab_id, first, stop, 1))
+                    return lab_test
+
+            # Another worker took this window; resync it (without this transaction's
+            # own, uncommitted reservations) and search again
+            logger.info(f"Lab {lab.lab_id} occupancy was stale, resyncing buckets {first}-{stop}")
+            own = self._held_counts(held, lab.lab_id, first, stop)
+            self._store(lab.lab_id, first, [count - mine for count, mine in zip(db_counts, own)])
+
+        raise LabCapacityError(
+            f"No lab capacity for {test_type.test_name} within {self.search_hours} hours of "
+            f"{requested_start.isoformat()}"
+        )
+
+    def release(self, lab_test: LabTest):
+        """
+        Free the lab time held by a test that finished or will not run.
+        Call before the test's status is changed away from an active one.
+        """
+        self.release_many([lab_test])
+
+    def release_many(self, lab_tests: Iterable[LabTest]):
+        """Release a batch of tests with a single commit hook"""
+        spans = [
+            (lab_test.lab_id, *self._span(lab_test.test_datetime, lab_test.reserved_until))
+            for lab_test in lab_tests
+            if lab_test.status in ACTIVE_STATUSES and lab_test.reserved_until
+        ]
+        if not spans:
+            return
+
+        def apply():
+            for lab_id, first, stop in spans:
+                self._add(lab_id, first, stop, -1)
+            self._prune()
+
+        transaction.on_commit(apply)
+
+
+lab_scheduler = LabScheduler()
@@ -0,0 +1,71 @@
+"""
+Lab technician worklist: pending tests for one lab, ordered for processing
+"""
+import time
+from datetime import timedelta
+from typing import List
+
+from django.conf import settings
+from django.db.models import Case, F, IntegerField, Value, When
+from django.utils import timezone
+
+from .models import Lab, LabTest
+
+def resolve_lab_ids(lab_name: str) -> List[int]:
+    """
+    Ids of the labs a technician's free-text assigned_lab names. Lab names are
+    not unique, so like a lab__lab_name filter this matches every lab with the
+    name. Not cached: a rename or delete must take effect in every worker at once.
+    """
+    return list(Lab.objects.filter(lab_name=lab_name).values_list('lab_id', flat=True))
+
+
+def sla_deadline_for(priority: str, paid_at=None):
+    """Result due time for a test paid at paid_at, from LAB_TEST_SLA_HOURS"""
+    sla_hours = getattr(settings, 'LAB_TEST_SLA_HOURS', {})
+    return (paid_at or timezone.now()) + timedelta(hours=sla_hours.get(priority, 24))
+
+
+def worklist_queryset(lab_ids: List[int]):
+    """
+    Paid tests waiting in the given labs: high priority first, then by scheduled time,
+    then by SLA deadline. Everything the worklist renders is joined in, so the
+    whole list is a single query.
+    """
+    priority_rank = Case(
+        When(priority=LabTest.Priority.HIGH, then=Value(0)),
+        When(priority=LabTest.Priority.MEDIUM, then=Value(1)),
+        default=Value(2),
+        output_field=IntegerField(),
+    )
+    return LabTest.objects.filter(
+        lab_id__in=lab_ids,
+        status=LabTest.Status.PAID
+    ).select_related(
+        'test_type', 'tran', 'appointment__patient', 'appointment__staff', 'appointment__slot'
+    ).annotate(
+        priority_rank=priority_rank
+    ).order_by(
+        'priority_rank', 'test_datetime', F('sla_deadline').asc(nulls_last=True)
+    )
+
+
+def wait_for_paid_tests(lab_ids: List[int], since, timeout: float) -> bool:
+    """
+    Long-poll helper: block until a test in the labs has been paid after `since`
+    or until `timeout` seconds pass. Returns True when something new arrived.
+    """
+    interval = getattr(settings, 'LAB_WORKLIST_POLL_INTERVAL', 1.0)
+    deadline = time.monotonic() + timeout
+    new_tests = LabTest.objects.filter(
+        lab_id__in=lab_ids,
+        status=LabTest.Status.PAID,
+        tran__transaction_datetime__gt=since
+    )
+    while True:
+        if new_tests.exists():
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(interval, remaining))
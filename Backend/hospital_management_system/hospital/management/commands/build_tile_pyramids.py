@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from hospital.models import LabTest
+from hospital.tile_service import tile_service
+
+
+class Command(BaseCommand):
+    help = "Build tile pyramids for lab test images that do not have one yet"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lab-test-id', type=int, help='Only this lab test')
+        parser.add_argument('--force', action='store_true', help='Rebuild existing pyramids')
+
+    def handle(self, *args, **options):
+        lab_tests = LabTest.objects.exclude(test_image='').exclude(test_image__isnull=True)
+        if options['lab_test_id']:
+            lab_tests = lab_tests.filter(lab_test_id=options['lab_test_id'])
+
+        built = skipped = failed = 0
+        for lab_test_id, image_name in lab_tests.values_list('lab_test_id', 'test_image').iterator():
+            try:
+                if tile_service.build(lab_test_id, image_name, force=options['force']) is None:
+                    skipped += 1
+                else:
+                    built += 1
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f"Lab test {lab_test_id}: {str(e)}")
+
+        self.stdout.write(self.style.SUCCESS(f"Built {built} tile pyramids ({skipped} up to date, {failed} failed)"))
@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from hospital.lab_flagging_service import flag_lab_tests
+from hospital.models import LabResultFlag, LabTest
+
+
+class Command(BaseCommand):
+    help = "Recompute reference-range flags for a day's completed lab results"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', type=str, help='Day to flag (YYYY-MM-DD), defaults to today')
+        parser.add_argument('--batch-size', type=int, default=2000, help='Lab tests evaluated per batch')
+
+    def handle(self, *args, **options):
+        if options['date']:
+            try:
+                day = datetime.strptime(options['date'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('Invalid date format. Use YYYY-MM-DD')
+        else:
+            day = timezone.localdate()
+
+        start = timezone.make_aware(datetime.combine(day, datetime.min.time()))
+        end = start + timedelta(days=1)
+        lab_tests = LabTest.objects.filter(
+            status=LabTest.Status.COMPLETED,
+            test_datetime__gte=start,
+            test_datetime__lt=end
+        ).select_related('test_type').order_by('lab_test_id')
+
+        totals = {'tests': 0, 'flags': 0, 'critical': 0}
+
+        def flush(batch):
+            flags = flag_lab_tests(batch)
+            totals['tests'] += len(batch)
+            totals['flags'] += len(flags)
+            totals['critical'] += sum(flag.flag in LabResultFlag.CRITICAL for flag in flags)
+
+        batch = []
+        for lab_test in lab_tests.iterator(chunk_size=options['batch_size']):
+            batch.append(lab_test)
+            if len(batch) >= options['batch_size']:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Flagged {totals['tests']} lab tests for {day}: "
+            f"{totals['flags']} abnormal values, {totals['critical']} critical"
+        ))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from hospital.lab_flagging_service import ranges_from_schema
+from hospital.models import LabTestType, ReferenceRange
+
+
+class Command(BaseCommand):
+    help = 'Create or update reference ranges from the range strings in each LabTestType.test_schema'
+
+    def handle(self, *args, **options):
+        created_count = updated_count = 0
+
+        for test_type in LabTestType.objects.all():
+            for definition in ranges_from_schema(test_type):
+                # Only the schema-derived bounds are touched; critical limits and
+                # age-banded ranges entered by admins are left alone
+                _, created = ReferenceRange.objects.update_or_create(
+                    test_type=test_type,
+                    analyte=definition['analyte'],
+                    sex=definition['sex'],
+                    age_min_years=None,
+                    age_max_years=None,
+                    defaults={
+                        'low': definition['low'],
+                        'high': definition['high'],
+                        'unit': definition['unit'],
+                    }
+                )
+                if created:
+                    created_count += 1
+                else:
+                    updated_count += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Reference ranges loaded: {created_count} created, {updated_count} updated"
+        ))
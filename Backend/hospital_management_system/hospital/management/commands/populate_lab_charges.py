@@ -2,6 +2,7 @@ import decimal
 from django.core.management.base import BaseCommand
 from django.utils import timezone
 from hospital.models import LabTestType, LabTestCharge, Unit
+from hospital.price_book_service import price_book
 
 
 class Command(BaseCommand):
@@ -44,8 +45,9 @@ class Command(BaseCommand):
             try:
                 test_type = LabTestType.objects.get(test_type_id=test_type_id)
                 
-                # Deactivate old active charges
-                LabTestCharge.objects.filter(test=test_type, is_active=True).update(is_active=False)
+                # End old active charges where the new one starts
+                effective_from = timezone.now()
+                price_book.retire(LabTestCharge.objects.filter(test=test_type), at=effective_from)
 
                 # Create new active charge
                 LabTestCharge.objects.create(
@@ -53,7 +55,8 @@ class Command(BaseCommand):
                     charge_amount=amount,
                     charge_unit=inr_unit,
                     charge_remark=remark,
-                    is_active=True
+                    is_active=True,
+                    effective_from=effective_from
                 )
 
                 self.stdout.write(self.style.SUCCESS(f'Charge set for: {test_type.test_name}'))
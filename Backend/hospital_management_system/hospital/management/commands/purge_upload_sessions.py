@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from hospital.upload_service import upload_service
+
+
+class Command(BaseCommand):
+    help = "Abort expired chunked uploads and delete their stored chunks"
+
+    def handle(self, *args, **options):
+        purged = upload_service.purge_expired()
+        self.stdout.write(self.style.SUCCESS(f"Purged {purged} expired uploads"))
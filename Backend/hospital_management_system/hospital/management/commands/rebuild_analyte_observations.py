@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from hospital.analyte_history_service import record_observations
+from hospital.models import LabTest
+
+
+class Command(BaseCommand):
+    help = "Rebuild the per-patient analyte history from completed lab results"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000, help='Lab tests indexed per batch')
+
+    def handle(self, *args, **options):
+        lab_tests = LabTest.objects.filter(
+            status=LabTest.Status.COMPLETED
+        ).select_related('test_type').order_by('lab_test_id')
+
+        totals = {'tests': 0, 'observations': 0}
+
+        def flush(batch):
+            totals['observations'] += record_observations(batch)
+            totals['tests'] += len(batch)
+
+        batch = []
+        for lab_test in lab_tests.iterator(chunk_size=options['batch_size']):
+            batch.append(lab_test)
+            if len(batch) >= options['batch_size']:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {totals['observations']} analyte values from {totals['tests']} lab tests"
+        ))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from hospital.rating_summary_service import rating_summaries
+
+
+class Command(BaseCommand):
+    help = "Rebuild the per-doctor rating summaries from the appointment ratings"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--doctor', action='append', dest='doctors', help='Only this doctor (staff id); repeatable')
+
+    def handle(self, *args, **options):
+        written = rating_summaries.refresh(options['doctors'])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {written} doctor rating summaries"))
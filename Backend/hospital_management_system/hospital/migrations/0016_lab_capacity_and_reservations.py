@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:39
+
+from datetime import timedelta
+
+from django.db import migrations, models
+
+
+def backfill_reserved_until(apps, schema_editor):
+    # Existing tests were booked without a duration; give them the default one
+    LabTest = apps.get_model('hospital', 'LabTest')
+    for lab_test in LabTest.objects.filter(reserved_until__isnull=True).only('lab_test_id', 'test_datetime').iterator():
+        LabTest.objects.filter(pk=lab_test.pk).update(
+            reserved_until=lab_test.test_datetime + timedelta(minutes=15)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0015_patienthistorydocs_patienthistory'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lab',
+            name='capacity',
+            field=models.PositiveIntegerField(default=4, help_text='Tests the lab can run in parallel in one scheduling bucket'),
+        ),
+        migrations.AddField(
+            model_name='lab',
+            name='high_priority_reserve',
+            field=models.PositiveIntegerField(default=1, help_text='Capacity per bucket held back for high-priority tests'),
+        ),
+        migrations.AddField(
+            model_name='labtest',
+            name='reserved_until',
+            field=models.DateTimeField(blank=True, help_text='End of the lab time reserved for this test', null=True),
+        ),
+        migrations.AddField(
+            model_name='labtesttype',
+            name='expected_duration_minutes',
+            field=models.PositiveIntegerField(default=15, help_text='Lab time reserved for one test of this type'),
+        ),
+        migrations.RunPython(backfill_reserved_until, migrations.RunPython.noop),
+    ]
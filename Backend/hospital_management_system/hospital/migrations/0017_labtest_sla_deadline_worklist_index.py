@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0016_lab_capacity_and_reservations'),
+        ('transactions', '0003_alter_transaction_patient_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='labtest',
+            name='sla_deadline',
+            field=models.DateTimeField(blank=True, help_text='Time by which results are due, set on payment', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='labtest',
+            index=models.Index(fields=['lab', 'status', 'test_datetime'], name='labtest_worklist_idx'),
+        ),
+    ]
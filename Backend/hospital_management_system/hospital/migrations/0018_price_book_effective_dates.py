@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:44
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill_effective_dates(apps, schema_editor):
+    # Existing prices start when they were created; retired ones ended at their last update
+    for model_name in ('AppointmentCharge', 'LabTestCharge'):
+        model = apps.get_model('hospital', model_name)
+        model.objects.update(effective_from=F('created_at'))
+        model.objects.filter(is_active=False).update(effective_to=F('updated_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0017_labtest_sla_deadline_worklist_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointmentcharge',
+            name='effective_from',
+            field=models.DateTimeField(default=django.utils.timezone.now, help_text='Start of the period this price applies to'),
+        ),
+        migrations.AddField(
+            model_name='appointmentcharge',
+            name='effective_to',
+            field=models.DateTimeField(blank=True, help_text='End of the period (exclusive); empty while the price is current', null=True),
+        ),
+        migrations.AddField(
+            model_name='labtestcharge',
+            name='effective_from',
+            field=models.DateTimeField(default=django.utils.timezone.now, help_text='Start of the period this price applies to'),
+        ),
+        migrations.AddField(
+            model_name='labtestcharge',
+            name='effective_to',
+            field=models.DateTimeField(blank=True, help_text='End of the period (exclusive); empty while the price is current', null=True),
+        ),
+        migrations.RunPython(backfill_effective_dates, migrations.RunPython.noop),
+    ]
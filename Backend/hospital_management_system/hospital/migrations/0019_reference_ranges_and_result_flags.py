@@ -0,0 +1,51 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0018_price_book_effective_dates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReferenceRange',
+            fields=[
+                ('reference_range_id', models.AutoField(primary_key=True, serialize=False)),
+                ('analyte', models.CharField(help_text="Schema parameter name without sex qualifier, e.g. 'ESR'", max_length=100)),
+                ('sex', models.CharField(choices=[('any', 'Any'), ('male', 'Male'), ('female', 'Female')], default='any', max_length=10)),
+                ('age_min_years', models.FloatField(blank=True, help_text='Inclusive; empty for no lower age bound', null=True)),
+                ('age_max_years', models.FloatField(blank=True, help_text='Exclusive; empty for no upper age bound', null=True)),
+                ('low', models.FloatField(blank=True, null=True)),
+                ('high', models.FloatField(blank=True, null=True)),
+                ('critical_low', models.FloatField(blank=True, null=True)),
+                ('critical_high', models.FloatField(blank=True, null=True)),
+                ('unit', models.CharField(blank=True, max_length=50, null=True)),
+                ('test_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reference_ranges', to='hospital.labtesttype')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LabResultFlag',
+            fields=[
+                ('flag_id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('analyte', models.CharField(max_length=100)),
+                ('value', models.FloatField()),
+                ('flag', models.CharField(choices=[('low', 'Low'), ('high', 'High'), ('critical_low', 'Critical Low'), ('critical_high', 'Critical High')], max_length=15)),
+                ('observed_at', models.DateTimeField(help_text="Copied from the lab test's test_datetime")),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('lab_test', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='flags', to='hospital.labtest')),
+                ('reference_range', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='flags', to='hospital.referencerange')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='referencerange',
+            index=models.Index(fields=['test_type', 'analyte'], name='refrange_analyte_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='labresultflag',
+            index=models.Index(fields=['flag', 'observed_at'], name='labflag_flag_observed_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:53
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0019_reference_ranges_and_result_flags'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalyteObservation',
+            fields=[
+                ('observation_id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('analyte', models.CharField(max_length=100)),
+                ('value', models.FloatField(blank=True, help_text='Numeric result; empty for text results', null=True)),
+                ('value_text', models.CharField(blank=True, max_length=255, null=True)),
+                ('unit', models.CharField(blank=True, max_length=50, null=True)),
+                ('observed_at', models.DateTimeField(help_text="Copied from the lab test's test_datetime")),
+                ('lab_test', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='observations', to='hospital.labtest')),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='analyte_observations', to='hospital.patient')),
+                ('test_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='analyte_observations', to='hospital.labtesttype')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['patient', 'test_type', 'analyte', 'observed_at'], name='observation_series_idx')],
+            },
+        ),
+    ]
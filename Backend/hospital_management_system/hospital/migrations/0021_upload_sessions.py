@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:55
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0020_analyte_observations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('upload_id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('target', models.CharField(choices=[('lab_test_image', 'Lab Test Image'), ('patient_document', 'Patient Document')], max_length=20)),
+                ('document_type', models.CharField(blank=True, choices=[('lab_report', 'Lab Report'), ('prescription', 'Prescription'), ('discharge_summary', 'Discharge Summary'), ('other', 'Other')], max_length=20, null=True)),
+                ('owner_id', models.CharField(help_text='patient_id or staff_id of the uploader', max_length=50)),
+                ('file_name', models.CharField(max_length=255)),
+                ('content_type', models.CharField(blank=True, max_length=100, null=True)),
+                ('total_size', models.BigIntegerField()),
+                ('checksum', models.CharField(blank=True, help_text='Optional SHA-256 of the whole file, checked on finalize', max_length=64, null=True)),
+                ('received_bytes', models.BigIntegerField(default=0)),
+                ('parts', models.JSONField(default=list, help_text='Stored chunks in order: [{offset, size, sha256, path}]')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('completed', 'Completed'), ('aborted', 'Aborted')], default='pending', max_length=10)),
+                ('stored_path', models.CharField(blank=True, max_length=500, null=True)),
+                ('expires_at', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('lab_test', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to='hospital.labtest')),
+                ('patient', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to='hospital.patient')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'expires_at'], name='upload_session_expiry_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:22
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+
+
+def build_summaries(apps, schema_editor):
+    # Same grouped aggregate as RatingSummaryService.refresh, over the historical models
+    AppointmentRating = apps.get_model('hospital', 'AppointmentRating')
+    DoctorRatingSummary = apps.get_model('hospital', 'DoctorRatingSummary')
+    prior_mean = float(getattr(settings, 'RATING_PRIOR_MEAN', 3.0))
+    prior_weight = float(getattr(settings, 'RATING_PRIOR_WEIGHT', 5))
+    rows = AppointmentRating.objects.filter(appointment__status='completed').values('appointment__staff_id').annotate(
+        rating_count=Count('pk'),
+        rating_sum=Sum('rating'),
+        **{f'stars_{stars}': Count('pk', filter=Q(rating=stars)) for stars in range(1, 6)}
+    ).order_by()
+    DoctorRatingSummary.objects.bulk_create([
+        DoctorRatingSummary(
+            doctor_id=row.pop('appointment__staff_id'),
+            score=(prior_weight * prior_mean + row['rating_sum']) / (prior_weight + row['rating_count']),
+            **row
+        )
+        for row in rows
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0022_appointment_day_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DoctorRatingSummary',
+            fields=[
+                ('doctor', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='rating_summary', serialize=False, to='hospital.staff')),
+                ('rating_count', models.PositiveIntegerField(default=0)),
+                ('rating_sum', models.PositiveIntegerField(default=0)),
+                ('stars_1', models.PositiveIntegerField(default=0)),
+                ('stars_2', models.PositiveIntegerField(default=0)),
+                ('stars_3', models.PositiveIntegerField(default=0)),
+                ('stars_4', models.PositiveIntegerField(default=0)),
+                ('stars_5', models.PositiveIntegerField(default=0)),
+                ('score', models.FloatField(default=0, help_text='Average rating smoothed towards RATING_PRIOR_MEAN, for ranking')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['-score'], name='doctor_rating_score_idx')],
+            },
+        ),
+        migrations.RunPython(build_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0023_doctor_rating_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='appointmentrating',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='labtest',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='patientvitals',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['updated_at'], name='appointment_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='appointmentrating',
+            index=models.Index(fields=['updated_at'], name='rating_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='labtest',
+            index=models.Index(fields=['updated_at'], name='labtest_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patientvitals',
+            index=models.Index(fields=['updated_at'], name='vitals_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0024_updated_at_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='no_show_risk',
+            field=models.FloatField(blank=True, help_text='Predicted probability the patient misses the appointment', null=True),
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='no_show_scored_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:54
+
+from django.db import migrations, models
+
+
+def backfill_analyte_keys(apps, schema_editor):
+    # Same normalization as analyte_history_service.analyte_key; there are few distinct names
+    AnalyteObservation = apps.get_model('hospital', 'AnalyteObservation')
+    for analyte in AnalyteObservation.objects.values_list('analyte', flat=True).distinct():
+        AnalyteObservation.objects.filter(analyte=analyte).update(analyte_key=analyte.strip().lower())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0025_appointment_no_show_risk'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='analyteobservation',
+            name='observation_series_idx',
+        ),
+        migrations.AddField(
+            model_name='analyteobservation',
+            name='analyte_key',
+            field=models.CharField(default='', help_text='Lower-cased analyte, for case-insensitive lookups on the series index', max_length=100),
+        ),
+        migrations.RunPython(backfill_analyte_keys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='analyteobservation',
+            index=models.Index(fields=['patient', 'test_type', 'analyte_key', 'observed_at'], name='observation_series_idx'),
+        ),
+    ]
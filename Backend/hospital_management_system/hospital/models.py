@@ -1,4 +1,6 @@
 from django.db import models
+import uuid
+from django.utils import timezone
 from transactions.models import Transaction, Unit
 from django.contrib.auth.hashers import make_password, check_password
 
@@ -144,6 +146,8 @@ class AppointmentCharge(models.Model):
     charge_unit = models.ForeignKey(Unit, on_delete=models.PROTECT, related_name='appointment_charges')
     charge_remark = models.TextField(blank=True, null=True)
     is_active = models.BooleanField(default=True)
+    effective_from = models.DateTimeField(default=timezone.now, help_text="Start of the period this price applies to")
+    effective_to = models.DateTimeField(null=True, blank=True, help_text="End of the period (exclusive); empty while the price is current")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -167,6 +171,19 @@ class Appointment(models.Model):
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='upcoming')
     reason = models.TextField(blank=True, null=True)  # Added to store appointment reason
     appointment_date = models.DateField(null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    # Written by the no-show scoring job (machine_learning.no_show_service) for upcoming appointments
+    no_show_risk = models.FloatField(null=True, blank=True, help_text="Predicted probability the patient misses the appointment")
+    no_show_scored_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Day-by-day scans of the analytics rollups
+            models.Index(fields=['appointment_date'], name='appointment_date_idx'),
+            models.Index(fields=['created_at'], name='appointment_created_idx'),
+            # Change-data export watermark
+            models.Index(fields=['updated_at'], name='appointment_updated_idx'),
+        ]
 
     def __str__(self):
         return f"Appointment for {self.patient.patient_name} with {self.staff.staff_name} at {self.created_at}"
@@ -186,6 +203,12 @@ class PatientVitals(models.Model):
     patient_spo2 = models.FloatField()
     patient_temperature = models.FloatField()
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['updated_at'], name='vitals_updated_idx'),
+        ]
 
     def __str__(self):
         return f"Vitals for {self.patient.patient_name} at {self.created_at}"
@@ -205,6 +228,8 @@ class Lab(models.Model):
     lab_name = models.CharField(max_length=255)
     lab_type = models.ForeignKey(LabType, on_delete=models.CASCADE, related_name='labs')
     functional = models.BooleanField(default=True)
+    capacity = models.PositiveIntegerField(default=4, help_text="Tests the lab can run in parallel in one scheduling bucket")
+    high_priority_reserve = models.PositiveIntegerField(default=1, help_text="Capacity per bucket held back for high-priority tests")
 
     def __str__(self):
         return self.lab_name
@@ -233,6 +258,7 @@ class LabTestType(models.Model):
     test_target_organ = models.ForeignKey(TargetOrgan, on_delete=models.CASCADE, related_name='test_types')
     image_required = models.BooleanField(default=False)  # Whether image is required for this test
     test_remark = models.TextField(blank=True, null=True)
+    expected_duration_minutes = models.PositiveIntegerField(default=15, help_text="Lab time reserved for one test of this type")
 
     def __str__(self):
         return self.test_name
@@ -299,6 +325,7 @@ class LabTest(models.Model):
     lab_test_id = models.AutoField(primary_key=True)
     lab = models.ForeignKey('Lab', on_delete=models.CASCADE, related_name='lab_tests')
     test_datetime = models.DateTimeField()
+    reserved_until = models.DateTimeField(null=True, blank=True, help_text="End of the lab time reserved for this test")
     test_result = models.JSONField(blank=True, null=True)
     test_type = models.ForeignKey('LabTestType', on_delete=models.CASCADE, related_name='lab_tests')
     appointment = models.ForeignKey('Appointment', on_delete=models.CASCADE, related_name='lab_tests')
@@ -314,11 +341,94 @@ class LabTest(models.Model):
         choices=Status.choices,
         default=Status.RECOMMENDED
     )
+    sla_deadline = models.DateTimeField(null=True, blank=True, help_text="Time by which results are due, set on payment")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['lab', 'status', 'test_datetime'], name='labtest_worklist_idx'),
+            models.Index(fields=['updated_at'], name='labtest_updated_idx'),
+        ]
 
     def __str__(self):
         return f"Lab Test {self.lab_test_id} ({self.test_type.test_name})"
 
 
+class ReferenceRange(models.Model):
+    class Sex(models.TextChoices):
+        ANY = 'any', 'Any'
+        MALE = 'male', 'Male'
+        FEMALE = 'female', 'Female'
+
+    reference_range_id = models.AutoField(primary_key=True)
+    test_type = models.ForeignKey(LabTestType, on_delete=models.CASCADE, related_name='reference_ranges')
+    analyte = models.CharField(max_length=100, help_text="Schema parameter name without sex qualifier, e.g. 'ESR'")
+    sex = models.CharField(max_length=10, choices=Sex.choices, default=Sex.ANY)
+    age_min_years = models.FloatField(null=True, blank=True, help_text="Inclusive; empty for no lower age bound")
+    age_max_years = models.FloatField(null=True, blank=True, help_text="Exclusive; empty for no upper age bound")
+    low = models.FloatField(null=True, blank=True)
+    high = models.FloatField(null=True, blank=True)
+    critical_low = models.FloatField(null=True, blank=True)
+    critical_high = models.FloatField(null=True, blank=True)
+    unit = models.CharField(max_length=50, blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['test_type', 'analyte'], name='refrange_analyte_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.analyte} ({self.sex}): {self.low}-{self.high} {self.unit or ''}".strip()
+
+
+class LabResultFlag(models.Model):
+    class Flag(models.TextChoices):
+        LOW = 'low', 'Low'
+        HIGH = 'high', 'High'
+        CRITICAL_LOW = 'critical_low', 'Critical Low'
+        CRITICAL_HIGH = 'critical_high', 'Critical High'
+
+    CRITICAL = [Flag.CRITICAL_LOW, Flag.CRITICAL_HIGH]
+
+    flag_id = models.BigAutoField(primary_key=True)
+    lab_test = models.ForeignKey(LabTest, on_delete=models.CASCADE, related_name='flags')
+    analyte = models.CharField(max_length=100)
+    value = models.FloatField()
+    flag = models.CharField(max_length=15, choices=Flag.choices)
+    reference_range = models.ForeignKey(ReferenceRange, on_delete=models.SET_NULL, null=True, blank=True, related_name='flags')
+    observed_at = models.DateTimeField(help_text="Copied from the lab test's test_datetime")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['flag', 'observed_at'], name='labflag_flag_observed_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.analyte} {self.flag} ({self.value}) on Lab Test {self.lab_test_id}"
+
+
+class AnalyteObservation(models.Model):
+    observation_id = models.BigAutoField(primary_key=True)
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='analyte_observations')
+    test_type = models.ForeignKey(LabTestType, on_delete=models.CASCADE, related_name='analyte_observations')
+    lab_test = models.ForeignKey(LabTest, on_delete=models.CASCADE, related_name='observations')
+    analyte = models.CharField(max_length=100)
+    analyte_key = models.CharField(max_length=100, default='', help_text="Lower-cased analyte, for case-insensitive lookups on the series index")
+    value = models.FloatField(null=True, blank=True, help_text="Numeric result; empty for text results")
+    value_text = models.CharField(max_length=255, null=True, blank=True)
+    unit = models.CharField(max_length=50, null=True, blank=True)
+    observed_at = models.DateTimeField(help_text="Copied from the lab test's test_datetime")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['patient', 'test_type', 'analyte_key', 'observed_at'], name='observation_series_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.analyte} = {self.value if self.value is not None else self.value_text} for Patient {self.patient_id}"
+
+
 class FollowUp(models.Model):
     follow_up_id = models.AutoField(primary_key=True)
     appointment = models.ForeignKey(Appointment, on_delete=models.CASCADE, related_name='follow_ups')
@@ -384,6 +494,8 @@ class LabTestCharge(models.Model):
     charge_unit = models.ForeignKey(Unit, on_delete=models.PROTECT, related_name='lab_test_charges')
     charge_remark = models.TextField(blank=True, null=True)
     is_active = models.BooleanField(default=True)
+    effective_from = models.DateTimeField(default=timezone.now, help_text="Start of the period this price applies to")
+    effective_to = models.DateTimeField(null=True, blank=True, help_text="End of the period (exclusive); empty while the price is current")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -395,11 +507,50 @@ class AppointmentRating(models.Model):
     appointment = models.ForeignKey(Appointment, on_delete=models.CASCADE, related_name='ratings')
     rating = models.IntegerField()
     rating_comment = models.TextField(blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['updated_at'], name='rating_updated_idx'),
+        ]
 
     def __str__(self):
         return f"Rating for Appointment {self.appointment_id}: {self.rating}"
 
 
+class DoctorRatingSummary(models.Model):
+    """
+    Running totals of the ratings of a doctor's completed appointments,
+    kept up to date on every rating write (see rating_summary_service)
+    """
+    doctor = models.OneToOneField(Staff, on_delete=models.CASCADE, primary_key=True, related_name='rating_summary')
+    rating_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.PositiveIntegerField(default=0)
+    stars_1 = models.PositiveIntegerField(default=0)
+    stars_2 = models.PositiveIntegerField(default=0)
+    stars_3 = models.PositiveIntegerField(default=0)
+    stars_4 = models.PositiveIntegerField(default=0)
+    stars_5 = models.PositiveIntegerField(default=0)
+    score = models.FloatField(default=0, help_text="Average rating smoothed towards RATING_PRIOR_MEAN, for ranking")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-score'], name='doctor_rating_score_idx'),
+        ]
+
+    @property
+    def average_rating(self):
+        return self.rating_sum / self.rating_count if self.rating_count else 0
+
+    @property
+    def rating_distribution(self):
+        return {str(stars): getattr(self, f'stars_{stars}') for stars in range(5, 0, -1)}
+
+    def __str__(self):
+        return f"Ratings of {self.doctor_id}: {self.rating_count}"
+
+
 # New models for OCR processing of patient reports
 class PatientHistory(models.Model):
     history_id = models.AutoField(primary_key=True)
@@ -441,4 +592,40 @@ class PatientHistoryDocs(models.Model):
     class Meta:
         verbose_name = "Patient History Document"
         verbose_name_plural = "Patient History Documents"
-        ordering = ['-created_at']
\ No newline at end of file
+        ordering = ['-created_at']
+
+class UploadSession(models.Model):
+    class Target(models.TextChoices):
+        LAB_TEST_IMAGE = 'lab_test_image', 'Lab Test Image'
+        PATIENT_DOCUMENT = 'patient_document', 'Patient Document'
+
+    class Status(models.TextChoices):
+        PENDING = 'pending', 'Pending'
+        COMPLETED = 'completed', 'Completed'
+        ABORTED = 'aborted', 'Aborted'
+
+    upload_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    target = models.CharField(max_length=20, choices=Target.choices)
+    lab_test = models.ForeignKey(LabTest, on_delete=models.CASCADE, null=True, blank=True, related_name='upload_sessions')
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, null=True, blank=True, related_name='upload_sessions')
+    document_type = models.CharField(max_length=20, choices=PatientHistoryDocs.DOCUMENT_TYPE_CHOICES, blank=True, null=True)
+    owner_id = models.CharField(max_length=50, help_text="patient_id or staff_id of the uploader")
+    file_name = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100, blank=True, null=True)
+    total_size = models.BigIntegerField()
+    checksum = models.CharField(max_length=64, blank=True, null=True, help_text="Optional SHA-256 of the whole file, checked on finalize")
+    received_bytes = models.BigIntegerField(default=0)
+    parts = models.JSONField(default=list, help_text="Stored chunks in order: [{offset, size, sha256, path}]")
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.PENDING)
+    stored_path = models.CharField(max_length=500, blank=True, null=True)
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Upload {self.upload_id} ({self.file_name}): {self.received_bytes}/{self.total_size} bytes"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'expires_at'], name='upload_session_expiry_idx'),
+        ]
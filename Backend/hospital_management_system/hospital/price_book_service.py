@@ -0,0 +1,212 @@
+"""
+Effective-dated price book for appointment and lab test charges
+"""
+import logging
+import threading
+import time
+from bisect import bisect_right
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import AppointmentCharge, LabTestCharge
+
+logger = logging.getLogger(__name__)
+
+
+class _Versions:
+    """All versions of one price (one lab test type or one doctor), ordered by effective_from"""
+
+    __slots__ = ('starts', 'charges')
+
+    def __init__(self):
+        self.starts: List[datetime] = []
+        self.charges: list = []
+
+    def at(self, moment: datetime):
+        # Latest version that started at or before `moment` and had not ended by then
+        index = bisect_right(self.starts, moment) - 1
+        while index >= 0:
+            charge = self.charges[index]
+            if charge.effective_to is None or moment < charge.effective_to:
+                return charge
+            index -= 1
+        return None
+
+
+class PriceBook:
+    """
+    In-process cache of every charge version, for point-in-time price lookups.
+
+    Each charge row is valid over [effective_from, effective_to); an open
+    effective_to means the price is still current. The whole charge table of a
+    kind is loaded in one query (joined with its unit and test or doctor) the
+    first time it is needed, so lookups afterwards never touch the database.
+    The cache is dropped when a charge is saved or deleted in this process,
+    and reloaded every PRICE_BOOK_REFRESH_SECONDS to pick up changes made by
+    other workers.
+    """
+
+    LAB_TEST = 'lab_test'
+    APPOINTMENT = 'appointment'
+
+    _sources = {
+        LAB_TEST: (LabTestCharge, 'test'),
+        APPOINTMENT: (AppointmentCharge, 'doctor'),
+    }
+
+    def __init__(self):
+        self.refresh_seconds = getattr(settings, 'PRICE_BOOK_REFRESH_SECONDS', 60)
+        self._books: Dict[str, Dict[object, _Versions]] = {}
+        self._loaded_at: Dict[str, float] = {}
+        self._lock = threading.RLock()
+
+    # ------------------------------------------------------------------
+    # Loading and invalidation
+    # ------------------------------------------------------------------
+
+    def _load(self, kind: str) -> Dict[object, _Versions]:
+        model, relation = self._sources[kind]
+        key_field = f'{relation}_id'
+        book: Dict[object, _Versions] = {}
+        rows = model.objects.select_related('charge_unit', relation).order_by(key_field, 'effective_from', 'pk')
+        for charge in rows:
+            versions = book.setdefault(getattr(charge, key_field), _Versions())
+            versions.starts.append(charge.effective_from)
+            versions.charges.append(charge)
+        logger.info(f"Loaded {kind} price book with {len(book)} priced items")
+        return book
+
+    def _is_stale(self, kind: str) -> bool:
+        loaded_at = self._loaded_at.get(kind)
+        return loaded_at is None or time.monotonic() - loaded_at >= self.refresh_seconds
+
+    def _book(self, kind: str) -> Dict[object, _Versions]:
+        # Hold on to the dict itself: a concurrent invalidate() may drop it from _books at any time
+        book = self._books.get(kind)
+        if book is None or self._is_stale(kind):
+            with self._lock:
+                book = self._books.get(kind)
+                if book is None or self._is_stale(kind):
+                    book = self._load(kind)
+                    self._books[kind] = book
+                    self._loaded_at[kind] = time.monotonic()
+        return book
+
+    def invalidate(self, kind: str = None):
+        """Drop cached prices of one kind (or all); they reload on the next lookup"""
+        with self._lock:
+            for name in ([kind] if kind else list(self._sources)):
+                self._loaded_at.pop(name, None)
+                self._books.pop(name, None)
+
+    def invalidate_on_commit(self, kind: str = None):
+        # Drop now so this transaction sees its own writes, and again once they
+        # are visible to everyone else
+        self.invalidate(kind)
+        transaction.on_commit(lambda: self.invalidate(kind))
+
+    # ------------------------------------------------------------------
+    # Lookups
+    # ------------------------------------------------------------------
+
+    def _lookup(self, kind: str, key, at: datetime = None):
+        versions = self._book(kind).get(key)
+        return versions.at(at or timezone.now()) if versions else None
+
+    def _lookup_many(self, kind: str, keys: Iterable, at: datetime = None) -> dict:
+        book = self._book(kind)
+        at = at or timezone.now()
+        charges = {}
+        for key in set(keys):
+            versions = book.get(key)
+            charge = versions.at(at) if versions else None
+            if charge is not None:
+                charges[key] = charge
+        return charges
+
+    def _current(self, kind: str) -> list:
+        now = timezone.now()
+        charges = (versions.at(now) for versions in self._book(kind).values())
+        return [charge for charge in charges if charge is not None]
+
+    def lab_test_charge(self, test_type_id: int, at: datetime = None) -> Optional[LabTestCharge]:
+        """
+        Charge for a lab test type at a point in time
+
+        Args:
+            test_type_id: LabTestType id
+            at: Moment to price at (defaults to now)
+
+        Returns:
+            The LabTestCharge in effect, or None if the test was not priced then
+        """
+        return self._lookup(self.LAB_TEST, test_type_id, at)
+
+    def lab_test_charges(self, test_type_ids: Iterable[int], at: datetime = None) -> Dict[int, LabTestCharge]:
+        """Charges in effect at `at` keyed by test type id; unpriced types are left out"""
+        return self._lookup_many(self.LAB_TEST, test_type_ids, at)
+
+    def appointment_charge(self, doctor_id: str, at: datetime = None) -> Optional[AppointmentCharge]:
+        """
+        Consultation charge for a doctor at a point in time
+
+        Args:
+            doctor_id: Staff id of the doctor
+            at: Moment to price at (defaults to now)
+
+        Returns:
+            The AppointmentCharge in effect, or None if the doctor had no charge then
+        """
+        return self._lookup(self.APPOINTMENT, doctor_id, at)
+
+    def appointment_charges(self, doctor_ids: Iterable[str], at: datetime = None) -> Dict[str, AppointmentCharge]:
+        """Charges in effect at `at` keyed by doctor id; doctors without one are left out"""
+        return self._lookup_many(self.APPOINTMENT, doctor_ids, at)
+
+    def current_lab_test_charges(self) -> List[LabTestCharge]:
+        return self._current(self.LAB_TEST)
+
+    def charges_for_lab_tests(self, lab_tests: Iterable) -> dict:
+        """
+        Price a batch of lab tests, each at the time it was paid (or now if unpaid).
+        Expects `tran` to be selected with the tests.
+
+        Returns:
+            Dict of lab_test_id -> LabTestCharge, without tests that have no price
+        """
+        book = self._book(self.LAB_TEST)
+        now = timezone.now()
+        charges = {}
+        for lab_test in lab_tests:
+            versions = book.get(lab_test.test_type_id)
+            if versions is None:
+                continue
+            at = lab_test.tran.transaction_datetime if lab_test.tran_id else now
+            charge = versions.at(at)
+            if charge is not None:
+                charges[lab_test.lab_test_id] = charge
+        return charges
+
+    # ------------------------------------------------------------------
+    # Writes
+    # ------------------------------------------------------------------
+
+    def retire(self, charges, at: datetime = None) -> int:
+        """
+        End the currently active charges in `charges` (a queryset) at `at`.
+        Use instead of a bare update(is_active=False) so the history stays
+        effective-dated and the cache is dropped.
+        """
+        model = charges.model
+        retired = charges.filter(is_active=True).update(
+            is_active=False, effective_to=at or timezone.now()
+        )
+        self.invalidate_on_commit(self.LAB_TEST if model is LabTestCharge else self.APPOINTMENT)
+        return retired
+
+
+price_book = PriceBook()
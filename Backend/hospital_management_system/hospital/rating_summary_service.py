@@ -0,0 +1,158 @@
+"""
+Per-doctor rating summaries: counts, sums and star histograms kept in step with AppointmentRating
+"""
+import logging
+from collections import defaultdict
+from typing import Dict, Iterable, Optional, Tuple
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, FloatField, Q, Sum, Value
+from django.db.models.functions import Cast
+from django.utils import timezone
+
+from .models import AppointmentRating, DoctorRatingSummary
+
+logger = logging.getLogger(__name__)
+
+# Ratings count towards their doctor's summary only while the appointment is completed,
+# like the ratings DoctorRatingsView lists
+COUNTED_STATUS = 'completed'
+STARS = range(1, 6)
+
+# (doctor_id, rating) of a counted rating
+RatingState = Tuple[str, int]
+
+
+def rating_state(doctor_id: Optional[str], appointment_status: Optional[str], rating: Optional[int]) -> Optional[RatingState]:
+    if doctor_id is None or appointment_status != COUNTED_STATUS or rating is None:
+        return None
+    return doctor_id, int(rating)
+
+
+class RatingSummaryService:
+    """
+    Keeps DoctorRatingSummary in step with ratings.
+
+    A rating's create, update or delete arrives through signals and is
+    applied as F() increments of the doctor's row in a single UPDATE that
+    also recomputes the smoothed score, so concurrent ratings of the same
+    doctor never overwrite each other. The score is a Bayesian average: the
+    doctor's ratings plus RATING_PRIOR_WEIGHT imaginary ratings of
+    RATING_PRIOR_MEAN, so a doctor with two 5-star ratings does not outrank
+    one with two hundred 4.8s. Changes that move ratings between doctors
+    (an appointment's doctor or status changing) recompute the affected
+    rows from scratch with refresh().
+    """
+
+    def __init__(self):
+        self.prior_mean = float(getattr(settings, 'RATING_PRIOR_MEAN', 3.0))
+        self.prior_weight = float(getattr(settings, 'RATING_PRIOR_WEIGHT', 5))
+
+    def score(self, rating_count: int, rating_sum: int) -> float:
+        return (self.prior_weight * self.prior_mean + rating_sum) / (self.prior_weight + rating_count)
+
+    # ------------------------------------------------------------------
+    # Incremental updates
+    # ------------------------------------------------------------------
+
+    def rating_changed(self, before: Optional[RatingState], after: Optional[RatingState]):
+        """
+        Apply a rating's change to the summaries
+
+        Args:
+            before: State before the change, None if it did not count (new rating)
+            after: State after the change, None if it no longer counts (deleted rating)
+        """
+        deltas = defaultdict(lambda: defaultdict(int))
+        for state, sign in ((before, -1), (after, 1)):
+            if state is None:
+                continue
+            doctor_id, rating = state
+            deltas[doctor_id]['rating_count'] += sign
+            deltas[doctor_id]['rating_sum'] += sign * rating
+            if rating in STARS:
+                deltas[doctor_id][f'stars_{rating}'] += sign
+        for doctor_id, columns in deltas.items():
+            self.apply(doctor_id, columns)
+
+    def apply(self, doctor_id: str, deltas: Dict[str, int]):
+        deltas = {column: delta for column, delta in deltas.items() if delta}
+        if not deltas:
+            return
+        updates = {column: F(column) + delta for column, delta in deltas.items()}
+        # Every SET expression sees the old row, so the score is computed from the new totals explicitly
+        updates['score'] = (
+            Value(self.prior_weight * self.prior_mean) + Cast(updates.get('rating_sum', F('rating_sum')), FloatField())
+        ) / (
+            Value(self.prior_weight) + Cast(updates.get('rating_count', F('rating_count')), FloatField())
+        )
+        updates['updated_at'] = timezone.now()
+
+        summaries = DoctorRatingSummary.objects.filter(doctor_id=doctor_id)
+        if summaries.update(**updates):
+            return
+        try:
+            with transaction.atomic():
+                DoctorRatingSummary.objects.create(
+                    doctor_id=doctor_id,
+                    score=self.score(deltas.get('rating_count', 0), deltas.get('rating_sum', 0)),
+                    **deltas
+                )
+        except IntegrityError:
+            # Created concurrently: add to that row instead
+            summaries.update(**updates)
+
+    # ------------------------------------------------------------------
+    # Recompute
+    # ------------------------------------------------------------------
+
+    def refresh(self, doctor_ids: Optional[Iterable[str]] = None) -> int:
+        """
+        Recompute summaries from the ratings with one grouped aggregate
+
+        Args:
+            doctor_ids: Only these doctors; all of them if None
+
+        Returns:
+            Number of summaries written
+        """
+        ratings = AppointmentRating.objects.filter(appointment__status=COUNTED_STATUS)
+        summaries = DoctorRatingSummary.objects.all()
+        if doctor_ids is not None:
+            doctor_ids = list(set(doctor_ids) - {None})
+            ratings = ratings.filter(appointment__staff_id__in=doctor_ids)
+            summaries = summaries.filter(doctor_id__in=doctor_ids)
+
+        rows = ratings.values('appointment__staff_id').annotate(
+            rating_count=Count('pk'),
+            rating_sum=Sum('rating'),
+            **{f'stars_{stars}': Count('pk', filter=Q(rating=stars)) for stars in STARS}
+        ).order_by()
+
+        with transaction.atomic():
+            summaries.delete()
+            created = DoctorRatingSummary.objects.bulk_create([
+                DoctorRatingSummary(
+                    doctor_id=row.pop('appointment__staff_id'),
+                    score=self.score(row['rating_count'], row['rating_sum']),
+                    **row
+                )
+                for row in rows
+            ], batch_size=1000)
+        logger.info(f"Rebuilt {len(created)} doctor rating summaries")
+        return len(created)
+
+    # ------------------------------------------------------------------
+    # Reads
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def top_doctors(limit: int = 5, min_ratings: int = 5):
+        """Best doctors by smoothed score: an index scan over the summaries"""
+        return DoctorRatingSummary.objects.filter(
+            rating_count__gte=min_ratings
+        ).select_related('doctor').order_by('-score')[:limit]
+
+
+rating_summaries = RatingSummaryService()
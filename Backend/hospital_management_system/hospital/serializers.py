@@ -4,6 +4,7 @@ from .models import (Lab, LabType, LabTestType, LabTestCategory,
                      TargetOrgan, AppointmentRating, AppointmentCharge, 
                      LabTest, LabTestCharge, Appointment, PatientHistory, 
                      PatientHistoryDocs)
+from .price_book_service import price_book
 
 class LabTypeSerializer(serializers.ModelSerializer):
     class Meta:
@@ -15,7 +16,7 @@ class LabSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Lab
-        fields = ['lab_id', 'lab_name', 'lab_type', 'lab_type_name', 'functional']
+        fields = ['lab_id', 'lab_name', 'lab_type', 'lab_type_name', 'functional', 'capacity', 'high_priority_reserve']
 
 class LabTestCategorySerializer(serializers.ModelSerializer):
     class Meta:
@@ -36,7 +37,7 @@ class LabTestTypeSerializer(serializers.ModelSerializer):
         fields = [
             'test_type_id', 'test_name', 'test_schema', 
             'test_category', 'test_target_organ', 
-            'image_required', 'test_remark'
+            'image_required', 'test_remark', 'expected_duration_minutes'
         ]
 
 class AppointmentRatingSerializer(serializers.ModelSerializer):
@@ -69,7 +70,7 @@ class LabTestSerializer(serializers.ModelSerializer):
     class Meta:
         model = LabTest
         fields = [
-            'lab_test_id', 'lab', 'lab_name', 'test_datetime', 
+            'lab_test_id', 'lab', 'lab_name', 'test_datetime', 'reserved_until',
             'test_result', 'test_type', 'test_type_name', 
             'appointment', 'priority', 'status',
             'patient_name', 'doctor_name'
@@ -83,7 +84,7 @@ class AppointmentChargeSerializer(serializers.ModelSerializer):
         model = AppointmentCharge
         fields = ['appointment_charge_id', 'doctor', 'doctor_name', 'charge_amount', 
                   'charge_unit', 'charge_unit_symbol', 'charge_remark', 'is_active', 
-                  'created_at', 'updated_at']
+                  'effective_from', 'effective_to', 'created_at', 'updated_at']
         read_only_fields = ['appointment_charge_id', 'created_at', 'updated_at']
 
 class LabTestChargeSerializer(serializers.ModelSerializer):
@@ -92,7 +93,7 @@ class LabTestChargeSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = LabTestCharge
-        fields = ['test_charge_id', 'test', 'test_name', 'charge_amount', 'charge_unit', 'charge_unit_symbol', 'charge_remark', 'is_active', 'created_at', 'updated_at']
+        fields = ['test_charge_id', 'test', 'test_name', 'charge_amount', 'charge_unit', 'charge_unit_symbol', 'charge_remark', 'is_active', 'effective_from', 'effective_to', 'created_at', 'updated_at']
         read_only_fields = ['test_charge_id', 'created_at', 'updated_at']
 
 # class RecommendedLabTestSerializer(serializers.ModelSerializer):
@@ -126,19 +127,21 @@ class RecommendedLabTestSerializer(serializers.ModelSerializer):
             'charge_unit_symbol'
         ]
     
+    def _charge(self, obj):
+        # Views pass prices resolved in bulk as context['lab_test_charges']
+        charges = self.context.get('lab_test_charges')
+        if charges is not None:
+            return charges.get(obj.lab_test_id)
+        at = obj.tran.transaction_datetime if obj.tran_id else None
+        return price_book.lab_test_charge(obj.test_type_id, at)
+
     def get_charge_amount(self, obj):
-        try:
-            charge = LabTestCharge.objects.get(test=obj.test_type, is_active=True)
-            return str(charge.charge_amount)
-        except LabTestCharge.DoesNotExist:
-            return None
+        charge = self._charge(obj)
+        return str(charge.charge_amount) if charge else None
     
     def get_charge_unit_symbol(self, obj):
-        try:
-            charge = LabTestCharge.objects.get(test=obj.test_type, is_active=True)
-            return charge.charge_unit.unit_symbol
-        except LabTestCharge.DoesNotExist:
-            return None
+        charge = self._charge(obj)
+        return charge.charge_unit.unit_symbol if charge else None
 
 class AssignedPatientSerializer(serializers.ModelSerializer):
     patient_name = serializers.CharField(source='patient.patient_name', read_only=True)
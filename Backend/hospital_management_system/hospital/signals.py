@@ -0,0 +1,97 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .lab_flagging_service import reference_ranges
+from .models import Appointment, AppointmentCharge, AppointmentRating, LabTest, LabTestCharge, ReferenceRange
+from .price_book_service import price_book
+from .rating_summary_service import rating_state, rating_summaries
+from .tile_service import tile_service
+
+
+@receiver(pre_save, sender=LabTestCharge)
+@receiver(pre_save, sender=AppointmentCharge)
+def sync_charge_effective_dates(sender, instance, **kwargs):
+    # is_active is still what admins toggle; keep the effective period in step with it
+    if not instance.is_active and instance.effective_to is None:
+        instance.effective_to = timezone.now()
+    elif instance.is_active and instance.effective_to is not None and instance.effective_to <= timezone.now():
+        instance.effective_to = None
+
+
+@receiver(post_save, sender=LabTestCharge)
+@receiver(post_delete, sender=LabTestCharge)
+def invalidate_lab_test_prices(sender, instance, **kwargs):
+    price_book.invalidate_on_commit(price_book.LAB_TEST)
+
+
+@receiver(post_save, sender=AppointmentCharge)
+@receiver(post_delete, sender=AppointmentCharge)
+def invalidate_appointment_prices(sender, instance, **kwargs):
+    price_book.invalidate_on_commit(price_book.APPOINTMENT)
+
+
+@receiver(post_save, sender=ReferenceRange)
+@receiver(post_delete, sender=ReferenceRange)
+def invalidate_reference_ranges(sender, instance, **kwargs):
+    reference_ranges.invalidate()
+
+
+@receiver(pre_save, sender=LabTest)
+def remember_test_image(sender, instance, update_fields=None, **kwargs):
+    if instance.pk and (update_fields is None or 'test_image' in update_fields):
+        instance._previous_test_image = LabTest.objects.filter(pk=instance.pk).values_list('test_image', flat=True).first()
+
+
+@receiver(post_save, sender=LabTest)
+def build_test_image_tiles(sender, instance, created, update_fields=None, **kwargs):
+    # Tile a newly attached image in the background; other saves leave the pyramid alone
+    if update_fields is not None and 'test_image' not in update_fields:
+        return
+    if instance.test_image and (created or instance.test_image.name != getattr(instance, '_previous_test_image', None)):
+        tile_service.schedule(instance.lab_test_id, instance.test_image.name)
+
+
+@receiver(pre_save, sender=AppointmentRating)
+def remember_rating_state(sender, instance, **kwargs):
+    # The summary needs what the rating counted for before this save
+    if instance.pk:
+        previous = AppointmentRating.objects.filter(pk=instance.pk).values_list(
+            'appointment__staff_id', 'appointment__status', 'rating'
+        ).first()
+        instance._previous_rating_state = rating_state(*previous) if previous else None
+
+
+@receiver(post_save, sender=AppointmentRating)
+def update_rating_summary(sender, instance, created, **kwargs):
+    before = None if created else getattr(instance, '_previous_rating_state', None)
+    doctor_id, status = Appointment.objects.filter(pk=instance.appointment_id).values_list(
+        'staff_id', 'status'
+    ).first() or (None, None)
+    rating_summaries.rating_changed(before, rating_state(doctor_id, status, instance.rating))
+
+
+@receiver(post_delete, sender=AppointmentRating)
+def remove_rating_from_summary(sender, instance, **kwargs):
+    # Ratings are deleted before their appointment in a cascade, so it can still be looked up
+    previous = Appointment.objects.filter(pk=instance.appointment_id).values_list('staff_id', 'status').first()
+    if previous:
+        rating_summaries.rating_changed(rating_state(*previous, instance.rating), None)
+
+
+@receiver(pre_save, sender=Appointment)
+def remember_appointment_doctor(sender, instance, **kwargs):
+    if instance.pk:
+        instance._previous_rating_owner = Appointment.objects.filter(pk=instance.pk).values_list(
+            'staff_id', 'status'
+        ).first()
+
+
+@receiver(post_save, sender=Appointment)
+def move_appointment_ratings(sender, instance, created, **kwargs):
+    # A new doctor or a status change moves the appointment's ratings in or out of a summary
+    previous = getattr(instance, '_previous_rating_owner', None)
+    if created or previous is None or previous == (instance.staff_id, instance.status):
+        return
+    if AppointmentRating.objects.filter(appointment_id=instance.pk).exists():
+        rating_summaries.refresh({previous[0], instance.staff_id})
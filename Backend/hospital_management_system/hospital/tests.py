@@ -1,3 +1,638 @@
-from django.test import TestCase
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
+
+from transactions.models import PaymentMethod, Transaction, TransactionType, Unit
+from .analyte_history_service import analyte_series, record_observations
+from .lab_flagging_service import evaluate
+from .lab_results_service import CompiledSchema, import_results, parse_result_rows, schema_registry
+from .lab_scheduling_service import LabCapacityError, LabScheduler
+from .models import (
+    Appointment, AppointmentRating, DoctorRatingSummary, Lab, LabResultFlag, LabTechnicianDetails, LabTest, LabTestCategory, LabTestCharge, LabTestType, LabType,
+    Patient, PatientDetails, ReferenceRange, Role, Shift, Slot, Staff, TargetOrgan
+)
+from .price_book_service import PriceBook
+from .rating_summary_service import rating_summaries
+from .tile_service import tile_service
+
+
+def _appointment(patient=None, staff=None):
+    patient = patient or Patient.objects.create(patient_name='Test Patient', patient_email='patient@example.com', patient_mobile='9999999999')
+    if staff is None:
+        role, _ = Role.objects.get_or_create(role_name='doctor', defaults={'role_permissions': {}})
+        staff = Staff.objects.create(
+            staff_id=f'DOC{Staff.objects.count() + 1:03d}', staff_name='Test Doctor', role=role,
+            created_at=date(2025, 1, 1), staff_email='doctor@example.com', staff_mobile='8888888888'
+        )
+    shift = Shift.objects.create(shift_name='Morning', start_time=time(9), end_time=time(13))
+    slot = Slot.objects.create(slot_start_time=time(9), slot_duration=15, shift=shift)
+    return Appointment.objects.create(patient=patient, staff=staff, slot=slot, appointment_date=date(2025, 1, 6))
+
+
+def _payment(patient, unit, amount, **kwargs):
+    transaction_type, _ = TransactionType.objects.get_or_create(transaction_type_name='payment')
+    payment_method, _ = PaymentMethod.objects.get_or_create(payment_method_name='UPI')
+    return Transaction.objects.create(
+        transaction_type=transaction_type,
+        payment_method=payment_method,
+        transaction_amount=amount,
+        transaction_unit=unit,
+        transaction_status=kwargs.pop('transaction_status', 'completed'),
+        patient=patient,
+        **kwargs
+    )
+
+
+def _paid_lab_test(lab, test_type, appointment, **kwargs):
+    unit, _ = Unit.objects.get_or_create(unit_name='INR', defaults={'unit_symbol': '₹'})
+    return LabTest.objects.create(
+        lab=lab, test_type=test_type, appointment=appointment, status=LabTest.Status.PAID,
+        tran=_payment(appointment.patient, unit, Decimal('500.00')),
+        test_datetime=kwargs.pop('test_datetime', timezone.now()), **kwargs
+    )
+
+
+def _lab_technician(assigned_lab):
+    role, _ = Role.objects.get_or_create(role_name='lab_technician', defaults={'role_permissions': {}})
+    staff = Staff.objects.create(
+        staff_id=f'LAB{Staff.objects.count() + 1:03d}', staff_name='Test Technician', role=role,
+        created_at=date(2025, 1, 1), staff_email='lab@example.com', staff_mobile='7777777777'
+    )
+    LabTechnicianDetails.objects.create(staff=staff, certification='MLT', lab_experience_years=3, assigned_lab=assigned_lab)
+    return staff
+
+
+def _lab_fixtures(capacity=2, high_priority_reserve=1, duration_minutes=60, test_schema=None):
+    lab_type = LabType.objects.create(lab_type_name='Pathology', supported_tests=[])
+    lab = Lab.objects.create(lab_name='Lab A', lab_type=lab_type, capacity=capacity, high_priority_reserve=high_priority_reserve)
+    test_type = LabTestType.objects.create(
+        test_name='CBC',
+        test_schema=test_schema,
+        test_category=LabTestCategory.objects.create(test_category_name='Hematology'),
+        test_target_organ=TargetOrgan.objects.create(target_organ_name='Blood'),
+        expected_duration_minutes=duration_minutes
+    )
+    return lab, test_type
+
+
+class LabSchedulerTests(TestCase):
+    def setUp(self):
+        # One routine test per bucket, searched one hour ahead: a second hour-long test cannot fit
+        self.lab, self.test_type = _lab_fixtures(capacity=2, high_priority_reserve=1, duration_minutes=60)
+        self.appointment = _appointment()
+        self.scheduler = LabScheduler(bucket_minutes=15, search_hours=1)
+        self.start = timezone.make_aware(datetime(2030, 1, 7, 9, 0))
+
+    def _occupancy(self):
+        first, stop = self.scheduler._span(self.start, self.start + timedelta(hours=2))
+        return self.scheduler._counts(self.lab.lab_id, first, stop)
+
+    def _schedule(self, held=()):
+        return self.scheduler.schedule(
+            [self.lab], self.test_type, self.start, held=held, appointment=self.appointment
+        )
+
+    def test_committed_reservation_is_counted(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            lab_test = self._schedule()
+        self.assertEqual(lab_test.reserved_until, self.start + timedelta(hours=1))
+        self.assertEqual(self._occupancy(), [1] * 4 + [0] * 4)
+
+    def test_capacity_error_rolls_back_earlier_reservations(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with transaction.atomic():
+                reserved = [self._schedule()]
+                # Memory does not see the first test yet; `held` keeps it from being double-booked
+                self.assertEqual(self._occupancy(), [0] * 8)
+                with self.assertRaises(LabCapacityError):
+                    self._schedule(held=reserved)
+                transaction.set_rollback(True)
+
+        self.assertEqual(callbacks, [])
+        self.assertFalse(LabTest.objects.exists())
+        self.assertEqual(self._occupancy(), [0] * 8)
+        # The freed time can be booked again
+        with self.captureOnCommitCallbacks(execute=True):
+            self._schedule()
+        self.assertEqual(LabTest.objects.count(), 1)
+
+
+class PriceBookTests(TestCase):
+    def setUp(self):
+        _, self.test_type = _lab_fixtures()
+        self.unit = Unit.objects.create(unit_name='INR', unit_symbol='₹')
+        self.changed_at = timezone.make_aware(datetime(2025, 3, 1))
+        LabTestCharge.objects.create(
+            test=self.test_type, charge_amount=Decimal('500.00'), charge_unit=self.unit, is_active=False,
+            effective_from=timezone.make_aware(datetime(2025, 1, 1)), effective_to=self.changed_at
+        )
+        LabTestCharge.objects.create(
+            test=self.test_type, charge_amount=Decimal('650.00'), charge_unit=self.unit, effective_from=self.changed_at
+        )
+        self.book = PriceBook()
+
+    def test_point_in_time_lookups(self):
+        charge_at = lambda moment: self.book.lab_test_charge(self.test_type.test_type_id, moment)
+        self.assertIsNone(charge_at(timezone.make_aware(datetime(2024, 12, 31))))
+        self.assertEqual(charge_at(self.changed_at - timedelta(seconds=1)).charge_amount, Decimal('500.00'))
+        self.assertEqual(charge_at(self.changed_at).charge_amount, Decimal('650.00'))
+        self.assertEqual(self.book.lab_test_charge(self.test_type.test_type_id).charge_amount, Decimal('650.00'))
+
+    def test_lookups_need_no_queries_until_invalidated(self):
+        self.book.lab_test_charges([self.test_type.test_type_id])
+        with self.assertNumQueries(0):
+            self.book.lab_test_charge(self.test_type.test_type_id)
+
+        retired_at = timezone.now()
+        self.book.retire(LabTestCharge.objects.filter(test=self.test_type), at=retired_at)
+        self.assertIsNone(self.book.lab_test_charge(self.test_type.test_type_id))
+        self.assertEqual(
+            self.book.lab_test_charge(self.test_type.test_type_id, retired_at - timedelta(seconds=1)).charge_amount,
+            Decimal('650.00')
+        )
+
+    def test_invalidate_right_after_reload_does_not_lose_the_book(self):
+        class InvalidatedAtOnce(dict):
+            # Another thread's invalidate() lands as soon as the reloaded book is stored
+            def __setitem__(self, kind, book):
+                super().__setitem__(kind, book)
+                self.pop(kind)
+
+        self.book._books = InvalidatedAtOnce()
+        self.assertEqual(self.book.lab_test_charge(self.test_type.test_type_id).charge_amount, Decimal('650.00'))
+
+class LabTechnicianWorklistTests(TestCase):
+    def setUp(self):
+        self.lab, self.test_type = _lab_fixtures()
+        self.appointment = _appointment()
+        self.client = APIClient()
+        self.client.force_authenticate(user=_lab_technician(self.lab.lab_name))
+        self.url = reverse('lab-tech-worklist')
+
+    def _paid_test(self, lab, priority=LabTest.Priority.MEDIUM):
+        return LabTest.objects.create(
+            lab=lab, test_type=self.test_type, appointment=self.appointment, priority=priority,
+            test_datetime=timezone.now(), status=LabTest.Status.PAID
+        )
+
+    def test_labs_sharing_the_assigned_name_are_all_listed(self):
+        twin = Lab.objects.create(lab_name=self.lab.lab_name, lab_type=self.lab.lab_type)
+        routine = self._paid_test(self.lab)
+        urgent = self._paid_test(twin, priority=LabTest.Priority.HIGH)
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(response.data['lab_ids']), [self.lab.lab_id, twin.lab_id])
+        self.assertEqual([test['lab_test_id'] for test in response.data['tests']], [urgent.lab_test_id, routine.lab_test_id])
+
+    def test_renamed_lab_is_no_longer_found(self):
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.lab.lab_name = 'Lab B'
+        self.lab.save()
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_long_poll_timeout_is_no_content(self):
+        self._paid_test(self.lab)
+        response = self.client.get(self.url, {'since': timezone.now().isoformat(), 'wait': 0})
+        self.assertEqual(response.status_code, 204)
+
+
+CBC_SCHEMA = {
+    "CBC": {
+        "sample_collected": "Blood",
+        "parameters": {
+            "Hemoglobin": {"type": "number", "unit": "g/dL"},
+            "WBC": {"type": "number", "unit": "cells/mcL"},
+            "ESR (Male)": {"type": "number", "unit": "mm/hr"},
+        }
+    }
+}
+
+
+class LabResultSchemaTests(TestCase):
+    def setUp(self):
+        self.lab, self.test_type = _lab_fixtures(test_schema=CBC_SCHEMA)
+        self.lab_test = _paid_lab_test(self.lab, self.test_type, _appointment())
+        self.client = APIClient()
+        self.client.force_authenticate(user=_lab_technician(self.lab.lab_name))
+        self.url = reverse('add-lab-test-results', args=[self.lab_test.lab_test_id])
+
+    def test_keys_match_parameters_and_aliases(self):
+        cleaned, errors = CompiledSchema(CBC_SCHEMA).validate({'hemoglobin': '13.5', 'wbc_count': 7000, 'ESR': 12, 'notes': 'ok'})
+        self.assertEqual(errors, [])
+        self.assertEqual(cleaned, {'hemoglobin': 13.5, 'wbc_count': 7000, 'ESR': 12, 'notes': 'ok'})
+
+    def test_unknown_keys_are_rejected_only_in_strict_mode(self):
+        schema = CompiledSchema(CBC_SCHEMA)
+        self.assertEqual(schema.validate({'Glucose': 90})[1], ["Unknown parameter 'Glucose'"])
+        self.assertEqual(schema.validate({'Glucose': 90}, strict=False), ({'Glucose': 90}, []))
+
+    def test_unknown_keys_are_kept_by_default(self):
+        response = self.client.put(self.url, {'test_result': {'Hemoglobin': 14, 'Glucose': 90}}, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.lab_test.refresh_from_db()
+        self.assertEqual(self.lab_test.test_result, {'Hemoglobin': 14, 'Glucose': 90})
+
+    def test_strict_request_rejects_unknown_keys(self):
+        response = self.client.put(
+            self.url, {'test_result': {'Hemoglobin': 14, 'Glucose': 90}, 'strict_schema': True}, format='json'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['details'], ["Unknown parameter 'Glucose'"])
+        self.lab_test.refresh_from_db()
+        self.assertEqual(self.lab_test.status, LabTest.Status.PAID)
+
+    @override_settings(LAB_RESULTS_STRICT_SCHEMA_KEYS=True)
+    def test_strict_setting_can_be_overridden_per_request(self):
+        result = {'test_result': {'Hemoglobin': 14, 'Glucose': 90}}
+        self.assertEqual(self.client.put(self.url, result, format='json').status_code, 400)
+        response = self.client.put(self.url, {**result, 'strict_schema': 'false'}, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+
+    def test_values_are_still_type_checked(self):
+        response = self.client.put(self.url, {'test_result': {'Hemoglobin': 'n/a'}}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['details'], ["Hemoglobin must be a number, got 'n/a'"])
+
+
+class BulkLabResultsTests(TestCase):
+    def setUp(self):
+        self.lab, self.test_type = _lab_fixtures(test_schema=CBC_SCHEMA)
+        appointment = _appointment()
+        self.lab_tests = [_paid_lab_test(self.lab, self.test_type, appointment) for _ in range(4)]
+        self.other_lab = Lab.objects.create(lab_name='Lab B', lab_type=self.lab.lab_type)
+        self.elsewhere = _paid_lab_test(self.other_lab, self.test_type, appointment)
+        self.client = APIClient()
+        self.client.force_authenticate(user=_lab_technician(self.lab.lab_name))
+        self.url = reverse('bulk-lab-test-results')
+
+    def _upload(self, name, content, **data):
+        return self.client.post(self.url, {'file': SimpleUploadedFile(name, content.encode('utf-8')), **data}, format='multipart')
+
+    def _statuses(self):
+        return [LabTest.objects.get(pk=lab_test.pk).status for lab_test in self.lab_tests]
+
+    def test_csv_rows_are_applied_and_rejected_independently(self):
+        first, second, third, fourth = (lab_test.lab_test_id for lab_test in self.lab_tests)
+        content = (
+            "lab_test_id, Hemoglobin ,WBC,status\n"
+            f"{first},13.5,7000,\n"
+            f"{second},n/a,7000,completed\n"
+            f"{self.elsewhere.lab_test_id},14,6000,\n"
+            f"{first},13.0,7100,\n"
+            "abc,14,6000,\n"
+            f"{third},,,failed\n"
+            f"{fourth},,,\n"
+        )
+        response = self._upload('export.csv', content)
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual((response.data['total_rows'], response.data['updated'], response.data['failed']), (7, 2, 5))
+        self.assertEqual({error['row']: error['errors'] for error in response.data['errors']}, {
+            2: ["Hemoglobin must be a number, got 'n/a'"],
+            3: ["Lab test not found in your lab"],
+            4: ["Lab test appears more than once in this upload"],
+            5: ["lab_test_id is missing or not an integer"],
+            7: ["No result values"],
+        })
+        self.assertEqual(
+            self._statuses(),
+            [LabTest.Status.COMPLETED, LabTest.Status.PAID, LabTest.Status.FAILED, LabTest.Status.PAID]
+        )
+        self.assertEqual(LabTest.objects.get(pk=first).test_result, {'Hemoglobin': 13.5, 'WBC': 7000})
+        self.assertEqual(LabTest.objects.get(pk=self.elsewhere.pk).status, LabTest.Status.PAID)
+
+    def test_ndjson_rows_with_result_objects(self):
+        first, second = self.lab_tests[0].lab_test_id, self.lab_tests[1].lab_test_id
+        content = (
+            f'{{"lab_test_id": {first}, "test_result": {{"Hemoglobin": 12.1, "notes": "haemolysed"}}}}\n'
+            "\n"
+            "{not json\n"
+            "[1, 2]\n"
+            f'{{"lab_test_id": "{second}", "status": "cancelled", "WBC": 5000}}\n'
+        )
+        response = self._upload('export.ndjson', content)
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual((response.data['total_rows'], response.data['updated']), (4, 1))
+        errors = {error['row']: error['errors'][0] for error in response.data['errors']}
+        self.assertTrue(errors[2].startswith('Invalid JSON'))
+        self.assertEqual(errors[3], 'Row must be a JSON object')
+        self.assertTrue(errors[4].startswith('status must be one of'))
+        self.assertEqual(LabTest.objects.get(pk=first).test_result, {'Hemoglobin': 12.1, 'notes': 'haemolysed'})
+
+    def test_rows_are_written_a_chunk_at_a_time(self):
+        rows = [{'lab_test_id': lab_test.lab_test_id, 'Hemoglobin': 13} for lab_test in self.lab_tests]
+        rows.insert(1, {'lab_test_id': self.elsewhere.lab_test_id, 'Hemoglobin': 13})
+        with mock.patch.object(LabTest.objects, 'bulk_update', wraps=LabTest.objects.bulk_update) as bulk_update:
+            report = import_results(iter(rows), [self.lab.lab_id], chunk_size=2)
+        self.assertEqual((report['updated'], report['failed']), (4, 1))
+        self.assertEqual([len(call.args[0]) for call in bulk_update.call_args_list], [1, 2, 1])
+        self.assertEqual(set(self._statuses()), {LabTest.Status.COMPLETED})
+
+    def test_unusable_uploads_are_rejected(self):
+        self.assertEqual(self._upload('export.xml', '<rows/>', format='xml').status_code, 400)
+        self.assertEqual(self.client.post(self.url, {}, format='multipart').status_code, 400)
+        with self.assertRaises(ValueError):
+            parse_result_rows(io.BytesIO(b''), 'xlsx')
+
+    def test_schema_is_compiled_once_until_it_changes(self):
+        schema_registry.clear()
+        first = schema_registry.get(LabTestType.objects.get(pk=self.test_type.pk))
+        self.assertIs(schema_registry.get(LabTestType.objects.get(pk=self.test_type.pk)), first)
+
+        edited = LabTestType.objects.get(pk=self.test_type.pk)
+        edited.test_schema['CBC']['parameters']['Platelets'] = {'type': 'number'}
+        edited.save()
+        recompiled = schema_registry.get(LabTestType.objects.get(pk=self.test_type.pk))
+        self.assertIsNot(recompiled, first)
+        self.assertEqual(recompiled.validate({'Platelets': 'many'})[1], ["Platelets must be a number, got 'many'"])
+
+
+class LabResultFlaggingTests(TestCase):
+    def setUp(self):
+        self.lab, self.test_type = _lab_fixtures(test_schema=CBC_SCHEMA)
+        self.appointment = _appointment()
+        ReferenceRange.objects.create(
+            test_type=self.test_type, analyte='Hemoglobin', low=12, high=17, critical_low=7, critical_high=20
+        )
+        ReferenceRange.objects.create(
+            test_type=self.test_type, analyte='Hemoglobin', sex=ReferenceRange.Sex.MALE, low=13.5, high=17.5,
+            critical_low=7, critical_high=20
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(user=_lab_technician(self.lab.lab_name))
+
+    def _flags(self, *values):
+        lab_tests = []
+        for value in values:
+            lab_test = _paid_lab_test(self.lab, self.test_type, self.appointment)
+            lab_test.test_result = {'hemoglobin': value, 'notes': 'fasting'}
+            lab_tests.append(lab_test)
+        flags = {flag.lab_test.lab_test_id: flag.flag for flag in evaluate(lab_tests)}
+        return [flags.get(lab_test.lab_test_id) for lab_test in lab_tests]
+
+    def test_values_are_flagged_against_their_range(self):
+        self.assertEqual(
+            self._flags(6, 10, 12, 14, 18, 25),
+            ['critical_low', 'low', None, None, 'high', 'critical_high']
+        )
+
+    def test_sex_specific_range_wins(self):
+        self.assertEqual(self._flags(13), [None])
+        PatientDetails.objects.create(
+            patient=self.appointment.patient, patient_dob=date(1990, 1, 1), patient_gender=True,
+            patient_blood_group='O+', patient_address='Somewhere'
+        )
+        self.assertEqual(self._flags(13), ['low'])
+
+    def test_result_and_flags_are_saved_together(self):
+        lab_test = _paid_lab_test(self.lab, self.test_type, self.appointment)
+        url = reverse('add-lab-test-results', args=[lab_test.lab_test_id])
+        response = self.client.put(url, {'test_result': {'Hemoglobin': 6.5}}, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data['flags'], [{'analyte': 'Hemoglobin', 'value': 6.5, 'flag': 'critical_low'}])
+        self.assertEqual(list(LabResultFlag.objects.values_list('lab_test_id', 'flag')), [(lab_test.lab_test_id, 'critical_low')])
+
+    def test_failed_flagging_does_not_commit_the_result(self):
+        lab_test = _paid_lab_test(self.lab, self.test_type, self.appointment)
+        url = reverse('add-lab-test-results', args=[lab_test.lab_test_id])
+        with mock.patch('hospital.lab_flagging_service.flag_lab_tests', side_effect=RuntimeError("flagging failed")):
+            with self.assertRaises(RuntimeError):
+                self.client.put(url, {'test_result': {'Hemoglobin': 6.5}}, format='json')
+        lab_test.refresh_from_db()
+        self.assertEqual(lab_test.status, LabTest.Status.PAID)
+        self.assertIsNone(lab_test.test_result)
+
+
+@override_settings(LAB_DELTA_CHECK_PERCENT=25, LAB_DELTA_CHECK_LIMITS={}, LAB_DELTA_CHECK_WINDOW_DAYS=30)
+class AnalyteHistoryTests(TestCase):
+    def setUp(self):
+        self.lab, self.test_type = _lab_fixtures(test_schema=CBC_SCHEMA)
+        self.appointment = _appointment()
+        self.patient_id = self.appointment.patient_id
+        first = timezone.make_aware(datetime(2025, 1, 1, 9))
+        lab_tests = []
+        for days, result in ((0, {'hemoglobin': 14, 'WBC': 7000}), (10, {'HEMOGLOBIN': 13.5}), (20, {'Hemoglobin': 9})):
+            lab_test = _paid_lab_test(self.lab, self.test_type, self.appointment, test_datetime=first + timedelta(days=days))
+            lab_test.test_result = result
+            lab_tests.append(lab_test)
+        record_observations(lab_tests)
+
+    def test_analyte_filter_is_case_insensitive_equality(self):
+        with CaptureQueriesContext(connection) as queries:
+            series = analyte_series(self.patient_id, analyte='HEMOGLOBIN')
+        sql = queries.captured_queries[0]['sql']
+        self.assertIn('"analyte_key" = ', sql)
+        self.assertNotIn('LIKE', sql.upper())
+        self.assertNotIn('UPPER(', sql.upper())
+
+        self.assertEqual(len(series), 1)
+        self.assertEqual(series[0]['analyte'], 'Hemoglobin')
+        self.assertEqual([point['value'] for point in series[0]['points']], [14, 13.5, 9])
+
+    def test_delta_checks(self):
+        points = analyte_series(self.patient_id, analyte='hemoglobin')[0]['points']
+        self.assertEqual([point['delta'] for point in points], [None, -0.5, -4.5])
+        self.assertEqual([point['delta_flag'] for point in points], [False, False, True])
+
+    def test_series_per_analyte(self):
+        series = analyte_series(self.patient_id)
+        self.assertEqual([(entry['analyte'], len(entry['points'])) for entry in series], [('Hemoglobin', 3), ('WBC', 1)])
+
+
+class ChunkedUploadTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.lab, self.test_type = _lab_fixtures()
+        self.lab_test = _paid_lab_test(self.lab, self.test_type, _appointment())
+        self.client = APIClient()
+        self.client.force_authenticate(user=_lab_technician(self.lab.lab_name))
+        self.content = bytes(range(256)) * 40
+
+    def _start(self, **data):
+        return self.client.post(reverse('upload-session-create'), {
+            'target': 'lab_test_image', 'lab_test_id': self.lab_test.lab_test_id, 'file_name': 'scan.png',
+            'total_size': len(self.content), 'checksum': hashlib.sha256(self.content).hexdigest(), **data
+        }, format='json')
+
+    def _chunk(self, upload_id, offset, data, checksum=None):
+        payload = {'chunk': SimpleUploadedFile('chunk', data), 'offset': offset}
+        if checksum:
+            payload['checksum'] = checksum
+        return self.client.put(reverse('upload-chunk', args=[upload_id]), payload, format='multipart')
+
+    def test_upload_resumes_from_received_bytes(self):
+        upload_id = self._start().data['upload_id']
+        self.assertEqual(self._chunk(upload_id, 0, self.content[:4000]).status_code, 200)
+        # The response was lost: re-sending the same chunk is acknowledged, a gap is refused
+        self.assertEqual(self._chunk(upload_id, 0, self.content[:4000]).data['received_bytes'], 4000)
+        gap = self._chunk(upload_id, 8000, self.content[8000:])
+        self.assertEqual((gap.status_code, gap.data['received_bytes']), (409, 4000))
+
+        received = self.client.get(reverse('upload-session-detail', args=[upload_id])).data['received_bytes']
+        self.assertEqual(self._chunk(upload_id, received, self.content[received:]).status_code, 200)
+        response = self.client.post(reverse('upload-finalize', args=[upload_id]))
+        self.assertEqual(response.status_code, 201, response.data)
+
+        self.lab_test.refresh_from_db()
+        with self.lab_test.test_image.open('rb') as image:
+            self.assertEqual(image.read(), self.content)
+
+    def test_checksum_mismatches_are_rejected(self):
+        upload_id = self._start().data['upload_id']
+        response = self._chunk(upload_id, 0, self.content[:4000], checksum='0' * 64)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['received_checksum'], hashlib.sha256(self.content[:4000]).hexdigest())
+
+        # A whole file that does not match the checksum given at the start is not attached
+        upload_id = self._start(checksum='f' * 64).data['upload_id']
+        self._chunk(upload_id, 0, self.content)
+        response = self.client.post(reverse('upload-finalize', args=[upload_id]))
+        self.assertEqual(response.status_code, 400)
+        self.lab_test.refresh_from_db()
+        self.assertFalse(self.lab_test.test_image)
+
+    def test_images_only_for_tests_in_the_technicians_lab(self):
+        other_lab = Lab.objects.create(lab_name='Lab B', lab_type=self.lab.lab_type)
+        self.lab_test.lab = other_lab
+        self.lab_test.save()
+        response = self._start()
+        self.assertEqual(response.status_code, 403)
+
+    def test_non_numeric_ids_are_rejected(self):
+        self.assertEqual(self._start(lab_test_id='abc').status_code, 400)
+        self.assertEqual(self._start(lab_test_id=None).status_code, 400)
+        self.assertEqual(self._start(lab_test_id=999999).status_code, 404)
+        response = self._start(target='patient_document', patient_id='abc', file_name='report.pdf')
+        self.assertEqual(response.status_code, 400)
+
+
+class LabTestImageTileTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        cache_dir = mock.patch.object(tile_service, 'cache_dir', os.path.join(self.media_root, 'tiles'))
+        cache_dir.start()
+        self.addCleanup(cache_dir.stop)
+
+        lab, test_type = _lab_fixtures()
+        self.lab_test = _paid_lab_test(lab, test_type, _appointment())
+        self.client = APIClient()
+        self.client.force_authenticate(user=_lab_technician(lab.lab_name))
+        self.version = self._attach_image('scan.png')
+
+    def _attach_image(self, name):
+        image = io.BytesIO()
+        Image.new('RGB', (600, 300), 'white').save(image, format='PNG')
+        self.lab_test.test_image.name = default_storage.save(f'lab_test_images/{name}', ContentFile(image.getvalue()))
+        self.lab_test.save(update_fields=['test_image'])
+        tile_service.build(self.lab_test.lab_test_id, self.lab_test.test_image.name)
+        return tile_service.version(self.lab_test.test_image.name)
+
+    def _tile(self, version=None, **headers):
+        args = [self.lab_test.lab_test_id] + ([version] if version else []) + [0, 1, 0]
+        name = 'lab-test-image-versioned-tile' if version else 'lab-test-image-tile'
+        return self.client.get(reverse(name, args=args), headers=headers)
+
+    def test_only_versioned_tiles_are_immutable(self):
+        versioned = self._tile(self.version)
+        self.assertEqual(versioned.status_code, 200)
+        self.assertEqual(versioned['Content-Type'], 'image/jpeg')
+        self.assertIn('immutable', versioned['Cache-Control'])
+        self.assertEqual(self._tile()['Cache-Control'], 'private, no-cache')
+
+    def test_replaced_image_invalidates_old_tile_urls(self):
+        old_etag = self._tile(self.version)['ETag']
+        new_version = self._attach_image('rescan.png')
+        response = self._tile(self.version)
+        self.assertEqual((response.status_code, response.data['version']), (404, new_version))
+        # Revalidating the unversioned URL with the old ETag fetches the new tile
+        self.assertEqual(self._tile(if_none_match=old_etag).status_code, 200)
+
+    def test_if_none_match_compares_whole_etags(self):
+        etag = self._tile(self.version)['ETag']
+        self.assertEqual(self._tile(self.version, if_none_match=f'"x", W/{etag}').status_code, 304)
+        self.assertEqual(self._tile(self.version, if_none_match='*').status_code, 304)
+        # A longer tag that merely contains this one is a different tag
+        self.assertEqual(self._tile(self.version, if_none_match=f'"{etag.strip(chr(34))}0"').status_code, 200)
+
+
+class RatingSummaryTests(TestCase):
+    def setUp(self):
+        self.first = _appointment()
+        self.doctor = self.first.staff
+        self.other_doctor = _appointment(patient=self.first.patient).staff
+        self.second = _appointment(patient=self.first.patient, staff=self.doctor)
+        Appointment.objects.filter(pk__in=[self.first.pk, self.second.pk]).update(status='completed')
+        self.first.refresh_from_db()
+        self.second.refresh_from_db()
+
+    def summary(self, doctor):
+        summary = DoctorRatingSummary.objects.filter(doctor=doctor).first()
+        if summary is None:
+            return None
+        return summary.rating_count, summary.rating_sum, summary.rating_distribution
+
+    def assertMatchesRecompute(self):
+        # The incremental summaries agree with recomputing them from the ratings
+        incremental = {doctor: self.summary(doctor) for doctor in (self.doctor, self.other_doctor)}
+        rating_summaries.refresh()
+        self.assertEqual({doctor: self.summary(doctor) for doctor in (self.doctor, self.other_doctor)}, incremental)
+
+    def test_summary_follows_update_and_delete(self):
+        rating = AppointmentRating.objects.create(appointment=self.first, rating=5)
+        AppointmentRating.objects.create(appointment=self.second, rating=3)
+        self.assertEqual(self.summary(self.doctor), (2, 8, {'5': 1, '4': 0, '3': 1, '2': 0, '1': 0}))
+
+        rating.rating = 4
+        rating.save()
+        self.assertEqual(self.summary(self.doctor), (2, 7, {'5': 0, '4': 1, '3': 1, '2': 0, '1': 0}))
+        summary = DoctorRatingSummary.objects.get(doctor=self.doctor)
+        self.assertAlmostEqual(summary.score, rating_summaries.score(2, 7))
+
+        rating.delete()
+        self.assertEqual(self.summary(self.doctor), (1, 3, {'5': 0, '4': 0, '3': 1, '2': 0, '1': 0}))
+        self.assertMatchesRecompute()
+
+    def test_ratings_move_with_the_appointment(self):
+        AppointmentRating.objects.create(appointment=self.first, rating=5)
+        AppointmentRating.objects.create(appointment=self.second, rating=2)
+
+        self.first.staff = self.other_doctor
+        self.first.save()
+        self.assertEqual(self.summary(self.doctor)[:2], (1, 2))
+        self.assertEqual(self.summary(self.other_doctor)[:2], (1, 5))
+
+        # Only completed appointments count
+        self.second.status = 'cancelled'
+        self.second.save()
+        self.assertIsNone(self.summary(self.doctor))
+        self.assertMatchesRecompute()
+
+    def test_uncompleted_appointment_ratings_do_not_count(self):
+        Appointment.objects.filter(pk=self.first.pk).update(status='upcoming')
+        AppointmentRating.objects.create(appointment=self.first, rating=1)
+        self.assertIsNone(self.summary(self.doctor))
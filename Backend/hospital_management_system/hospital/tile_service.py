@@ -0,0 +1,254 @@
+"""
+Multi-resolution tile pyramids for large lab test images
+"""
+import hashlib
+import io
+import logging
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Container layout (little-endian):
+#   header   8s magic, u4 width, u4 height, u2 tile_size, u2 level count
+#   levels   per level: u4 width, u4 height, u4 columns, u4 rows
+#   index    per tile, level by level and row by row: u8 offset, u4 length
+#   tiles    JPEG bytes
+MAGIC = b'HMSTILE1'
+_HEADER = struct.Struct('<8sIIHH')
+_LEVEL = struct.Struct('<IIII')
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('length', '<u4')])
+
+
+class TileNotFound(Exception):
+    pass
+
+
+def _levels(width: int, height: int, tile_size: int) -> List[Tuple[int, int, int, int]]:
+    """(width, height, columns, rows) per level; level 0 is full size and each next level is half of it"""
+    levels = []
+    while True:
+        levels.append((width, height, -(-width // tile_size), -(-height // tile_size)))
+        if width <= tile_size and height <= tile_size:
+            return levels
+        width, height = max(1, -(-width // 2)), max(1, -(-height // 2))
+
+
+def build_container(source, target_path: str, tile_size: int = 256, quality: int = 85) -> Dict:
+    """
+    Cut an image into a tile pyramid and write it as one container file
+
+    Each level is produced from the previous one with Image.reduce(2), so the
+    full-size image is decoded once. Tiles are written as they are encoded and
+    the index is filled in at the end; the file is built next to the target
+    and renamed into place, so readers never see a partial container.
+
+    Args:
+        source: Readable file object with the image
+        target_path: Path of the container file
+        tile_size: Tile width and height in pixels
+        quality: JPEG quality of the tiles
+
+    Returns:
+        Dict with width, height, tile_size and levels
+    """
+    image = Image.open(source)
+    image = image.convert('RGB' if image.mode not in ('L', 'RGB') else image.mode)
+    levels = _levels(image.width, image.height, tile_size)
+    tile_count = sum(columns * rows for _, _, columns, rows in levels)
+    index = np.zeros(tile_count, dtype=INDEX_DTYPE)
+    index_start = _HEADER.size + _LEVEL.size * len(levels)
+
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    partial_path = f"{target_path}.{os.getpid()}.{threading.get_ident()}.partial"
+    try:
+        with open(partial_path, 'wb') as out:
+            out.write(_HEADER.pack(MAGIC, image.width, image.height, tile_size, len(levels)))
+            for level in levels:
+                out.write(_LEVEL.pack(*level))
+            out.write(b'\0' * index.nbytes)
+
+            position = 0
+            for number, (width, height, columns, rows) in enumerate(levels):
+                if number:
+                    image = image.reduce(2)
+                for row in range(rows):
+                    for column in range(columns):
+                        box = (column * tile_size, row * tile_size,
+                               min((column + 1) * tile_size, width), min((row + 1) * tile_size, height))
+                        buffer = io.BytesIO()
+                        image.crop(box).save(buffer, format='JPEG', quality=quality)
+                        data = buffer.getvalue()
+                        index[position] = (out.tell(), len(data))
+                        out.write(data)
+                        position += 1
+
+            out.seek(index_start)
+            out.write(index.tobytes())
+        os.replace(partial_path, target_path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+    return {"width": levels[0][0], "height": levels[0][1], "tile_size": tile_size, "levels": levels}
+
+
+class TileContainer:
+    """Read-only view of a container file through mmap; tiles are slices of the mapping"""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as handle:
+            self._map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.width, self.height, self.tile_size, level_count = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self._map.close()
+            raise ValueError(f"{path} is not a tile container")
+        self.levels = [
+            _LEVEL.unpack_from(self._map, _HEADER.size + _LEVEL.size * number) for number in range(level_count)
+        ]
+        self._level_start = np.cumsum([0] + [columns * rows for _, _, columns, rows in self.levels])
+        self._index = np.frombuffer(
+            self._map, dtype=INDEX_DTYPE, count=int(self._level_start[-1]),
+            offset=_HEADER.size + _LEVEL.size * level_count
+        )
+
+    def tile(self, level: int, x: int, y: int) -> bytes:
+        if not 0 <= level < len(self.levels):
+            raise TileNotFound(f"Level {level} does not exist")
+        _, _, columns, rows = self.levels[level]
+        if not (0 <= x < columns and 0 <= y < rows):
+            raise TileNotFound(f"Tile {x},{y} is outside level {level}")
+        offset, length = self._index[self._level_start[level] + y * columns + x]
+        return self._map[int(offset):int(offset) + int(length)]
+
+    def metadata(self) -> Dict:
+        return {
+            "width": self.width,
+            "height": self.height,
+            "tile_size": self.tile_size,
+            "levels": [
+                {"level": number, "width": width, "height": height, "columns": columns, "rows": rows}
+                for number, (width, height, columns, rows) in enumerate(self.levels)
+            ],
+        }
+
+
+class TileService:
+    """
+    Builds tile pyramids in a background thread pool when a lab test image is
+    attached, and serves tiles out of the memory-mapped containers.
+
+    Containers live under TILE_CACHE_DIR, named after the lab test and a hash
+    of the image's storage name, so a replaced image gets a new pyramid and
+    stale tiles are never served. Open containers are kept in a small LRU so a
+    viewer panning around maps the file once.
+    """
+
+    def __init__(self):
+        self.cache_dir = getattr(settings, 'TILE_CACHE_DIR', os.path.join(settings.BASE_DIR, 'tile_cache'))
+        self.tile_size = getattr(settings, 'TILE_SIZE', 256)
+        self.quality = getattr(settings, 'TILE_JPEG_QUALITY', 85)
+        self.max_open = getattr(settings, 'TILE_OPEN_CONTAINERS', 64)
+        self._workers = getattr(settings, 'TILE_WORKERS', 2)
+        self._executor = None
+        self._pending = set()
+        self._open: OrderedDict = OrderedDict()
+        self._lock = threading.RLock()
+
+    def container_path(self, lab_test_id: int, image_name: str) -> str:
+        return os.path.join(self.cache_dir, str(lab_test_id), f"{self.version(image_name)}.tiles")
+
+    def version(self, image_name: str) -> str:
+        """Stable tag of an image's pyramid, for ETags"""
+        return hashlib.sha1(image_name.encode()).hexdigest()[:16]
+
+    # ------------------------------------------------------------------
+    # Building
+    # ------------------------------------------------------------------
+
+    def build(self, lab_test_id: int, image_name: str, force: bool = False) -> Optional[Dict]:
+        """Build the pyramid of one image now; returns None if it already exists and force is off"""
+        path = self.container_path(lab_test_id, image_name)
+        if os.path.exists(path) and not force:
+            return None
+        with default_storage.open(image_name, 'rb') as source:
+            metadata = build_container(source, path, self.tile_size, self.quality)
+        self._forget(path)
+        self._remove_stale(lab_test_id, path)
+        logger.info(f"Built {len(metadata['levels'])}-level tile pyramid for lab test {lab_test_id}")
+        return metadata
+
+    def schedule(self, lab_test_id: int, image_name: str):
+        """Build the pyramid in the background once the current transaction commits"""
+        transaction.on_commit(lambda: self._submit(lab_test_id, image_name))
+
+    def _submit(self, lab_test_id: int, image_name: str):
+        key = (lab_test_id, image_name)
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='tiler')
+        self._executor.submit(self._run, lab_test_id, image_name)
+
+    def _run(self, lab_test_id: int, image_name: str):
+        try:
+            self.build(lab_test_id, image_name)
+        except Exception as e:
+            logger.error(f"Error building tiles for lab test {lab_test_id}: {str(e)}")
+        finally:
+            with self._lock:
+                self._pending.discard((lab_test_id, image_name))
+
+    def is_pending(self, lab_test_id: int, image_name: str) -> bool:
+        with self._lock:
+            return (lab_test_id, image_name) in self._pending
+
+    def _remove_stale(self, lab_test_id: int, keep_path: str):
+        directory = os.path.dirname(keep_path)
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if path != keep_path and name.endswith('.tiles'):
+                self._forget(path)
+                os.remove(path)
+
+    # ------------------------------------------------------------------
+    # Serving
+    # ------------------------------------------------------------------
+
+    def container(self, lab_test_id: int, image_name: str) -> Optional[TileContainer]:
+        """The open container of an image, or None if its pyramid is not built yet"""
+        path = self.container_path(lab_test_id, image_name)
+        with self._lock:
+            container = self._open.get(path)
+            if container is not None:
+                self._open.move_to_end(path)
+                return container
+            if not os.path.exists(path):
+                return None
+            container = TileContainer(path)
+            self._open[path] = container
+            while len(self._open) > self.max_open:
+                # Dropped rather than closed: a request may still be reading it,
+                # and the mapping is released with the last reference
+                self._open.popitem(last=False)
+            return container
+
+    def _forget(self, path: str):
+        with self._lock:
+            self._open.pop(path, None)
+
+
+tile_service = TileService()
@@ -0,0 +1,302 @@
+"""
+Chunked, resumable uploads for lab test images and patient documents
+"""
+import hashlib
+import io
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Dict
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+
+from .models import LabTest, Patient, PatientHistoryDocs, UploadSession
+
+logger = logging.getLogger(__name__)
+
+
+class UploadError(Exception):
+    """An upload request that cannot be applied; `status` is the HTTP status to answer with"""
+
+    def __init__(self, message: str, status: int = 400, **details):
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+
+def _part_path(session: UploadSession, offset: int) -> str:
+    return f"uploads/{session.upload_id}/{offset:016d}.part"
+
+
+def _sha256(uploaded_file) -> str:
+    digest = hashlib.sha256()
+    for block in uploaded_file.chunks():
+        digest.update(block)
+    return digest.hexdigest()
+
+
+class _PartsReader(io.RawIOBase):
+    """
+    Read-only stream over a session's stored parts, in order, hashing as it
+    goes. Only one part is open at a time, so assembling a file of any size
+    holds a single read buffer in memory.
+    """
+
+    def __init__(self, storage, paths):
+        self._storage = storage
+        self._paths = list(paths)
+        self._current = None
+        self.digest = hashlib.sha256()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer) -> int:
+        while True:
+            if self._current is None:
+                if not self._paths:
+                    return 0
+                self._current = self._storage.open(self._paths.pop(0), 'rb')
+            data = self._current.read(len(buffer))
+            if data:
+                buffer[:len(data)] = data
+                self.digest.update(data)
+                return len(data)
+            self._current.close()
+            self._current = None
+
+    def close(self):
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+        super().close()
+
+
+class UploadService:
+    """
+    Init / chunk / finalize protocol on top of the default storage backend.
+
+    Each chunk is stored as its own object under uploads/<upload_id>/, keyed by
+    its byte offset, as soon as it arrives; a client that loses its connection
+    asks for the session's received_bytes and continues from there. Finalize
+    streams the parts, in order, into the final file through the storage
+    backend (the filesystem, or S3 through django-storages, which turns it into
+    a multipart upload), then deletes the parts. Nothing is ever appended in
+    place, so the same code works on storages that cannot append.
+    """
+
+    def __init__(self, storage=None):
+        self.storage = storage or default_storage
+        self.chunk_max_bytes = getattr(settings, 'UPLOAD_CHUNK_MAX_BYTES', 8 * 1024 * 1024)
+        self.max_bytes = getattr(settings, 'UPLOAD_MAX_BYTES', 2 * 1024 * 1024 * 1024)
+        self.ttl_hours = getattr(settings, 'UPLOAD_SESSION_TTL_HOURS', 24)
+
+    # ------------------------------------------------------------------
+    # Protocol
+    # ------------------------------------------------------------------
+
+    def start(self, owner_id: str, target: str, file_name: str, total_size: int,
+              lab_test: LabTest = None, patient: Patient = None, document_type: str = None,
+              content_type: str = None, checksum: str = None) -> UploadSession:
+        """
+        Open an upload session
+
+        Args:
+            owner_id: patient_id or staff_id of the uploader; only they may send chunks
+            target: UploadSession.Target value
+            file_name: Original file name
+            total_size: Size of the whole file in bytes
+            lab_test: Lab test the image belongs to (lab_test_image)
+            patient: Patient the document belongs to (patient_document)
+            document_type: PatientHistoryDocs document type (patient_document)
+            content_type: Optional MIME type
+            checksum: Optional SHA-256 hex digest of the whole file
+
+        Returns:
+            The new UploadSession
+        """
+        if total_size <= 0:
+            raise UploadError("total_size must be a positive number of bytes")
+        if total_size > self.max_bytes:
+            raise UploadError(f"File is larger than the {self.max_bytes} byte limit", status=413)
+        return UploadSession.objects.create(
+            owner_id=str(owner_id),
+            target=target,
+            lab_test=lab_test,
+            patient=patient,
+            document_type=document_type,
+            file_name=os.path.basename(file_name)[:255],
+            content_type=content_type,
+            total_size=total_size,
+            checksum=checksum.lower() if checksum else None,
+            expires_at=timezone.now() + timedelta(hours=self.ttl_hours),
+        )
+
+    def append_chunk(self, upload_id, owner_id: str, offset: int, chunk, checksum: str = None) -> UploadSession:
+        """
+        Store one chunk at `offset`
+
+        The offset must equal the bytes received so far. Re-sending a chunk that
+        was already stored (the response was lost) is acknowledged without
+        storing it again.
+
+        Args:
+            upload_id: Session id
+            owner_id: Caller's patient_id or staff_id
+            offset: Byte offset of the chunk in the file
+            chunk: Uploaded file holding the chunk
+            checksum: Optional SHA-256 hex digest of the chunk
+
+        Returns:
+            The updated UploadSession
+        """
+        size = chunk.size
+        if size <= 0:
+            raise UploadError("Chunk is empty")
+        if size > self.chunk_max_bytes:
+            raise UploadError(f"Chunk is larger than the {self.chunk_max_bytes} byte limit", status=413)
+        digest = _sha256(chunk)
+        if checksum and checksum.lower() != digest:
+            raise UploadError("Chunk checksum does not match", received_checksum=digest)
+
+        with transaction.atomic():
+            session = self._pending(upload_id, owner_id, lock=True)
+            if offset < session.received_bytes:
+                stored = next((part for part in session.parts if part['offset'] == offset), None)
+                if stored and stored['size'] == size and stored['sha256'] == digest:
+                    return session
+                raise UploadError("Chunk overlaps data already received", status=409,
+                                  received_bytes=session.received_bytes)
+            if offset != session.received_bytes:
+                raise UploadError("Chunk does not start where the previous one ended", status=409,
+                                  received_bytes=session.received_bytes)
+            if offset + size > session.total_size:
+                raise UploadError("Chunk runs past total_size", received_bytes=session.received_bytes)
+
+            path = _part_path(session, offset)
+            if self.storage.exists(path):
+                # Left over from a request that failed after storing its chunk
+                self.storage.delete(path)
+            path = self.storage.save(path, chunk)
+            session.parts = session.parts + [{"offset": offset, "size": size, "sha256": digest, "path": path}]
+            session.received_bytes = offset + size
+            session.save(update_fields=['parts', 'received_bytes', 'updated_at'])
+        return session
+
+    def finalize(self, upload_id, owner_id: str) -> Dict:
+        """
+        Assemble the parts into the final file and attach it
+
+        Returns:
+            Dict describing what the file was attached to
+        """
+        with transaction.atomic():
+            session = self._pending(upload_id, owner_id, lock=True)
+            if session.received_bytes != session.total_size:
+                raise UploadError("Upload is incomplete", status=409, received_bytes=session.received_bytes)
+
+            reader = _PartsReader(self.storage, [part['path'] for part in session.parts])
+            content = File(reader, name=session.file_name)
+            content.size = session.total_size
+            try:
+                stored_path = self.storage.save(self._final_path(session), content)
+            finally:
+                reader.close()
+
+            digest = reader.digest.hexdigest()
+            if session.checksum and session.checksum != digest:
+                self.storage.delete(stored_path)
+                raise UploadError("File checksum does not match", received_checksum=digest)
+
+            attached = self._attach(session, stored_path)
+            session.status = UploadSession.Status.COMPLETED
+            session.stored_path = stored_path
+            session.save(update_fields=['status', 'stored_path', 'updated_at'])
+
+        self._delete_parts(session)
+        logger.info(f"Finalized upload {session.upload_id} ({session.total_size} bytes) to {stored_path}")
+        return attached
+
+    def abort(self, upload_id, owner_id: str) -> UploadSession:
+        with transaction.atomic():
+            session = self._pending(upload_id, owner_id, lock=True)
+            session.status = UploadSession.Status.ABORTED
+            session.save(update_fields=['status', 'updated_at'])
+        self._delete_parts(session)
+        return session
+
+    def get(self, upload_id, owner_id: str) -> UploadSession:
+        session = UploadSession.objects.filter(upload_id=upload_id, owner_id=str(owner_id)).first()
+        if session is None:
+            raise UploadError("Upload not found", status=404)
+        return session
+
+    def purge_expired(self, now: datetime = None) -> int:
+        """Abort pending sessions past their expiry and delete their parts"""
+        expired = list(UploadSession.objects.filter(
+            status=UploadSession.Status.PENDING, expires_at__lt=now or timezone.now()
+        ))
+        for session in expired:
+            self._delete_parts(session)
+        UploadSession.objects.filter(
+            upload_id__in=[session.upload_id for session in expired]
+        ).update(status=UploadSession.Status.ABORTED, updated_at=timezone.now())
+        return len(expired)
+
+    # ------------------------------------------------------------------
+    # Helpers
+    # ------------------------------------------------------------------
+
+    def _pending(self, upload_id, owner_id: str, lock: bool = False) -> UploadSession:
+        sessions = UploadSession.objects.filter(upload_id=upload_id, owner_id=str(owner_id))
+        session = (sessions.select_for_update() if lock else sessions).first()
+        if session is None:
+            raise UploadError("Upload not found", status=404)
+        if session.status != UploadSession.Status.PENDING:
+            raise UploadError(f"Upload is already {session.status}", status=409)
+        if session.expires_at <= timezone.now():
+            raise UploadError("Upload has expired", status=410)
+        return session
+
+    def _final_path(self, session: UploadSession) -> str:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        if session.target == UploadSession.Target.LAB_TEST_IMAGE:
+            # Same directory as LabTest.test_image's upload_to
+            return f"lab_test_images/{timestamp}_{session.file_name}"
+        # Same layout as DocumentProcessingService._save_uploaded_file
+        return f"patient_documents/{session.patient_id}/{timestamp}_{session.file_name}"
+
+    def _attach(self, session: UploadSession, stored_path: str) -> Dict:
+        if session.target == UploadSession.Target.LAB_TEST_IMAGE:
+            lab_test = session.lab_test
+            lab_test.test_image.name = stored_path
+            lab_test.save(update_fields=['test_image', 'updated_at'])
+            return {"lab_test_id": lab_test.lab_test_id, "file_path": stored_path}
+
+        doc = PatientHistoryDocs.objects.create(
+            patient_id=session.patient_id,
+            document_type=session.document_type or 'other',
+            document_name=session.file_name,
+            document_url=stored_path,
+            document_processed=False
+        )
+        return {
+            "doc_id": doc.doc_id,
+            "document_name": doc.document_name,
+            "document_type": doc.document_type,
+            "file_path": stored_path
+        }
+
+    def _delete_parts(self, session: UploadSession):
+        for part in session.parts:
+            try:
+                self.storage.delete(part['path'])
+            except Exception as e:
+                logger.warning(f"Could not delete part {part['offset']} of upload {session.upload_id}: {str(e)}")
+
+
+upload_service = UploadService()
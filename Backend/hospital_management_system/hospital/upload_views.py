@@ -0,0 +1,174 @@
+"""
+Chunked upload views for lab test images and patient documents
+"""
+from rest_framework.views import APIView
+from rest_framework.response import Response
+from rest_framework import status
+from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
+from rest_framework.permissions import IsAuthenticated
+from django.shortcuts import get_object_or_404
+import logging
+
+from accounts.authentication import JWTAuthentication
+from .lab_worklist_service import resolve_lab_ids
+from .models import LabTest, LabTechnicianDetails, Patient, PatientHistoryDocs, UploadSession
+from .upload_service import upload_service, UploadError
+
+logger = logging.getLogger(__name__)
+
+
+def _owner_id(user):
+    return user.patient_id if hasattr(user, 'patient_id') else user.staff_id
+
+
+def _session_data(session):
+    return {
+        "upload_id": str(session.upload_id),
+        "target": session.target,
+        "file_name": session.file_name,
+        "total_size": session.total_size,
+        "received_bytes": session.received_bytes,
+        "status": session.status,
+        "expires_at": session.expires_at.isoformat(),
+        "chunk_max_bytes": upload_service.chunk_max_bytes
+    }
+
+
+def _error(e):
+    return Response({"error": str(e), **e.details}, status=e.status)
+
+
+class UploadSessionCreateView(APIView):
+    """
+    Start a chunked upload of a lab test image (lab technicians) or a patient
+    document (the patient or staff)
+    """
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+    parser_classes = [JSONParser, FormParser, MultiPartParser]
+
+    def post(self, request):
+        data = request.data
+        target = data.get('target')
+        file_name = data.get('file_name')
+        try:
+            total_size = int(data.get('total_size'))
+        except (TypeError, ValueError):
+            return Response({"error": "total_size must be an integer"}, status=400)
+        if not file_name:
+            return Response({"error": "file_name is required"}, status=400)
+
+        lab_test = patient = document_type = None
+        if target == UploadSession.Target.LAB_TEST_IMAGE:
+            if not hasattr(request.user, 'staff_id'):
+                return Response({"error": "Only staff can upload lab test images"}, status=403)
+            try:
+                assigned_lab = request.user.lab_tech_details.assigned_lab
+            except (AttributeError, LabTechnicianDetails.DoesNotExist):
+                return Response({"error": "Only lab technicians can upload lab test images"}, status=403)
+            try:
+                lab_test_id = int(data.get('lab_test_id'))
+            except (TypeError, ValueError):
+                return Response({"error": "lab_test_id must be an integer"}, status=400)
+            lab_test = get_object_or_404(LabTest, lab_test_id=lab_test_id)
+            # Same ownership rule as the worklist and bulk results: only tests of the technician's lab
+            if lab_test.lab_id not in resolve_lab_ids(assigned_lab):
+                return Response({"error": "You can only upload images for lab tests in your lab"}, status=403)
+            if not lab_test.tran_id:
+                return Response({"error": "This lab test has not been paid for yet"}, status=400)
+        elif target == UploadSession.Target.PATIENT_DOCUMENT:
+            try:
+                patient_id = int(data.get('patient_id'))
+            except (TypeError, ValueError):
+                return Response({"error": "patient_id must be an integer"}, status=400)
+            patient = get_object_or_404(Patient, patient_id=patient_id)
+            if hasattr(request.user, 'patient_id') and request.user.patient_id != patient.patient_id:
+                return Response({"error": "You can only upload your own documents"}, status=403)
+            document_type = data.get('document_type', 'other')
+            if document_type not in dict(PatientHistoryDocs.DOCUMENT_TYPE_CHOICES):
+                return Response({"error": "Invalid document_type"}, status=400)
+        else:
+            return Response({"error": f"target must be one of: {', '.join(UploadSession.Target.values)}"}, status=400)
+
+        try:
+            session = upload_service.start(
+                owner_id=_owner_id(request.user),
+                target=target,
+                file_name=file_name,
+                total_size=total_size,
+                lab_test=lab_test,
+                patient=patient,
+                document_type=document_type,
+                content_type=data.get('content_type'),
+                checksum=data.get('checksum')
+            )
+        except UploadError as e:
+            return _error(e)
+        return Response(_session_data(session), status=status.HTTP_201_CREATED)
+
+
+class UploadSessionDetailView(APIView):
+    """Progress of an upload (to resume from received_bytes), or abort it"""
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, upload_id):
+        try:
+            session = upload_service.get(upload_id, _owner_id(request.user))
+        except UploadError as e:
+            return _error(e)
+        return Response(_session_data(session), status=status.HTTP_200_OK)
+
+    def delete(self, request, upload_id):
+        try:
+            session = upload_service.abort(upload_id, _owner_id(request.user))
+        except UploadError as e:
+            return _error(e)
+        return Response(_session_data(session), status=status.HTTP_200_OK)
+
+
+class UploadChunkView(APIView):
+    """
+    Send one chunk: multipart with `chunk` (file), `offset` and optional
+    `checksum` (SHA-256 hex of the chunk)
+    """
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+    parser_classes = [MultiPartParser, FormParser]
+
+    def put(self, request, upload_id):
+        chunk = request.FILES.get('chunk')
+        if chunk is None:
+            return Response({"error": "chunk file is required"}, status=400)
+        try:
+            offset = int(request.data.get('offset'))
+        except (TypeError, ValueError):
+            return Response({"error": "offset must be an integer"}, status=400)
+        if offset < 0:
+            return Response({"error": "offset must not be negative"}, status=400)
+
+        try:
+            session = upload_service.append_chunk(
+                upload_id, _owner_id(request.user), offset, chunk, request.data.get('checksum')
+            )
+        except UploadError as e:
+            return _error(e)
+        return Response(_session_data(session), status=status.HTTP_200_OK)
+
+
+class UploadFinalizeView(APIView):
+    """Assemble the received chunks and attach the file to its lab test or patient"""
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, upload_id):
+        try:
+            attached = upload_service.finalize(upload_id, _owner_id(request.user))
+        except UploadError as e:
+            return _error(e)
+        except Exception as e:
+            logger.error(f"Error finalizing upload {upload_id}: {str(e)}")
+            return Response({"error": "Internal server error while finalizing upload"},
+                            status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response({"message": "Upload completed", "upload_id": str(upload_id), **attached},
+                        status=status.HTTP_201_CREATED)
@@ -90,6 +90,7 @@ from django.urls import path
 from . import views
 from . import functional_views
 from . import ocr_views
+from . import upload_views
 urlpatterns = [
     # Staff URLs
     path('staff/profile/', views.StaffProfileView.as_view(), name='staff-profile'),
@@ -144,6 +145,12 @@ urlpatterns = [
     path('general/appointments/<int:appointment_id>/recommend-lab-tests/', functional_views.RecommendLabTestsView.as_view(), name='recommend-lab-tests'),
     path('general/lab-tests/<int:lab_test_id>/pay/', functional_views.PayForLabTestsView.as_view(), name='pay-for-lab-test'),
     path('general/lab-tests/<int:lab_test_id>/results/', functional_views.AddLabTestResultsView.as_view(), name='add-lab-test-results'),
+    path('general/lab-tests/results/bulk/', functional_views.BulkLabTestResultsView.as_view(), name='bulk-lab-test-results'),
+    path('general/lab-results/flags/', functional_views.LabResultFlagListView.as_view(), name='lab-result-flags'),
+    path('general/patients/<int:patient_id>/analytes/', functional_views.PatientAnalyteHistoryView.as_view(), name='patient-analyte-history'),
+    path('general/lab-tests/<int:lab_test_id>/tiles/', functional_views.LabTestImageTilesView.as_view(), name='lab-test-image-tiles'),
+    path('general/lab-tests/<int:lab_test_id>/tiles/<int:level>/<int:x>/<int:y>/', functional_views.LabTestImageTileView.as_view(), name='lab-test-image-tile'),
+    path('general/lab-tests/<int:lab_test_id>/tiles/<str:version>/<int:level>/<int:x>/<int:y>/', functional_views.LabTestImageTileView.as_view(), name='lab-test-image-versioned-tile'),
     path('general/lab-tests/<int:lab_test_id>/status/', functional_views.UpdateLabTestStatusView.as_view(), name='update-lab-test-status'),
 
     # Lab Test Type API
@@ -175,6 +182,7 @@ urlpatterns = [
     
     # Lab Technician APIs
     path('general/lab-technician/assigned-patients/', functional_views.LabTechnicianAssignedPatientsView.as_view(), name='lab-tech-assigned-patients'),
+    path('general/lab-technician/worklist/', functional_views.LabTechnicianWorklistView.as_view(), name='lab-tech-worklist'),
     
     # OCR Patient Document Processing APIs
     path('ocr/documents/upload/', ocr_views.DocumentUploadView.as_view(), name='document-upload'),
@@ -185,4 +193,10 @@ urlpatterns = [
     path('ocr/histories/', ocr_views.PatientHistoryListView.as_view(), name='patient-histories-list'),
     path('ocr/document-types/', ocr_views.DocumentTypesView.as_view(), name='document-types'),
     path('ocr/supported-formats/', ocr_views.SupportedFormatsView.as_view(), name='supported-formats'),
+
+    # Chunked, resumable uploads (lab test images and patient documents)
+    path('general/uploads/', upload_views.UploadSessionCreateView.as_view(), name='upload-session-create'),
+    path('general/uploads/<uuid:upload_id>/', upload_views.UploadSessionDetailView.as_view(), name='upload-session-detail'),
+    path('general/uploads/<uuid:upload_id>/chunks/', upload_views.UploadChunkView.as_view(), name='upload-chunk'),
+    path('general/uploads/<uuid:upload_id>/finalize/', upload_views.UploadFinalizeView.as_view(), name='upload-finalize'),
 ]
\ No newline at end of file
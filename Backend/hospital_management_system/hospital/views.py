@@ -1,5 +1,5 @@
 # hospital/views.py (Create this file if it doesn't exist)
-from django.db.models import Avg
+from django.db import transaction
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
@@ -7,14 +7,17 @@ from rest_framework.parsers import MultiPartParser, FormParser
 from django.shortcuts import get_object_or_404
 from accounts.authentication import JWTAuthentication
 from rest_framework.permissions import IsAuthenticated
-from .models import Staff, StaffDetails, DoctorDetails, LabTechnicianDetails, Role, DoctorType, AppointmentRating, AppointmentCharge, LabTestCharge
+from .models import Staff, StaffDetails, DoctorDetails, LabTechnicianDetails, Role, DoctorType, AppointmentRating, AppointmentCharge, LabTestCharge, DoctorRatingSummary
 from .permissions import IsAdminStaff
 import uuid
 import datetime
+from django.utils import timezone
 from django.contrib.auth.hashers import make_password
 from .serializers import LabSerializer, LabTestTypeSerializer, LabTestChargeSerializer
 from .models import Lab, LabType, LabTestType, Appointment
 from .serializers import AppointmentRatingSerializer, AppointmentChargeSerializer
+from .price_book_service import price_book
+from .rating_summary_service import rating_summaries
 class StaffProfileView(APIView):
     authentication_classes = [JWTAuthentication]
     permission_classes = [IsAuthenticated]
@@ -820,12 +823,13 @@ class AppointmentRatingView(APIView):
         except (ValueError, TypeError):
             return Response({"error": "Invalid rating value"}, status=400)
             
-        # Create rating
-        appointment_rating = AppointmentRating.objects.create(
-            appointment=appointment,
-            rating=rating,
-            rating_comment=rating_comment
-        )
+        # Create rating; the doctor's rating summary is updated in the same transaction
+        with transaction.atomic():
+            appointment_rating = AppointmentRating.objects.create(
+                appointment=appointment,
+                rating=rating,
+                rating_comment=rating_comment
+            )
         
         serializer = AppointmentRatingSerializer(appointment_rating)
         #return Response(serializer.data, status=201)
@@ -895,7 +899,8 @@ class AppointmentRatingView(APIView):
         if rating_comment is not None:
             rating.rating_comment = rating_comment
             
-        rating.save()
+        with transaction.atomic():
+            rating.save()
         
         serializer = AppointmentRatingSerializer(rating)
         return Response(serializer.data, status=200)
@@ -919,7 +924,8 @@ class AppointmentRatingView(APIView):
             return Response({"error": "No rating found for this appointment"}, status=404)
             
         # Delete rating
-        rating.delete()
+        with transaction.atomic():
+            rating.delete()
         
         return Response({"message": "Rating deleted successfully"}, status=204)
     
@@ -937,10 +943,13 @@ class DoctorRatingsView(APIView):
         ratings = AppointmentRating.objects.filter(
             appointment__staff__staff_id=staff_id,
             appointment__status='completed'
-        ).order_by('-appointment__appointment_date')
+        ).select_related('appointment__patient', 'appointment__staff').order_by('-appointment__appointment_date')
         
-        # Calculate average rating
-        avg_rating = ratings.aggregate(Avg('rating'))['rating__avg'] or 0
+        # Average and count come from the doctor's rating summary
+        summary = DoctorRatingSummary.objects.filter(doctor_id=staff_id).first() or DoctorRatingSummary(
+            doctor_id=staff_id, score=rating_summaries.score(0, 0)
+        )
+        total_ratings = summary.rating_count
         
         # Paginate results
         start = (page - 1) * page_size
@@ -952,11 +961,13 @@ class DoctorRatingsView(APIView):
         
         # Build response
         response_data = {
-            'average_rating': round(avg_rating, 1),
-            'total_ratings': ratings.count(),
+            'average_rating': round(summary.average_rating, 1),
+            'total_ratings': total_ratings,
+            'rating_distribution': summary.rating_distribution,
+            'score': round(summary.score, 2),
             'page': page,
             'page_size': page_size,
-            'total_pages': (ratings.count() + page_size - 1) // page_size,
+            'total_pages': (total_ratings + page_size - 1) // page_size,
             'ratings': serializer.data
         }
         
@@ -1006,14 +1017,20 @@ class AppointmentChargeListCreateView(APIView):
     permission_classes = [IsAdminStaff]
 
     def get(self, request):
-        charges = AppointmentCharge.objects.all()
+        charges = AppointmentCharge.objects.select_related('doctor', 'charge_unit')
         serializer = AppointmentChargeSerializer(charges, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
     def post(self, request):
         serializer = AppointmentChargeSerializer(data=request.data)
         if serializer.is_valid():
-            serializer.save()
+            charge = serializer.save()
+            if charge.is_active:
+                # The new price supersedes the doctor's current one from its start date
+                price_book.retire(
+                    AppointmentCharge.objects.filter(doctor=charge.doctor).exclude(pk=charge.pk),
+                    at=charge.effective_from
+                )
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -1044,12 +1061,11 @@ class DoctorChargeView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, staff_id):
-        try:
-            charge = AppointmentCharge.objects.get(doctor__staff_id=staff_id, is_active=True)
-            serializer = AppointmentChargeSerializer(charge)
-            return Response(serializer.data, status=status.HTTP_200_OK)
-        except AppointmentCharge.DoesNotExist:
+        charge = price_book.appointment_charge(staff_id)
+        if charge is None:
             return Response({"error": "No charge found for this doctor"}, status=status.HTTP_404_NOT_FOUND)
+        serializer = AppointmentChargeSerializer(charge)
+        return Response(serializer.data, status=status.HTTP_200_OK)
 
 class LabTestChargeListCreateView(APIView):
     authentication_classes = [JWTAuthentication]
@@ -1057,7 +1073,7 @@ class LabTestChargeListCreateView(APIView):
 
     def get(self, request):
         """List all lab test charges"""
-        charges = LabTestCharge.objects.all()
+        charges = LabTestCharge.objects.select_related('test', 'charge_unit')
         serializer = LabTestChargeSerializer(charges, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
@@ -1065,15 +1081,14 @@ class LabTestChargeListCreateView(APIView):
         """Create a new lab test charge"""
         serializer = LabTestChargeSerializer(data=request.data)
         if serializer.is_valid():
+            charge = serializer.save()
             # Check if there's already an active charge for this test
-            if 'is_active' in request.data and request.data['is_active']:
-                # Deactivate all other charges for this test
-                LabTestCharge.objects.filter(
-                    test=request.data['test'], 
-                    is_active=True
-                ).update(is_active=False)
-                
-            serializer.save()
+            if charge.is_active:
+                # End all other charges for this test where the new price starts
+                price_book.retire(
+                    LabTestCharge.objects.filter(test=charge.test).exclude(pk=charge.pk),
+                    at=charge.effective_from
+                )
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -1092,14 +1107,13 @@ class LabTestChargeDetailView(APIView):
         charge = get_object_or_404(LabTestCharge, test_charge_id=test_charge_id)
         serializer = LabTestChargeSerializer(charge, data=request.data)
         if serializer.is_valid():
-            # If setting this charge to active, deactivate all other charges for this test
-            if 'is_active' in request.data and request.data['is_active']:
-                LabTestCharge.objects.filter(
-                    test=charge.test, 
-                    is_active=True
-                ).exclude(test_charge_id=test_charge_id).update(is_active=False)
-                
-            serializer.save()
+            charge = serializer.save()
+            # If setting this charge to active, end all other charges for this test
+            if charge.is_active:
+                price_book.retire(
+                    LabTestCharge.objects.filter(test=charge.test).exclude(test_charge_id=test_charge_id),
+                    at=max(charge.effective_from, timezone.now())
+                )
             return Response(serializer.data, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -1114,18 +1128,17 @@ class LabTestChargeForPatientView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, test_type_id):
-        try:
-            charge = LabTestCharge.objects.get(test__test_type_id=test_type_id, is_active=True)
-            serializer = LabTestChargeSerializer(charge)
-            return Response(serializer.data, status=status.HTTP_200_OK)
-        except LabTestCharge.DoesNotExist:
+        charge = price_book.lab_test_charge(test_type_id)
+        if charge is None:
             return Response({"error": "No charge found for this lab test"}, status=status.HTTP_404_NOT_FOUND)
+        serializer = LabTestChargeSerializer(charge)
+        return Response(serializer.data, status=status.HTTP_200_OK)
 
 class AllLabTestChargesView(APIView):
     authentication_classes = [JWTAuthentication]
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        charges = LabTestCharge.objects.filter(is_active=True)
+        charges = price_book.current_lab_test_charges()
         serializer = LabTestChargeSerializer(charges, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
@@ -44,6 +44,7 @@ INSTALLED_APPS = [
     'hospital',
     'accounts',
     'transactions',
+    'machine_learning',
     'storages',
 ]
 
@@ -215,3 +216,108 @@ LOGGING = {
         },
     },
 }
+
+# Lab scheduling: capacity bucket size, how far ahead to look for free lab time
+# and how often each worker reloads lab occupancy from the database
+LAB_SCHEDULE_BUCKET_MINUTES = 15
+LAB_SCHEDULE_SEARCH_HOURS = 24
+LAB_SCHEDULE_REBUILD_SECONDS = 300
+
+# Lab technician worklist: result turnaround per priority and long-poll interval
+LAB_TEST_SLA_HOURS = {'high': 4, 'medium': 24, 'low': 72}
+LAB_WORKLIST_POLL_INTERVAL = 1.0
+LAB_WORKLIST_MAX_WAIT_SECONDS = 30
+
+# Price book: how often each worker reloads charges changed by other workers
+PRICE_BOOK_REFRESH_SECONDS = 60
+
+# Bulk lab results: analyzer rows validated and written per chunk
+LAB_RESULTS_BULK_CHUNK_SIZE = 500
+
+# Single lab results: reject test_result keys that name no schema parameter
+# (clients can opt in per request with strict_schema=true)
+LAB_RESULTS_STRICT_SCHEMA_KEYS = False
+
+# Reference ranges: how often each worker reloads ranges edited elsewhere
+REFERENCE_RANGE_REFRESH_SECONDS = 300
+
+# Delta checks on a patient's analyte history: flag a change larger than the
+# per-analyte absolute limit, or else this percentage, within the window
+LAB_DELTA_CHECK_PERCENT = 25
+LAB_DELTA_CHECK_LIMITS = {}
+LAB_DELTA_CHECK_WINDOW_DAYS = 30
+
+# Chunked uploads: per-chunk and per-file limits, and how long an unfinished upload is kept
+UPLOAD_CHUNK_MAX_BYTES = 8 * 1024 * 1024
+UPLOAD_MAX_BYTES = 2 * 1024 * 1024 * 1024
+UPLOAD_SESSION_TTL_HOURS = 24
+
+# Lab image tile pyramids: tile size and quality, where containers are kept,
+# background tiler threads, open containers per worker, and browser cache lifetime
+TILE_SIZE = 256
+TILE_JPEG_QUALITY = 85
+TILE_CACHE_DIR = os.path.join(BASE_DIR, 'tile_cache')
+TILE_WORKERS = 2
+TILE_OPEN_CONTAINERS = 64
+TILE_CACHE_MAX_AGE = 86400
+
+# Invoice PDFs: WeasyPrint worker processes (0 renders inside the web process)
+INVOICE_PDF_WORKERS = 2
+
+# Billing run: tax added to invoices (same 5% as the invoice views) and items invoiced per transaction
+INVOICE_TAX_PERCENT = 5
+BILLING_RUN_BATCH_SIZE = 2000
+
+# Payment reconciliation: transactions updated per query and rows between progress reports
+RECONCILIATION_BATCH_SIZE = 5000
+RECONCILIATION_PROGRESS_ROWS = 100000
+
+# Idempotency-Key: how long responses are replayable, how long a claim is held and how long duplicates wait for it
+IDEMPOTENCY_KEY_TTL_HOURS = 24
+IDEMPOTENCY_LOCK_SECONDS = 60
+IDEMPOTENCY_WAIT_SECONDS = 10
+
+# Doctor rating summaries: scores are averages smoothed towards PRIOR_MEAN as if every doctor had PRIOR_WEIGHT extra ratings of it
+RATING_PRIOR_MEAN = 3.0
+RATING_PRIOR_WEIGHT = 5
+
+# Analytics response cache: lifetime, how long before expiry a requested entry is recomputed in the background,
+# entries kept per worker and background refresh threads
+ANALYTICS_CACHE_TTL_SECONDS = 60
+ANALYTICS_CACHE_REFRESH_AHEAD_SECONDS = 10
+ANALYTICS_CACHE_MAX_ENTRIES = 256
+ANALYTICS_CACHE_REFRESH_WORKERS = 2
+
+# Change-data export: output directory, rows fetched per query and written per file, and how recent
+# changes are left for the next run so rows of transactions still in flight are not skipped
+EXPORT_DIR = os.path.join(BASE_DIR, 'exports')
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_ROWS_PER_FILE = 100000
+EXPORT_SAFETY_LAG_SECONDS = 60
+
+# Appointment forecasts: days of history fitted, days held out to choose each series' model,
+# how old fits may get before a request retrains them, and the longest horizon served
+FORECAST_HISTORY_DAYS = 364
+FORECAST_HOLDOUT_DAYS = 14
+FORECAST_RETRAIN_HOURS = 24
+FORECAST_MAX_WEEKS = 4
+
+# No-show model: days of past appointments it learns from, L2 regularization, appointments a doctor needs
+# for a feature of their own, the fewest appointments worth training on, how old it may get before the
+# scoring job retrains it, and the risk from which an appointment is flagged for overbooking
+NO_SHOW_HISTORY_DAYS = 730
+NO_SHOW_L2 = 1.0
+NO_SHOW_MIN_DOCTOR_APPOINTMENTS = 20
+NO_SHOW_MIN_TRAINING_ROWS = 100
+NO_SHOW_RETRAIN_DAYS = 7
+NO_SHOW_HIGH_RISK = 0.4
+
+# Doctor recommender: where builds are written (shared by every worker) and hashed n-gram columns as a power of two
+RECOMMENDER_DIR = os.path.join(BASE_DIR, 'recommender')
+RECOMMENDER_HASH_BITS = 18
+
+# Lab test suggestions: where the nightly tables are written, tests kept per test or diagnosis term,
+# and how many appointments must share a pair before it is suggested
+LAB_SUGGESTIONS_FILE = os.path.join(RECOMMENDER_DIR, 'lab_test_suggestions.json')
+LAB_SUGGESTION_TOP_K = 10
+LAB_SUGGESTION_MIN_SUPPORT = 3
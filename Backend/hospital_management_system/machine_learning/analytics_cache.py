@@ -0,0 +1,191 @@
+"""
+In-process cache of analytics responses, with request coalescing and refresh-ahead
+"""
+import functools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Hashable, Tuple
+
+from django.conf import settings
+from django.db import close_old_connections
+from rest_framework.response import Response
+
+logger = logging.getLogger(__name__)
+
+CACHE_HEADER = 'Analytics-Cache'
+
+# (response data, status code)
+Result = Tuple[object, int]
+
+
+class _Entry:
+    __slots__ = ('result', 'expires_at')
+
+    def __init__(self, result: Result, expires_at: float):
+        self.result = result
+        self.expires_at = expires_at
+
+
+class _Flight:
+    """One computation in progress, which identical requests wait for instead of repeating it"""
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class AnalyticsCache:
+    """
+    Caches analytics responses per (endpoint, query parameters) for
+    ANALYTICS_CACHE_TTL_SECONDS.
+
+    On a miss the first request computes the response and every identical
+    request arriving meanwhile waits for that result rather than running the
+    same queries again (singleflight). A hit in the last
+    ANALYTICS_CACHE_REFRESH_AHEAD_SECONDS of an entry's life hands a
+    recompute to a background thread and still answers from the cache, so a
+    key that dashboards keep polling is replaced before it expires and no one
+    waits on it again. Keys nobody asks for simply expire. At most
+    ANALYTICS_CACHE_MAX_ENTRIES are kept, least recently used first out.
+
+    The cache lives in each worker process, like the price book: analytics
+    can be up to one TTL behind the database.
+    """
+
+    def __init__(self):
+        self.ttl = getattr(settings, 'ANALYTICS_CACHE_TTL_SECONDS', 60)
+        self.refresh_ahead = min(getattr(settings, 'ANALYTICS_CACHE_REFRESH_AHEAD_SECONDS', 10), self.ttl)
+        self.max_entries = getattr(settings, 'ANALYTICS_CACHE_MAX_ENTRIES', 256)
+        self._workers = getattr(settings, 'ANALYTICS_CACHE_REFRESH_WORKERS', 2)
+        self._entries: OrderedDict = OrderedDict()
+        self._flights = {}
+        self._refreshing = set()
+        self._executor = None
+        self._lock = threading.RLock()
+
+    def get(self, key: Hashable, compute: Callable[[], Result]) -> Tuple[Result, str]:
+        """
+        The cached result for `key`, computing it if needed
+
+        Args:
+            key: Identifies the response, e.g. (endpoint, sorted query parameters)
+            compute: Produces (data, status); only status 200 results are cached
+
+        Returns:
+            (result, how it was served: 'hit', 'miss' or 'coalesced')
+        """
+        if self.ttl <= 0:
+            return compute(), 'miss'
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at > now:
+                self._entries.move_to_end(key)
+                if entry.expires_at - now <= self.refresh_ahead:
+                    self._refresh_in_background(key, compute)
+                return entry.result, 'hit'
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, 'coalesced'
+
+        try:
+            flight.result = compute()
+            self._store(key, flight.result)
+            return flight.result, 'miss'
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def invalidate(self):
+        """Drop every cached response; the next request for each recomputes it"""
+        with self._lock:
+            self._entries.clear()
+
+    def _store(self, key: Hashable, result: Result):
+        if result[1] != 200:
+            return
+        with self._lock:
+            self._entries[key] = _Entry(result, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    # ------------------------------------------------------------------
+    # Refresh-ahead
+    # ------------------------------------------------------------------
+
+    def _refresh_in_background(self, key: Hashable, compute: Callable[[], Result]):
+        # Called with the lock held
+        if key in self._refreshing:
+            return
+        self._refreshing.add(key)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='analytics-refresh')
+        self._executor.submit(self._refresh, key, compute)
+
+    def _refresh(self, key: Hashable, compute: Callable[[], Result]):
+        # Runs outside any request, so the thread's connection is opened and closed here,
+        # as Django does around each request
+        close_old_connections()
+        try:
+            self._store(key, compute())
+        except Exception as e:
+            # The entry just expires and the next request recomputes it
+            logger.error(f"Error refreshing analytics {key}: {str(e)}")
+        finally:
+            close_old_connections()
+            with self._lock:
+                self._refreshing.discard(key)
+
+
+analytics_cache = AnalyticsCache()
+
+
+def cached_analytics(handler):
+    """
+    Serve an APIView GET handler through the analytics cache, keyed by the
+    view and its query parameters. The handler must depend on nothing else
+    in the request, since a background refresh reruns it with the request of
+    whichever call triggered it.
+    """
+    @functools.wraps(handler)
+    def wrapper(view, request, *args, **kwargs):
+        params = tuple(sorted((name, tuple(values)) for name, values in request.query_params.lists()))
+        key = (type(view).__name__, tuple(args), tuple(sorted(kwargs.items())), params)
+
+        def compute() -> Result:
+            response = handler(view, request, *args, **kwargs)
+            return response.data, response.status_code
+
+        (data, status), served = analytics_cache.get(key, compute)
+        return Response(data, status=status, headers={CACHE_HEADER: served})
+
+    return wrapper
+
+
+class CachedAnalyticsMixin:
+    """APIView mixin serving the view's get() through the analytics cache"""
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        handler = cls.__dict__.get('get')
+        if handler is not None:
+            cls.get = cached_analytics(handler)
@@ -0,0 +1,399 @@
+"""
+Appointment demand forecasts per doctor and per specialization
+"""
+import logging
+import time
+from datetime import date, timedelta
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Max, Sum
+from django.utils import timezone
+
+from hospital.models import DoctorDetails
+from .models import DailyAppointments, ForecastSeries, ForecastTraining, RollupDay
+from .rollup_service import rollups
+
+logger = logging.getLogger(__name__)
+
+WEEK = 7
+
+# Holt-Winters smoothing parameters tried for every series at once
+ALPHAS = np.array([0.05, 0.1, 0.2, 0.3, 0.5])
+BETAS = np.array([0.0, 0.01, 0.05, 0.1])
+GAMMAS = np.array([0.05, 0.1, 0.2, 0.3])
+# Damping of the Holt-Winters trend, so a few busy weeks do not extrapolate forever
+DAMPING = 0.98
+# Regularization of the seasonal-trend normal equations (a weekday a new doctor has not worked yet)
+RIDGE = 1e-3
+
+
+def weekday_index(first_weekday: int, count: int) -> np.ndarray:
+    """Weekday (Monday = 0) of `count` consecutive days, the first of which falls on `first_weekday`"""
+    return (np.arange(count) + first_weekday) % WEEK
+
+
+def active_days(history: np.ndarray) -> np.ndarray:
+    """
+    Days from each series' first appointment on: a doctor who joined last
+    month has no demand to learn from before that
+    """
+    return np.cumsum(history, axis=1) > 0
+
+
+def damped_steps(damping: np.ndarray, steps: np.ndarray) -> np.ndarray:
+    """damping + damping**2 + ... + damping**steps, elementwise (just steps when damping is 1)"""
+    damping = np.asarray(damping, dtype=float)
+    steps = np.asarray(steps, dtype=float)
+    undamped = np.isclose(damping, 1.0)
+    safe = np.where(undamped, 0.5, damping)
+    return np.where(undamped, steps, safe * (1 - safe ** steps) / (1 - safe))
+
+
+def project(level, trend, damping, seasonal, first_weekday: int, steps) -> np.ndarray:
+    """
+    Forecasts of several series for days after the end of their history
+
+    Args:
+        level, trend, damping: Arrays of shape (series,)
+        seasonal: Array of shape (series, 7), Monday first
+        first_weekday: Weekday of the first day after the history
+        steps: 1-based day offsets after the history
+
+    Returns:
+        Array of shape (series, len(steps)), never negative
+    """
+    steps = np.asarray(steps)
+    days = (first_weekday + steps - 1) % WEEK
+    forecast = (
+        np.asarray(level, dtype=float)[:, None]
+        + np.asarray(trend, dtype=float)[:, None] * damped_steps(np.asarray(damping)[:, None], steps[None, :])
+        + np.asarray(seasonal, dtype=float)[:, days]
+    )
+    return np.maximum(forecast, 0)
+
+
+# ----------------------------------------------------------------------
+# Batched fits: all series are the rows of one (series, days) matrix
+# ----------------------------------------------------------------------
+
+def fit_seasonal_trend(history: np.ndarray, active: np.ndarray, first_weekday: int) -> Dict[str, np.ndarray]:
+    """
+    Day-of-week effects plus a linear trend, by least squares over each
+    series' active days. The series share one design matrix, so the normal
+    equations of all of them come out of two einsums and are solved in a
+    single batched call.
+
+    Returns:
+        State at the end of the history: level, trend (per day), damping (1) and seasonal
+    """
+    series, days = history.shape
+    design = np.zeros((days, WEEK + 1))
+    design[np.arange(days), weekday_index(first_weekday, days)] = 1
+    # Time in units of the whole window keeps the system well conditioned
+    design[:, WEEK] = np.arange(days) / days
+
+    weights = active.astype(float)
+    normal = np.einsum('st,ti,tj->sij', weights, design, design) + RIDGE * np.eye(WEEK + 1)
+    target = np.einsum('st,ti->si', weights * history, design)
+    coefficients = np.linalg.solve(normal, target[:, :, None])[:, :, 0]
+
+    effects = coefficients[:, :WEEK]
+    slope = coefficients[:, WEEK] / days
+    mean_effect = effects.mean(axis=1)
+    return {
+        'level': mean_effect + slope * (days - 1),
+        'trend': slope,
+        'damping': np.ones(series),
+        'seasonal': effects - mean_effect[:, None],
+    }
+
+
+def fit_holt_winters(history: np.ndarray, active: np.ndarray, first_weekday: int) -> Dict[str, np.ndarray]:
+    """
+    Additive Holt-Winters with a damped trend and weekly seasonality. Every
+    combination of ALPHAS x BETAS x GAMMAS runs for every series in a single
+    pass over the days, on arrays of shape (combinations, series), and each
+    series keeps the combination with the smallest one-step-ahead squared
+    error. Days before a series' first appointment leave its state alone.
+
+    Returns:
+        State at the end of the history (level, trend, damping, seasonal) and the chosen alpha, beta, gamma
+    """
+    series, days = history.shape
+    alpha, beta, gamma = (grid.reshape(-1, 1) for grid in np.meshgrid(ALPHAS, BETAS, GAMMAS, indexing='ij'))
+    combinations = alpha.shape[0]
+    day_of_week = weekday_index(first_weekday, days)
+
+    # Start from each series' mean and weekday profile over its active days
+    active_count = np.maximum(active.sum(axis=1), 1)
+    mean = (history * active).sum(axis=1) / active_count
+    profile = np.zeros((series, WEEK))
+    for weekday in range(WEEK):
+        columns = day_of_week == weekday
+        seen = active[:, columns].sum(axis=1)
+        total = (history[:, columns] * active[:, columns]).sum(axis=1)
+        profile[:, weekday] = np.where(seen > 0, total / np.maximum(seen, 1) - mean, 0)
+
+    level = np.repeat(mean[None, :], combinations, axis=0)
+    trend = np.zeros((combinations, series))
+    seasonal = np.repeat(profile[None, :, :], combinations, axis=0)
+    errors = np.zeros((combinations, series))
+    # The first active week only settles the state and is not scored
+    scored = np.cumsum(active, axis=1) > WEEK
+
+    for day in range(days):
+        weekday = day_of_week[day]
+        observed = history[:, day]
+        season = seasonal[:, :, weekday]
+        expected_level = level + DAMPING * trend
+        error = observed - (expected_level + season)
+        errors += np.where(scored[:, day], error ** 2, 0)
+
+        new_level = alpha * (observed - season) + (1 - alpha) * expected_level
+        new_trend = beta * (new_level - level) + (1 - beta) * DAMPING * trend
+        new_season = gamma * (observed - new_level) + (1 - gamma) * season
+        mask = active[:, day]
+        level = np.where(mask, new_level, level)
+        trend = np.where(mask, new_trend, trend)
+        seasonal[:, :, weekday] = np.where(mask, new_season, season)
+
+    best = errors.argmin(axis=0)
+    chosen = (best, np.arange(series))
+    return {
+        'level': level[chosen],
+        'trend': trend[chosen],
+        'damping': np.full(series, DAMPING),
+        'seasonal': seasonal[chosen],
+        'alpha': alpha[best, 0],
+        'beta': beta[best, 0],
+        'gamma': gamma[best, 0],
+    }
+
+
+FITS = {
+    ForecastSeries.SEASONAL_TREND: fit_seasonal_trend,
+    ForecastSeries.HOLT_WINTERS: fit_holt_winters,
+}
+STATE = ('level', 'trend', 'damping', 'seasonal', 'alpha', 'beta', 'gamma')
+
+
+def fit_series(history: np.ndarray, first: date, holdout_days: int) -> Dict[str, np.ndarray]:
+    """
+    Fit both models to every series, score each on the last `holdout_days`
+    after fitting it on the days before, and keep the better one per series,
+    refitted on the whole history
+
+    Args:
+        history: Daily appointment counts, shape (series, days)
+        first: Date of the first column
+        holdout_days: Days held out to choose the model
+
+    Returns:
+        Per-series arrays: method (index into FITS), mae and the state of
+        the chosen model (alpha, beta and gamma are NaN for seasonal-trend)
+    """
+    history = np.asarray(history, dtype=float)
+    series, days = history.shape
+    active = active_days(history)
+    train_days = days - holdout_days
+    holdout_weekday = (first + timedelta(days=train_days)).weekday()
+    steps = np.arange(1, holdout_days + 1)
+
+    errors, fits = [], []
+    for fit in FITS.values():
+        trial = fit(history[:, :train_days], active[:, :train_days], first.weekday())
+        predicted = project(trial['level'], trial['trend'], trial['damping'], trial['seasonal'], holdout_weekday, steps)
+        held_out = active[:, train_days:]
+        errors.append((np.abs(predicted - history[:, train_days:]) * held_out).sum(axis=1) / np.maximum(held_out.sum(axis=1), 1))
+        fits.append(fit(history, active, first.weekday()))
+
+    errors = np.stack(errors)
+    chosen = errors.argmin(axis=0)
+    rows = np.arange(series)
+    result = {'method': chosen, 'mae': errors[chosen, rows]}
+    for name in STATE:
+        stacked = np.stack([fit.get(name, np.full(series, np.nan)) for fit in fits])
+        result[name] = stacked[chosen, rows]
+    return result
+
+
+class ForecastingService:
+    """
+    Trains and serves appointment-volume forecasts for roster planning.
+
+    Daily appointment counts per doctor come from the DailyAppointments
+    rollup in one grouped query; a specialization's series is the sum of
+    its doctors'. Every series is fitted with both a day-of-week x trend
+    regression and Holt-Winters exponential smoothing, all series at once in
+    NumPy (see fit_series), and the model that did better on the held-out
+    last FORECAST_HOLDOUT_DAYS is kept. Fitted states are stored in
+    ForecastSeries, so serving a forecast is a read and a few array
+    operations; the models are retrained when older than
+    FORECAST_RETRAIN_HOURS or by train_forecasts.
+    """
+
+    def __init__(self):
+        self.history_days = getattr(settings, 'FORECAST_HISTORY_DAYS', 364)
+        self.holdout_days = getattr(settings, 'FORECAST_HOLDOUT_DAYS', 14)
+        self.retrain_after = timedelta(hours=getattr(settings, 'FORECAST_RETRAIN_HOURS', 24))
+        self.max_weeks = getattr(settings, 'FORECAST_MAX_WEEKS', 4)
+
+    # ------------------------------------------------------------------
+    # Training
+    # ------------------------------------------------------------------
+
+    def history(self, last: date) -> Dict:
+        """
+        Daily appointment counts of every doctor and specialization up to `last`
+
+        Returns:
+            Dict with first (date), kinds and keys (per row) and counts (rows x days)
+        """
+        first = last - timedelta(days=self.history_days - 1)
+        rollups.ensure_fresh(RollupDay.APPOINTMENTS)
+        rows = list(DailyAppointments.objects.filter(day__gte=first, day__lte=last).values(
+            'doctor_id', 'day'
+        ).annotate(appointments=Sum('appointment_count')).order_by())
+
+        doctors = sorted({row['doctor_id'] for row in rows})
+        position = {doctor_id: number for number, doctor_id in enumerate(doctors)}
+        counts = np.zeros((len(doctors), self.history_days))
+        if rows:
+            np.add.at(
+                counts,
+                (
+                    np.fromiter((position[row['doctor_id']] for row in rows), dtype=np.int64, count=len(rows)),
+                    np.fromiter(((row['day'] - first).days for row in rows), dtype=np.int64, count=len(rows)),
+                ),
+                np.fromiter((row['appointments'] for row in rows), dtype=float, count=len(rows))
+            )
+
+        # Specializations as they are now: a doctor's whole history counts towards their current one
+        specialization_of = dict(DoctorDetails.objects.filter(staff_id__in=doctors).values_list(
+            'staff_id', 'doctor_specialization'
+        ))
+        specializations = sorted(set(specialization_of.values()))
+        membership = np.zeros((len(specializations), len(doctors)))
+        spec_position = {name: number for number, name in enumerate(specializations)}
+        for doctor_id, specialization in specialization_of.items():
+            membership[spec_position[specialization], position[doctor_id]] = 1
+
+        return {
+            'first': first,
+            'kinds': [ForecastSeries.DOCTOR] * len(doctors) + [ForecastSeries.SPECIALIZATION] * len(specializations),
+            'keys': doctors + specializations,
+            'counts': np.vstack([counts, membership @ counts]) if doctors else counts,
+        }
+
+    def train(self, today: date = None) -> Dict:
+        """
+        Fit every series on the history up to yesterday and store the fits
+
+        Returns:
+            Summary: series fitted, seconds spent loading and fitting, and how many series each method won
+        """
+        today = today or timezone.localdate()
+        started = time.perf_counter()
+        data = self.history(today - timedelta(days=1))
+        loaded = time.perf_counter()
+        fitted = fit_series(data['counts'], data['first'], self.holdout_days) if data['keys'] else None
+        fit_done = time.perf_counter()
+
+        methods = list(FITS)
+        now = timezone.now()
+        last = today - timedelta(days=1)
+        records = []
+        for row, (kind, key) in enumerate(zip(data['kinds'], data['keys'])):
+            method = methods[fitted['method'][row]]
+            records.append(ForecastSeries(
+                kind=kind,
+                key=key,
+                method=method,
+                level=float(fitted['level'][row]),
+                trend=float(fitted['trend'][row]),
+                damping=float(fitted['damping'][row]),
+                seasonal=[round(float(value), 6) for value in fitted['seasonal'][row]],
+                smoothing={} if method == ForecastSeries.SEASONAL_TREND else {
+                    name: float(fitted[name][row]) for name in ('alpha', 'beta', 'gamma')
+                },
+                history_start=data['first'],
+                history_end=last,
+                mae=float(fitted['mae'][row]),
+                trained_at=now,
+            ))
+        with transaction.atomic():
+            ForecastSeries.objects.all().delete()
+            ForecastSeries.objects.bulk_create(records, batch_size=1000)
+            ForecastTraining.objects.create(series=len(records), history_end=last, trained_at=now)
+
+        summary = {
+            'series': len(records),
+            'load_seconds': round(loaded - started, 3),
+            'fit_seconds': round(fit_done - loaded, 3),
+            **{method: sum(1 for record in records if record.method == method) for method in methods},
+        }
+        logger.info(f"Trained appointment forecasts: {summary}")
+        return summary
+
+    def ensure_trained(self):
+        """Retrain if it never trained or the last run is older than FORECAST_RETRAIN_HOURS"""
+        # Keyed off the runs rather than the fits: a run with no history stores no fits
+        trained_at = ForecastTraining.objects.aggregate(latest=Max('trained_at'))['latest']
+        if trained_at is None or timezone.now() - trained_at >= self.retrain_after:
+            try:
+                self.train()
+            except IntegrityError:
+                pass  # Another request retrained at the same time; its fits are just as fresh
+
+    # ------------------------------------------------------------------
+    # Forecasts
+    # ------------------------------------------------------------------
+
+    def forecast(self, kind: str, keys: Optional[Iterable[str]] = None, weeks: int = 1,
+                 start: date = None) -> List[Dict]:
+        """
+        Daily forecasts for `weeks` weeks from `start` (today by default)
+
+        Args:
+            kind: ForecastSeries.DOCTOR or ForecastSeries.SPECIALIZATION
+            keys: Staff ids or specializations; all of the kind if None
+
+        Returns:
+            One dict per series: kind, key, method, mae, trained_at and daily (list of (date, appointments))
+        """
+        start = start or timezone.localdate()
+        fits = ForecastSeries.objects.filter(kind=kind).order_by('key')
+        if keys is not None:
+            fits = fits.filter(key__in=list(keys))
+        fits = list(fits)
+        if not fits:
+            return []
+
+        results = []
+        # Series trained together share history_end; group in case a partial retrain left several
+        for history_end in sorted({fit.history_end for fit in fits}):
+            group = [fit for fit in fits if fit.history_end == history_end]
+            # Step 1 is the day after history_end; start is never earlier than that day
+            offset = max((start - history_end).days, 1)
+            values = project(
+                [fit.level for fit in group], [fit.trend for fit in group], [fit.damping for fit in group],
+                [fit.seasonal for fit in group], (history_end + timedelta(days=1)).weekday(),
+                np.arange(offset, offset + weeks * WEEK)
+            )
+            for fit, row in zip(group, values):
+                results.append({
+                    'kind': fit.kind,
+                    'key': fit.key,
+                    'method': fit.method,
+                    'mae': fit.mae,
+                    'trained_at': fit.trained_at,
+                    'daily': [(history_end + timedelta(days=offset + day), float(value)) for day, value in enumerate(row)],
+                })
+        results.sort(key=lambda result: result['key'])
+        return results
+
+
+forecaster = ForecastingService()
@@ -0,0 +1,266 @@
+"""
+Lab test suggestions from tests ordered together and for similar diagnoses
+"""
+import json
+import logging
+import math
+import os
+import threading
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from hospital.models import Diagnosis, LabTest, LabTestType
+from .recommender_service import TOKEN_PATTERN
+
+logger = logging.getLogger(__name__)
+
+TABLE_VERSION = 1
+# Terms a partly typed word expands to
+PREFIX_TERMS = 20
+
+
+def diagnosis_terms(data) -> List[str]:
+    """Distinct words of every string in a diagnosis' JSON, keys left out"""
+    strings = []
+
+    def collect(value):
+        if isinstance(value, str):
+            strings.append(value)
+        elif isinstance(value, dict):
+            for item in value.values():
+                collect(item)
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                collect(item)
+
+    collect(data)
+    words = TOKEN_PATTERN.findall(' '.join(strings).lower())
+    return sorted({word for word in words if len(word) >= 3 and not word.isdigit()})
+
+
+def pair_counts(left_groups: np.ndarray, left_items: np.ndarray, right_groups: np.ndarray,
+                right_items: np.ndarray, right_size: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Entries of L^T R for the sparse incidence matrices L (groups x left
+    items) and R (groups x right items): how many groups contain each pair.
+    Both sides must be sorted by group; every left entry is joined with the
+    right entries of its group in one vectorized step.
+
+    Returns:
+        (left item, right item, count) of the nonzero entries
+    """
+    group_count = int(max(left_groups.max(initial=-1), right_groups.max(initial=-1))) + 1
+    right_start = np.searchsorted(right_groups, np.arange(group_count))
+    repeats = np.bincount(right_groups, minlength=group_count)[left_groups]
+    total = int(repeats.sum())
+    offsets = np.arange(total) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    right = right_items[np.repeat(right_start[left_groups], repeats) + offsets]
+    keys, counts = np.unique(np.repeat(left_items, repeats).astype(np.int64) * right_size + right, return_counts=True)
+    return keys // right_size, keys % right_size, counts
+
+
+def top_k(sources: np.ndarray, targets: np.ndarray, scores: np.ndarray, support: np.ndarray,
+          k: int) -> Dict[int, List[Tuple[int, float, int]]]:
+    """The k best (target, score, support) of each source, best first"""
+    order = np.lexsort((-scores, sources))
+    table: Dict[int, List[Tuple[int, float, int]]] = {}
+    for position in order:
+        suggestions = table.setdefault(int(sources[position]), [])
+        if len(suggestions) < k:
+            suggestions.append((int(targets[position]), round(float(scores[position]), 4), int(support[position])))
+    return table
+
+
+class LabSuggestionService:
+    """
+    Suggests lab tests while a doctor orders them, from two tables built by a
+    nightly batch over every appointment with lab tests:
+
+    - test -> test: of the appointments that ordered test A, the share that
+      also ordered B (the A x B entry of the test co-occurrence matrix A^T A,
+      over A's diagonal entry)
+    - diagnosis term -> test: of the appointments whose diagnosis mentions a
+      word, the share that ordered the test, weighted by how specific the
+      word is (its inverse document frequency)
+
+    Both matrices are computed with vectorized sparse pair counts, and only
+    the LAB_SUGGESTION_TOP_K best tests of each row seen together at least
+    LAB_SUGGESTION_MIN_SUPPORT times are kept. The tables are written to
+    LAB_SUGGESTIONS_FILE and held in memory by each worker, so a suggestion
+    is a few dictionary lookups and never queries the database.
+    """
+
+    def __init__(self):
+        self.path = getattr(settings, 'LAB_SUGGESTIONS_FILE', os.path.join(settings.BASE_DIR, 'recommender', 'lab_test_suggestions.json'))
+        self.top_k = getattr(settings, 'LAB_SUGGESTION_TOP_K', 10)
+        self.min_support = getattr(settings, 'LAB_SUGGESTION_MIN_SUPPORT', 3)
+        self._table: Optional[Dict] = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------------
+    # Nightly build
+    # ------------------------------------------------------------------
+
+    def build(self) -> Dict:
+        """
+        Recompute both tables from the lab tests and diagnoses of every appointment, and publish them
+
+        Returns:
+            Summary: appointments, tests and terms with suggestions, and when it was built
+        """
+        orders = np.array(list(LabTest.objects.values_list('appointment_id', 'test_type_id').distinct().order_by(
+            'appointment_id', 'test_type_id'
+        )), dtype=np.int64).reshape(-1, 2)
+        appointment_ids, groups = np.unique(orders[:, 0], return_inverse=True)
+        tests = orders[:, 1]
+        test_size = int(tests.max(initial=0)) + 1
+
+        # Test co-occurrence: the diagonal counts the appointments that ordered each test
+        first, second, together = pair_counts(groups, tests, groups, tests, test_size)
+        ordered = np.bincount(tests, minlength=test_size)
+        pairs = (first != second) & (together >= self.min_support)
+        test_table = top_k(
+            first[pairs], second[pairs], together[pairs] / ordered[first[pairs]], together[pairs], self.top_k
+        )
+
+        # Diagnosis terms of the same appointments
+        position = {int(appointment_id): group for group, appointment_id in enumerate(appointment_ids)}
+        term_ids: Dict[str, int] = {}
+        term_rows = []
+        for appointment_id, data in Diagnosis.objects.values_list(
+            'appointment_id', 'diagnosis_data'
+        ).order_by('appointment_id').iterator(chunk_size=2000):
+            # Diagnoses of appointments without lab tests say nothing about which tests go with them
+            if appointment_id not in position:
+                continue
+            for term in diagnosis_terms(data):
+                term_rows.append((position[appointment_id], term_ids.setdefault(term, len(term_ids))))
+        term_rows = np.unique(np.array(term_rows, dtype=np.int64).reshape(-1, 2), axis=0)
+        terms = sorted(term_ids, key=term_ids.get)
+
+        term_table: Dict[int, List[Tuple[int, float, int]]] = {}
+        if len(term_rows):
+            term, test, together = pair_counts(term_rows[:, 0], term_rows[:, 1], groups, tests, test_size)
+            mentioned = np.bincount(term_rows[:, 1], minlength=len(terms))
+            # Inverse document frequency scaled to at most 1, so common words barely count
+            specificity = np.log((1 + len(appointment_ids)) / (1 + mentioned)) / math.log(1 + len(appointment_ids))
+            kept = together >= self.min_support
+            term_table = top_k(
+                term[kept], test[kept], together[kept] / mentioned[term[kept]] * specificity[term[kept]],
+                together[kept], self.top_k
+            )
+
+        table = {
+            'version': TABLE_VERSION,
+            'built_at': timezone.now().isoformat(),
+            'appointments': len(appointment_ids),
+            'names': dict(LabTestType.objects.values_list('test_type_id', 'test_name')),
+            'tests': test_table,
+            'terms': {terms[term]: suggestions for term, suggestions in term_table.items()},
+        }
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        partial_path = f"{self.path}.partial"
+        with open(partial_path, 'w', encoding='utf-8') as table_file:
+            json.dump(table, table_file)
+        os.replace(partial_path, self.path)
+
+        summary = {
+            'appointments': table['appointments'],
+            'tests': len(test_table),
+            'terms': len(table['terms']),
+            'built_at': table['built_at'],
+        }
+        logger.info(f"Built lab test suggestions: {summary}")
+        return summary
+
+    # ------------------------------------------------------------------
+    # In-memory table
+    # ------------------------------------------------------------------
+
+    def table(self) -> Dict:
+        """The published tables, reloaded when the nightly build replaces the file; built if there is none"""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            self.build()
+            mtime = os.stat(self.path).st_mtime_ns
+        if self._table is not None and mtime == self._mtime:
+            return self._table
+        with self._lock:
+            if self._table is None or mtime != self._mtime:
+                with open(self.path, encoding='utf-8') as table_file:
+                    raw = json.load(table_file)
+                self._table = {
+                    'built_at': raw['built_at'],
+                    'names': {int(test_id): name for test_id, name in raw['names'].items()},
+                    'tests': {int(test_id): suggestions for test_id, suggestions in raw['tests'].items()},
+                    'terms': raw['terms'],
+                    # Sorted for prefix lookups of a word still being typed
+                    'sorted_terms': sorted(raw['terms']),
+                }
+                self._mtime = mtime
+        return self._table
+
+    def _terms(self, table: Dict, text: str) -> List[Tuple[str, float]]:
+        """Known terms of `text` with their weights; an unknown last word is read as a prefix"""
+        words = TOKEN_PATTERN.findall((text or '').lower())
+        matched = [(word, 1.0) for word in words if word in table['terms']]
+        if words and words[-1] not in table['terms'] and not text.endswith(' '):
+            prefix, sorted_terms = words[-1], table['sorted_terms']
+            start = bisect_left(sorted_terms, prefix)
+            expansions = []
+            for term in sorted_terms[start:start + PREFIX_TERMS]:
+                if not term.startswith(prefix):
+                    break
+                expansions.append(term)
+            matched += [(term, 1.0 / len(expansions)) for term in expansions]
+        return matched
+
+    def suggest(self, test_ids: Iterable[int] = (), text: str = '', limit: int = 10) -> Dict:
+        """
+        Tests to suggest next
+
+        Args:
+            test_ids: Tests already chosen; never suggested again
+            text: Diagnosis text, possibly with a word still being typed
+
+        Returns:
+            Dict with built_at and suggestions (test_type_id, test_name, score, because)
+        """
+        table = self.table()
+        chosen = {int(test_id) for test_id in test_ids}
+        scores: Dict[int, float] = {}
+        because: Dict[int, List[str]] = {}
+
+        def add(source: str, suggestions, weight: float):
+            for test_id, score, _ in suggestions:
+                if test_id not in chosen:
+                    scores[test_id] = scores.get(test_id, 0.0) + weight * score
+                    because.setdefault(test_id, []).append(source)
+
+        for test_id in chosen:
+            add(f"test:{test_id}", table['tests'].get(test_id, ()), 1.0)
+        for term, weight in self._terms(table, text):
+            add(f"term:{term}", table['terms'][term], weight)
+
+        best = sorted(scores, key=lambda test_id: (-scores[test_id], test_id))[:limit]
+        return {
+            'built_at': table['built_at'],
+            'suggestions': [
+                {
+                    'test_type_id': test_id,
+                    'test_name': table['names'].get(test_id),
+                    'score': round(scores[test_id], 4),
+                    'because': because[test_id],
+                }
+                for test_id in best
+            ],
+        }
+
+
+lab_suggestions = LabSuggestionService()
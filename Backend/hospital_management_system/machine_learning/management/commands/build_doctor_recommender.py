@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from machine_learning.recommender_service import recommender
+
+
+class Command(BaseCommand):
+    help = "Rebuild the doctor recommender from past appointment reasons (run nightly)"
+
+    def handle(self, *args, **options):
+        meta = recommender.build()
+        self.stdout.write(
+            f"{meta['documents']} reasons, {len(meta['specializations'])} specializations, "
+            f"{len(meta['doctors'])} doctors"
+        )
+        self.stdout.write(self.style.SUCCESS(f"Published build {meta['build_id']}"))
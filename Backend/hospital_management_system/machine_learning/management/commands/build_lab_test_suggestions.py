@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from machine_learning.lab_suggestion_service import lab_suggestions
+
+
+class Command(BaseCommand):
+    help = "Rebuild the lab test co-occurrence suggestions (run nightly)"
+
+    def handle(self, *args, **options):
+        summary = lab_suggestions.build()
+        self.stdout.write(
+            f"{summary['appointments']} appointments: suggestions for {summary['tests']} tests "
+            f"and {summary['terms']} diagnosis terms"
+        )
+        self.stdout.write(self.style.SUCCESS("Lab test suggestions published"))
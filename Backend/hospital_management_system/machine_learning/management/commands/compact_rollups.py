@@ -0,0 +1,32 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from machine_learning.rollup_service import rollups
+
+
+class Command(BaseCommand):
+    help = "Recompute the dirty and recent days of the analytics rollups (run nightly)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=str, help='Also recompute every day from this one (YYYY-MM-DD); yesterday by default')
+        parser.add_argument('--rebuild', action='store_true', help='Rebuild the rollups from scratch')
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            for kind in rollups.KINDS:
+                rows = rollups.rebuild(kind)
+                self.stdout.write(f"{kind}: {rows} rows")
+            self.stdout.write(self.style.SUCCESS("Rebuilt all rollups"))
+            return
+
+        since = None
+        if options['since']:
+            try:
+                since = datetime.strptime(options['since'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('Invalid date format. Use YYYY-MM-DD')
+
+        done = rollups.compact(since)
+        for kind, days in done.items():
+            self.stdout.write(f"{kind}: {days} days recomputed")
+        self.stdout.write(self.style.SUCCESS("Rollups compacted"))
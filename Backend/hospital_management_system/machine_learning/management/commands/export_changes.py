@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+from machine_learning.export_service import EXPORT_TABLES, change_exporter, pending_changes
+
+
+class Command(BaseCommand):
+    help = "Export rows changed since the last run to columnar files (Parquet, or NumPy .npz without pyarrow)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--table', action='append', dest='tables', choices=sorted(EXPORT_TABLES),
+                            help='Only this table; repeatable')
+        parser.add_argument('--output', type=str, help='Output directory (EXPORT_DIR by default)')
+        parser.add_argument('--format', type=str, choices=['parquet', 'npz'], help='File format (parquet if pyarrow is installed)')
+        parser.add_argument('--reset', action='store_true', help='Forget the watermarks and export everything again')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the rows changed since the last run')
+
+    def handle(self, *args, **options):
+        tables = options['tables']
+        if options['dry_run']:
+            for table, count in pending_changes(tables).items():
+                self.stdout.write(f"{table}: {count} changed rows")
+            return
+
+        if options['reset']:
+            change_exporter.reset(tables)
+
+        def progress(table, rows):
+            self.stdout.write(f"{table}: {rows} rows")
+
+        try:
+            exported = change_exporter.export(
+                tables, output_dir=options['output'], file_format=options['format'], progress=progress
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Exported {sum(exported.values())} changed rows from {len(exported)} tables to "
+            f"{change_exporter.catalog_path(options['output'])}"
+        ))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+from machine_learning.no_show_service import no_shows
+
+
+class Command(BaseCommand):
+    help = "Score every upcoming appointment for no-show risk, retraining the model when it is stale (run hourly)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retrain', action='store_true', help='Train a new model before scoring')
+        parser.add_argument('--train-only', action='store_true', help='Train a new model without scoring')
+
+    def handle(self, *args, **options):
+        try:
+            model = no_shows.current_model(retrain=options['retrain'] or options['train_only'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        metrics = model.metrics
+        self.stdout.write(
+            f"Model of {model.trained_at:%Y-%m-%d %H:%M} on {model.training_rows} appointments: "
+            f"AUC {metrics.get('auc')}, log loss {metrics.get('log_loss')} "
+            f"(base rate {metrics.get('base_rate_log_loss')})"
+        )
+        if options['train_only']:
+            self.stdout.write(self.style.SUCCESS("No-show model trained"))
+            return
+
+        scored = no_shows.score_upcoming(model)
+        self.stdout.write(self.style.SUCCESS(f"Scored {scored} upcoming appointments"))
@@ -0,0 +1,40 @@
+import time
+from datetime import date, timedelta
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from machine_learning.forecasting_service import fit_series, forecaster
+
+
+class Command(BaseCommand):
+    help = "Fit the appointment forecasts of every doctor and specialization (run nightly)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--history-days', type=int, help='Days of history to fit; FORECAST_HISTORY_DAYS by default')
+        parser.add_argument('--benchmark', type=int, metavar='SERIES',
+                            help='Only time a fit of this many synthetic series, without touching the database')
+
+    def handle(self, *args, **options):
+        history_days = options['history_days'] or forecaster.history_days
+        if history_days <= forecaster.holdout_days + 14:
+            raise CommandError(f'--history-days must be more than {forecaster.holdout_days + 14}')
+
+        if options['benchmark']:
+            series = options['benchmark']
+            rng = np.random.default_rng(0)
+            weekly = rng.uniform(0, 8, size=(series, 7))
+            days = np.arange(history_days)
+            demand = weekly[:, days % 7] + rng.uniform(-0.01, 0.02, size=(series, 1)) * days
+            history = rng.poisson(np.maximum(demand, 0)).astype(float)
+            started = time.perf_counter()
+            fit_series(history, date.today() - timedelta(days=history_days), forecaster.holdout_days)
+            elapsed = time.perf_counter() - started
+            self.stdout.write(self.style.SUCCESS(f"Fitted {series} series of {history_days} days in {elapsed:.2f}s"))
+            return
+
+        forecaster.history_days = history_days
+        summary = forecaster.train()
+        self.stdout.write(
+            f"{summary['series']} series: loaded in {summary['load_seconds']}s, fitted in {summary['fit_seconds']}s"
+        )
+        self.stdout.write(self.style.SUCCESS("Forecasts trained"))
@@ -0,0 +1,78 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('hospital', '0022_appointment_day_indexes'),
+        ('transactions', '0007_transaction_datetime_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupDay',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('revenue', 'Revenue'), ('appointments', 'Appointments'), ('ratings', 'Ratings')], max_length=20)),
+                ('day', models.DateField()),
+                ('dirty', models.BooleanField(default=True)),
+                ('refreshed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['kind', 'dirty'], name='rollup_day_dirty_idx')],
+                'constraints': [models.UniqueConstraint(fields=('kind', 'day'), name='rollup_day_unique')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyAppointments',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('status', models.CharField(max_length=100)),
+                ('specialization', models.CharField(blank=True, default='', max_length=255)),
+                ('appointment_count', models.PositiveIntegerField()),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='hospital.staff')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('day', 'status', 'doctor'), name='daily_appointments_unique')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyRatings',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('rating_count', models.PositiveIntegerField()),
+                ('rating_sum', models.PositiveIntegerField()),
+                ('stars_1', models.PositiveIntegerField(default=0)),
+                ('stars_2', models.PositiveIntegerField(default=0)),
+                ('stars_3', models.PositiveIntegerField(default=0)),
+                ('stars_4', models.PositiveIntegerField(default=0)),
+                ('stars_5', models.PositiveIntegerField(default=0)),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='hospital.staff')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('day', 'doctor'), name='daily_ratings_unique')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyRevenue',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=14)),
+                ('transaction_count', models.PositiveIntegerField()),
+                ('payment_method', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='transactions.paymentmethod')),
+                ('transaction_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='transactions.transactiontype')),
+                ('unit', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='transactions.unit')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('day', 'unit', 'payment_method', 'transaction_type'), name='daily_revenue_unique')],
+            },
+        ),
+    ]
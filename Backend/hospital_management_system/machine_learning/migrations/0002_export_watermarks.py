@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machine_learning', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('table', models.CharField(max_length=100, unique=True)),
+                ('last_changed_at', models.DateTimeField(blank=True, null=True)),
+                ('last_pk', models.CharField(blank=True, default='', max_length=100)),
+                ('rows_exported', models.PositiveBigIntegerField(default=0)),
+                ('exported_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
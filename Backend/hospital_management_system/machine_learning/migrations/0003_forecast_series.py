@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machine_learning', '0002_export_watermarks'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ForecastSeries',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('doctor', 'Doctor'), ('specialization', 'Specialization')], max_length=20)),
+                ('key', models.CharField(help_text='Staff id of the doctor, or the specialization', max_length=255)),
+                ('method', models.CharField(choices=[('seasonal_trend', 'Seasonal Trend'), ('holt_winters', 'Holt Winters')], max_length=20)),
+                ('level', models.FloatField()),
+                ('trend', models.FloatField()),
+                ('damping', models.FloatField(default=1.0)),
+                ('seasonal', models.JSONField(help_text='Day-of-week effects, Monday first')),
+                ('smoothing', models.JSONField(blank=True, default=dict, help_text='Smoothing parameters of Holt-Winters fits')),
+                ('history_start', models.DateField()),
+                ('history_end', models.DateField()),
+                ('mae', models.FloatField(help_text='Mean absolute error per day on the held-out last weeks')),
+                ('trained_at', models.DateTimeField()),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('kind', 'key'), name='forecast_series_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machine_learning', '0003_forecast_series'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NoShowModel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('features', models.JSONField(help_text='Names of the feature columns, in weight order')),
+                ('weights', models.JSONField()),
+                ('intercept', models.FloatField()),
+                ('means', models.JSONField(default=dict)),
+                ('scales', models.JSONField(default=dict)),
+                ('doctors', models.JSONField(default=list)),
+                ('prior_miss_rate', models.FloatField(help_text='Share of missed appointments in the training data')),
+                ('training_rows', models.PositiveIntegerField()),
+                ('metrics', models.JSONField(default=dict, help_text='AUC, log loss and base rate on the held-out latest appointments')),
+                ('trained_at', models.DateTimeField()),
+            ],
+            options={
+                'get_latest_by': 'trained_at',
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machine_learning', '0004_no_show_model'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ForecastTraining',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('series', models.PositiveIntegerField(help_text='Series fitted in this run')),
+                ('history_end', models.DateField()),
+                ('trained_at', models.DateTimeField()),
+            ],
+            options={
+                'get_latest_by': 'trained_at',
+            },
+        ),
+    ]
@@ -1,3 +1,177 @@
 from django.db import models
 
-# Create your models here.
+
+class RollupDay(models.Model):
+    """
+    Bookkeeping of one day of one rollup: when it was last computed and
+    whether rows behind it changed since (see rollup_service)
+    """
+    REVENUE = 'revenue'
+    APPOINTMENTS = 'appointments'
+    RATINGS = 'ratings'
+    KINDS = [REVENUE, APPOINTMENTS, RATINGS]
+
+    kind = models.CharField(max_length=20, choices=[(kind, kind.title()) for kind in KINDS])
+    day = models.DateField()
+    dirty = models.BooleanField(default=True)
+    refreshed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'day'], name='rollup_day_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['kind', 'dirty'], name='rollup_day_dirty_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.day}{' (dirty)' if self.dirty else ''}"
+
+
+class DailyRevenue(models.Model):
+    """Completed transactions per day, currency, payment method and transaction type"""
+    day = models.DateField()
+    unit = models.ForeignKey('transactions.Unit', on_delete=models.CASCADE, related_name='+')
+    payment_method = models.ForeignKey('transactions.PaymentMethod', on_delete=models.CASCADE, related_name='+')
+    transaction_type = models.ForeignKey('transactions.TransactionType', on_delete=models.CASCADE, related_name='+')
+    amount = models.DecimalField(max_digits=14, decimal_places=2)
+    transaction_count = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'unit', 'payment_method', 'transaction_type'], name='daily_revenue_unique'),
+        ]
+
+    def __str__(self):
+        return f"Revenue {self.day}: {self.amount}"
+
+
+class DailyAppointments(models.Model):
+    """Appointments per appointment day, status and doctor"""
+    day = models.DateField()
+    status = models.CharField(max_length=100)
+    doctor = models.ForeignKey('hospital.Staff', on_delete=models.CASCADE, related_name='+')
+    specialization = models.CharField(max_length=255, blank=True, default='')
+    appointment_count = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'status', 'doctor'], name='daily_appointments_unique'),
+        ]
+
+    def __str__(self):
+        return f"Appointments {self.day} {self.status}: {self.appointment_count}"
+
+
+class DailyRatings(models.Model):
+    """Ratings per day the rated appointment was booked, and doctor"""
+    day = models.DateField()
+    doctor = models.ForeignKey('hospital.Staff', on_delete=models.CASCADE, related_name='+')
+    rating_count = models.PositiveIntegerField()
+    rating_sum = models.PositiveIntegerField()
+    stars_1 = models.PositiveIntegerField(default=0)
+    stars_2 = models.PositiveIntegerField(default=0)
+    stars_3 = models.PositiveIntegerField(default=0)
+    stars_4 = models.PositiveIntegerField(default=0)
+    stars_5 = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'doctor'], name='daily_ratings_unique'),
+        ]
+
+    def __str__(self):
+        return f"Ratings {self.day} {self.doctor_id}: {self.rating_count}"
+
+
+class ExportWatermark(models.Model):
+    """
+    How far the change-data export of one table has got: the (changed_at,
+    primary key) of the last row written (see export_service)
+    """
+    table = models.CharField(max_length=100, unique=True)
+    last_changed_at = models.DateTimeField(null=True, blank=True)
+    last_pk = models.CharField(max_length=100, blank=True, default='')
+    rows_exported = models.PositiveBigIntegerField(default=0)
+    exported_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.table} up to {self.last_changed_at}"
+
+
+class ForecastSeries(models.Model):
+    """
+    Fitted appointment-demand model of one doctor or specialization, stored as
+    the state to project from (see forecasting_service): the forecast for a
+    day h days after history_end is
+    level + trend * (damping + ... + damping**h) + seasonal[weekday]
+    """
+    DOCTOR = 'doctor'
+    SPECIALIZATION = 'specialization'
+    KINDS = [DOCTOR, SPECIALIZATION]
+
+    SEASONAL_TREND = 'seasonal_trend'
+    HOLT_WINTERS = 'holt_winters'
+    METHODS = [SEASONAL_TREND, HOLT_WINTERS]
+
+    kind = models.CharField(max_length=20, choices=[(kind, kind.title()) for kind in KINDS])
+    key = models.CharField(max_length=255, help_text="Staff id of the doctor, or the specialization")
+    method = models.CharField(max_length=20, choices=[(method, method.replace('_', ' ').title()) for method in METHODS])
+    level = models.FloatField()
+    trend = models.FloatField()
+    damping = models.FloatField(default=1.0)
+    seasonal = models.JSONField(help_text="Day-of-week effects, Monday first")
+    smoothing = models.JSONField(default=dict, blank=True, help_text="Smoothing parameters of Holt-Winters fits")
+    history_start = models.DateField()
+    history_end = models.DateField()
+    mae = models.FloatField(help_text="Mean absolute error per day on the held-out last weeks")
+    trained_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'key'], name='forecast_series_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.key} ({self.method})"
+
+
+class ForecastTraining(models.Model):
+    """
+    One forecast training run. Kept even when the run had no history to fit,
+    so the endpoint can tell a recent empty run from never having trained
+    """
+    series = models.PositiveIntegerField(help_text="Series fitted in this run")
+    history_end = models.DateField()
+    trained_at = models.DateTimeField()
+
+    class Meta:
+        get_latest_by = 'trained_at'
+
+    def __str__(self):
+        return f"{self.series} series up to {self.history_end}"
+
+
+class NoShowModel(models.Model):
+    """
+    Logistic regression of appointment no-shows (see no_show_service). Each
+    training run adds a row; appointments are scored with the latest.
+    """
+    features = models.JSONField(help_text="Names of the feature columns, in weight order")
+    weights = models.JSONField()
+    intercept = models.FloatField()
+    # Standardization of the numeric features, and the doctors with a column of their own
+    means = models.JSONField(default=dict)
+    scales = models.JSONField(default=dict)
+    doctors = models.JSONField(default=list)
+    prior_miss_rate = models.FloatField(help_text="Share of missed appointments in the training data")
+    training_rows = models.PositiveIntegerField()
+    metrics = models.JSONField(default=dict, help_text="AUC, log loss and base rate on the held-out latest appointments")
+    trained_at = models.DateTimeField()
+
+    class Meta:
+        get_latest_by = 'trained_at'
+
+    def __str__(self):
+        return f"No-show model of {self.trained_at:%Y-%m-%d %H:%M}"
+
@@ -0,0 +1,312 @@
+"""
+No-show risk of upcoming appointments, by logistic regression on past misses
+"""
+import logging
+from datetime import date, timedelta
+from typing import Dict, Optional
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Count, Q
+from django.db.models.functions import ExtractHour, TruncDate
+from django.utils import timezone
+
+from hospital.models import Appointment
+from .models import NoShowModel
+
+logger = logging.getLogger(__name__)
+
+NUMERIC_FEATURES = ['log_lead_days', 'log_prior_appointments', 'prior_miss_rate']
+WEEKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+# Slot start hours split into before 10, 10-12, 12-14, 14-17 and from 17
+HOUR_EDGES = [10, 12, 14, 17]
+HOUR_BINS = ['before_10', '10_to_12', '12_to_14', '14_to_17', 'after_17']
+PAYMENT_STATES = ['completed', 'pending', 'failed', 'refunded', 'none']
+# Past appointments a patient's own miss rate counts as, against the overall rate
+PRIOR_WEIGHT = 3
+# Share of the latest appointments held out to measure each trained model
+HOLDOUT_FRACTION = 0.2
+
+ROW_FIELDS = ('appointment_id', 'patient_id', 'staff_id', 'appointment_date', 'booked_on', 'slot_hour', 'payment', 'status')
+
+
+def load_rows(queryset) -> Dict[str, np.ndarray]:
+    """
+    The columns the features are built from, one array per column, for the
+    appointments in `queryset` (which must have an appointment_date)
+    """
+    rows = list(queryset.annotate(
+        booked_on=TruncDate('created_at'),
+        slot_hour=ExtractHour('slot__slot_start_time'),
+    ).values_list(
+        'appointment_id', 'patient_id', 'staff_id', 'appointment_date', 'booked_on', 'slot_hour',
+        'tran__transaction_status', 'status'
+    ).order_by('appointment_date', 'appointment_id'))
+    columns = list(zip(*rows)) if rows else [()] * len(ROW_FIELDS)
+    return {
+        'appointment_id': np.array(columns[0], dtype=np.int64),
+        'patient_id': np.array(columns[1], dtype=np.int64),
+        'staff_id': np.array(columns[2], dtype=object),
+        'appointment_date': np.array(columns[3], dtype='datetime64[D]'),
+        'booked_on': np.array(columns[4], dtype='datetime64[D]'),
+        'slot_hour': np.array(columns[5], dtype=np.int64),
+        'payment': np.array([status or 'none' for status in columns[6]], dtype=object),
+        'status': np.array(columns[7], dtype=object),
+    }
+
+
+def prior_history(patient_id: np.ndarray, missed: np.ndarray):
+    """
+    For appointments sorted by date, how many earlier appointments each
+    patient had and how many of those they missed, in one pass
+
+    Returns:
+        (prior appointments, prior misses), both aligned with the input
+    """
+    order = np.lexsort((np.arange(len(patient_id)), patient_id))
+    patients = patient_id[order]
+    misses = missed[order].astype(np.int64)
+    starts = np.flatnonzero(np.r_[True, patients[1:] != patients[:-1]])
+    group = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(patients)]))
+    misses_before = np.cumsum(misses) - misses
+
+    prior_count = np.empty(len(order), dtype=np.int64)
+    prior_misses = np.empty(len(order), dtype=np.int64)
+    prior_count[order] = np.arange(len(order)) - starts[group]
+    prior_misses[order] = misses_before - misses_before[starts][group]
+    return prior_count, prior_misses
+
+
+def numeric_features(rows: Dict[str, np.ndarray], prior_count: np.ndarray, prior_misses: np.ndarray,
+                     prior_miss_rate: float) -> Dict[str, np.ndarray]:
+    """The unscaled NUMERIC_FEATURES; a patient's miss rate is pulled towards the overall one"""
+    lead_days = np.maximum((rows['appointment_date'] - rows['booked_on']).astype(np.int64), 0)
+    return {
+        'log_lead_days': np.log1p(lead_days),
+        'log_prior_appointments': np.log1p(prior_count),
+        'prior_miss_rate': (prior_misses + PRIOR_WEIGHT * prior_miss_rate) / (prior_count + PRIOR_WEIGHT),
+    }
+
+
+def one_hot(values: np.ndarray, categories) -> np.ndarray:
+    """Indicator columns of `values` against `categories`; values outside them get all zeros"""
+    return (values[:, None] == np.asarray(categories, dtype=object)[None, :]).astype(float)
+
+
+def sigmoid(z: np.ndarray) -> np.ndarray:
+    return 0.5 * (1 + np.tanh(0.5 * z))
+
+
+def fit_logistic(X: np.ndarray, y: np.ndarray, l2: float, iterations: int = 50, tolerance: float = 1e-8):
+    """
+    L2-regularized logistic regression by Newton's method. Each step is a
+    handful of matrix products over all rows and one solve of the (features x
+    features) system, so a few hundred thousand appointments train in seconds.
+
+    Returns:
+        (weights, intercept); the intercept is not regularized
+    """
+    rows, columns = X.shape
+    design = np.hstack([X, np.ones((rows, 1))])
+    penalty = np.full(columns + 1, l2)
+    penalty[-1] = 0
+    coefficients = np.zeros(columns + 1)
+    # Starting from the base rate saves the first iterations
+    rate = np.clip(y.mean(), 1e-6, 1 - 1e-6)
+    coefficients[-1] = np.log(rate / (1 - rate))
+
+    for _ in range(iterations):
+        p = sigmoid(design @ coefficients)
+        gradient = design.T @ (p - y) + penalty * coefficients
+        hessian = (design * (p * (1 - p))[:, None]).T @ design + np.diag(penalty) + 1e-9 * np.eye(columns + 1)
+        step = np.linalg.solve(hessian, gradient)
+        coefficients -= step
+        if np.max(np.abs(step)) < tolerance:
+            break
+    return coefficients[:-1], coefficients[-1]
+
+
+def roc_auc(y: np.ndarray, scores: np.ndarray) -> Optional[float]:
+    """Area under the ROC curve from score ranks (ties share their average rank); None with one class only"""
+    positives = int(y.sum())
+    negatives = len(y) - positives
+    if positives == 0 or negatives == 0:
+        return None
+    order = np.argsort(scores, kind='mergesort')
+    ranks = np.empty(len(scores))
+    ranks[order] = np.arange(1, len(scores) + 1)
+    _, tie, counts = np.unique(scores, return_inverse=True, return_counts=True)
+    ranks = (np.bincount(tie, weights=ranks) / counts)[tie]
+    return float((ranks[y == 1].sum() - positives * (positives + 1) / 2) / (positives * negatives))
+
+
+def log_loss(y: np.ndarray, p: np.ndarray) -> float:
+    p = np.clip(p, 1e-12, 1 - 1e-12)
+    return float(-np.mean(y * np.log(p) + (1 - y) * np.log(1 - p)))
+
+
+class NoShowService:
+    """
+    Predicts which upcoming appointments will be missed, so the admin board
+    can overbook the slots most likely to go empty.
+
+    Features of an appointment: lead time from booking, the patient's number
+    of past appointments and their (smoothed) share of misses, weekday, slot
+    start hour, the doctor (doctors with at least
+    NO_SHOW_MIN_DOCTOR_APPOINTMENTS appointments get a column of their own)
+    and the status of its payment. A past appointment counts as missed unless
+    it was completed, the same rule AllAppointmentsView applies when it marks
+    stale upcoming appointments missed.
+
+    The model is a NumPy logistic regression fitted on the last
+    NO_SHOW_HISTORY_DAYS and stored in NoShowModel. score_upcoming() then
+    scores every upcoming appointment in one vectorized pass and writes
+    Appointment.no_show_risk; the score_no_shows command runs both
+    periodically.
+    """
+
+    def __init__(self):
+        self.history_days = getattr(settings, 'NO_SHOW_HISTORY_DAYS', 730)
+        self.l2 = getattr(settings, 'NO_SHOW_L2', 1.0)
+        self.min_doctor_appointments = getattr(settings, 'NO_SHOW_MIN_DOCTOR_APPOINTMENTS', 20)
+        self.min_training_rows = getattr(settings, 'NO_SHOW_MIN_TRAINING_ROWS', 100)
+        self.retrain_after = timedelta(days=getattr(settings, 'NO_SHOW_RETRAIN_DAYS', 7))
+        self.high_risk = getattr(settings, 'NO_SHOW_HIGH_RISK', 0.4)
+
+    # ------------------------------------------------------------------
+    # Features
+    # ------------------------------------------------------------------
+
+    def design(self, rows: Dict[str, np.ndarray], prior_count: np.ndarray, prior_misses: np.ndarray,
+               model: NoShowModel) -> np.ndarray:
+        """Feature matrix of `rows`, standardized and encoded as `model` was trained"""
+        numeric = numeric_features(rows, prior_count, prior_misses, model.prior_miss_rate)
+        weekday = (rows['appointment_date'].astype(np.int64) + 3) % 7  # 1970-01-01 was a Thursday
+        hour_bin = np.digitize(rows['slot_hour'], HOUR_EDGES)
+        return np.hstack([
+            np.column_stack([
+                (numeric[name] - model.means[name]) / model.scales[name] for name in NUMERIC_FEATURES
+            ]) if len(rows['appointment_id']) else np.zeros((0, len(NUMERIC_FEATURES))),
+            one_hot(weekday, range(7)),
+            one_hot(hour_bin, range(len(HOUR_BINS))),
+            one_hot(rows['payment'], PAYMENT_STATES),
+            one_hot(rows['staff_id'], model.doctors),
+        ])
+
+    @staticmethod
+    def feature_names(doctors) -> list:
+        return (
+            NUMERIC_FEATURES
+            + [f'weekday_{name}' for name in WEEKDAYS]
+            + [f'slot_{name}' for name in HOUR_BINS]
+            + [f'payment_{state}' for state in PAYMENT_STATES]
+            + [f'doctor_{doctor}' for doctor in doctors]
+        )
+
+    # ------------------------------------------------------------------
+    # Training
+    # ------------------------------------------------------------------
+
+    def train(self, today: date = None) -> NoShowModel:
+        """
+        Fit a model on the appointments of the last NO_SHOW_HISTORY_DAYS
+        before today, measure it on the latest HOLDOUT_FRACTION of them after
+        fitting on the rest, and store it refitted on all of them
+
+        Raises:
+            ValueError: Too few past appointments, or no misses or no completed ones
+        """
+        today = today or timezone.localdate()
+        rows = load_rows(Appointment.objects.filter(
+            appointment_date__gte=today - timedelta(days=self.history_days),
+            appointment_date__lt=today
+        ))
+        missed = (rows['status'] != 'completed').astype(float)
+        if len(missed) < self.min_training_rows or missed.min() == missed.max():
+            raise ValueError(
+                f"Not enough past appointments to train the no-show model: {len(missed)} "
+                f"({int(missed.sum())} missed); need {self.min_training_rows} with both outcomes"
+            )
+
+        prior_count, prior_misses = prior_history(rows['patient_id'], missed)
+        doctors, counts = np.unique(rows['staff_id'].astype(str), return_counts=True)
+        model = NoShowModel(
+            doctors=[str(doctor) for doctor in doctors[counts >= self.min_doctor_appointments]],
+            prior_miss_rate=float(missed.mean()),
+            training_rows=len(missed),
+        )
+        raw = numeric_features(rows, prior_count, prior_misses, model.prior_miss_rate)
+        model.means = {name: float(raw[name].mean()) for name in NUMERIC_FEATURES}
+        model.scales = {name: float(raw[name].std()) or 1.0 for name in NUMERIC_FEATURES}
+        X = self.design(rows, prior_count, prior_misses, model)
+
+        # Rows are in date order, so the held-out part is the most recent
+        split = int(len(missed) * (1 - HOLDOUT_FRACTION))
+        weights, intercept = fit_logistic(X[:split], missed[:split], self.l2)
+        held_out = sigmoid(X[split:] @ weights + intercept)
+        model.metrics = {
+            'auc': roc_auc(missed[split:], held_out),
+            'log_loss': log_loss(missed[split:], held_out),
+            'base_rate_log_loss': log_loss(missed[split:], np.full(len(held_out), missed[:split].mean())),
+            'held_out_rows': len(held_out),
+        }
+
+        weights, intercept = fit_logistic(X, missed, self.l2)
+        model.features = self.feature_names(model.doctors)
+        model.weights = [float(weight) for weight in weights]
+        model.intercept = float(intercept)
+        model.trained_at = timezone.now()
+        model.save()
+        logger.info(f"Trained no-show model on {len(missed)} appointments: {model.metrics}")
+        return model
+
+    def current_model(self, retrain: bool = False) -> NoShowModel:
+        """The latest model, trained first if there is none, it is older than NO_SHOW_RETRAIN_DAYS or `retrain`"""
+        model = NoShowModel.objects.order_by('-trained_at').first()
+        if retrain or model is None or timezone.now() - model.trained_at >= self.retrain_after:
+            model = self.train()
+        return model
+
+    # ------------------------------------------------------------------
+    # Scoring
+    # ------------------------------------------------------------------
+
+    def score_upcoming(self, model: NoShowModel = None, today: date = None) -> int:
+        """
+        Score every upcoming appointment from today on and store the risks
+
+        Returns:
+            Number of appointments scored
+        """
+        model = model or self.current_model()
+        today = today or timezone.localdate()
+        rows = load_rows(Appointment.objects.filter(status='upcoming', appointment_date__gte=today))
+        if not len(rows['appointment_id']):
+            return 0
+
+        # Patients' past appointments over the same window the model was trained on, in one grouped query
+        history = {
+            patient_id: (count, misses)
+            for patient_id, count, misses in Appointment.objects.filter(
+                appointment_date__gte=today - timedelta(days=self.history_days),
+                appointment_date__lt=today
+            ).values('patient_id').annotate(
+                count=Count('pk'), misses=Count('pk', filter=~Q(status='completed'))
+            ).values_list('patient_id', 'count', 'misses').order_by()
+        }
+        past = np.array([history.get(patient_id, (0, 0)) for patient_id in rows['patient_id']], dtype=np.int64)
+
+        X = self.design(rows, past[:, 0], past[:, 1], model)
+        risks = sigmoid(X @ np.asarray(model.weights) + model.intercept)
+
+        scored_at = timezone.now()
+        # bulk_update leaves updated_at alone: a new score is not a change to the appointment
+        Appointment.objects.bulk_update([
+            Appointment(appointment_id=int(appointment_id), no_show_risk=round(float(risk), 4), no_show_scored_at=scored_at)
+            for appointment_id, risk in zip(rows['appointment_id'], risks)
+        ], ['no_show_risk', 'no_show_scored_at'], batch_size=500)
+        logger.info(f"Scored {len(risks)} upcoming appointments for no-show risk")
+        return len(risks)
+
+
+no_shows = NoShowService()
@@ -0,0 +1,374 @@
+"""
+Doctor recommendations from the reason a patient gives when booking
+"""
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import zlib
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Count
+from django.utils import timezone
+
+from hospital.models import Appointment, DoctorDetails, DoctorRatingSummary, Leave, Schedule
+from hospital.rating_summary_service import rating_summaries
+
+logger = logging.getLogger(__name__)
+
+POINTER_NAME = 'current.json'
+MATRICES = ('specializations', 'doctors')
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+
+# ----------------------------------------------------------------------
+# Hashed n-gram features
+# ----------------------------------------------------------------------
+
+def ngrams(text: str) -> List[str]:
+    """
+    Word unigrams and bigrams, plus character trigrams of each word so that
+    misspellings ("hedache") still share features with the usual spelling
+    """
+    words = TOKEN_PATTERN.findall((text or '').lower())
+    grams = [f'w:{word}' for word in words]
+    grams += [f'b:{first} {second}' for first, second in zip(words, words[1:])]
+    for word in words:
+        padded = f'<{word}>'
+        grams += [f'c:{padded[start:start + 3]}' for start in range(len(padded) - 2)]
+    return grams
+
+
+class FeatureHasher:
+    """
+    Maps n-grams to one of 2**bits columns with CRC32, which unlike hash() is
+    the same in every process, so no vocabulary has to be stored or shared.
+    A build caches the columns of the n-grams it has seen, since reasons
+    repeat the same words; queries do not, so arbitrary input cannot grow it.
+    """
+
+    def __init__(self, bits: int, cache: bool = False):
+        self.columns = 1 << bits
+        self._mask = self.columns - 1
+        self._cache: Optional[Dict[str, int]] = {} if cache else None
+
+    def column(self, gram: str) -> int:
+        if self._cache is None:
+            return zlib.crc32(gram.encode('utf-8')) & self._mask
+        column = self._cache.get(gram)
+        if column is None:
+            column = self._cache[gram] = zlib.crc32(gram.encode('utf-8')) & self._mask
+        return column
+
+    def counts(self, texts: List[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Hashed n-gram counts of `texts`
+
+        Returns:
+            (row, column, count) arrays of the nonzero entries, sorted by row then column
+        """
+        rows, columns = [], []
+        for row, text in enumerate(texts):
+            hashed = [self.column(gram) for gram in ngrams(text)]
+            rows.extend([row] * len(hashed))
+            columns.extend(hashed)
+        keys, counts = np.unique(
+            np.asarray(rows, dtype=np.int64) * self.columns + np.asarray(columns, dtype=np.int64),
+            return_counts=True
+        )
+        return keys // self.columns, keys % self.columns, counts.astype(np.float32)
+
+
+def tfidf(rows: np.ndarray, columns: np.ndarray, counts: np.ndarray, idf: np.ndarray, row_count: int) -> np.ndarray:
+    """Sublinear TF-IDF weights of the entries, each row scaled to unit length"""
+    return unit_rows(rows, (1 + np.log(counts)) * idf[columns], row_count).astype(np.float32)
+
+
+def unit_rows(rows: np.ndarray, values: np.ndarray, row_count: int) -> np.ndarray:
+    """Sparse entries scaled so that each row has unit length"""
+    norms = np.sqrt(np.bincount(rows, weights=values ** 2, minlength=row_count))
+    return values / np.maximum(norms[rows], 1e-12)
+
+
+def by_column(rows: np.ndarray, columns: np.ndarray, values: np.ndarray, column_count: int) -> Dict[str, np.ndarray]:
+    """
+    A sparse (rows x columns) matrix in compressed sparse column form: the
+    entries of column j are indices/data[indptr[j]:indptr[j + 1]]. Multiplying
+    it by a query then only reads the columns the query has.
+    """
+    order = np.lexsort((rows, columns))
+    indptr = np.zeros(column_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(columns, minlength=column_count), out=indptr[1:])
+    return {'indptr': indptr, 'indices': rows[order].astype(np.int32), 'data': values[order].astype(np.float32)}
+
+
+def centroids(labels: np.ndarray, rows: np.ndarray, columns: np.ndarray, weights: np.ndarray,
+              label_count: int, column_count: int) -> Dict[str, np.ndarray]:
+    """Unit-length sum of the document vectors of each label, as a (labels x columns) sparse matrix"""
+    keys, inverse = np.unique(labels[rows].astype(np.int64) * column_count + columns, return_inverse=True)
+    sums = np.bincount(inverse, weights=weights)
+    label_rows, label_columns = keys // column_count, keys % column_count
+    return by_column(label_rows, label_columns, unit_rows(label_rows, sums, label_count), column_count)
+
+
+def multiply(matrix: Dict[str, np.ndarray], columns: np.ndarray, weights: np.ndarray, row_count: int) -> np.ndarray:
+    """Sparse matrix times a sparse query vector (its nonzero columns and weights)"""
+    starts = np.asarray(matrix['indptr'][columns], dtype=np.int64)
+    lengths = np.asarray(matrix['indptr'][columns + 1], dtype=np.int64) - starts
+    total = int(lengths.sum())
+    scores = np.zeros(row_count)
+    if not total:
+        return scores
+    # Positions of every stored entry of the query's columns, without a Python loop
+    offsets = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    positions = np.repeat(starts, lengths) + offsets
+    np.add.at(scores, matrix['indices'][positions], matrix['data'][positions] * np.repeat(weights, lengths))
+    return scores
+
+
+# ----------------------------------------------------------------------
+# Memory-mapped index
+# ----------------------------------------------------------------------
+
+class RecommenderIndex:
+    """One build, with its arrays memory-mapped read-only: every worker shares the same pages"""
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, 'meta.json'), encoding='utf-8') as meta_file:
+            self.meta = json.load(meta_file)
+        self.idf = np.load(os.path.join(path, 'idf.npy'), mmap_mode='r')
+        self.matrices = {
+            name: {part: np.load(os.path.join(path, f'{name}.{part}.npy'), mmap_mode='r') for part in ('indptr', 'indices', 'data')}
+            for name in MATRICES
+        }
+        self.hasher = FeatureHasher(self.meta['hash_bits'])
+
+    def query(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Nonzero columns and unit-length TF-IDF weights of a reason"""
+        _, columns, counts = self.hasher.counts([text])
+        if not len(columns):
+            return columns, counts
+        return columns, tfidf(np.zeros(len(columns), dtype=np.int64), columns, counts, self.idf, 1)
+
+    def scores(self, name: str, columns: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        """Cosine similarity of the query to every row of the `name` matrix"""
+        return multiply(self.matrices[name], columns, weights, len(self.meta[name]))
+
+
+class RecommenderService:
+    """
+    Suggests specializations and doctors for the free-text reason of a new
+    appointment.
+
+    A build hashes the word and character n-grams of every past appointment
+    reason (see FeatureHasher), weights them by TF-IDF and sums them into one
+    unit vector per specialization and one per doctor. A reason is then
+    scored against all of them with two sparse matrix-vector products.
+
+    Builds are written under RECOMMENDER_DIR as .npy files and published by
+    atomically replacing current.json. Workers memory-map the current build
+    and notice a new one from the pointer's modification time, so the
+    matrices are never recomputed or copied per worker. The
+    build_doctor_recommender command rebuilds it periodically.
+    """
+
+    def __init__(self):
+        self.directory = getattr(settings, 'RECOMMENDER_DIR', os.path.join(settings.BASE_DIR, 'recommender'))
+        self.hash_bits = getattr(settings, 'RECOMMENDER_HASH_BITS', 18)
+        self._index: Optional[RecommenderIndex] = None
+        self._pointer_mtime = None
+        self._lock = threading.Lock()
+
+    @property
+    def pointer_path(self) -> str:
+        return os.path.join(self.directory, POINTER_NAME)
+
+    # ------------------------------------------------------------------
+    # Building
+    # ------------------------------------------------------------------
+
+    def build(self) -> Dict:
+        """
+        Build the index from every past appointment with a reason and a
+        doctor with doctor details, and publish it
+
+        Returns:
+            The build's metadata
+        """
+        rows = list(Appointment.objects.filter(
+            staff__doctor_details__isnull=False
+        ).exclude(reason__isnull=True).exclude(reason='').values_list(
+            'reason', 'staff_id', 'staff__doctor_details__doctor_specialization'
+        ).order_by('appointment_id'))
+        texts = [reason for reason, _, _ in rows]
+        hasher = FeatureHasher(self.hash_bits, cache=True)
+        doc_rows, columns, counts = hasher.counts(texts)
+
+        # Smoothed inverse document frequency; a column no reason has gets the largest weight but never matters
+        frequency = np.bincount(columns, minlength=hasher.columns)
+        idf = (np.log((1 + len(texts)) / (1 + frequency)) + 1).astype(np.float32)
+        weights = tfidf(doc_rows, columns, counts, idf, len(texts))
+
+        specializations = sorted({specialization for _, _, specialization in rows})
+        doctors = sorted({staff_id for _, staff_id, _ in rows})
+        label_of = {
+            'specializations': self._positions([specialization for _, _, specialization in rows], specializations),
+            'doctors': self._positions([staff_id for _, staff_id, _ in rows], doctors),
+        }
+        names = {'specializations': specializations, 'doctors': doctors}
+
+        build_id = timezone.now().strftime('%Y%m%dT%H%M%S%f')
+        path = os.path.join(self.directory, build_id)
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'idf.npy'), idf)
+        for name in MATRICES:
+            matrix = centroids(label_of[name], doc_rows, columns, weights, len(names[name]), hasher.columns)
+            for part, values in matrix.items():
+                np.save(os.path.join(path, f'{name}.{part}.npy'), values)
+        meta = {
+            'build_id': build_id,
+            'built_at': timezone.now().isoformat(),
+            'hash_bits': self.hash_bits,
+            'documents': len(texts),
+            'specializations': specializations,
+            'doctors': doctors,
+        }
+        with open(os.path.join(path, 'meta.json'), 'w', encoding='utf-8') as meta_file:
+            json.dump(meta, meta_file)
+
+        self._publish(build_id)
+        logger.info(f"Built doctor recommender {build_id} from {len(texts)} appointment reasons")
+        return meta
+
+    @staticmethod
+    def _positions(values: List[str], names: List[str]) -> np.ndarray:
+        position = {name: number for number, name in enumerate(names)}
+        return np.array([position[value] for value in values], dtype=np.int64)
+
+    def _publish(self, build_id: str):
+        partial_path = f"{self.pointer_path}.partial"
+        with open(partial_path, 'w', encoding='utf-8') as pointer_file:
+            json.dump({'build_id': build_id}, pointer_file)
+        os.replace(partial_path, self.pointer_path)
+
+        # Keep the previous build for workers that have not switched yet; mapped files survive deletion anyway
+        builds = sorted(entry for entry in os.listdir(self.directory) if os.path.isdir(os.path.join(self.directory, entry)))
+        for old in builds[:-2]:
+            shutil.rmtree(os.path.join(self.directory, old), ignore_errors=True)
+
+    # ------------------------------------------------------------------
+    # Loading
+    # ------------------------------------------------------------------
+
+    def index(self) -> Optional[RecommenderIndex]:
+        """The current build, mapped on first use and remapped after a rebuild; None if never built"""
+        try:
+            mtime = os.stat(self.pointer_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        if self._index is not None and mtime == self._pointer_mtime:
+            return self._index
+        with self._lock:
+            if self._index is None or mtime != self._pointer_mtime:
+                with open(self.pointer_path, encoding='utf-8') as pointer_file:
+                    build_id = json.load(pointer_file)['build_id']
+                self._index = RecommenderIndex(os.path.join(self.directory, build_id))
+                self._pointer_mtime = mtime
+        return self._index
+
+    def ensure_built(self) -> RecommenderIndex:
+        """The current build, building the first one if there is none"""
+        index = self.index()
+        if index is None:
+            # One build per worker: requests that arrive during it wait and then map that build
+            with self._lock:
+                if not os.path.exists(self.pointer_path):
+                    self.build()
+            index = self.index()
+        return index
+
+    # ------------------------------------------------------------------
+    # Recommendations
+    # ------------------------------------------------------------------
+
+    def recommend(self, reason: str, on: date = None, specialization_limit: int = 3,
+                  doctor_limit: int = 5) -> Dict:
+        """
+        Specializations ranked by similarity to `reason`, then the available
+        doctors of the best ones, by how well their own past appointments
+        match and then by rating
+
+        Args:
+            reason: Free text the patient typed
+            on: Only doctors with a schedule that day; doctors not on leave if None
+
+        Returns:
+            Dict with specializations (name, score) and doctors (staff id, name,
+            specialization, doctor type, match, rating score, free slots when `on` is given)
+        """
+        index = self.ensure_built()
+        columns, weights = index.query(reason)
+        specialization_scores = index.scores('specializations', columns, weights)
+        doctor_scores = dict(zip(index.meta['doctors'], index.scores('doctors', columns, weights)))
+
+        ranked = [
+            (index.meta['specializations'][row], float(specialization_scores[row]))
+            for row in np.argsort(-specialization_scores, kind='stable')[:specialization_limit]
+            if specialization_scores[row] > 0
+        ]
+        specialization_rank = {name: rank for rank, (name, _) in enumerate(ranked)}
+
+        candidates = DoctorDetails.objects.filter(
+            doctor_specialization__in=list(specialization_rank), staff__on_leave=False
+        ).select_related('staff', 'doctor_type')
+        today = on or timezone.localdate()
+        candidates = candidates.exclude(staff_id__in=Leave.objects.filter(
+            leave_start__lte=today, leave_end__gte=today
+        ).values('staff_id'))
+        free_slots = {}
+        if on is not None:
+            free_slots = self._free_slots(on)
+            candidates = candidates.filter(staff_id__in=list(free_slots))
+
+        details = list(candidates)
+        ratings = dict(DoctorRatingSummary.objects.filter(
+            doctor_id__in=[detail.staff_id for detail in details]
+        ).values_list('doctor_id', 'score'))
+        doctors = [
+            {
+                'staff_id': detail.staff_id,
+                'staff_name': detail.staff.staff_name,
+                'specialization': detail.doctor_specialization,
+                'doctor_type': detail.doctor_type.doctor_type,
+                'match': round(float(doctor_scores.get(detail.staff_id, 0.0)), 4),
+                'rating_score': ratings.get(detail.staff_id, rating_summaries.score(0, 0)),
+                **({'free_slots': free_slots[detail.staff_id]} if on is not None else {}),
+            }
+            for detail in details
+        ]
+        doctors.sort(key=lambda doctor: (
+            specialization_rank[doctor['specialization']], -doctor['match'], -doctor['rating_score']
+        ))
+        return {
+            'build_id': index.meta['build_id'],
+            'specializations': [{'specialization': name, 'score': round(score, 4)} for name, score in ranked],
+            'doctors': doctors[:doctor_limit],
+        }
+
+    @staticmethod
+    def _free_slots(on: date) -> Dict[str, int]:
+        """Doctors with a schedule on `on` that still has unbooked slots, and how many"""
+        slots = dict(Schedule.objects.filter(schedule_date=on).values('staff_id').annotate(
+            slots=Count('shift__slots')
+        ).values_list('staff_id', 'slots').order_by())
+        booked = dict(Appointment.objects.filter(staff_id__in=list(slots), appointment_date=on).values('staff_id').annotate(booked=Count('pk')).values_list('staff_id', 'booked').order_by())
+        free = {staff_id: count - booked.get(staff_id, 0) for staff_id, count in slots.items()}
+        return {staff_id: count for staff_id, count in free.items() if count > 0}
+
+
+recommender = RecommenderService()
@@ -0,0 +1,209 @@
+"""
+Daily rollups of revenue, appointments and ratings for the analytics endpoints
+"""
+import logging
+from datetime import date, datetime, timedelta
+from functools import reduce
+from operator import or_
+from typing import Iterable, List, Tuple
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from hospital.models import Appointment, AppointmentRating
+from transactions.models import Transaction
+from .models import DailyAppointments, DailyRatings, DailyRevenue, RollupDay
+
+logger = logging.getLogger(__name__)
+
+
+def _day_ranges(days: Iterable[date]) -> List[Tuple[date, date]]:
+    """Sorted days merged into runs of consecutive days: [(first, last), ...]"""
+    ranges = []
+    for day in sorted(set(days)):
+        if ranges and ranges[-1][1] + timedelta(days=1) == day:
+            ranges[-1] = (ranges[-1][0], day)
+        else:
+            ranges.append((day, day))
+    return ranges
+
+
+def _midnight(day: date) -> datetime:
+    return timezone.make_aware(datetime.combine(day, datetime.min.time()))
+
+
+def _datetime_filter(field: str, days: Iterable[date]) -> Q:
+    # Ranges on the raw column, so the index on it is used
+    return reduce(or_, (
+        Q(**{f'{field}__gte': _midnight(first), f'{field}__lt': _midnight(last + timedelta(days=1))})
+        for first, last in _day_ranges(days)
+    ), Q(pk__in=[]))
+
+
+def _date_filter(field: str, days: Iterable[date]) -> Q:
+    return reduce(or_, (Q(**{f'{field}__range': (first, last)}) for first, last in _day_ranges(days)), Q(pk__in=[]))
+
+
+class RollupService:
+    """
+    Maintains DailyRevenue, DailyAppointments and DailyRatings.
+
+    A day of a rollup is always recomputed whole from its source rows with
+    one GROUP BY, never patched row by row, so it cannot drift. Writes to
+    transactions, appointments and ratings only mark their day dirty
+    (machine_learning.signals); the next analytics request recomputes the
+    dirty days, which during the day is mostly just today, a few hundred rows
+    read through the date indexes. compact_rollups recomputes whatever is
+    left dirty every night so requests rarely have to. The first request
+    after install builds everything from scratch.
+    """
+
+    def mark_dirty(self, kind: str, days: Iterable[date]):
+        days = {day for day in days if day is not None}
+        if not days:
+            return
+        RollupDay.objects.bulk_create(
+            [RollupDay(kind=kind, day=day, dirty=True) for day in days],
+            update_conflicts=True, unique_fields=['kind', 'day'], update_fields=['dirty']
+        )
+
+    # ------------------------------------------------------------------
+    # Computing
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _revenue(days_filter) -> List[DailyRevenue]:
+        rows = Transaction.objects.filter(
+            days_filter('transaction_datetime'), transaction_status='completed'
+        ).values(
+            'transaction_unit_id', 'payment_method_id', 'transaction_type_id', day=TruncDate('transaction_datetime')
+        ).annotate(amount=Sum('transaction_amount'), transaction_count=Count('pk')).order_by()
+        return [
+            DailyRevenue(
+                day=row['day'], unit_id=row['transaction_unit_id'], payment_method_id=row['payment_method_id'],
+                transaction_type_id=row['transaction_type_id'], amount=row['amount'],
+                transaction_count=row['transaction_count']
+            )
+            for row in rows
+        ]
+
+    @staticmethod
+    def _appointments(days_filter) -> List[DailyAppointments]:
+        # Appointments without a date belong to no day
+        rows = Appointment.objects.filter(days_filter('appointment_date'), appointment_date__isnull=False).values(
+            'appointment_date', 'status', 'staff_id', 'staff__doctor_details__doctor_specialization'
+        ).annotate(appointment_count=Count('pk')).order_by()
+        return [
+            DailyAppointments(
+                day=row['appointment_date'], status=row['status'], doctor_id=row['staff_id'],
+                specialization=row['staff__doctor_details__doctor_specialization'] or '',
+                appointment_count=row['appointment_count']
+            )
+            for row in rows
+        ]
+
+    @staticmethod
+    def _ratings(days_filter) -> List[DailyRatings]:
+        rows = AppointmentRating.objects.filter(days_filter('appointment__created_at')).values(
+            'appointment__staff_id', day=TruncDate('appointment__created_at')
+        ).annotate(
+            rating_count=Count('pk'),
+            rating_sum=Sum('rating'),
+            **{f'stars_{stars}': Count('pk', filter=Q(rating=stars)) for stars in range(1, 6)}
+        ).order_by()
+        return [
+            DailyRatings(
+                day=row.pop('day'), doctor_id=row.pop('appointment__staff_id'), **row
+            )
+            for row in rows
+        ]
+
+    # kind -> (rollup model, compute function, source filter for a set of days)
+    KINDS = {
+        RollupDay.REVENUE: (DailyRevenue, '_revenue', _datetime_filter),
+        RollupDay.APPOINTMENTS: (DailyAppointments, '_appointments', _date_filter),
+        RollupDay.RATINGS: (DailyRatings, '_ratings', _datetime_filter),
+    }
+
+    def refresh(self, kind: str, days: Iterable[date]) -> int:
+        """
+        Recompute some days of one rollup
+
+        The days' bookkeeping rows are locked and marked clean before the
+        source is read, so a write that lands meanwhile marks its day dirty
+        again (after this transaction commits) instead of being lost.
+
+        Returns:
+            Number of rollup rows written
+        """
+        days = sorted(set(days))
+        if not days:
+            return 0
+        model, compute, source_filter = self.KINDS[kind]
+        with transaction.atomic():
+            self.mark_dirty(kind, days)
+            list(RollupDay.objects.select_for_update().filter(kind=kind, day__in=days))
+            RollupDay.objects.filter(kind=kind, day__in=days).update(dirty=False, refreshed_at=timezone.now())
+            model.objects.filter(_date_filter('day', days)).delete()
+            rows = getattr(self, compute)(lambda field: source_filter(field, days))
+            model.objects.bulk_create(rows, batch_size=1000)
+        return len(rows)
+
+    def rebuild(self, kind: str) -> int:
+        """Recompute a rollup for every day that has data, in one pass over the source"""
+        model, compute, _ = self.KINDS[kind]
+        with transaction.atomic():
+            model.objects.all().delete()
+            rows = getattr(self, compute)(lambda field: Q())
+            model.objects.bulk_create(rows, batch_size=1000)
+            RollupDay.objects.filter(kind=kind).delete()
+            now = timezone.now()
+            days = {row.day for row in rows} | {timezone.localdate()}
+            RollupDay.objects.bulk_create(
+                [RollupDay(kind=kind, day=day, dirty=False, refreshed_at=now) for day in days], batch_size=1000
+            )
+        logger.info(f"Rebuilt {kind} rollup: {len(rows)} rows over {len(days)} days")
+        return len(rows)
+
+    # ------------------------------------------------------------------
+    # Keeping fresh
+    # ------------------------------------------------------------------
+
+    def ensure_fresh(self, *kinds: str):
+        """Bring rollups up to date before reading them: build them the first time, then refresh dirty days"""
+        for kind in kinds or self.KINDS:
+            if not RollupDay.objects.filter(kind=kind).exists():
+                try:
+                    self.rebuild(kind)
+                except IntegrityError:
+                    # Fine if another request built it at the same time, a real error otherwise
+                    if not RollupDay.objects.filter(kind=kind).exists():
+                        raise
+                continue
+            dirty = list(RollupDay.objects.filter(kind=kind, dirty=True).values_list('day', flat=True))
+            if dirty:
+                self.refresh(kind, dirty)
+
+    def compact(self, since: date = None) -> dict:
+        """
+        Nightly pass: recompute every dirty day, plus all days from `since`
+        (yesterday by default, as late writes to it are most likely)
+
+        Returns:
+            Dict of kind -> days recomputed
+        """
+        since = since or timezone.localdate() - timedelta(days=1)
+        today = timezone.localdate()
+        recent = [since + timedelta(days=offset) for offset in range((today - since).days + 1)]
+        done = {}
+        for kind in self.KINDS:
+            dirty = set(RollupDay.objects.filter(kind=kind, dirty=True).values_list('day', flat=True))
+            days = dirty | set(recent)
+            self.refresh(kind, days)
+            done[kind] = len(days)
+        return done
+
+
+rollups = RollupService()
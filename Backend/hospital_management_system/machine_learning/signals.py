@@ -0,0 +1,58 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from hospital.models import Appointment, AppointmentRating
+from transactions.models import Transaction
+from transactions.signals import transactions_updated
+from .models import RollupDay
+from .rollup_service import rollups
+
+
+def _day(moment):
+    return timezone.localdate(moment) if moment else None
+
+
+@receiver(post_save, sender=Transaction)
+@receiver(post_delete, sender=Transaction)
+def transaction_changed(sender, instance, **kwargs):
+    rollups.mark_dirty(RollupDay.REVENUE, [_day(instance.transaction_datetime)])
+
+
+@receiver(transactions_updated, sender=Transaction)
+def transactions_updated_in_bulk(sender, transaction_ids, **kwargs):
+    rollups.mark_dirty(RollupDay.REVENUE, Transaction.objects.filter(
+        pk__in=transaction_ids
+    ).dates('transaction_datetime', 'day'))
+
+
+@receiver(pre_save, sender=Appointment)
+def remember_appointment_day(sender, instance, **kwargs):
+    # A reschedule moves the appointment out of its old day as well
+    if instance.pk:
+        instance._previous_rollup_state = Appointment.objects.filter(pk=instance.pk).values_list(
+            'appointment_date', 'staff_id'
+        ).first()
+
+
+@receiver(post_save, sender=Appointment)
+def appointment_changed(sender, instance, **kwargs):
+    previous_date, previous_staff_id = getattr(instance, '_previous_rollup_state', None) or (None, None)
+    rollups.mark_dirty(RollupDay.APPOINTMENTS, [instance.appointment_date, previous_date])
+    if previous_staff_id is not None and previous_staff_id != instance.staff_id:
+        # Its ratings now count for another doctor
+        rollups.mark_dirty(RollupDay.RATINGS, [_day(instance.created_at)])
+
+
+@receiver(post_delete, sender=Appointment)
+def appointment_deleted(sender, instance, **kwargs):
+    rollups.mark_dirty(RollupDay.APPOINTMENTS, [instance.appointment_date])
+    rollups.mark_dirty(RollupDay.RATINGS, [_day(instance.created_at)])
+
+
+@receiver(post_save, sender=AppointmentRating)
+@receiver(post_delete, sender=AppointmentRating)
+def rating_changed(sender, instance, **kwargs):
+    # Looked up rather than followed: on a cascade delete the appointment may be gone already
+    created_at = Appointment.objects.filter(pk=instance.appointment_id).values_list('created_at', flat=True).first()
+    rollups.mark_dirty(RollupDay.RATINGS, [_day(created_at)])
@@ -1,3 +1,773 @@
-from django.test import TestCase
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time as clock
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.core.management import call_command
+from django.db import IntegrityError
+from django.db.models import Count, Sum
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from hospital.models import (
+    Appointment, AppointmentRating, DoctorDetails, DoctorType, Patient, Role, Schedule, Shift, Slot, Staff
+)
+from hospital.tests import _appointment, _payment
+from transactions.models import PaymentMethod, Transaction, TransactionType, Unit
+from transactions.reconciliation_service import reconciliation
+from .analytics_cache import AnalyticsCache, analytics_cache
+from .export_service import ChangeExporter, load_npz_partition, pending_changes
+from .forecasting_service import fit_series, forecaster, project
+from .lab_suggestion_service import diagnosis_terms, lab_suggestions, pair_counts
+from .models import DailyAppointments, DailyRevenue, ExportWatermark, ForecastSeries, ForecastTraining, RollupDay
+from .no_show_service import fit_logistic, no_shows, prior_history, roc_auc, sigmoid
+from .recommender_service import FeatureHasher, by_column, multiply, ngrams, recommender
+from .rollup_service import rollups
+from .time_bucket_service import period_series, shift_buckets, time_series
+from .views import (
+    DoctorRecommendationView, DoctorSpecializationAnalyticsView, LabTestSuggestionView, NoShowRiskView,
+    SpecializationBreakdownView
+)
+
+
+class AnalyticsCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = AnalyticsCache()
+        self.calls = 0
+
+    def compute(self, status=200, delay=0):
+        def run():
+            self.calls += 1
+            clock.sleep(delay)
+            return {'calls': self.calls}, status
+        return run
+
+    def test_concurrent_misses_compute_once(self):
+        served = []
+        start = threading.Barrier(8)
+
+        def request():
+            start.wait()
+            served.append(self.cache.get('key', self.compute(delay=0.2)))
+
+        threads = [threading.Thread(target=request) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual([result for result, _ in served], [({'calls': 1}, 200)] * 8)
+        self.assertEqual(sorted(how for _, how in served), ['coalesced'] * 7 + ['miss'])
+        self.assertEqual(self.cache.get('key', self.compute()), (({'calls': 1}, 200), 'hit'))
+
+    def test_errors_are_not_cached(self):
+        self.cache.get('key', self.compute(status=500))
+        self.cache.get('key', self.compute(status=500))
+        self.assertEqual(self.calls, 2)
+
+    def test_hit_near_expiry_refreshes_in_background(self):
+        self.cache.ttl, self.cache.refresh_ahead = 0.5, 0.4
+        self.cache.get('key', self.compute())
+        clock.sleep(0.2)
+        self.assertEqual(self.cache.get('key', self.compute()), (({'calls': 1}, 200), 'hit'))
+        for _ in range(50):
+            if self.calls == 2 and not self.cache._refreshing:
+                break
+            clock.sleep(0.01)
+        self.assertEqual(self.cache.get('key', self.compute()), (({'calls': 2}, 200), 'hit'))
+
+    def test_background_refresh_releases_its_connection(self):
+        def failing():
+            raise RuntimeError('database went away')
+
+        with mock.patch('machine_learning.analytics_cache.close_old_connections') as close:
+            self.cache._refresh('key', self.compute())
+            self.assertEqual(close.call_count, 2)
+            self.cache._refresh('key', failing)
+            self.assertEqual(close.call_count, 4)
+        self.assertEqual(self.cache._refreshing, set())
+
+
+class ForecastFitTests(SimpleTestCase):
+    def test_batched_fit_recovers_weekly_pattern_and_trend(self):
+        first = date(2025, 1, 6)
+        days = np.arange(364)
+        weekly = np.array([[10, 8, 8, 8, 6, 2, 0], [3, 3, 3, 3, 3, 3, 3]], dtype=float)
+        history = weekly[:, days % 7] + np.array([[0.01], [0]]) * days
+        # A doctor who only started taking appointments recently
+        history = np.vstack([history, np.where(days >= 300, weekly[0, days % 7], 0)])
+
+        fitted = fit_series(history, first, holdout_days=14)
+        ahead = np.arange(364, 371)
+        forecast = project(
+            fitted['level'], fitted['trend'], fitted['damping'], fitted['seasonal'],
+            (first + timedelta(days=364)).weekday(), np.arange(1, 8)
+        )
+        np.testing.assert_allclose(forecast[0], weekly[0, ahead % 7] + 0.01 * ahead, atol=0.3)
+        np.testing.assert_allclose(forecast[1], 3, atol=0.2)
+        np.testing.assert_allclose(forecast[2], weekly[0, ahead % 7], atol=0.5)
+
+
+class ForecastTrainingTests(TestCase):
+    def setUp(self):
+        stale = timezone.now() - forecaster.retrain_after - timedelta(minutes=1)
+        ForecastSeries.objects.create(
+            kind=ForecastSeries.DOCTOR, key='DOC1', method=ForecastSeries.SEASONAL_TREND, level=5, trend=0,
+            seasonal=[0] * 7, history_start=date(2025, 1, 6), history_end=date(2025, 3, 30), mae=1,
+            trained_at=stale
+        )
+        ForecastTraining.objects.create(series=1, history_end=date(2025, 3, 30), trained_at=stale)
+
+    def test_fresh_fits_are_not_retrained(self):
+        ForecastTraining.objects.update(trained_at=timezone.now())
+        with mock.patch.object(forecaster, 'train') as train:
+            forecaster.ensure_trained()
+        train.assert_not_called()
+
+    def test_run_without_history_is_not_repeated(self):
+        ForecastSeries.objects.all().delete()
+        ForecastTraining.objects.all().delete()
+        with mock.patch.object(forecaster, 'history', wraps=forecaster.history) as history:
+            forecaster.ensure_trained()
+            forecaster.ensure_trained()
+        history.assert_called_once()
+        self.assertFalse(ForecastSeries.objects.exists())
+        self.assertEqual(ForecastTraining.objects.get().series, 0)
+
+    def test_losing_a_concurrent_retrain_is_not_an_error(self):
+        # The other request's bulk_create won the forecast_series_unique race
+        with mock.patch.object(forecaster, 'train', side_effect=IntegrityError('forecast_series_unique')) as train:
+            forecaster.ensure_trained()
+        train.assert_called_once()
+        self.assertEqual(len(forecaster.forecast(ForecastSeries.DOCTOR, start=date(2025, 3, 31))), 1)
+
+
+class NoShowModelTests(SimpleTestCase):
+    def test_prior_history_counts_only_earlier_appointments(self):
+        prior_count, prior_misses = prior_history(np.array([5, 3, 5, 5, 3]), np.array([1, 0, 0, 1, 1]))
+        self.assertEqual(prior_count.tolist(), [0, 0, 1, 2, 1])
+        self.assertEqual(prior_misses.tolist(), [0, 0, 1, 1, 0])
+
+    def test_logistic_regression_recovers_weights(self):
+        rng = np.random.default_rng(0)
+        X = rng.normal(size=(50000, 5))
+        weights = np.array([1.0, -0.5, 0.25, 0, 2.0])
+        y = (rng.random(50000) < sigmoid(X @ weights - 1)).astype(float)
+        fitted, intercept = fit_logistic(X, y, l2=1.0)
+        np.testing.assert_allclose(fitted, weights, atol=0.06)
+        self.assertAlmostEqual(intercept, -1, delta=0.06)
+        self.assertGreater(roc_auc(y, X @ fitted), 0.8)
+        self.assertEqual(roc_auc(np.array([0, 0, 1, 1]), np.array([0.1, 0.4, 0.35, 0.8])), 0.75)
+
+
+class NoShowScoringTests(TestCase):
+    def setUp(self):
+        self.factory = APIRequestFactory()
+        self.admin = Staff.objects.create(
+            staff_id='ADMIN', staff_name='Admin', created_at=date.today(), staff_email='admin@example.com',
+            staff_mobile='9999999999', role=Role.objects.create(role_name='Admin', role_permissions={'is_admin': True})
+        )
+        doctor_role = Role.objects.create(role_name='Doctor', role_permissions={})
+        self.doctors = [
+            Staff.objects.create(
+                staff_id=f'DOC{number}', staff_name=f'Doctor {number}', role=doctor_role, created_at=date.today(),
+                staff_email='doctor@example.com', staff_mobile='9999999999'
+            )
+            for number in (1, 2)
+        ]
+        shift = Shift.objects.create(shift_name='Morning', start_time=time(9), end_time=time(13))
+        self.slot = Slot.objects.create(slot_start_time=time(9), slot_duration=15, shift=shift)
+        self.flaky, self.steady = [
+            Patient.objects.create(patient_name=name, patient_email='patient@example.com', patient_mobile='9999999999')
+            for name in ('Flaky', 'Steady')
+        ]
+        # 120 past appointments: the flaky patient misses four in five, the steady one one in ten
+        self.today = timezone.localdate()
+        Appointment.objects.bulk_create([
+            Appointment(
+                patient=patient, staff=self.doctors[day % 2], slot=self.slot,
+                appointment_date=self.today - timedelta(days=day + 1),
+                status='missed' if day % 10 < misses else 'completed'
+            )
+            for day in range(60)
+            for patient, misses in ((self.flaky, 8), (self.steady, 1))
+        ])
+
+    def book(self, patient, doctor, days_ahead):
+        return Appointment.objects.create(
+            patient=patient, staff=doctor, slot=self.slot, appointment_date=self.today + timedelta(days=days_ahead)
+        )
+
+    def get(self, **params):
+        request = self.factory.get('/', params)
+        force_authenticate(request, user=self.admin)
+        return NoShowRiskView.as_view()(request)
+
+    def test_scores_upcoming_without_touching_updated_at(self):
+        flaky = self.book(self.flaky, self.doctors[0], 1)
+        steady = self.book(self.steady, self.doctors[0], 1)
+        updated_at = dict(Appointment.objects.values_list('pk', 'updated_at'))
+
+        model = no_shows.train(self.today)
+        self.assertEqual(model.training_rows, 120)
+        self.assertEqual(no_shows.score_upcoming(model, self.today), 2)
+
+        flaky.refresh_from_db()
+        steady.refresh_from_db()
+        self.assertGreater(flaky.no_show_risk, steady.no_show_risk)
+        self.assertIsNotNone(flaky.no_show_scored_at)
+        self.assertEqual(dict(Appointment.objects.values_list('pk', 'updated_at')), updated_at)
+
+    def test_doctor_days_and_min_risk(self):
+        self.book(self.flaky, self.doctors[0], 1)
+        self.book(self.steady, self.doctors[0], 1)
+        self.book(self.steady, self.doctors[1], 2)
+        no_shows.score_upcoming(no_shows.train(self.today), self.today)
+        # Booked after the scoring run
+        self.book(self.flaky, self.doctors[1], 2)
+        risks = list(Appointment.objects.filter(
+            appointment_date=self.today + timedelta(days=1)
+        ).values_list('no_show_risk', flat=True))
+
+        data = self.get(days='7').data
+        self.assertEqual(data['model']['training_rows'], 120)
+        self.assertEqual(len(data['appointments']), 3)
+        self.assertEqual(
+            [(row['staff_id'], row['booked'], row['scored']) for row in data['doctor_days']],
+            [('DOC1', 2, 2), ('DOC2', 2, 1)]
+        )
+        self.assertEqual(data['doctor_days'][0]['expected_no_shows'], round(sum(risks), 2))
+
+        highest = max(risks)
+        data = self.get(days='7', min_risk=str(highest)).data
+        self.assertEqual([row['patient_name'] for row in data['appointments']], ['Flaky'])
+        self.assertEqual(len(data['doctor_days']), 2)
+
+    def test_bad_days_are_rejected(self):
+        for days in ('week', '0', '32'):
+            self.assertEqual(self.get(days=days).status_code, 400, days)
+
+
+class RecommenderTests(SimpleTestCase):
+    def test_sparse_product_matches_dense(self):
+        rng = np.random.default_rng(0)
+        dense = (rng.random((6, 50)) < 0.2) * rng.random((6, 50))
+        rows, columns = np.nonzero(dense)
+        matrix = by_column(rows, columns, dense[rows, columns], 50)
+        query_columns, weights = np.array([3, 7, 20, 49]), rng.random(4)
+        np.testing.assert_allclose(multiply(matrix, query_columns, weights, 6), dense[:, query_columns] @ weights, rtol=1e-6)
+
+    def test_misspelling_shares_features(self):
+        hasher = FeatureHasher(18)
+        _, usual, _ = hasher.counts(['Headache'])
+        _, typo, _ = hasher.counts(['hedache'])
+        self.assertIn('b:chest pain', ngrams('Chest pain'))
+        self.assertGreaterEqual(len(np.intersect1d(usual, typo)), 3)
+
+
+class RecommenderBuildTests(TestCase):
+    REASONS = {
+        'DOC1': ['Chest pain', 'chest pain and palpitations', 'sharp chest pain'],
+        'DOC2': ['High blood pressure', 'blood pressure check'],
+        'DOC3': ['Headache', 'migraine headache', 'dizziness and numbness'],
+    }
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        # The view uses the module's service, so it gets the empty directory too
+        for name, value in (('directory', directory), ('_index', None), ('_pointer_mtime', None)):
+            patcher = mock.patch.object(recommender, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.factory = APIRequestFactory()
+        doctor_role = Role.objects.create(role_name='Doctor', role_permissions={})
+        doctor_type = DoctorType.objects.create(doctor_type='Consultant')
+        self.patient = Patient.objects.create(patient_name='Test Patient', patient_email='patient@example.com', patient_mobile='9999999999')
+        self.shift = Shift.objects.create(shift_name='Morning', start_time=time(9), end_time=time(13))
+        self.slots = [Slot.objects.create(slot_start_time=time(hour), slot_duration=60, shift=self.shift) for hour in (9, 10)]
+        self.doctors = {}
+        for staff_id, specialization in (('DOC1', 'Cardiology'), ('DOC2', 'Cardiology'), ('DOC3', 'Neurology')):
+            doctor = self.doctors[staff_id] = Staff.objects.create(
+                staff_id=staff_id, staff_name=f'Doctor {staff_id}', role=doctor_role, created_at=date.today(),
+                staff_email='doctor@example.com', staff_mobile='9999999999'
+            )
+            DoctorDetails.objects.create(
+                staff=doctor, doctor_specialization=specialization, doctor_license='LIC',
+                doctor_experience_years=5, doctor_type=doctor_type
+            )
+            for reason in self.REASONS[staff_id]:
+                self.book(doctor, date(2025, 1, 6), reason)
+
+    def book(self, doctor, on, reason=None):
+        return Appointment.objects.create(
+            patient=self.patient, staff=doctor, slot=self.slots[0], appointment_date=on, reason=reason, status='completed'
+        )
+
+    def get(self, **params):
+        request = self.factory.get('/', params)
+        force_authenticate(request, user=self.doctors['DOC1'])
+        return DoctorRecommendationView.as_view()(request)
+
+    def test_build_is_memory_mapped_and_republished(self):
+        first = recommender.build()
+        index = recommender.index()
+        self.assertEqual(index.meta['build_id'], first['build_id'])
+        self.assertEqual((first['documents'], first['specializations']), (8, ['Cardiology', 'Neurology']))
+        self.assertIsInstance(index.idf, np.memmap)
+        self.assertIsInstance(index.matrices['doctors']['data'], np.memmap)
+        self.assertIs(recommender.index(), index)
+
+        builds = [first['build_id']]
+        for _ in range(2):
+            builds.append(recommender.build()['build_id'])
+            # Two builds can land in the same tick of the file clock; the pointer must look newer
+            os.utime(recommender.pointer_path, ns=(recommender._pointer_mtime + 1, recommender._pointer_mtime + 1))
+            self.assertEqual(recommender.index().meta['build_id'], builds[-1])
+        with open(recommender.pointer_path, encoding='utf-8') as pointer_file:
+            self.assertEqual(json.load(pointer_file), {'build_id': builds[-1]})
+        self.assertEqual(sorted(entry for entry in os.listdir(recommender.directory) if entry != 'current.json'), builds[1:])
+
+    def test_ranks_specializations_then_doctor_match(self):
+        recommendations = recommender.recommend('chest pain since yesterday')
+        self.assertEqual(recommendations['specializations'][0]['specialization'], 'Cardiology')
+        self.assertEqual([doctor['staff_id'] for doctor in recommendations['doctors']][:2], ['DOC1', 'DOC2'])
+        self.assertGreater(recommendations['doctors'][0]['match'], recommendations['doctors'][1]['match'])
+
+        # Misspelled, through the character trigrams
+        recommendations = recommender.recommend('bad hedache')
+        self.assertEqual(recommendations['specializations'][0]['specialization'], 'Neurology')
+        self.assertEqual(recommendations['doctors'][0]['staff_id'], 'DOC3')
+
+    def test_concurrent_first_requests_build_once(self):
+        # Built ahead, as the threads cannot see the test's data, and hidden until the mocked build publishes it
+        recommender.build()
+        hidden = f'{recommender.pointer_path}.hidden'
+        os.replace(recommender.pointer_path, hidden)
+
+        def build():
+            clock.sleep(0.1)
+            os.replace(hidden, recommender.pointer_path)
+
+        start = threading.Barrier(4)
+        indexes = []
+
+        def request():
+            start.wait()
+            indexes.append(recommender.ensure_built())
+
+        with mock.patch.object(recommender, 'build', side_effect=build) as build_mock:
+            threads = [threading.Thread(target=request) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        build_mock.assert_called_once()
+        self.assertEqual(len(indexes), 4)
+        self.assertEqual(len({id(index) for index in indexes}), 1)
+
+    def test_malformed_parameters_are_rejected(self):
+        for params in ({}, {'reason': '  '}, {'reason': 'headache', 'date': '06/01/2025'},
+                       {'reason': 'headache', 'limit': 'five'}, {'reason': 'headache', 'limit': '0'}):
+            self.assertEqual(self.get(**params).status_code, 400, params)
+        self.assertFalse(os.path.exists(recommender.pointer_path))
+
+    def test_date_keeps_doctors_with_free_slots(self):
+        on = date(2025, 2, 3)
+        for staff_id in ('DOC1', 'DOC2'):
+            Schedule.objects.create(staff=self.doctors[staff_id], schedule_date=on, shift=self.shift)
+        # DOC1 has one of two slots left; DOC2 is fully booked
+        self.book(self.doctors['DOC1'], on)
+        self.book(self.doctors['DOC2'], on)
+        self.book(self.doctors['DOC2'], on)
+
+        response = self.get(reason='chest pain', date='2025-02-03')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(doctor['staff_id'], doctor['free_slots']) for doctor in response.data['doctors']], [('DOC1', 1)]
+        )
+        self.assertNotIn('free_slots', self.get(reason='chest pain').data['doctors'][0])
+
+
+class LabSuggestionTests(SimpleTestCase):
+    def test_pair_counts_match_dense_product(self):
+        rng = np.random.default_rng(0)
+        left, right = rng.random((30, 8)) < 0.3, rng.random((30, 5)) < 0.4
+        left_groups, left_items = np.nonzero(left)
+        right_groups, right_items = np.nonzero(right)
+        first, second, counts = pair_counts(left_groups, left_items, right_groups, right_items, 5)
+        product = np.zeros((8, 5), dtype=int)
+        product[first, second] = counts
+        np.testing.assert_array_equal(product, left.T.astype(int) @ right.astype(int))
+
+    def test_diagnosis_terms_read_nested_values(self):
+        data = {'notes': 'Type 2 diabetes', 'symptoms': ['Thirst', {'detail': 'fatigue'}], 'code': 250}
+        self.assertEqual(diagnosis_terms(data), ['diabetes', 'fatigue', 'thirst', 'type'])
+
+
+class LabTestSuggestionViewTests(TestCase):
+    def setUp(self):
+        self.factory = APIRequestFactory()
+        self.doctor = Staff.objects.create(
+            staff_id='DOC1', staff_name='Doctor 1', created_at=date.today(), staff_email='doctor@example.com',
+            staff_mobile='9999999999', role=Role.objects.create(role_name='Doctor', role_permissions={})
+        )
+        DoctorDetails.objects.create(
+            staff=self.doctor, doctor_specialization='Cardiology', doctor_license='LIC', doctor_experience_years=5,
+            doctor_type=DoctorType.objects.create(doctor_type='Consultant')
+        )
+        suggest = mock.patch.object(lab_suggestions, 'suggest', return_value={'built_at': None, 'suggestions': []})
+        self.suggest = suggest.start()
+        self.addCleanup(suggest.stop)
+
+    def get(self, **params):
+        request = self.factory.get('/', params)
+        force_authenticate(request, user=self.doctor)
+        return LabTestSuggestionView.as_view()(request)
+
+    def test_malformed_parameters_are_rejected(self):
+        for params in ({'appointment_id': 'abc'}, {'test_type_ids': '1,x'}, {'limit': 'ten'}):
+            self.assertEqual(self.get(**params).status_code, 400, params)
+        self.suggest.assert_not_called()
+
+    def test_unknown_appointment_is_not_found(self):
+        self.assertEqual(self.get(appointment_id='999').status_code, 404)
+
+    def test_suggests_from_chosen_tests(self):
+        response = self.get(test_type_ids='3, 5', q='diab', limit='5')
+        self.assertEqual(response.status_code, 200)
+        self.suggest.assert_called_once_with([3, 5], 'diab', 5)
+
+
+class SpecializationAnalyticsTests(TestCase):
+    def setUp(self):
+        self.factory = APIRequestFactory()
+        self.admin = Staff.objects.create(
+            staff_id='ADMIN', staff_name='Admin', created_at=date.today(), staff_email='admin@example.com',
+            staff_mobile='9999999999', role=Role.objects.create(role_name='Admin', role_permissions={'is_admin': True})
+        )
+        self.doctor_role = Role.objects.create(role_name='Doctor', role_permissions={})
+        self.doctor_types = [DoctorType.objects.create(doctor_type=name) for name in ('Consultant', 'Resident')]
+        shift = Shift.objects.create(shift_name='Morning', start_time=time(9), end_time=time(13))
+        self.slot = Slot.objects.create(slot_start_time=time(9), slot_duration=15, shift=shift)
+        self.patient = Patient.objects.create(patient_name='Test Patient', patient_email='patient@example.com', patient_mobile='9999999999')
+        self.transaction_fields = {
+            'transaction_type': TransactionType.objects.create(transaction_type_name='payment'),
+            'payment_method': PaymentMethod.objects.create(payment_method_name='cash'),
+            'transaction_unit': Unit.objects.create(unit_name='INR', unit_symbol='₹'),
+            'patient': self.patient,
+        }
+        self.doctors = 0
+
+    def add_doctors(self, count, specializations):
+        for _ in range(count):
+            self.doctors += 1
+            doctor = Staff.objects.create(
+                staff_id=f'DOC{self.doctors}', staff_name=f'Doctor {self.doctors}', role=self.doctor_role,
+                created_at=date.today(), staff_email='doctor@example.com', staff_mobile='9999999999'
+            )
+            DoctorDetails.objects.create(
+                staff=doctor, doctor_specialization=specializations[self.doctors % len(specializations)],
+                doctor_license='LIC', doctor_experience_years=5,
+                doctor_type=self.doctor_types[self.doctors % len(self.doctor_types)]
+            )
+            for status in ('completed', 'completed', 'missed'):
+                payment = Transaction.objects.create(
+                    transaction_amount=Decimal('500.00'), transaction_status='completed', **self.transaction_fields
+                )
+                appointment = Appointment.objects.create(
+                    patient=self.patient, staff=doctor, slot=self.slot, tran=payment, status=status
+                )
+                if status == 'completed':
+                    AppointmentRating.objects.create(appointment=appointment, rating=4)
+
+    def get(self, view):
+        analytics_cache.invalidate()
+        request = self.factory.get('/')
+        force_authenticate(request, user=self.admin)
+        return view.as_view()(request)
+
+    def assertConstantQueries(self, view, queries):
+        # The same number of queries for 3 doctors in 1 specialization as for 33 in 4
+        self.add_doctors(3, ['Cardiology'])
+        with self.assertNumQueries(queries):
+            self.get(view)
+        self.add_doctors(30, ['Cardiology', 'Neurology', 'Oncology', 'Pediatrics'])
+        with self.assertNumQueries(queries):
+            response = self.get(view)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_specialization_analytics_query_count(self):
+        data = self.assertConstantQueries(DoctorSpecializationAnalyticsView, 1)
+        self.assertEqual(data['total_doctors'], 33)
+        self.assertEqual(sum(row['count'] for row in data['specialization_distribution']), 33)
+        self.assertEqual(sum(row['appointment_count'] for row in data['appointment_distribution']), 99)
+
+    def test_specialization_breakdown_query_count(self):
+        data = self.assertConstantQueries(SpecializationBreakdownView, 3)
+        cardiology = next(row for row in data['specializations'] if row['specialization'] == 'Cardiology')
+        doctors = cardiology['doctor_count']
+        self.assertEqual(cardiology['appointment_count'], 3 * doctors)
+        self.assertEqual(cardiology['completed_appointments'], 2 * doctors)
+        self.assertEqual(cardiology['revenue'], Decimal('1500.00') * doctors)
+        self.assertEqual(cardiology['rating_count'], 2 * doctors)
+        self.assertEqual(cardiology['avg_rating'], 4)
+        self.assertEqual(sum(row['doctor_count'] for row in data['breakdown']), 33)
+
+
+class TimeSeriesTests(TestCase):
+    def setUp(self):
+        self.transaction_fields = {
+            'transaction_type': TransactionType.objects.create(transaction_type_name='payment'),
+            'payment_method': PaymentMethod.objects.create(payment_method_name='cash'),
+            'transaction_unit': Unit.objects.create(unit_name='INR', unit_symbol='₹'),
+            'patient': Patient.objects.create(patient_name='Test Patient', patient_email='patient@example.com', patient_mobile='9999999999'),
+        }
+
+    def pay(self, moment, amount):
+        payment = Transaction.objects.create(transaction_amount=Decimal(amount), **self.transaction_fields)
+        # transaction_datetime is auto_now_add
+        Transaction.objects.filter(pk=payment.pk).update(transaction_datetime=timezone.make_aware(moment))
+
+    def series(self, granularity, first, last):
+        return time_series(
+            Transaction.objects.all(), 'transaction_datetime', granularity, first, last,
+            payments=Count('transaction_id'), revenue=Sum('transaction_amount')
+        )
+
+    def test_month_boundaries_and_zero_fill(self):
+        self.pay(datetime(2024, 12, 31, 23, 59, 59), '10.00')
+        self.pay(datetime(2025, 1, 1, 0, 0), '20.00')
+        self.pay(datetime(2025, 1, 31, 23, 59, 59), '30.00')
+        self.pay(datetime(2025, 2, 1, 0, 0), '40.00')
+        self.pay(datetime(2025, 4, 30, 12, 0), '50.00')
+        # Outside the requested buckets
+        self.pay(datetime(2025, 5, 1, 0, 0), '60.00')
+
+        series = self.series('month', date(2025, 1, 15), date(2025, 4, 2))
+        self.assertEqual(
+            [(row['start'], row['end'], row['payments'], row['revenue']) for row in series],
+            [
+                (date(2025, 1, 1), date(2025, 1, 31), 2, Decimal('50.00')),
+                (date(2025, 2, 1), date(2025, 2, 28), 1, Decimal('40.00')),
+                (date(2025, 3, 1), date(2025, 3, 31), 0, 0),
+                (date(2025, 4, 1), date(2025, 4, 30), 1, Decimal('50.00')),
+            ]
+        )
+
+    def test_days_and_weeks_are_zero_filled(self):
+        self.pay(datetime(2025, 1, 5, 23, 0), '10.00')   # Sunday
+        self.pay(datetime(2025, 1, 6, 1, 0), '20.00')    # Monday
+
+        days = self.series('day', date(2025, 1, 4), date(2025, 1, 7))
+        self.assertEqual([row['payments'] for row in days], [0, 1, 1, 0])
+        weeks = self.series('week', date(2025, 1, 1), date(2025, 1, 13))
+        self.assertEqual(
+            [(row['start'], row['payments']) for row in weeks],
+            [(date(2024, 12, 30), 1), (date(2025, 1, 6), 1), (date(2025, 1, 13), 0)]
+        )
+        self.assertEqual(self.series('day', date(2025, 1, 7), date(2025, 1, 6)), [])
+
+    def test_year_period_covers_the_last_twelve_full_months(self):
+        self.assertEqual(shift_buckets(date(2025, 1, 1), 'month', -12), date(2024, 1, 1))
+        self.pay(datetime(2024, 2, 29, 12, 0), '10.00')
+        series = period_series(
+            Transaction.objects.all(), 'transaction_datetime', 'year', date(2025, 1, 20), payments=Count('transaction_id')
+        )
+        self.assertEqual(len(series), 12)
+        self.assertEqual((series[0]['month'], series[-1]['month']), ('January 2024', 'December 2024'))
+        self.assertEqual([row['payments'] for row in series], [0, 1] + [0] * 10)
+
+
+class RevenueRollupTests(TestCase):
+    def setUp(self):
+        self.transaction_fields = {
+            'transaction_type': TransactionType.objects.create(transaction_type_name='payment'),
+            'payment_method': PaymentMethod.objects.create(payment_method_name='cash'),
+            'transaction_unit': Unit.objects.create(unit_name='INR', unit_symbol='₹'),
+            'patient': Patient.objects.create(patient_name='Test Patient', patient_email='patient@example.com', patient_mobile='9999999999'),
+        }
+        self.today = timezone.localdate()
+
+    def pay(self, amount, **kwargs):
+        return Transaction.objects.create(
+            transaction_amount=Decimal(amount), transaction_status=kwargs.pop('transaction_status', 'completed'),
+            **self.transaction_fields, **kwargs
+        )
+
+    def revenue(self):
+        rollups.ensure_fresh(RollupDay.REVENUE)
+        return DailyRevenue.objects.filter(day=self.today).values_list('amount', flat=True).first()
+
+    def dirty(self):
+        return RollupDay.objects.get(kind=RollupDay.REVENUE, day=self.today).dirty
+
+    def test_write_during_refresh_marks_the_day_dirty_again(self):
+        self.pay('100.00')
+        self.assertEqual(self.revenue(), Decimal('100.00'))
+        self.pay('50.00')
+        self.assertTrue(self.dirty())
+
+        compute = rollups._revenue
+
+        def compute_while_paid(days_filter):
+            rows = compute(days_filter)
+            # Lands after the day was marked clean and its source read
+            self.pay('25.00')
+            return rows
+
+        with mock.patch.object(rollups, '_revenue', side_effect=compute_while_paid):
+            rollups.refresh(RollupDay.REVENUE, [self.today])
+        self.assertEqual(DailyRevenue.objects.get(day=self.today).amount, Decimal('150.00'))
+        self.assertTrue(self.dirty())
+        self.assertEqual(self.revenue(), Decimal('175.00'))
+        self.assertFalse(self.dirty())
+
+    def test_reconciled_status_change_marks_the_day_dirty(self):
+        payment = self.pay('100.00', transaction_status='pending', transaction_reference='REF-1')
+        self.assertIsNone(self.revenue())
+        self.assertFalse(self.dirty())
+
+        reconciliation._apply('completed', [payment.transaction_id], dry_run=False)
+        self.assertTrue(self.dirty())
+        self.assertEqual(self.revenue(), Decimal('100.00'))
+
+
+class AppointmentRollupTests(TestCase):
+    def setUp(self):
+        self.dated = _appointment()
+        # As in the fixture data: booked without a date
+        self.undated = _appointment(patient=self.dated.patient, staff=self.dated.staff)
+        Appointment.objects.filter(pk=self.undated.pk).update(appointment_date=None)
+        RollupDay.objects.all().delete()
+
+    def test_undated_appointments_are_left_out(self):
+        rollups.ensure_fresh(RollupDay.APPOINTMENTS)
+        self.assertEqual(
+            list(DailyAppointments.objects.values_list('day', 'appointment_count')), [(self.dated.appointment_date, 1)]
+        )
+        self.assertTrue(RollupDay.objects.filter(kind=RollupDay.APPOINTMENTS, day=self.dated.appointment_date).exists())
+
+    def test_failed_first_build_is_not_hidden(self):
+        with mock.patch.object(rollups, 'rebuild', side_effect=IntegrityError('NOT NULL constraint failed')):
+            with self.assertRaises(IntegrityError):
+                rollups.ensure_fresh(RollupDay.APPOINTMENTS)
+
+    def test_build_lost_to_another_request_is_fine(self):
+        def built_elsewhere(kind):
+            RollupDay.objects.create(kind=kind, day=self.dated.appointment_date, dirty=False)
+            raise IntegrityError('rollup_day_unique')
+
+        with mock.patch.object(rollups, 'rebuild', side_effect=built_elsewhere):
+            rollups.ensure_fresh(RollupDay.APPOINTMENTS)
+
+
+class ChangeExportTests(TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir, ignore_errors=True)
+        self.exporter = ChangeExporter()
+        self.exporter.rows_per_file = 2
+
+        self.appointment = _appointment()
+        unit = Unit.objects.create(unit_name='INR', unit_symbol='₹')
+        self.payments = [
+            _payment(self.appointment.patient, unit, Decimal(amount)) for amount in ('500.00', '12.34', '0.05')
+        ]
+        # All three changed in the same instant
+        self.changed_at = timezone.make_aware(datetime(2025, 3, 1, 10, 0))
+        Transaction.objects.update(updated_at=self.changed_at)
+        self.until = timezone.now() + timedelta(minutes=1)
+
+    def export(self, tables=('transactions',)):
+        return self.exporter.export(tables, output_dir=self.output_dir, file_format='npz', until=self.until)
+
+    def partitions(self, table='transactions'):
+        return self.exporter.read_catalog(self.output_dir)['tables'][table]['partitions']
+
+    def load(self, partition):
+        return load_npz_partition(os.path.join(self.output_dir, partition['file']))
+
+    def test_second_run_exports_nothing_new(self):
+        self.assertEqual(self.export(), {'transactions': 3})
+        self.assertEqual(self.export(), {'transactions': 0})
+        self.assertEqual(sum(partition['rows'] for partition in self.partitions()), 3)
+        watermark = ExportWatermark.objects.get(table='transactions')
+        self.assertEqual((watermark.last_changed_at, watermark.rows_exported), (self.changed_at, 3))
+        self.assertEqual(watermark.last_pk, str(self.payments[-1].transaction_id))
+
+        # A row changed again is exported again
+        Transaction.objects.filter(pk=self.payments[0].pk).update(updated_at=self.changed_at + timedelta(minutes=5))
+        self.assertEqual(self.export(), {'transactions': 1})
+        self.assertEqual(self.load(self.partitions()[-1])['transaction_id'].tolist(), [self.payments[0].transaction_id])
+
+    def test_rows_sharing_a_timestamp_are_split_by_primary_key(self):
+        ExportWatermark.objects.create(
+            table='transactions', last_changed_at=self.changed_at, last_pk=str(self.payments[0].transaction_id)
+        )
+        self.assertEqual(self.export(), {'transactions': 2})
+        exported = [self.load(partition)['transaction_id'].tolist() for partition in self.partitions()]
+        self.assertEqual(exported, [[payment.transaction_id for payment in self.payments[1:]]])
+
+    def test_partitions_are_cut_and_catalogued(self):
+        self.export()
+        partitions = self.partitions()
+        self.assertEqual([partition['rows'] for partition in partitions], [2, 1])
+        self.assertEqual(
+            [partition['file'] for partition in partitions],
+            [f"transactions/{partitions[0]['run_id']}-{number:04d}.npz" for number in (1, 2)]
+        )
+        for partition in partitions:
+            self.assertTrue(os.path.exists(os.path.join(self.output_dir, partition['file'])))
+            self.assertEqual(partition['changed_from'], self.changed_at.isoformat())
+        columns = {column['name']: column for column in partitions[0]['columns']}
+        self.assertEqual(columns['transaction_amount'], {
+            'name': 'transaction_amount', 'type': 'decimal', 'precision': 10, 'scale': 2
+        })
+        self.assertEqual(columns['patient_id']['type'], 'int')
+        ids = np.concatenate([self.load(partition)['transaction_id'] for partition in partitions])
+        self.assertEqual(ids.tolist(), sorted(payment.transaction_id for payment in self.payments))
+
+    def test_npz_round_trip_keeps_nulls_and_decimals(self):
+        Appointment.objects.filter(pk=self.appointment.pk).update(appointment_date=None)
+        self.export(('transactions', 'appointments'))
+
+        payments = self.load(self.partitions()[0])
+        self.assertEqual(payments['transaction_amount'].dtype, np.int64)
+        self.assertEqual(payments['transaction_amount'].tolist(), [50000, 1234])
+        self.assertEqual(payments['updated_at'][0], np.datetime64('2025-03-01T10:00:00', 'us'))
+        self.assertTrue(payments['transaction_reference'].mask.all())
+
+        appointments = self.load(self.partitions('appointments')[0])
+        self.assertTrue(np.isnat(appointments['appointment_date'].data[0]))
+        self.assertTrue(appointments['appointment_date'].mask[0])
+        self.assertTrue(appointments['tran_id'].mask[0])
+        self.assertEqual(appointments['patient_id'].tolist(), [self.appointment.patient_id])
+        self.assertFalse(np.ma.isMaskedArray(appointments['patient_id']))
+
+    def test_dry_run_only_counts(self):
+        self.assertEqual(pending_changes(['transactions']), {'transactions': 3})
+        output = io.StringIO()
+        call_command('export_changes', '--dry-run', '--table', 'transactions', '--output', self.output_dir, stdout=output)
+        self.assertIn('transactions: 3 changed rows', output.getvalue())
+        self.assertFalse(os.listdir(self.output_dir))
+        self.assertFalse(ExportWatermark.objects.exists())
+
+        self.export()
+        self.assertEqual(pending_changes(['transactions']), {'transactions': 0})
+
+    def test_unknown_table_or_format_is_rejected(self):
+        with self.assertRaises(ValueError):
+            self.exporter.export(['doctors'], output_dir=self.output_dir, file_format='npz')
+        with self.assertRaises(ValueError):
+            self.exporter.export(['transactions'], output_dir=self.output_dir, file_format='csv')
@@ -0,0 +1,115 @@
+"""
+Time-bucketed series for the analytics views: one GROUP BY query per series
+"""
+from datetime import date, timedelta
+from typing import Dict, List
+
+from django.db.models import DateField
+from django.db.models.functions import Trunc
+
+GRANULARITIES = ('day', 'week', 'month')
+
+
+def bucket_start(day: date, granularity: str) -> date:
+    """First day of the bucket containing `day` (weeks start on Monday, like TruncWeek)"""
+    if granularity == 'day':
+        return day
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    raise ValueError(f"Unknown granularity: {granularity}")
+
+
+def next_bucket(start: date, granularity: str) -> date:
+    if granularity == 'day':
+        return start + timedelta(days=1)
+    if granularity == 'week':
+        return start + timedelta(days=7)
+    if granularity == 'month':
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    raise ValueError(f"Unknown granularity: {granularity}")
+
+
+def shift_buckets(start: date, granularity: str, count: int) -> date:
+    """The bucket `count` buckets before (negative) or after `start`"""
+    if granularity == 'month':
+        months = start.year * 12 + start.month - 1 + count
+        return date(months // 12, months % 12 + 1, 1)
+    return start + timedelta(days=count * (7 if granularity == 'week' else 1))
+
+
+def buckets(first: date, last: date, granularity: str) -> List[date]:
+    """Start of every bucket from the one containing `first` to the one containing `last`"""
+    starts = []
+    current = bucket_start(first, granularity)
+    while current <= last:
+        starts.append(current)
+        current = next_bucket(current, granularity)
+    return starts
+
+
+def time_series(queryset, field: str, granularity: str, first: date, last: date, **aggregates) -> List[Dict]:
+    """
+    Aggregate a queryset per day, week or month
+
+    Rows are grouped by Trunc(field) in a single query, and buckets without
+    rows are filled in with zeros, so a chart always gets every bucket.
+
+    Args:
+        queryset: Rows to aggregate
+        field: Date or datetime field to bucket by (may span relations)
+        granularity: 'day', 'week' or 'month'
+        first, last: Days whose buckets make up the series
+        aggregates: Name -> aggregate expression, e.g. revenue=Sum('amount')
+
+    Returns:
+        One dict per bucket, in order: start, end (last day) and the aggregates
+    """
+    starts = buckets(first, last, granularity)
+    if not starts:
+        return []
+    rows = queryset.annotate(
+        bucket=Trunc(field, granularity, output_field=DateField())
+    ).filter(
+        bucket__gte=starts[0], bucket__lte=starts[-1]
+    ).values('bucket').annotate(**aggregates).order_by('bucket')
+
+    values = {row.pop('bucket'): row for row in rows}
+    empty = {name: 0 for name in aggregates}
+    return [
+        {
+            'start': start,
+            'end': next_bucket(start, granularity) - timedelta(days=1),
+            **{name: value if value is not None else 0 for name, value in values.get(start, empty).items()}
+        }
+        for start in starts
+    ]
+
+
+def period_series(queryset, field: str, period: str, today: date, **aggregates) -> List[Dict]:
+    """
+    The historical series shown for an analytics period, labelled the way the
+    views always have: the last 7 days for 'week', the last 4 weeks for
+    'month' and the last 12 full months for 'year'
+    """
+    if period == 'week':
+        granularity, first, last = 'day', today - timedelta(days=6), today
+    elif period == 'month':
+        granularity, first, last = 'week', shift_buckets(bucket_start(today, 'week'), 'week', -3), today
+    elif period == 'year':
+        this_month = bucket_start(today, 'month')
+        granularity, first, last = 'month', shift_buckets(this_month, 'month', -12), this_month - timedelta(days=1)
+    else:
+        raise ValueError(f"Unknown period: {period}")
+
+    series = []
+    for bucket in time_series(queryset, field, granularity, first, last, **aggregates):
+        if granularity == 'day':
+            label = {'date': bucket['start'].isoformat()}
+        elif granularity == 'week':
+            label = {'period': f"{bucket['start'].isoformat()} to {min(bucket['end'], today).isoformat()}"}
+        else:
+            label = {'month': bucket['start'].strftime('%B %Y')}
+        series.append({**label, **{name: bucket[name] for name in aggregates}})
+    return series
@@ -11,4 +11,13 @@ urlpatterns = [
     path('admin/analytics/ratings/', views.RatingAnalyticsView.as_view(), name='rating-analytics'),
     path('admin/analytics/appointments/', views.AppointmentAnalyticsView.as_view(), name='appointment-analytics'),
     path('admin/analytics/doctor-specializations/', views.DoctorSpecializationAnalyticsView.as_view(), name='doctor-specialization-analytics'),
+    path('admin/analytics/specializations/breakdown/', views.SpecializationBreakdownView.as_view(), name='specialization-breakdown'),
+    
+    # Forecasts
+    path('admin/forecasts/appointments/', views.AppointmentForecastView.as_view(), name='appointment-forecast'),
+    path('admin/no-show/upcoming/', views.NoShowRiskView.as_view(), name='no-show-risk'),
+    
+    # Recommendations
+    path('recommendations/doctors/', views.DoctorRecommendationView.as_view(), name='doctor-recommendations'),
+    path('recommendations/lab-tests/', views.LabTestSuggestionView.as_view(), name='lab-test-suggestions'),
 ]
@@ -2,16 +2,24 @@ from django.shortcuts import render
 from accounts.authentication import JWTAuthentication
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.permissions import IsAdminUser
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from django.utils import timezone
-from datetime import timedelta
+from datetime import datetime, timedelta
 from django.db.models import Sum
 from hospital.permissions import IsAdminStaff
-from transactions.models import Transaction
-from hospital.models import Appointment, AppointmentRating, Staff, Patient
-from django.db.models import Avg, Count
+from hospital.models import Appointment, Diagnosis, DoctorDetails, DoctorRatingSummary, LabTest, Staff, Patient
+from hospital.rating_summary_service import rating_summaries
+from django.db.models import Count, Q
+from .analytics_cache import CachedAnalyticsMixin
+from .forecasting_service import forecaster
+from .lab_suggestion_service import diagnosis_terms, lab_suggestions
+from .models import DailyAppointments, DailyRatings, DailyRevenue, ForecastSeries, NoShowModel, RollupDay
+from .no_show_service import no_shows
+from .recommender_service import recommender
+from .rollup_service import rollups
+from .time_bucket_service import period_series
 # Create your views here.
-class RevenueAnalyticsView(APIView):
+class RevenueAnalyticsView(CachedAnalyticsMixin, APIView):
     authentication_classes = [JWTAuthentication]
     permission_classes = [IsAdminStaff]
 
@@ -30,67 +38,21 @@ class RevenueAnalyticsView(APIView):
         else:
             return Response({"error": "Invalid period"}, status=400)
             
-        # Get all completed transactions in the period
-        transactions = Transaction.objects.filter(
-            transaction_datetime__date__gte=start_date,
-            transaction_datetime__date__lte=today,
-            transaction_status='completed'
-        )
+        # Completed transactions are read from the daily rollup
+        rollups.ensure_fresh(RollupDay.REVENUE)
         
         # Calculate total revenue
-        total_revenue = transactions.aggregate(
-            total=Sum('transaction_amount')
+        total_revenue = DailyRevenue.objects.filter(
+            day__gte=start_date,
+            day__lte=today
+        ).aggregate(
+            total=Sum('amount')
         )['total'] or 0
         
-        # Group by date for historical data
-        historical_data = []
-        
-        # Group by day, week, or month depending on period
-        if period == 'week':
-            # Daily data for week view
-            for i in range(7):
-                date = today - timedelta(days=i)
-                daily_revenue = transactions.filter(
-                    transaction_datetime__date=date
-                ).aggregate(total=Sum('transaction_amount'))['total'] or 0
-                
-                historical_data.append({
-                    'date': date.isoformat(),
-                    'revenue': daily_revenue
-                })
-        elif period == 'month':
-            # Weekly data for month view
-            for i in range(4):
-                week_end = today - timedelta(days=i*7)
-                week_start = week_end - timedelta(days=6)
-                weekly_revenue = transactions.filter(
-                    transaction_datetime__date__gte=week_start,
-                    transaction_datetime__date__lte=week_end
-                ).aggregate(total=Sum('transaction_amount'))['total'] or 0
-                
-                historical_data.append({
-                    'period': f"{week_start.isoformat()} to {week_end.isoformat()}",
-                    'revenue': weekly_revenue
-                })
-        else:
-            # Monthly data for year view
-            for i in range(12):
-                month_end = today.replace(day=1) - timedelta(days=1)
-                month_end = month_end.replace(month=month_end.month-i if month_end.month > i else 12-(i-month_end.month))
-                month_start = month_end.replace(day=1)
-                
-                monthly_revenue = transactions.filter(
-                    transaction_datetime__date__gte=month_start,
-                    transaction_datetime__date__lte=month_end
-                ).aggregate(total=Sum('transaction_amount'))['total'] or 0
-                
-                historical_data.append({
-                    'month': month_start.strftime('%B %Y'),
-                    'revenue': monthly_revenue
-                })
-        
-        # Reverse to get chronological order
-        historical_data.reverse()
+        # Daily data for week view, weekly for month view, monthly for year view
+        historical_data = period_series(
+            DailyRevenue.objects.all(), 'day', period, today, revenue=Sum('amount')
+        )
         
         return Response({
             'total_revenue': total_revenue,
@@ -98,7 +60,7 @@ class RevenueAnalyticsView(APIView):
             'historical_data': historical_data
         }, status=200)
 
-class RatingAnalyticsView(APIView):
+class RatingAnalyticsView(CachedAnalyticsMixin, APIView):
     authentication_classes = [JWTAuthentication]
     permission_classes = [IsAdminStaff]
 
@@ -117,152 +79,158 @@ class RatingAnalyticsView(APIView):
         else:
             return Response({"error": "Invalid period"}, status=400)
             
-        # Get all ratings in the period
-        ratings = AppointmentRating.objects.filter(
-            appointment__created_at__date__gte=start_date,
-            appointment__created_at__date__lte=today
-        )
-        
-        # Calculate average rating
-        avg_rating = ratings.aggregate(avg=Avg('rating'))['avg'] or 0
+        # Ratings are read from the daily rollup
+        rollups.ensure_fresh(RollupDay.RATINGS)
         
-        # Rating distribution
-        rating_distribution = {
-            '5': ratings.filter(rating=5).count(),
-            '4': ratings.filter(rating=4).count(),
-            '3': ratings.filter(rating=3).count(),
-            '2': ratings.filter(rating=2).count(),
-            '1': ratings.filter(rating=1).count()
-        }
+        # Average, count and distribution in one query
+        summary = DailyRatings.objects.filter(
+            day__gte=start_date,
+            day__lte=today
+        ).aggregate(
+            rating_sum=Sum('rating_sum', default=0),
+            total=Sum('rating_count', default=0),
+            **{str(stars): Sum(f'stars_{stars}', default=0) for stars in range(5, 0, -1)}
+        )
+        rating_sum = summary.pop('rating_sum')
+        total_ratings = summary.pop('total')
+        avg_rating = rating_sum / total_ratings if total_ratings else 0
+        rating_distribution = summary
         
-        # Top rated doctors
-        top_doctors = Staff.objects.filter(
-            appointments__ratings__isnull=False
-        ).annotate(
-            avg_rating=Avg('appointments__ratings__rating'),
-            rating_count=Count('appointments__ratings')
-        ).filter(
-            rating_count__gte=5  # Minimum 5 ratings
-        ).order_by('-avg_rating')[:5]
+        # Top rated doctors by smoothed score
+        top_doctors = rating_summaries.top_doctors(limit=5, min_ratings=5)  # Minimum 5 ratings
         
         top_doctors_data = [{
-            'staff_id': doctor.staff_id,
-            'staff_name': doctor.staff_name,
-            'avg_rating': doctor.avg_rating,
-            'rating_count': doctor.rating_count
-        } for doctor in top_doctors]
+            'staff_id': summary.doctor_id,
+            'staff_name': summary.doctor.staff_name,
+            'avg_rating': summary.average_rating,
+            'rating_count': summary.rating_count,
+            'score': summary.score
+        } for summary in top_doctors]
         
         # Historical rating data
         historical_data = []
-        
-        # Group by appropriate time period
-        if period == 'week':
-            for i in range(7):
-                date = today - timedelta(days=i)
-                daily_ratings = ratings.filter(
-                    appointment__created_at__date=date
-                )
-                avg = daily_ratings.aggregate(avg=Avg('rating'))['avg'] or 0
-                
-                historical_data.append({
-                    'date': date.isoformat(),
-                    'avg_rating': avg,
-                    'count': daily_ratings.count()
-                })
-        elif period == 'month':
-            for i in range(4):
-                week_end = today - timedelta(days=i*7)
-                week_start = week_end - timedelta(days=6)
-                weekly_ratings = ratings.filter(
-                    appointment__created_at__date__gte=week_start,
-                    appointment__created_at__date__lte=week_end
-                )
-                avg = weekly_ratings.aggregate(avg=Avg('rating'))['avg'] or 0
-                
-                historical_data.append({
-                    'period': f"{week_start.isoformat()} to {week_end.isoformat()}",
-                    'avg_rating': avg,
-                    'count': weekly_ratings.count()
-                })
-        else:
-            for i in range(12):
-                month_end = today.replace(day=1) - timedelta(days=1)
-                month_end = month_end.replace(month=month_end.month-i if month_end.month > i else 12-(i-month_end.month))
-                month_start = month_end.replace(day=1)
-                
-                monthly_ratings = ratings.filter(
-                    appointment__created_at__date__gte=month_start,
-                    appointment__created_at__date__lte=month_end
-                )
-                avg = monthly_ratings.aggregate(avg=Avg('rating'))['avg'] or 0
-                
-                historical_data.append({
-                    'month': month_start.strftime('%B %Y'),
-                    'avg_rating': avg,
-                    'count': monthly_ratings.count()
-                })
-        
-        historical_data.reverse()
+        for bucket in period_series(
+            DailyRatings.objects.all(), 'day', period, today,
+            rating_sum=Sum('rating_sum'), count=Sum('rating_count')
+        ):
+            rating_sum = bucket.pop('rating_sum')
+            count = bucket.pop('count')
+            historical_data.append({**bucket, 'avg_rating': rating_sum / count if count else 0, 'count': count})
         
         return Response({
             'average_rating': avg_rating,
-            'total_ratings': ratings.count(),
+            'total_ratings': total_ratings,
             'rating_distribution': rating_distribution,
             'top_rated_doctors': top_doctors_data,
             'historical_data': historical_data
         }, status=200)
 
-class DoctorSpecializationAnalyticsView(APIView):
+class DoctorSpecializationAnalyticsView(CachedAnalyticsMixin, APIView):
     authentication_classes = [JWTAuthentication]
     permission_classes = [IsAdminStaff]
 
     def get(self, request):
-        # Get all doctors with their specializations
-        doctors = Staff.objects.filter(doctor_details__isnull=False)
-        
-        # Count doctors by specialization
-        specialization_counts = {}
-        for doctor in doctors:
-            specialization = doctor.doctor_details.doctor_specialization
-            if specialization in specialization_counts:
-                specialization_counts[specialization] += 1
-            else:
-                specialization_counts[specialization] = 1
-        
-        # Convert to list for response
+        # Doctors and their appointments per specialization in one grouped query
+        specializations = DoctorDetails.objects.values('doctor_specialization').annotate(
+            count=Count('pk', distinct=True),
+            appointment_count=Count('staff__appointments')
+        ).order_by()
+        
         specialization_data = [
-            {'specialization': spec, 'count': count}
-            for spec, count in specialization_counts.items()
+            {'specialization': row['doctor_specialization'], 'count': row['count']}
+            for row in specializations
         ]
         
         # Sort by count (descending)
         specialization_data.sort(key=lambda x: x['count'], reverse=True)
         
         # Get appointment distribution by specialization
-        appointment_distribution = []
-        for spec in specialization_counts.keys():
-            spec_doctors = doctors.filter(doctor_details__doctor_specialization=spec)
-            spec_doctor_ids = spec_doctors.values_list('staff_id', flat=True)
-            
-            appointment_count = Appointment.objects.filter(
-                staff__staff_id__in=spec_doctor_ids
-            ).count()
-            
-            appointment_distribution.append({
-                'specialization': spec,
-                'appointment_count': appointment_count
-            })
+        appointment_distribution = [
+            {'specialization': row['doctor_specialization'], 'appointment_count': row['appointment_count']}
+            for row in specializations
+        ]
         
         # Sort by appointment count (descending)
         appointment_distribution.sort(key=lambda x: x['appointment_count'], reverse=True)
         
         return Response({
-            'total_doctors': doctors.count(),
+            'total_doctors': sum(row['count'] for row in specialization_data),
             'specialization_distribution': specialization_data,
             'appointment_distribution': appointment_distribution
         }, status=200)
 
-class AppointmentAnalyticsView(APIView):
+class SpecializationBreakdownView(CachedAnalyticsMixin, APIView):
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAdminStaff]
+
+    def get(self, request):
+        """Doctors, appointments, revenue and ratings per specialization and doctor type"""
+        group = ('doctor_specialization', 'doctor_type__doctor_type')
+        
+        # One grouped query per source table, so the query count never depends on
+        # how many doctors or specializations there are; joining them in a single
+        # query would multiply appointments by ratings
+        doctors = DoctorDetails.objects.values(*group).annotate(doctor_count=Count('pk')).order_by()
+        
+        appointments = Appointment.objects.filter(staff__doctor_details__isnull=False).values(
+            *(f'staff__doctor_details__{field}' for field in group)
+        ).annotate(
+            appointment_count=Count('pk'),
+            completed_appointments=Count('pk', filter=Q(status='completed')),
+            revenue=Sum('tran__transaction_amount', filter=Q(tran__transaction_status='completed'), default=0)
+        ).order_by()
+        
+        ratings = DoctorRatingSummary.objects.filter(doctor__doctor_details__isnull=False).values(
+            *(f'doctor__doctor_details__{field}' for field in group)
+        ).annotate(
+            rating_count=Sum('rating_count'),
+            rating_sum=Sum('rating_sum')
+        ).order_by()
+        
+        empty = {
+            'doctor_count': 0, 'appointment_count': 0, 'completed_appointments': 0,
+            'revenue': 0, 'rating_count': 0, 'rating_sum': 0
+        }
+        breakdown = {}
+        for rows, prefix in ((doctors, ''), (appointments, 'staff__doctor_details__'), (ratings, 'doctor__doctor_details__')):
+            for row in rows:
+                key = tuple(row.pop(f'{prefix}{field}') for field in group)
+                breakdown.setdefault(key, dict(empty)).update(row)
+        
+        by_specialization = {}
+        for (specialization, _), row in breakdown.items():
+            totals = by_specialization.setdefault(specialization, dict(empty))
+            for name in empty:
+                totals[name] += row[name]
+        
+        def entry(row):
+            return {
+                'doctor_count': row['doctor_count'],
+                'appointment_count': row['appointment_count'],
+                'completed_appointments': row['completed_appointments'],
+                'revenue': row['revenue'],
+                'avg_rating': row['rating_sum'] / row['rating_count'] if row['rating_count'] else 0,
+                'rating_count': row['rating_count']
+            }
+        
+        specialization_data = [
+            {'specialization': specialization, **entry(row)}
+            for specialization, row in by_specialization.items()
+        ]
+        specialization_data.sort(key=lambda x: x['appointment_count'], reverse=True)
+        
+        breakdown_data = [
+            {'specialization': specialization, 'doctor_type': doctor_type, **entry(row)}
+            for (specialization, doctor_type), row in breakdown.items()
+        ]
+        breakdown_data.sort(key=lambda x: x['appointment_count'], reverse=True)
+        
+        return Response({
+            'specializations': specialization_data,
+            'breakdown': breakdown_data
+        }, status=200)
+
+class AppointmentAnalyticsView(CachedAnalyticsMixin, APIView):
     authentication_classes = [JWTAuthentication]
     permission_classes = [IsAdminStaff]
 
@@ -279,67 +247,30 @@ class AppointmentAnalyticsView(APIView):
         else:
             return Response({"error": "Invalid period"}, status=400)
             
-        # Get appointments in the period
-        appointments = Appointment.objects.filter(
-            appointment_date__gte=start_date,
-            appointment_date__lte=today
+        # Appointments are read from the daily rollup
+        rollups.ensure_fresh(RollupDay.APPOINTMENTS)
+        appointments = DailyAppointments.objects.filter(
+            day__gte=start_date,
+            day__lte=today
         )
         
-        # Total appointments
-        total_appointments = appointments.count()
+        # Total appointments and appointments by status in one query
+        status_distribution = appointments.aggregate(
+            total=Sum('appointment_count', default=0),
+            **{
+                status: Sum('appointment_count', filter=Q(status=status), default=0)
+                for status, _ in Appointment.STATUS_CHOICES
+            }
+        )
+        total_appointments = status_distribution.pop('total')
         
         # Get total number of patients in the database
         total_patients = Patient.objects.count()
-
-        # Appointments by status
-        status_distribution = {
-            'upcoming': appointments.filter(status='upcoming').count(),
-            'completed': appointments.filter(status='completed').count(),
-            'missed': appointments.filter(status='missed').count()
-        }
         
         # Historical booking data
-        historical_data = []
-        
-        if period == 'week':
-            for i in range(7):
-                date = today - timedelta(days=i)
-                daily_count = appointments.filter(appointment_date=date).count()
-                
-                historical_data.append({
-                    'date': date.isoformat(),
-                    'count': daily_count
-                })
-        elif period == 'month':
-            for i in range(4):
-                week_end = today - timedelta(days=i*7)
-                week_start = week_end - timedelta(days=6)
-                weekly_count = appointments.filter(
-                    appointment_date__gte=week_start,
-                    appointment_date__lte=week_end
-                ).count()
-                
-                historical_data.append({
-                    'period': f"{week_start.isoformat()} to {week_end.isoformat()}",
-                    'count': weekly_count
-                })
-        else:
-            for i in range(12):
-                month_end = today.replace(day=1) - timedelta(days=1)
-                month_end = month_end.replace(month=month_end.month-i if month_end.month > i else 12-(i-month_end.month))
-                month_start = month_end.replace(day=1)
-                
-                monthly_count = appointments.filter(
-                    appointment_date__gte=month_start,
-                    appointment_date__lte=month_end
-                ).count()
-                
-                historical_data.append({
-                    'month': month_start.strftime('%B %Y'),
-                    'count': monthly_count
-                })
-        
-        historical_data.reverse()
+        historical_data = period_series(
+            DailyAppointments.objects.all(), 'day', period, today, count=Sum('appointment_count')
+        )
         
         return Response({
             'total_appointments': total_appointments,
@@ -347,3 +278,195 @@ class AppointmentAnalyticsView(APIView):
             'status_distribution': status_distribution,
             'historical_data': historical_data
         }, status=200)
+
+class AppointmentForecastView(CachedAnalyticsMixin, APIView):
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAdminStaff]
+
+    def get(self, request):
+        """Forecast appointments per doctor or specialization for the next 1-4 weeks"""
+        kind = request.query_params.get('kind', ForecastSeries.DOCTOR)
+        if kind not in ForecastSeries.KINDS:
+            return Response({"error": "Invalid kind"}, status=400)
+        
+        try:
+            weeks = int(request.query_params.get('weeks', 1))
+        except ValueError:
+            return Response({"error": "Invalid weeks"}, status=400)
+        if not 1 <= weeks <= forecaster.max_weeks:
+            return Response({"error": f"weeks must be between 1 and {forecaster.max_weeks}"}, status=400)
+        
+        keys = request.query_params.getlist('key') or None
+        
+        # Fitted parameters are stored per series; this only trains when they are stale
+        forecaster.ensure_trained()
+        forecasts = forecaster.forecast(kind, keys, weeks)
+        
+        names = {}
+        if kind == ForecastSeries.DOCTOR:
+            names = dict(Staff.objects.filter(
+                staff_id__in=[forecast['key'] for forecast in forecasts]
+            ).values_list('staff_id', 'staff_name'))
+        
+        forecast_data = []
+        for forecast in forecasts:
+            daily = [{'date': day, 'appointments': round(value, 2)} for day, value in forecast['daily']]
+            forecast_data.append({
+                'key': forecast['key'],
+                'name': names.get(forecast['key'], forecast['key']),
+                'method': forecast['method'],
+                'mae': round(forecast['mae'], 3),
+                'weekly_totals': [
+                    round(sum(value for _, value in forecast['daily'][week * 7:(week + 1) * 7]), 2)
+                    for week in range(weeks)
+                ],
+                'daily': daily
+            })
+        
+        return Response({
+            'kind': kind,
+            'weeks': weeks,
+            'trained_at': forecasts[0]['trained_at'] if forecasts else None,
+            'forecasts': forecast_data
+        }, status=200)
+
+class NoShowRiskView(APIView):
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAdminStaff]
+
+    def get(self, request):
+        """Upcoming appointments by no-show risk, and expected no-shows per doctor and day, for overbooking"""
+        try:
+            days = int(request.query_params.get('days', 7))
+            min_risk = float(request.query_params.get('min_risk', 0))
+        except ValueError:
+            return Response({"error": "Invalid days or min_risk"}, status=400)
+        if not 1 <= days <= 31:
+            return Response({"error": "days must be between 1 and 31"}, status=400)
+        
+        today = timezone.localdate()
+        upcoming = Appointment.objects.filter(
+            status='upcoming',
+            appointment_date__gte=today,
+            appointment_date__lt=today + timedelta(days=days)
+        )
+        staff_id = request.query_params.get('staff_id')
+        if staff_id:
+            upcoming = upcoming.filter(staff_id=staff_id)
+        
+        # Risks are written by the score_no_shows job; appointments booked since its last run have none yet
+        appointments = upcoming.filter(no_show_risk__gte=min_risk).select_related(
+            'patient', 'staff', 'slot', 'tran'
+        ).order_by('-no_show_risk', 'appointment_date')
+        appointment_data = [
+            {
+                'appointment_id': app.appointment_id,
+                'date': app.appointment_date,
+                'slot_start_time': app.slot.slot_start_time,
+                'staff_id': app.staff_id,
+                'doctor_name': app.staff.staff_name,
+                'patient_id': app.patient_id,
+                'patient_name': app.patient.patient_name,
+                'payment_status': app.tran.transaction_status if app.tran else None,
+                'no_show_risk': app.no_show_risk,
+                'high_risk': app.no_show_risk >= no_shows.high_risk
+            }
+            for app in appointments
+        ]
+        
+        doctor_days = upcoming.values('appointment_date', 'staff_id', 'staff__staff_name').annotate(
+            booked=Count('pk'),
+            scored=Count('no_show_risk'),
+            expected_no_shows=Sum('no_show_risk', default=0),
+            high_risk=Count('pk', filter=Q(no_show_risk__gte=no_shows.high_risk))
+        ).order_by('appointment_date', 'staff_id')
+        doctor_day_data = [
+            {
+                'date': row['appointment_date'],
+                'staff_id': row['staff_id'],
+                'doctor_name': row['staff__staff_name'],
+                'booked': row['booked'],
+                'scored': row['scored'],
+                'expected_no_shows': round(row['expected_no_shows'], 2),
+                'high_risk': row['high_risk']
+            }
+            for row in doctor_days
+        ]
+        
+        model = NoShowModel.objects.order_by('-trained_at').first()
+        return Response({
+            'model': {
+                'trained_at': model.trained_at,
+                'training_rows': model.training_rows,
+                'metrics': model.metrics
+            } if model else None,
+            'high_risk_threshold': no_shows.high_risk,
+            'appointments': appointment_data,
+            'doctor_days': doctor_day_data
+        }, status=200)
+
+class DoctorRecommendationView(APIView):
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        """Specializations and available doctors matching the reason for an appointment"""
+        reason = request.query_params.get('reason', '').strip()
+        if not reason:
+            return Response({"error": "Reason is required"}, status=400)
+        
+        on = None
+        date_str = request.query_params.get('date')
+        if date_str:
+            try:
+                on = datetime.strptime(date_str, '%Y-%m-%d').date()
+            except ValueError:
+                return Response({"error": "Invalid date format. Use YYYY-MM-DD"}, status=400)
+        
+        try:
+            limit = int(request.query_params.get('limit', 5))
+        except ValueError:
+            return Response({"error": "Invalid limit"}, status=400)
+        if not 1 <= limit <= 20:
+            return Response({"error": "limit must be between 1 and 20"}, status=400)
+        
+        recommendations = recommender.recommend(reason, on=on, doctor_limit=limit)
+        return Response({
+            'reason': reason,
+            'date': on,
+            'specializations': recommendations['specializations'],
+            'doctors': recommendations['doctors']
+        }, status=200)
+
+class LabTestSuggestionView(APIView):
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        """Lab tests to suggest while a doctor picks tests for RecommendLabTestsView"""
+        if not hasattr(request.user, 'staff_id') or not DoctorDetails.objects.filter(staff_id=request.user.staff_id).exists():
+            return Response({"error": "Only doctors can get lab test suggestions"}, status=403)
+        
+        try:
+            test_type_ids = [int(test_id) for test_id in request.query_params.get('test_type_ids', '').split(',') if test_id.strip()]
+            limit = int(request.query_params.get('limit', 10))
+            appointment_id = int(request.query_params['appointment_id']) if request.query_params.get('appointment_id') else None
+        except ValueError:
+            return Response({"error": "Invalid test_type_ids, limit or appointment_id"}, status=400)
+        if not 1 <= limit <= 50:
+            return Response({"error": "limit must be between 1 and 50"}, status=400)
+        text = request.query_params.get('q', '')
+        
+        # With an appointment, its diagnosis and the tests already ordered for it count too
+        if appointment_id is not None:
+            if not Appointment.objects.filter(appointment_id=appointment_id, staff_id=request.user.staff_id).exists():
+                return Response({"error": "Appointment not found"}, status=404)
+            test_type_ids += LabTest.objects.filter(appointment_id=appointment_id).values_list('test_type_id', flat=True)
+            terms = [
+                term for data in Diagnosis.objects.filter(appointment_id=appointment_id).values_list('diagnosis_data', flat=True)
+                for term in diagnosis_terms(data)
+            ]
+            text = ' '.join(terms + [text])
+        
+        suggestions = lab_suggestions.suggest(test_type_ids, text, limit)
+        return Response(suggestions, status=200)
@@ -0,0 +1,243 @@
+"""
+End-of-day billing run: invoices every paid appointment and lab test that has none yet
+"""
+import logging
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import Dict, List, Optional
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from hospital.models import Appointment, LabTest
+from hospital.price_book_service import price_book
+from .ledger_service import ledger
+from .models import Invoice, InvoiceLineItem, InvoiceType
+
+logger = logging.getLogger(__name__)
+
+
+def tax_in_cents(subtotals: np.ndarray, percent: int) -> np.ndarray:
+    """
+    Tax on an array of amounts in cents, rounded half to even like the
+    invoice's DecimalField does when the single-invoice views save
+    `subtotal * 0.05`. Integer arithmetic throughout, so no float error.
+    """
+    quotient, remainder = np.divmod(subtotals * percent, 100)
+    round_up = (remainder > 50) | ((remainder == 50) & (quotient % 2 == 1))
+    return quotient + round_up
+
+
+class BillingRunService:
+    """
+    Creates one invoice per billable item, the same invoice
+    GenerateAppointmentInvoiceView / GenerateLabTestInvoiceView would, but for
+    all of them at once.
+
+    Billable items are found with a single NOT EXISTS anti-join against the
+    invoice line items, then loaded and invoiced a batch at a time: totals and
+    tax for the batch are computed as NumPy arrays of cents, the invoice
+    numbers come from one block allocation, and invoices and line items are
+    written with two bulk_creates. Each batch commits on its own and re-checks
+    the anti-join under a row lock, so a run can be interrupted and restarted,
+    or overlap with an invoice created by hand, without billing anything twice.
+    """
+
+    def __init__(self):
+        self.tax_percent = getattr(settings, 'INVOICE_TAX_PERCENT', 5)
+        self.batch_size = getattr(settings, 'BILLING_RUN_BATCH_SIZE', 2000)
+
+    # ------------------------------------------------------------------
+    # Selection
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _cutoff(day: Optional[date]) -> datetime:
+        """Start of the day after `day` (today by default): everything paid before it is billed"""
+        day = day or timezone.localdate()
+        return timezone.make_aware(datetime.combine(day + timedelta(days=1), datetime.min.time()))
+
+    @staticmethod
+    def unbilled_appointments(cutoff: datetime):
+        return Appointment.objects.filter(
+            tran__isnull=False,
+            charge__isnull=False,
+            tran__transaction_datetime__lt=cutoff
+        ).filter(
+            ~Exists(InvoiceLineItem.objects.filter(appointment_id=OuterRef('pk')))
+        )
+
+    @staticmethod
+    def unbilled_lab_tests(cutoff: datetime):
+        return LabTest.objects.filter(
+            tran__isnull=False,
+            status__in=[LabTest.Status.PAID, LabTest.Status.COMPLETED],
+            tran__transaction_datetime__lt=cutoff
+        ).filter(
+            ~Exists(InvoiceLineItem.objects.filter(lab_test_id=OuterRef('pk')))
+        )
+
+    # ------------------------------------------------------------------
+    # Run
+    # ------------------------------------------------------------------
+
+    def run(self, day: Optional[date] = None, dry_run: bool = False, batch_size: Optional[int] = None) -> Dict:
+        """
+        Invoice everything paid up to the end of `day`
+
+        Args:
+            day: Last day of payments to bill, today by default
+            dry_run: Only report what would be invoiced
+            batch_size: Items invoiced per transaction
+
+        Returns:
+            Summary with the invoice count, skipped items and totals per unit
+        """
+        batch_size = batch_size or self.batch_size
+        cutoff = self._cutoff(day)
+        invoice_types = dict(
+            InvoiceType.objects.filter(
+                invoice_type_name__in=[InvoiceLineItem.APPOINTMENT, InvoiceLineItem.LAB_TEST]
+            ).values_list('invoice_type_name', 'invoice_type_id')
+        )
+
+        summary = {
+            "dry_run": dry_run,
+            "billed_through": (cutoff - timedelta(days=1)).date().isoformat(),
+            "invoices": 0,
+            "appointments": 0,
+            "lab_tests": 0,
+            "skipped": [],
+            "totals": {}
+        }
+        totals = defaultdict(lambda: np.zeros(3, dtype=np.int64))
+
+        kinds = [
+            (InvoiceLineItem.APPOINTMENT, self.unbilled_appointments, self._appointment_batch, 'appointments'),
+            (InvoiceLineItem.LAB_TEST, self.unbilled_lab_tests, self._lab_test_batch, 'lab_tests'),
+        ]
+        for kind, unbilled, load_batch, counter in kinds:
+            # The anti-join runs once; batches are then loaded by primary key
+            ids = list(unbilled(cutoff).order_by('pk').values_list('pk', flat=True))
+            if not ids:
+                continue
+            if kind not in invoice_types:
+                summary["skipped"].append({"item_type": kind, "count": len(ids), "reason": f"Invoice type '{kind}' not found"})
+                continue
+            for start in range(0, len(ids), batch_size):
+                with transaction.atomic():
+                    rows, skipped = load_batch(unbilled(cutoff), ids[start:start + batch_size], lock=not dry_run)
+                    summary["skipped"].extend(skipped)
+                    if not rows:
+                        continue
+                    amounts = self._totals(rows)
+                    if not dry_run:
+                        self._create_invoices(rows, amounts, invoice_types[kind])
+                summary[counter] += len(rows)
+                summary["invoices"] += len(rows)
+                for unit, unit_totals in self._totals_by_unit(rows, amounts).items():
+                    totals[unit] += unit_totals
+
+        summary["totals"] = {
+            unit: {name: str(self._decimal(value)) for name, value in zip(('subtotal', 'tax', 'total'), unit_totals)}
+            for unit, unit_totals in totals.items()
+        }
+        logger.info(
+            f"Billing run through {summary['billed_through']}{' (dry run)' if dry_run else ''}: "
+            f"{summary['invoices']} invoices, {len(summary['skipped'])} items skipped"
+        )
+        return summary
+
+    # ------------------------------------------------------------------
+    # Batches
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _locked(queryset, lock: bool):
+        # Only the billed rows are locked, not the nullable joined ones
+        return queryset.select_for_update(of=('self',)) if lock else queryset
+
+    def _appointment_batch(self, unbilled, ids: List[int], lock: bool):
+        appointments = self._locked(unbilled, lock).filter(pk__in=ids).select_related(
+            'staff', 'slot', 'charge__charge_unit', 'tran'
+        ).order_by('pk')
+        rows = [{
+            "item": appointment,
+            "charge": appointment.charge,
+            "tran": appointment.tran,
+            "patient_id": appointment.patient_id,
+            "remark": f"Invoice for appointment on {appointment.created_at.strftime('%Y-%m-%d')}",
+            "line_item": InvoiceLineItem.for_appointment(appointment, appointment.charge)
+        } for appointment in appointments]
+        return rows, []
+
+    def _lab_test_batch(self, unbilled, ids: List[int], lock: bool):
+        lab_tests = list(self._locked(unbilled, lock).filter(pk__in=ids).select_related(
+            'test_type', 'lab', 'tran', 'appointment'
+        ).order_by('pk'))
+        # Priced as they were when the test was paid
+        charges = price_book.charges_for_lab_tests(lab_tests)
+        rows, skipped = [], []
+        for lab_test in lab_tests:
+            charge = charges.get(lab_test.lab_test_id)
+            if charge is None:
+                skipped.append({"item_type": InvoiceLineItem.LAB_TEST, "item_id": lab_test.lab_test_id,
+                                "reason": "No charge information found"})
+                continue
+            rows.append({
+                "item": lab_test,
+                "charge": charge,
+                "tran": lab_test.tran,
+                "patient_id": lab_test.appointment.patient_id,
+                "remark": f"Invoice for {lab_test.test_type.test_name} on {lab_test.test_datetime.strftime('%Y-%m-%d')}",
+                "line_item": InvoiceLineItem.for_lab_test(lab_test, charge)
+            })
+        return rows, skipped
+
+    def _totals(self, rows: List[Dict]) -> np.ndarray:
+        """(subtotal, tax, total) in cents, one row per item"""
+        subtotals = np.fromiter(
+            (int(row["charge"].charge_amount.scaleb(2)) for row in rows), dtype=np.int64, count=len(rows)
+        )
+        taxes = tax_in_cents(subtotals, self.tax_percent)
+        return np.column_stack((subtotals, taxes, subtotals + taxes))
+
+    @staticmethod
+    def _totals_by_unit(rows: List[Dict], amounts: np.ndarray) -> Dict[str, np.ndarray]:
+        units = np.array([row["charge"].charge_unit.unit_symbol for row in rows])
+        return {str(unit): amounts[units == unit].sum(axis=0) for unit in np.unique(units)}
+
+    @staticmethod
+    def _decimal(cents) -> Decimal:
+        return Decimal(int(cents)).scaleb(-2)
+
+    def _create_invoices(self, rows: List[Dict], amounts: np.ndarray, invoice_type_id: int):
+        numbers = Invoice.allocate_numbers(len(rows))
+        invoices = Invoice.objects.bulk_create([
+            Invoice(
+                invoice_number=number,
+                tran=row["tran"],
+                invoice_type_id=invoice_type_id,
+                patient_id=row["patient_id"],
+                invoice_items=[row["item"].pk],
+                invoice_subtotal=self._decimal(subtotal),
+                invoice_tax=self._decimal(tax),
+                invoice_total=self._decimal(total),
+                invoice_unit=row["charge"].charge_unit,
+                invoice_status='paid' if row["tran"].transaction_status == 'completed' else 'pending',
+                invoice_remark=row["remark"]
+            )
+            for row, number, (subtotal, tax, total) in zip(rows, numbers, amounts.tolist())
+        ])
+        for row, invoice in zip(rows, invoices):
+            row["line_item"].invoice = invoice
+        InvoiceLineItem.objects.bulk_create([row["line_item"] for row in rows])
+        # bulk_create sends no signals
+        ledger.invoices_created(invoices)
+
+
+billing_run = BillingRunService()
@@ -0,0 +1,195 @@
+"""
+Invoice PDF rendering: cached in storage, rendered by a pool of warm WeasyPrint processes
+"""
+import hashlib
+import logging
+import multiprocessing
+import os
+import shutil
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Iterable, List
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import Prefetch
+from django.template.loader import render_to_string
+
+from . import pdf_worker
+from .models import Invoice, InvoiceLineItem
+
+logger = logging.getLogger(__name__)
+
+
+class InvoicePDFService:
+    """
+    A rendered PDF is stored as invoice_pdfs/<invoice_id>/<hash>.pdf, where the
+    hash is taken over the invoice's rendered HTML. Any change to the invoice,
+    its line items or the template therefore gives a new file, and an
+    unchanged invoice is served from storage without running WeasyPrint.
+
+    Rendering runs in a process pool whose workers load WeasyPrint (fonts,
+    CSS machinery) once when they start, so a request only pays for layout
+    and the CPU work stays out of the web worker. Workers are spawned rather
+    than forked, as the web process may have threads and open connections.
+    INVOICE_PDF_WORKERS = 0 renders in-process.
+    """
+
+    def __init__(self):
+        self.workers = getattr(settings, 'INVOICE_PDF_WORKERS', 2)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------------
+    # Rendering
+    # ------------------------------------------------------------------
+
+    def _executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=pdf_worker.warm_up
+                )
+            return self._pool
+
+    def _reset_pool(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _render_all(self, html_documents: List[str]) -> List[bytes]:
+        if not self.workers:
+            return [pdf_worker.render_pdf(html) for html in html_documents]
+        try:
+            return list(self._executor().map(pdf_worker.render_pdf, html_documents))
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory); start a fresh pool next time
+            logger.error("Invoice PDF worker pool broke, rendering in-process")
+            self._reset_pool()
+            return [pdf_worker.render_pdf(html) for html in html_documents]
+
+    @staticmethod
+    def with_line_items(invoices):
+        """Load everything the template shows, line items included, in two queries"""
+        return invoices.select_related('invoice_type', 'patient', 'invoice_unit').prefetch_related(
+            Prefetch('line_items', queryset=InvoiceLineItem.objects.select_related('unit'))
+        )
+
+    def html(self, invoice: Invoice) -> str:
+        """Rendered HTML of an invoice (see with_line_items)"""
+        context = {
+            'invoice': invoice,
+            'detailed_items': [item.as_detail() for item in invoice.line_items.all()],
+            'hospital_name': 'Your Hospital Name',
+            'hospital_address': 'Your Hospital Address',
+            'hospital_phone': 'Your Hospital Phone',
+            'hospital_email': 'your@hospital.com'
+        }
+        return render_to_string('invoice_template.html', context)
+
+    @staticmethod
+    def _path(invoice_id: int, html: str) -> str:
+        digest = hashlib.sha256(html.encode('utf-8')).hexdigest()[:20]
+        return f"invoice_pdfs/{invoice_id}/{digest}.pdf"
+
+    # ------------------------------------------------------------------
+    # Cache
+    # ------------------------------------------------------------------
+
+    def ensure(self, invoices: Iterable[Invoice]) -> Dict[int, str]:
+        """
+        Storage paths of the current PDFs of a batch of invoices, rendering
+        the missing ones in parallel
+
+        Args:
+            invoices: Invoices loaded through with_line_items
+
+        Returns:
+            Dict of invoice_id -> storage path
+        """
+        paths = {}
+        missing = {}
+        for invoice in invoices:
+            html = self.html(invoice)
+            path = self._path(invoice.invoice_id, html)
+            paths[invoice.invoice_id] = path
+            if not default_storage.exists(path):
+                missing[invoice.invoice_id] = html
+
+        if missing:
+            rendered = self._render_all(list(missing.values()))
+            for invoice_id, pdf in zip(missing, rendered):
+                default_storage.save(paths[invoice_id], ContentFile(pdf))
+                self._remove_stale(invoice_id, paths[invoice_id])
+            logger.info(f"Rendered {len(missing)} invoice PDFs")
+        return paths
+
+    def pdf_path(self, invoice: Invoice) -> str:
+        return self.ensure([invoice])[invoice.invoice_id]
+
+    @staticmethod
+    def etag(path: str) -> str:
+        # The file name is the content hash
+        return f'"{os.path.splitext(os.path.basename(path))[0]}"'
+
+    def _remove_stale(self, invoice_id: int, current_path: str):
+        directory = os.path.dirname(current_path)
+        try:
+            _, files = default_storage.listdir(directory)
+            for name in files:
+                path = f"{directory}/{name}"
+                if path != current_path:
+                    default_storage.delete(path)
+        except Exception as e:
+            logger.warning(f"Could not clean up old PDFs of invoice {invoice_id}: {str(e)}")
+
+    # ------------------------------------------------------------------
+    # Export
+    # ------------------------------------------------------------------
+
+    def export_zip(self, invoices, output, batch_size: int = 100) -> int:
+        """
+        Write the PDFs of `invoices` (a queryset) into a ZIP archive
+
+        Invoices are rendered a batch at a time across the pool, and each PDF
+        is copied from storage into the archive as a stream, so memory stays
+        bounded however long the date range is.
+
+        Args:
+            invoices: Invoice queryset
+            output: Path or writable binary file for the archive
+            batch_size: Invoices rendered in parallel per batch
+
+        Returns:
+            Number of invoices written
+        """
+        invoices = self.with_line_items(invoices).order_by('invoice_id')
+        written = 0
+        with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_STORED) as archive:
+            batch = []
+            for invoice in invoices.iterator(chunk_size=batch_size):
+                batch.append(invoice)
+                if len(batch) >= batch_size:
+                    written += self._write_batch(archive, batch)
+                    batch = []
+            if batch:
+                written += self._write_batch(archive, batch)
+        return written
+
+    def _write_batch(self, archive: zipfile.ZipFile, invoices: List[Invoice]) -> int:
+        paths = self.ensure(invoices)
+        for invoice in invoices:
+            # PDFs are already compressed
+            with default_storage.open(paths[invoice.invoice_id], 'rb') as source, \
+                    archive.open(f"invoice_{invoice.invoice_number}.pdf", 'w') as target:
+                shutil.copyfileobj(source, target)
+        return len(invoices)
+
+
+invoice_pdfs = InvoicePDFService()
@@ -0,0 +1,176 @@
+"""
+Per-patient ledger: running invoice balances maintained as invoices and transactions change
+"""
+import logging
+from collections import defaultdict
+from datetime import datetime
+from decimal import ROUND_HALF_UP, Decimal
+from typing import Dict, Iterable, Optional, Tuple
+
+from django.db import IntegrityError, transaction
+from django.db.models import DateTimeField, F, Max, Q, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from .models import Invoice, PatientLedger, Transaction
+
+logger = logging.getLogger(__name__)
+
+# Ledger column an invoice counts towards, by status; cancelled invoices count nowhere
+STATUS_COLUMNS = {'pending': 'outstanding', 'paid': 'paid', 'refunded': 'refunded'}
+
+CENT = Decimal('0.01')
+
+# (patient_id, unit_id, status, total) of an invoice
+InvoiceState = Tuple[int, int, str, Decimal]
+
+
+def invoice_state(invoice: Invoice) -> InvoiceState:
+    # Rounded to the cents the database stores: an unsaved total such as subtotal * 1.05 may have more places
+    total = Decimal(invoice.invoice_total).quantize(CENT, rounding=ROUND_HALF_UP)
+    return invoice.patient_id, invoice.invoice_unit_id, invoice.invoice_status, total
+
+
+class LedgerService:
+    """
+    Keeps PatientLedger in step with invoices.
+
+    Single saves and deletes arrive through signals and are applied as
+    F() increments of the affected row, so concurrent changes for the same
+    patient never overwrite each other. Bulk writes (billing run,
+    reconciliation) report their invoices or patients here directly. rebuild()
+    recomputes rows from scratch with grouped aggregates, for the initial
+    load or after a change made behind the ORM's back.
+    """
+
+    # ------------------------------------------------------------------
+    # Incremental updates
+    # ------------------------------------------------------------------
+
+    def invoice_changed(self, before: Optional[InvoiceState], after: Optional[InvoiceState], at: datetime = None):
+        """
+        Apply an invoice's change to the ledger
+
+        Args:
+            before: State before the change, None for a new invoice
+            after: State after the change, None for a deleted invoice
+            at: When it happened, now by default
+        """
+        deltas = defaultdict(lambda: defaultdict(Decimal))
+        if before is not None:
+            patient_id, unit_id, status, total = before
+            if status in STATUS_COLUMNS:
+                deltas[(patient_id, unit_id)][STATUS_COLUMNS[status]] -= total
+        if after is not None:
+            patient_id, unit_id, status, total = after
+            deltas[(patient_id, unit_id)]  # Recorded as activity even if cancelled
+            if status in STATUS_COLUMNS:
+                deltas[(patient_id, unit_id)][STATUS_COLUMNS[status]] += total
+        for (patient_id, unit_id), columns in deltas.items():
+            # A deletion never creates a row: the patient may be on its way out too
+            self.apply(patient_id, unit_id, columns, at, create=after is not None)
+
+    def invoices_created(self, invoices: Iterable[Invoice], at: datetime = None):
+        """Add a batch of new invoices, e.g. after bulk_create; one update per patient and unit"""
+        deltas = defaultdict(lambda: defaultdict(Decimal))
+        for invoice in invoices:
+            patient_id, unit_id, status, total = invoice_state(invoice)
+            columns = deltas[(patient_id, unit_id)]
+            if status in STATUS_COLUMNS:
+                columns[STATUS_COLUMNS[status]] += total
+        for (patient_id, unit_id), columns in deltas.items():
+            self.apply(patient_id, unit_id, columns, at)
+
+    def touch(self, patient_id: int, unit_id: int, at: datetime = None):
+        """Record activity without changing balances (a transaction was created or changed)"""
+        self.apply(patient_id, unit_id, {}, at)
+
+    def touch_transactions(self, transaction_ids: Iterable[int], at: datetime = None) -> int:
+        """touch() for transactions changed in bulk: one update over all their patients"""
+        at = at or timezone.now()
+        moment = Value(at, output_field=DateTimeField())
+        patient_ids = Transaction.objects.filter(pk__in=transaction_ids).values('patient_id')
+        return PatientLedger.objects.filter(patient_id__in=patient_ids).update(
+            last_activity=Greatest(Coalesce('last_activity', moment), moment), updated_at=timezone.now()
+        )
+
+    def apply(self, patient_id: int, unit_id: int, deltas: Dict[str, Decimal], at: datetime = None, create: bool = True):
+        at = at or timezone.now()
+        moment = Value(at, output_field=DateTimeField())
+        updates = {column: F(column) + delta for column, delta in deltas.items() if delta}
+        updates['last_activity'] = Greatest(Coalesce('last_activity', moment), moment)
+        updates['updated_at'] = timezone.now()
+
+        entries = PatientLedger.objects.filter(patient_id=patient_id, unit_id=unit_id)
+        if entries.update(**updates) or not create:
+            return
+        try:
+            with transaction.atomic():
+                PatientLedger.objects.create(
+                    patient_id=patient_id, unit_id=unit_id, last_activity=at,
+                    **{column: delta for column, delta in deltas.items()}
+                )
+        except IntegrityError:
+            # Created concurrently: add to that row instead
+            entries.update(**updates)
+
+    # ------------------------------------------------------------------
+    # Rebuild
+    # ------------------------------------------------------------------
+
+    def rebuild(self, patient_ids: Optional[Iterable[int]] = None) -> int:
+        """
+        Recompute ledger rows from the invoices and transactions
+
+        Args:
+            patient_ids: Only these patients; all of them if None
+
+        Returns:
+            Number of ledger rows written
+        """
+        invoices = Invoice.objects.all()
+        transactions = Transaction.objects.all()
+        entries = PatientLedger.objects.all()
+        if patient_ids is not None:
+            patient_ids = list(set(patient_ids))
+            invoices = invoices.filter(patient_id__in=patient_ids)
+            transactions = transactions.filter(patient_id__in=patient_ids)
+            entries = entries.filter(patient_id__in=patient_ids)
+
+        zero = Decimal('0.00')
+        totals = {
+            (row['patient_id'], row['invoice_unit_id']): row
+            for row in invoices.values('patient_id', 'invoice_unit_id').annotate(
+                **{
+                    column: Sum('invoice_total', filter=Q(invoice_status=status), default=zero)
+                    for status, column in STATUS_COLUMNS.items()
+                },
+                last_activity=Max('updated_at')
+            ).order_by()
+        }
+        for row in transactions.values('patient_id', 'transaction_unit_id').annotate(
+            last_activity=Max('updated_at')
+        ).order_by():
+            key = (row['patient_id'], row['transaction_unit_id'])
+            if key in totals:
+                totals[key]['last_activity'] = max(totals[key]['last_activity'], row['last_activity'])
+            else:
+                totals[key] = {column: zero for column in STATUS_COLUMNS.values()}
+                totals[key]['last_activity'] = row['last_activity']
+
+        with transaction.atomic():
+            entries.delete()
+            PatientLedger.objects.bulk_create([
+                PatientLedger(
+                    patient_id=patient_id,
+                    unit_id=unit_id,
+                    last_activity=row['last_activity'],
+                    **{column: row[column] for column in STATUS_COLUMNS.values()}
+                )
+                for (patient_id, unit_id), row in totals.items()
+            ], batch_size=1000)
+        logger.info(f"Rebuilt {len(totals)} patient ledger rows")
+        return len(totals)
+
+
+ledger = LedgerService()
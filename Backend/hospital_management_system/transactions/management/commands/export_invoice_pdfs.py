@@ -0,0 +1,32 @@
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from transactions.invoice_pdf_service import invoice_pdfs
+from transactions.models import Invoice
+
+
+class Command(BaseCommand):
+    help = "Export the PDFs of all invoices in a date range as one ZIP file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=str, required=True, help='First day (YYYY-MM-DD)')
+        parser.add_argument('--end', type=str, required=True, help='Last day, inclusive (YYYY-MM-DD)')
+        parser.add_argument('--output', type=str, required=True, help='Path of the ZIP file to write')
+        parser.add_argument('--batch-size', type=int, default=100, help='Invoices rendered in parallel per batch')
+
+    def handle(self, *args, **options):
+        try:
+            start = datetime.strptime(options['start'], '%Y-%m-%d').date()
+            end = datetime.strptime(options['end'], '%Y-%m-%d').date()
+        except ValueError:
+            raise CommandError('Invalid date format. Use YYYY-MM-DD')
+        if end < start:
+            raise CommandError('--end must not be before --start')
+
+        invoices = Invoice.objects.filter(
+            invoice_datetime__gte=timezone.make_aware(datetime.combine(start, datetime.min.time())),
+            invoice_datetime__lt=timezone.make_aware(datetime.combine(end + timedelta(days=1), datetime.min.time()))
+        )
+        written = invoice_pdfs.export_zip(invoices, options['output'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Exported {written} invoices to {options['output']}"))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from transactions.ledger_service import ledger
+
+
+class Command(BaseCommand):
+    help = "Recompute the per-patient ledger from invoices and transactions"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patient', type=int, action='append', dest='patients', help='Only this patient (repeatable)')
+
+    def handle(self, *args, **options):
+        rows = ledger.rebuild(options['patients'])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {rows} patient ledger rows"))
@@ -0,0 +1,90 @@
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from transactions.reconciliation_service import ReconciliationError, reconciliation
+
+
+class Command(BaseCommand):
+    help = "Reconcile transactions against a payment provider settlement file (CSV or NDJSON)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('statement', nargs='?', help='Settlement file (.csv, .ndjson or .jsonl)')
+        parser.add_argument('--report', type=str, help='Write every flagged row to this CSV file')
+        parser.add_argument('--dry-run', action='store_true', help='Report only, do not update transaction statuses')
+        parser.add_argument('--start', type=str, help='First day of the statement period (YYYY-MM-DD)')
+        parser.add_argument('--end', type=str, help='Last day of the statement period, inclusive (YYYY-MM-DD)')
+        parser.add_argument('--reference-field', type=str, default='reference', help='Column holding the transaction reference')
+        parser.add_argument('--amount-field', type=str, default='amount', help='Column holding the settled amount')
+        parser.add_argument('--status-field', type=str, default='status', help='Column holding the settlement status')
+        parser.add_argument('--benchmark', type=int, metavar='ROWS',
+                            help='Reconcile a synthetic file of ROWS rows built from the existing transactions (implies --dry-run)')
+
+    def handle(self, *args, **options):
+        start = self._day(options['start'])
+        end = self._day(options['end'])
+        if end is not None:
+            end += timedelta(days=1)
+
+        kwargs = dict(
+            report_path=options['report'],
+            dry_run=options['dry_run'],
+            start=start,
+            end=end,
+            progress=self._progress,
+            reference_field=options['reference_field'],
+            amount_field=options['amount_field'],
+            status_field=options['status_field'],
+        )
+
+        if options['benchmark']:
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'statement.csv')
+                transactions = reconciliation.write_synthetic_statement(path, options['benchmark'])
+                self.stdout.write(
+                    f"Synthetic statement: {options['benchmark']} rows over {transactions} transactions, "
+                    f"{os.path.getsize(path) / 2**20:.1f} MiB"
+                )
+                kwargs.update(dry_run=True, reference_field='reference', amount_field='amount', status_field='status')
+                result = self._reconcile(path, kwargs)
+            self.stdout.write(self.style.SUCCESS(
+                f"{result['rows']} rows in {result['seconds']}s "
+                f"({result['rows'] / max(result['seconds'], 0.001):,.0f} rows/s, index {result['index_seconds']}s)"
+            ))
+            return
+
+        if not options['statement']:
+            raise CommandError('Give a statement file, or --benchmark ROWS')
+        if not os.path.exists(options['statement']):
+            raise CommandError(f"{options['statement']} does not exist")
+        self._reconcile(options['statement'], kwargs)
+
+    def _reconcile(self, path, kwargs):
+        try:
+            result = reconciliation.reconcile(path, **kwargs)
+        except ReconciliationError as e:
+            raise CommandError(str(e))
+        self.stdout.write(json.dumps(result, indent=2))
+        verb = 'would be updated' if result['dry_run'] else 'updated'
+        self.stdout.write(self.style.SUCCESS(
+            f"Reconciled {result['rows']} rows: {result['matched']} matched, {result['status_updates']} statuses {verb}"
+        ))
+        return result
+
+    def _progress(self, counts):
+        self.stdout.write(
+            f"  {counts['rows']:,} rows, {counts['matched']:,} matched, "
+            f"{counts['rows'] - counts['matched']:,} flagged ({counts['elapsed']:.1f}s)"
+        )
+
+    @staticmethod
+    def _day(value):
+        if not value:
+            return None
+        try:
+            return timezone.make_aware(datetime.combine(datetime.strptime(value, '%Y-%m-%d').date(), datetime.min.time()))
+        except ValueError:
+            raise CommandError('Invalid date format. Use YYYY-MM-DD')
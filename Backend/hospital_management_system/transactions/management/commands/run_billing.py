@@ -0,0 +1,35 @@
+import json
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from transactions.billing_run_service import billing_run
+
+
+class Command(BaseCommand):
+    help = "Invoice every paid appointment and lab test that has no invoice yet"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', type=str, help='Bill payments made up to the end of this day (YYYY-MM-DD), today by default')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be invoiced')
+        parser.add_argument('--batch-size', type=int, default=None, help='Items invoiced per transaction')
+
+    def handle(self, *args, **options):
+        day = None
+        if options['date']:
+            try:
+                day = datetime.strptime(options['date'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('Invalid date format. Use YYYY-MM-DD')
+
+        summary = billing_run.run(day=day, dry_run=options['dry_run'], batch_size=options['batch_size'])
+
+        for item in summary['skipped']:
+            self.stdout.write(self.style.WARNING(json.dumps(item)))
+        for unit, totals in summary['totals'].items():
+            self.stdout.write(f"{unit}: subtotal {totals['subtotal']}, tax {totals['tax']}, total {totals['total']}")
+        verb = 'Would create' if summary['dry_run'] else 'Created'
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {summary['invoices']} invoices ({summary['appointments']} appointments, "
+            f"{summary['lab_tests']} lab tests) through {summary['billed_through']}; "
+            f"{len(summary['skipped'])} items skipped"
+        ))
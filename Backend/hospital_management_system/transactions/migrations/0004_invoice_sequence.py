@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:58
+
+from datetime import datetime
+
+from django.db import migrations, models
+
+
+def seed_sequences(apps, schema_editor):
+    # Carry on from the highest number already issued on each day
+    Invoice = apps.get_model('transactions', 'Invoice')
+    InvoiceSequence = apps.get_model('transactions', 'InvoiceSequence')
+    last_values = {}
+    for number in Invoice.objects.filter(invoice_number__startswith='INV-').values_list('invoice_number', flat=True).iterator():
+        try:
+            _, day, sequence = number.split('-')
+            day, sequence = datetime.strptime(day, '%Y%m%d').date(), int(sequence)
+        except ValueError:
+            continue
+        last_values[day] = max(last_values.get(day, 0), sequence)
+    InvoiceSequence.objects.bulk_create(
+        [InvoiceSequence(sequence_date=day, last_value=last_value) for day, last_value in last_values.items()],
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0003_alter_transaction_patient_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvoiceSequence',
+            fields=[
+                ('sequence_date', models.DateField(primary_key=True, serialize=False)),
+                ('last_value', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(seed_sequences, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,108 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def _charge_at(versions, at):
+    # Latest lab test charge version in effect at `at`
+    for charge in versions:
+        if charge.effective_from <= at and (charge.effective_to is None or at < charge.effective_to):
+            return charge
+    return None
+
+
+def backfill_line_items(apps, schema_editor):
+    Invoice = apps.get_model('transactions', 'Invoice')
+    InvoiceLineItem = apps.get_model('transactions', 'InvoiceLineItem')
+    Appointment = apps.get_model('hospital', 'Appointment')
+    LabTest = apps.get_model('hospital', 'LabTest')
+    LabTestCharge = apps.get_model('hospital', 'LabTestCharge')
+
+    lab_test_charges = {}
+    for charge in LabTestCharge.objects.order_by('-effective_from'):
+        lab_test_charges.setdefault(charge.test_id, []).append(charge)
+
+    invoices = Invoice.objects.select_related('invoice_type').order_by('invoice_id')
+    batch = []
+    for invoice in invoices.iterator(chunk_size=500):
+        item_ids = [item_id for item_id in (invoice.invoice_items or []) if isinstance(item_id, int)]
+        single = len(item_ids) == 1
+        if invoice.invoice_type.invoice_type_name == 'appointment':
+            appointments = Appointment.objects.select_related('staff', 'slot', 'charge').in_bulk(item_ids)
+            for position, item_id in enumerate(item_ids):
+                appointment = appointments.get(item_id)
+                if appointment is None:
+                    continue
+                charge = appointment.charge
+                batch.append(InvoiceLineItem(
+                    invoice=invoice,
+                    position=position,
+                    item_type='appointment',
+                    appointment=appointment,
+                    description=f"Consultation with {appointment.staff.staff_name}",
+                    details={
+                        "doctor_name": appointment.staff.staff_name,
+                        "appointment_date": appointment.created_at.strftime('%Y-%m-%d'),
+                        "slot_time": appointment.slot.slot_start_time.strftime('%H:%M')
+                    },
+                    # A single-item invoice billed exactly that item
+                    amount=invoice.invoice_subtotal if single else (charge.charge_amount if charge else None),
+                    unit_id=invoice.invoice_unit_id if single else (charge.charge_unit_id if charge else None)
+                ))
+        elif invoice.invoice_type.invoice_type_name == 'lab_test':
+            lab_tests = LabTest.objects.select_related('test_type', 'lab').in_bulk(item_ids)
+            for position, item_id in enumerate(item_ids):
+                lab_test = lab_tests.get(item_id)
+                if lab_test is None:
+                    continue
+                charge = _charge_at(lab_test_charges.get(lab_test.test_type_id, []), invoice.invoice_datetime)
+                batch.append(InvoiceLineItem(
+                    invoice=invoice,
+                    position=position,
+                    item_type='lab_test',
+                    lab_test=lab_test,
+                    description=f"{lab_test.test_type.test_name} ({lab_test.lab.lab_name})",
+                    details={
+                        "test_name": lab_test.test_type.test_name,
+                        "lab_name": lab_test.lab.lab_name,
+                        "test_date": lab_test.test_datetime.strftime('%Y-%m-%d')
+                    },
+                    amount=invoice.invoice_subtotal if single else (charge.charge_amount if charge else None),
+                    unit_id=invoice.invoice_unit_id if single else (charge.charge_unit_id if charge else None)
+                ))
+        if len(batch) >= 1000:
+            InvoiceLineItem.objects.bulk_create(batch)
+            batch = []
+    InvoiceLineItem.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0021_upload_sessions'),
+        ('transactions', '0004_invoice_sequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvoiceLineItem',
+            fields=[
+                ('line_item_id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('position', models.PositiveSmallIntegerField(default=0)),
+                ('item_type', models.CharField(choices=[('appointment', 'Appointment'), ('lab_test', 'Lab Test')], max_length=20)),
+                ('description', models.CharField(max_length=255)),
+                ('details', models.JSONField(default=dict, help_text='Snapshot of the item as shown on the invoice')),
+                ('amount', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('appointment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='invoice_line_items', to='hospital.appointment')),
+                ('invoice', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='line_items', to='transactions.invoice')),
+                ('lab_test', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='invoice_line_items', to='hospital.labtest')),
+                ('unit', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='invoice_line_items', to='transactions.unit')),
+            ],
+            options={
+                'ordering': ['invoice', 'position'],
+            },
+        ),
+        migrations.RunPython(backfill_line_items, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:11
+
+from decimal import Decimal
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Max, Q, Sum
+
+
+def build_ledgers(apps, schema_editor):
+    # Same grouped aggregates as LedgerService.rebuild, over the historical models
+    Invoice = apps.get_model('transactions', 'Invoice')
+    Transaction = apps.get_model('transactions', 'Transaction')
+    PatientLedger = apps.get_model('transactions', 'PatientLedger')
+    zero = Decimal('0.00')
+    rows = {}
+    for row in Invoice.objects.values('patient_id', 'invoice_unit_id').annotate(
+        outstanding=Sum('invoice_total', filter=Q(invoice_status='pending'), default=zero),
+        paid=Sum('invoice_total', filter=Q(invoice_status='paid'), default=zero),
+        refunded=Sum('invoice_total', filter=Q(invoice_status='refunded'), default=zero),
+        last_activity=Max('updated_at')
+    ).order_by():
+        rows[(row.pop('patient_id'), row.pop('invoice_unit_id'))] = row
+    for row in Transaction.objects.values('patient_id', 'transaction_unit_id').annotate(
+        last_activity=Max('updated_at')
+    ).order_by():
+        entry = rows.setdefault(
+            (row['patient_id'], row['transaction_unit_id']),
+            {'outstanding': zero, 'paid': zero, 'refunded': zero, 'last_activity': row['last_activity']}
+        )
+        entry['last_activity'] = max(entry['last_activity'], row['last_activity'])
+    PatientLedger.objects.bulk_create(
+        [PatientLedger(patient_id=patient_id, unit_id=unit_id, **row) for (patient_id, unit_id), row in rows.items()],
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hospital', '0021_upload_sessions'),
+        ('transactions', '0005_invoice_line_items'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientLedger',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('outstanding', models.DecimalField(decimal_places=2, default=0, help_text='Total of pending invoices', max_digits=12)),
+                ('paid', models.DecimalField(decimal_places=2, default=0, help_text='Total of paid invoices', max_digits=12)),
+                ('refunded', models.DecimalField(decimal_places=2, default=0, help_text='Total of refunded invoices', max_digits=12)),
+                ('last_activity', models.DateTimeField(blank=True, help_text="Latest change to the patient's invoices or transactions", null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger_entries', to='hospital.patient')),
+                ('unit', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='ledger_entries', to='transactions.unit')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('patient', 'unit'), name='patient_ledger_unique')],
+            },
+        ),
+        migrations.RunPython(build_ledgers, migrations.RunPython.noop),
+    ]
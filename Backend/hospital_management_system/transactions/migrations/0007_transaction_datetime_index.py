@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0006_patient_ledger'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['transaction_datetime'], name='transaction_datetime_idx'),
+        ),
+    ]
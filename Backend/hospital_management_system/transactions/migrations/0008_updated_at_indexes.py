@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0007_transaction_datetime_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(fields=['updated_at'], name='invoice_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='invoicelineitem',
+            index=models.Index(fields=['created_at'], name='line_item_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['updated_at'], name='transaction_updated_idx'),
+        ),
+    ]
@@ -1,4 +1,5 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import F
 from django.utils import timezone
 
 class Unit(models.Model):
@@ -48,6 +49,12 @@ class Transaction(models.Model):
     transaction_remark = models.TextField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['transaction_datetime'], name='transaction_datetime_idx'),
+            models.Index(fields=['updated_at'], name='transaction_updated_idx'),
+        ]
     
     def __str__(self):
         return f"Transaction {self.transaction_reference}: {self.transaction_amount} {self.transaction_unit.unit_symbol}"
@@ -62,6 +69,38 @@ class InvoiceType(models.Model):
     def __str__(self):
         return self.invoice_type_name
 
+class InvoiceSequence(models.Model):
+    """Last invoice sequence number handed out per day (INV-YYYYMMDD-XXXX)"""
+    sequence_date = models.DateField(primary_key=True)
+    last_value = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Invoice sequence {self.sequence_date}: {self.last_value}"
+
+    @classmethod
+    def allocate(cls, count=1, day=None):
+        """
+        Reserve `count` consecutive sequence numbers for `day` (defaults to today)
+        and return them as a range.
+
+        The counter row is bumped with a single UPDATE ... SET last_value =
+        last_value + count, which locks it until the surrounding transaction
+        ends, so concurrent callers queue on the row instead of reading the same
+        last invoice. A rolled back transaction gives its numbers back.
+        """
+        day = day or timezone.now().date()
+        with transaction.atomic():
+            if not cls.objects.filter(sequence_date=day).update(last_value=F('last_value') + count):
+                try:
+                    with transaction.atomic():
+                        cls.objects.create(sequence_date=day, last_value=count)
+                except IntegrityError:
+                    # Another caller created the day's row first
+                    cls.objects.filter(sequence_date=day).update(last_value=F('last_value') + count)
+            last_value = cls.objects.filter(sequence_date=day).values_list('last_value', flat=True).get()
+        return range(last_value - count + 1, last_value + 1)
+
 class Invoice(models.Model):
     invoice_id = models.AutoField(primary_key=True)
     invoice_number = models.CharField(max_length=50, unique=True)  # Human-readable invoice number
@@ -83,25 +122,142 @@ class Invoice(models.Model):
     invoice_remark = models.TextField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['updated_at'], name='invoice_updated_idx'),
+        ]
     
     def __str__(self):
         return f"Invoice #{self.invoice_number} - {self.invoice_total} {self.invoice_unit.unit_symbol}"
     
+    @staticmethod
+    def format_number(day, sequence):
+        # Format: INV-YYYYMMDD-XXXX where XXXX is a sequential number
+        return f'INV-{day.strftime("%Y%m%d")}-{sequence:04d}'
+
+    @classmethod
+    def allocate_numbers(cls, count, day=None):
+        """
+        Pre-allocate a block of invoice numbers, e.g. for a billing run that
+        creates many invoices with bulk_create. Costs one counter update
+        however large the block.
+        """
+        day = day or timezone.now().date()
+        return [cls.format_number(day, sequence) for sequence in InvoiceSequence.allocate(count, day)]
+
     def save(self, *args, **kwargs):
         # Generate invoice number if not provided
         if not self.invoice_number:
-            # Format: INV-YYYYMMDD-XXXX where XXXX is a sequential number
-            today = timezone.now().strftime('%Y%m%d')
-            last_invoice = Invoice.objects.filter(invoice_number__startswith=f'INV-{today}').order_by('invoice_number').last()
-            
-            if last_invoice:
-                # Extract the last sequence number and increment
-                last_seq = int(last_invoice.invoice_number.split('-')[-1])
-                new_seq = last_seq + 1
-            else:
-                new_seq = 1
-                
-            self.invoice_number = f'INV-{today}-{new_seq:04d}'
+            self.invoice_number = self.allocate_numbers(1)[0]
             
         super().save(*args, **kwargs)
 
+
+
+class InvoiceLineItem(models.Model):
+    """
+    One billed item of an invoice, with its description and price copied at
+    billing time so the invoice reads the same after the appointment, lab test
+    or price changes.
+    """
+    APPOINTMENT = 'appointment'
+    LAB_TEST = 'lab_test'
+
+    line_item_id = models.BigAutoField(primary_key=True)
+    invoice = models.ForeignKey(Invoice, on_delete=models.CASCADE, related_name='line_items')
+    position = models.PositiveSmallIntegerField(default=0)
+    item_type = models.CharField(max_length=20, choices=[
+        (APPOINTMENT, 'Appointment'),
+        (LAB_TEST, 'Lab Test')
+    ])
+    appointment = models.ForeignKey("hospital.Appointment", on_delete=models.SET_NULL, null=True, blank=True, related_name='invoice_line_items')
+    lab_test = models.ForeignKey("hospital.LabTest", on_delete=models.SET_NULL, null=True, blank=True, related_name='invoice_line_items')
+    description = models.CharField(max_length=255)
+    details = models.JSONField(default=dict, help_text='Snapshot of the item as shown on the invoice')
+    amount = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    unit = models.ForeignKey(Unit, on_delete=models.PROTECT, null=True, blank=True, related_name='invoice_line_items')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['invoice', 'position']
+        indexes = [
+            models.Index(fields=['created_at'], name='line_item_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.description}: {self.amount}"
+
+    @property
+    def item_id(self):
+        return self.appointment_id if self.item_type == self.APPOINTMENT else self.lab_test_id
+
+    @classmethod
+    def for_appointment(cls, appointment, charge, position=0, **kwargs):
+        """Unsaved line item for an appointment (expects staff and slot to be loaded)"""
+        return cls(
+            position=position,
+            item_type=cls.APPOINTMENT,
+            appointment=appointment,
+            description=f"Consultation with {appointment.staff.staff_name}",
+            details={
+                "doctor_name": appointment.staff.staff_name,
+                "appointment_date": appointment.created_at.strftime('%Y-%m-%d'),
+                "slot_time": appointment.slot.slot_start_time.strftime('%H:%M')
+            },
+            amount=charge.charge_amount if charge else None,
+            unit=charge.charge_unit if charge else None,
+            **kwargs
+        )
+
+    @classmethod
+    def for_lab_test(cls, lab_test, charge, position=0, **kwargs):
+        """Unsaved line item for a lab test (expects test_type and lab to be loaded)"""
+        return cls(
+            position=position,
+            item_type=cls.LAB_TEST,
+            lab_test=lab_test,
+            description=f"{lab_test.test_type.test_name} ({lab_test.lab.lab_name})",
+            details={
+                "test_name": lab_test.test_type.test_name,
+                "lab_name": lab_test.lab.lab_name,
+                "test_date": lab_test.test_datetime.strftime('%Y-%m-%d')
+            },
+            amount=charge.charge_amount if charge else None,
+            unit=charge.charge_unit if charge else None,
+            **kwargs
+        )
+
+    def as_detail(self):
+        """The invoice detail / PDF representation of the item"""
+        return {
+            "item_id": self.item_id,
+            "item_type": self.item_type,
+            "description": self.description,
+            **self.details,
+            "amount": self.amount,
+            "unit_symbol": self.unit.unit_symbol if self.unit_id else None
+        }
+
+
+class PatientLedger(models.Model):
+    """
+    A patient's running invoice balances in one currency, kept up to date by
+    transactions.ledger_service as invoices and transactions change, so billing
+    screens read one row instead of summing every invoice.
+    """
+    patient = models.ForeignKey("hospital.Patient", on_delete=models.CASCADE, related_name='ledger_entries')
+    unit = models.ForeignKey(Unit, on_delete=models.PROTECT, related_name='ledger_entries')
+    outstanding = models.DecimalField(max_digits=12, decimal_places=2, default=0, help_text='Total of pending invoices')
+    paid = models.DecimalField(max_digits=12, decimal_places=2, default=0, help_text='Total of paid invoices')
+    refunded = models.DecimalField(max_digits=12, decimal_places=2, default=0, help_text='Total of refunded invoices')
+    last_activity = models.DateTimeField(null=True, blank=True, help_text="Latest change to the patient's invoices or transactions")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['patient', 'unit'], name='patient_ledger_unique'),
+        ]
+
+    def __str__(self):
+        return f"Ledger of patient {self.patient_id}: {self.outstanding} outstanding"
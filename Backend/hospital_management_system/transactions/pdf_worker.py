@@ -0,0 +1,16 @@
+"""
+WeasyPrint rendering for the invoice PDF worker processes.
+
+Kept free of Django imports so a freshly spawned worker only loads WeasyPrint.
+"""
+
+
+def warm_up():
+    """Worker initializer: load WeasyPrint, its fonts and CSS machinery once, before the first real invoice"""
+    from weasyprint import HTML
+    HTML(string='<html><body><p>warm-up</p></body></html>').write_pdf()
+
+
+def render_pdf(html: str) -> bytes:
+    from weasyprint import HTML
+    return HTML(string=html).write_pdf()
@@ -0,0 +1,288 @@
+"""
+Reconciliation of transactions against payment provider settlement files
+"""
+import csv
+import json
+import logging
+import random
+import time
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction as db_transaction
+from django.utils import timezone
+
+from .ledger_service import ledger
+from .models import Transaction
+from .signals import transactions_updated
+
+logger = logging.getLogger(__name__)
+
+# Ledger statuses, stored as small codes in the index
+STATUSES = ['pending', 'completed', 'failed', 'refunded']
+STATUS_CODES = {status: code for code, status in enumerate(STATUSES)}
+
+# Provider statuses and the transaction status they settle to
+SETTLEMENT_STATUSES = {
+    'settled': 'completed',
+    'success': 'completed',
+    'succeeded': 'completed',
+    'completed': 'completed',
+    'captured': 'completed',
+    'failed': 'failed',
+    'declined': 'failed',
+    'refunded': 'refunded',
+}
+
+REPORT_FIELDS = ['issue', 'line', 'reference', 'transaction_id', 'ledger_amount', 'statement_amount']
+
+
+class ReconciliationError(Exception):
+    pass
+
+
+class TransactionIndex:
+    """
+    Every transaction that has a reference, loaded with one values_list pass:
+    a dict from reference to row number, and NumPy columns for the rest, so
+    a million transactions take tens of megabytes rather than a million
+    model instances.
+    """
+
+    def __init__(self, start: Optional[datetime] = None, end: Optional[datetime] = None):
+        rows = Transaction.objects.filter(transaction_reference__isnull=False).values_list(
+            'transaction_reference', 'transaction_id', 'transaction_amount', 'transaction_status', 'transaction_datetime'
+        )
+        self.positions: Dict[str, int] = {}
+        ids, amounts, statuses, expected = [], [], [], []
+        for reference, transaction_id, amount, status, moment in rows.iterator(chunk_size=10000):
+            self.positions[reference] = len(ids)
+            ids.append(transaction_id)
+            amounts.append(_cents(amount))
+            statuses.append(STATUS_CODES.get(status, -1))
+            # Completed transactions in the statement period should appear in it
+            expected.append(
+                status == 'completed' and (start is not None or end is not None)
+                and (start is None or moment >= start) and (end is None or moment < end)
+            )
+        self.ids = np.array(ids, dtype=np.int64)
+        self.amounts = np.array(amounts, dtype=np.int64)
+        self.statuses = np.array(statuses, dtype=np.int8)
+        self.expected = np.array(expected, dtype=bool)
+        self.seen = np.zeros(len(ids), dtype=bool)
+        self._references = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def reference(self, position: int) -> str:
+        # Only needed for the few unmatched transactions, so the reverse map is built on first use
+        if self._references is None:
+            self._references = np.empty(len(self.ids), dtype=object)
+            for reference, row in self.positions.items():
+                self._references[row] = reference
+        return self._references[position]
+
+
+def _cents(amount) -> int:
+    return int(Decimal(amount).scaleb(2).to_integral_value())
+
+
+def _format_cents(cents) -> str:
+    return str(Decimal(int(cents)).scaleb(-2))
+
+
+def read_statement(path: str, reference_field: str = 'reference', amount_field: str = 'amount',
+                   status_field: str = 'status') -> Iterator[Tuple[int, str, str, str]]:
+    """
+    Stream (line, reference, amount, status) out of a CSV or NDJSON settlement
+    file, one row at a time; the format is taken from the extension
+    (.ndjson / .jsonl, anything else is CSV with a header row)
+    """
+    with open(path, 'r', newline='', encoding='utf-8') as handle:
+        if path.endswith(('.ndjson', '.jsonl')):
+            for line, text in enumerate(handle, start=1):
+                if not text.strip():
+                    continue
+                try:
+                    row = json.loads(text)
+                except ValueError:
+                    yield line, '', '', ''
+                    continue
+                yield line, *('' if row.get(name) is None else str(row[name])
+                              for name in (reference_field, amount_field, status_field))
+        else:
+            reader = csv.DictReader(handle)
+            missing = {reference_field, amount_field} - set(reader.fieldnames or [])
+            if missing:
+                raise ReconciliationError(f"Statement is missing the column(s): {', '.join(sorted(missing))}")
+            for line, row in enumerate(reader, start=2):
+                yield line, row.get(reference_field) or '', row.get(amount_field) or '', row.get(status_field) or ''
+
+
+class ReconciliationService:
+    """
+    Matches a settlement file against Transaction by transaction_reference.
+
+    The file is read row by row and never held in memory; only the index of
+    transactions is. Each row ends up as one of:
+      - matched: the amount agrees; if the provider's status differs from the
+        transaction's, the transaction is updated (in bulk, per status)
+      - unknown_reference: no transaction has the reference
+      - amount_mismatch: the settled amount differs from the transaction's
+      - duplicate: the reference was already seen earlier in the file
+      - invalid: the row has no reference or an unreadable amount
+    If a statement period is given, completed transactions of that period the
+    file never mentioned are then reported as missing_in_statement. Every issue is
+    written as a row of the CSV report.
+    """
+
+    def __init__(self):
+        self.batch_size = getattr(settings, 'RECONCILIATION_BATCH_SIZE', 5000)
+        self.progress_every = getattr(settings, 'RECONCILIATION_PROGRESS_ROWS', 100000)
+
+    def reconcile(self, path: str, report_path: Optional[str] = None, dry_run: bool = False,
+                  start: Optional[datetime] = None, end: Optional[datetime] = None,
+                  progress: Optional[Callable[[Dict], None]] = None, **fields) -> Dict:
+        """
+        Reconcile one settlement file
+
+        Args:
+            path: CSV or NDJSON settlement file
+            report_path: Where to write the issues as CSV (not written if None)
+            dry_run: Report only, leave transaction statuses unchanged
+            start, end: Statement period, for missing_in_statement
+            progress: Called with the running counts every RECONCILIATION_PROGRESS_ROWS rows
+            fields: reference_field / amount_field / status_field column names
+
+        Returns:
+            Counts per outcome, status updates applied and timing
+        """
+        started = time.perf_counter()
+        index = TransactionIndex(start, end)
+        indexed = time.perf_counter()
+
+        counts = {
+            "rows": 0, "matched": 0, "unknown_reference": 0, "amount_mismatch": 0,
+            "duplicate": 0, "invalid": 0, "missing_in_statement": 0, "status_updates": 0
+        }
+        pending_updates = {status: [] for status in set(SETTLEMENT_STATUSES.values())}
+
+        report_file = open(report_path, 'w', newline='', encoding='utf-8') if report_path else None
+        report = csv.writer(report_file) if report_file else None
+        if report:
+            report.writerow(REPORT_FIELDS)
+
+        def flag(issue, line, reference, position=None, statement_amount=''):
+            counts[issue] += 1
+            if report:
+                report.writerow([
+                    issue, line, reference,
+                    int(index.ids[position]) if position is not None else '',
+                    _format_cents(index.amounts[position]) if position is not None else '',
+                    statement_amount
+                ])
+
+        try:
+            for line, reference, amount, status in read_statement(path, **fields):
+                counts["rows"] += 1
+                if progress and counts["rows"] % self.progress_every == 0:
+                    progress(dict(counts, elapsed=time.perf_counter() - started))
+
+                reference = reference.strip()
+                try:
+                    cents = _cents(amount.strip())
+                except (InvalidOperation, ValueError):
+                    cents = None
+                if not reference or cents is None:
+                    flag("invalid", line, reference, statement_amount=amount)
+                    continue
+
+                position = index.positions.get(reference)
+                if position is None:
+                    flag("unknown_reference", line, reference, statement_amount=amount)
+                    continue
+                if index.seen[position]:
+                    flag("duplicate", line, reference, position, amount)
+                    continue
+                index.seen[position] = True
+                if index.amounts[position] != cents:
+                    flag("amount_mismatch", line, reference, position, amount)
+                    continue
+
+                counts["matched"] += 1
+                settled = SETTLEMENT_STATUSES.get(status.strip().lower())
+                if settled is not None and index.statuses[position] != STATUS_CODES[settled]:
+                    queue = pending_updates[settled]
+                    queue.append(int(index.ids[position]))
+                    if len(queue) >= self.batch_size:
+                        counts["status_updates"] += self._apply(settled, queue, dry_run)
+                        queue.clear()
+
+            for settled, queue in pending_updates.items():
+                if queue:
+                    counts["status_updates"] += self._apply(settled, queue, dry_run)
+
+            for position in np.flatnonzero(index.expected & ~index.seen):
+                flag("missing_in_statement", '', index.reference(position), int(position))
+        finally:
+            if report_file:
+                report_file.close()
+
+        counts.update(
+            dry_run=dry_run,
+            transactions_indexed=len(index),
+            index_seconds=round(indexed - started, 2),
+            seconds=round(time.perf_counter() - started, 2)
+        )
+        logger.info(f"Reconciled {path}: {counts}")
+        return counts
+
+    @staticmethod
+    def _apply(status: str, transaction_ids, dry_run: bool) -> int:
+        if dry_run:
+            return len(transaction_ids)
+        with db_transaction.atomic():
+            updated = Transaction.objects.filter(pk__in=transaction_ids).update(
+                transaction_status=status, updated_at=timezone.now()
+            )
+            ledger.touch_transactions(transaction_ids)
+            # A bulk update sends no post_save: tell whoever keeps figures derived from them
+            transactions_updated.send(sender=Transaction, transaction_ids=transaction_ids)
+        return updated
+
+    # ------------------------------------------------------------------
+    # Benchmark
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def write_synthetic_statement(path: str, rows: int, seed: int = 0) -> int:
+        """
+        Write a CSV settlement file of `rows` rows for benchmarking, cycling
+        through the transactions in the database (so rows beyond their number
+        are duplicates), with about 1% unknown references and 1% wrong amounts
+
+        Returns:
+            Number of transactions the rows were drawn from
+        """
+        transactions = list(Transaction.objects.filter(transaction_reference__isnull=False).values_list(
+            'transaction_reference', 'transaction_amount'
+        ))
+        rng = random.Random(seed)
+        with open(path, 'w', newline='', encoding='utf-8') as handle:
+            writer = csv.writer(handle)
+            writer.writerow(['reference', 'amount', 'status'])
+            for number in range(rows):
+                roll = rng.random()
+                if not transactions or roll < 0.01:
+                    writer.writerow([f"SYN-UNKNOWN-{number}", '100.00', 'settled'])
+                    continue
+                reference, amount = transactions[number % len(transactions)]
+                writer.writerow([reference, amount + 1 if roll < 0.02 else amount, 'settled'])
+        return len(transactions)
+
+
+reconciliation = ReconciliationService()
@@ -1,6 +1,6 @@
 # transactions/serializers.py
 from rest_framework import serializers
-from .models import Invoice, InvoiceType, Transaction, Unit
+from .models import Invoice, InvoiceType, PatientLedger, Transaction, Unit
 
 class InvoiceSerializer(serializers.ModelSerializer):
     invoice_type_name = serializers.CharField(source='invoice_type.invoice_type_name', read_only=True)
@@ -16,3 +16,11 @@ class InvoiceSerializer(serializers.ModelSerializer):
             'invoice_unit', 'unit_symbol', 'invoice_status', 'invoice_remark'
         ]
         read_only_fields = ['invoice_id', 'invoice_number', 'invoice_datetime']
+
+class PatientLedgerSerializer(serializers.ModelSerializer):
+    unit_name = serializers.CharField(source='unit.unit_name', read_only=True)
+    unit_symbol = serializers.CharField(source='unit.unit_symbol', read_only=True)
+
+    class Meta:
+        model = PatientLedger
+        fields = ['unit', 'unit_name', 'unit_symbol', 'outstanding', 'paid', 'refunded', 'last_activity']
@@ -0,0 +1,34 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import Signal, receiver
+
+from .ledger_service import invoice_state, ledger
+from .models import Invoice, Transaction
+
+# Sent with transaction_ids after transactions were changed with a bulk update,
+# which sends no post_save (e.g. by reconciliation)
+transactions_updated = Signal()
+
+
+@receiver(pre_save, sender=Invoice)
+def remember_invoice_state(sender, instance, **kwargs):
+    # The ledger needs what the invoice counted for before this save
+    if instance.pk:
+        instance._previous_ledger_state = Invoice.objects.filter(pk=instance.pk).values_list(
+            'patient_id', 'invoice_unit_id', 'invoice_status', 'invoice_total'
+        ).first()
+
+
+@receiver(post_save, sender=Invoice)
+def update_ledger_for_invoice(sender, instance, created, **kwargs):
+    before = None if created else getattr(instance, '_previous_ledger_state', None)
+    ledger.invoice_changed(before, invoice_state(instance), at=instance.updated_at)
+
+
+@receiver(post_delete, sender=Invoice)
+def remove_invoice_from_ledger(sender, instance, **kwargs):
+    ledger.invoice_changed(invoice_state(instance), None)
+
+
+@receiver(post_save, sender=Transaction)
+def record_transaction_activity(sender, instance, **kwargs):
+    ledger.touch(instance.patient_id, instance.transaction_unit_id, at=instance.updated_at)
@@ -1,3 +1,458 @@
-from django.test import TestCase
+import csv
+import os
+import shutil
+import tempfile
+import threading
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.db import connection, transaction
+from django.core.files.storage import default_storage
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from hospital.models import AppointmentCharge, LabTest, LabTestCharge, Patient, Role, Staff
+from hospital.price_book_service import price_book
+from hospital.tests import _appointment, _lab_fixtures, _payment
+from . import pdf_worker
+from .billing_run_service import billing_run
+from .invoice_pdf_service import invoice_pdfs
+from .ledger_service import ledger
+from .reconciliation_service import ReconciliationError, reconciliation
+from .models import Invoice, InvoiceLineItem, InvoiceSequence, InvoiceType, Transaction, Unit
+
+
+def _invoice_fixtures():
+    patient = Patient.objects.create(patient_name='Test Patient', patient_email='patient@example.com', patient_mobile='9999999999')
+    invoice_type = InvoiceType.objects.create(invoice_type_name='appointment')
+    unit = Unit.objects.create(unit_name='INR', unit_symbol='₹')
+    return patient, invoice_type, unit
+
+
+def _invoice(patient, invoice_type, unit, **kwargs):
+    return Invoice(**{
+        'patient': patient,
+        'invoice_type': invoice_type,
+        'invoice_unit': unit,
+        'invoice_items': [],
+        'invoice_subtotal': Decimal('100.00'),
+        'invoice_tax': Decimal('0.00'),
+        'invoice_total': Decimal('100.00'),
+        **kwargs
+    })
+
+
+def _admin_client():
+    role = Role.objects.create(role_name='admin', role_permissions={'is_admin': True})
+    admin = Staff.objects.create(
+        staff_id='ADM001', staff_name='Admin', role=role, created_at=date(2025, 1, 1),
+        staff_email='admin@example.com', staff_mobile='6666666666'
+    )
+    client = APIClient()
+    client.force_authenticate(user=admin)
+    return client
+
+
+class InvoiceSequenceTests(TestCase):
+    def setUp(self):
+        self.patient, self.invoice_type, self.unit = _invoice_fixtures()
+
+    def test_numbers_are_sequential_per_day(self):
+        first = _invoice(self.patient, self.invoice_type, self.unit)
+        first.save()
+        second = _invoice(self.patient, self.invoice_type, self.unit)
+        second.save()
+        prefix = first.invoice_number.rsplit('-', 1)[0]
+        self.assertTrue(first.invoice_number.endswith('-0001'))
+        self.assertEqual(second.invoice_number, f'{prefix}-0002')
+
+    def test_block_allocation(self):
+        day = date(2025, 5, 15)
+        block = Invoice.allocate_numbers(3, day)
+        self.assertEqual(block, ['INV-20250515-0001', 'INV-20250515-0002', 'INV-20250515-0003'])
+        self.assertEqual(Invoice.allocate_numbers(1, day), ['INV-20250515-0004'])
+        self.assertEqual(InvoiceSequence.objects.get(sequence_date=day).last_value, 4)
+
+    def test_numbers_restart_on_a_new_day(self):
+        def invoice_at(moment):
+            with mock.patch('django.utils.timezone.now', return_value=timezone.make_aware(moment)):
+                invoice = _invoice(self.patient, self.invoice_type, self.unit)
+                invoice.save()
+            return invoice.invoice_number
+
+        late = [invoice_at(datetime(2025, 5, 15, 23, 59, second)) for second in (58, 59)]
+        early = [invoice_at(datetime(2025, 5, 16, 0, 0, second)) for second in (0, 1)]
+        self.assertEqual(late, ['INV-20250515-0001', 'INV-20250515-0002'])
+        self.assertEqual(early, ['INV-20250516-0001', 'INV-20250516-0002'])
+        # The earlier day's counter carries on where it stopped
+        self.assertEqual(Invoice.allocate_numbers(1, date(2025, 5, 15)), ['INV-20250515-0003'])
+        self.assertEqual(
+            dict(InvoiceSequence.objects.values_list('sequence_date', 'last_value')),
+            {date(2025, 5, 15): 3, date(2025, 5, 16): 2}
+        )
+
+    def test_blocks_and_single_numbers_are_contiguous(self):
+        day = date(2025, 5, 15)
+        allocated = []
+        for count in (1, 250, 1, 1, 40, 1):
+            block = list(InvoiceSequence.allocate(count, day))
+            self.assertEqual(len(block), count)
+            self.assertEqual(block, list(range(block[0], block[0] + count)))
+            allocated += block
+        self.assertEqual(allocated, list(range(1, 295)))
+
+    def test_rolled_back_block_is_handed_out_again(self):
+        day = date(2025, 5, 15)
+        Invoice.allocate_numbers(2, day)
+        with transaction.atomic():
+            self.assertEqual(Invoice.allocate_numbers(3, day), ['INV-20250515-0003', 'INV-20250515-0004', 'INV-20250515-0005'])
+            transaction.set_rollback(True)
+        self.assertEqual(Invoice.allocate_numbers(1, day), ['INV-20250515-0003'])
+
+    def test_explicit_number_is_kept(self):
+        invoice = _invoice(self.patient, self.invoice_type, self.unit, invoice_number='INV-MANUAL-1')
+        invoice.save()
+        self.assertEqual(invoice.invoice_number, 'INV-MANUAL-1')
+        self.assertFalse(InvoiceSequence.objects.exists())
+
+
+class InvoiceSequenceConcurrencyTests(TransactionTestCase):
+    threads = 8
+    invoices = 10000
+
+    def setUp(self):
+        # Threads need a database they can share: not in-memory SQLite
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest("needs a file-backed or server test database")
+
+    def test_concurrent_invoices_get_unique_numbers(self):
+        patient, invoice_type, unit = _invoice_fixtures()
+        per_thread = self.invoices // self.threads
+        errors = []
+        start = threading.Barrier(self.threads)
+
+        def create_invoices(use_blocks):
+            try:
+                start.wait()
+                if use_blocks:
+                    # Billing-run style: reserve a block, then bulk insert
+                    for _ in range(per_thread // 250):
+                        numbers = Invoice.allocate_numbers(250)
+                        Invoice.objects.bulk_create([
+                            _invoice(patient, invoice_type, unit, invoice_number=number) for number in numbers
+                        ])
+                else:
+                    for _ in range(per_thread):
+                        _invoice(patient, invoice_type, unit).save()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [
+            threading.Thread(target=create_invoices, args=(index % 2 == 0,)) for index in range(self.threads)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        numbers = list(Invoice.objects.values_list('invoice_number', flat=True))
+        self.assertEqual(len(numbers), self.invoices)
+        self.assertEqual(len(set(numbers)), self.invoices)
+        sequences = sorted(int(number.rsplit('-', 1)[1]) for number in numbers)
+        self.assertEqual(sequences, list(range(1, self.invoices + 1)))
+
+
+class PatientLedgerTests(TestCase):
+    def setUp(self):
+        self.patient, self.invoice_type, self.unit = _invoice_fixtures()
+        self.client = _admin_client()
+        self.first = _invoice(self.patient, self.invoice_type, self.unit)
+        self.first.save()
+        self.second = _invoice(self.patient, self.invoice_type, self.unit, invoice_status='paid')
+        self.second.save()
+
+    def _balances(self):
+        response = self.client.get(reverse('patient-ledger', args=[self.patient.patient_id]))
+        self.assertEqual(response.status_code, 200)
+        return [
+            (balance['outstanding'], balance['paid'], balance['refunded']) for balance in response.data['balances']
+        ]
+
+    def _set_status(self, invoice, status):
+        response = self.client.put(reverse('update-invoice-status', args=[invoice.invoice_id]), {'status': status}, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+
+    def test_totals_follow_status_changes(self):
+        self.assertEqual(self._balances(), [('100.00', '100.00', '0.00')])
+        self._set_status(self.first, 'paid')
+        self.assertEqual(self._balances(), [('0.00', '200.00', '0.00')])
+        self._set_status(self.second, 'refunded')
+        self.assertEqual(self._balances(), [('0.00', '100.00', '100.00')])
+        self._set_status(self.first, 'cancelled')
+        self.assertEqual(self._balances(), [('0.00', '0.00', '100.00')])
+
+        # The incremental totals agree with a rebuild from the invoices
+        incremental = self._balances()
+        ledger.rebuild([self.patient.patient_id])
+        self.assertEqual(self._balances(), incremental)
+
+    def test_uneven_tax_total_is_counted_as_stored(self):
+        # 333.33 plus 5% tax is 349.9965, saved as 350.00
+        subtotal = Decimal('333.33')
+        invoice = _invoice(
+            self.patient, self.invoice_type, self.unit,
+            invoice_subtotal=subtotal, invoice_tax=subtotal * Decimal('0.05'), invoice_total=subtotal * Decimal('1.05')
+        )
+        invoice.save()
+        self.assertEqual(self._balances(), [('450.00', '100.00', '0.00')])
+        self._set_status(invoice, 'paid')
+        self._set_status(self.first, 'paid')
+        self.assertEqual(self._balances(), [('0.00', '550.00', '0.00')])
+
+    def test_deleted_invoice_leaves_the_totals(self):
+        self.second.delete()
+        self.assertEqual(self._balances(), [('100.00', '0.00', '0.00')])
+
+
+class LabTestInvoiceTests(TestCase):
+    def setUp(self):
+        self.appointment = _appointment()
+        self.patient = self.appointment.patient
+        self.lab, self.test_type = _lab_fixtures()
+        self.unit = Unit.objects.create(unit_name='INR', unit_symbol='₹')
+        InvoiceType.objects.create(invoice_type_name='lab_test')
+        LabTestCharge.objects.create(
+            test=self.test_type, charge_amount=Decimal('400.00'), charge_unit=self.unit,
+            effective_from=timezone.now() - timedelta(days=30)
+        )
+        payment = _payment(self.patient, self.unit, Decimal('840.00'))
+        self.lab_tests = [
+            LabTest.objects.create(
+                lab=self.lab, test_type=self.test_type, appointment=self.appointment, tran=payment,
+                test_datetime=timezone.now(), status=LabTest.Status.PAID
+            )
+            for _ in range(2)
+        ]
+        self.client = _admin_client()
+        self.url = reverse('generate-multiple-lab-tests-invoice')
+
+    def test_string_ids_from_json_are_accepted(self):
+        response = self.client.post(self.url, {
+            'patient_id': self.patient.patient_id,
+            'lab_test_ids': [str(lab_test.lab_test_id) for lab_test in self.lab_tests]
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(Decimal(response.data['invoice_subtotal']), Decimal('800.00'))
+        self.assertEqual(
+            list(InvoiceLineItem.objects.order_by('position').values_list('lab_test_id', flat=True)),
+            [lab_test.lab_test_id for lab_test in self.lab_tests]
+        )
+
+    def test_line_items_keep_what_was_billed(self):
+        response = self.client.post(self.url, {
+            'patient_id': self.patient.patient_id, 'lab_test_ids': [lab_test.lab_test_id for lab_test in self.lab_tests]
+        }, format='json')
+        invoice_id = response.data['invoice_id']
+
+        # The test, the lab and the price all change after billing
+        self.test_type.test_name = 'Complete Blood Count'
+        self.test_type.save()
+        self.lab.lab_name = 'Hematology Lab'
+        self.lab.save()
+        price_book.retire(LabTestCharge.objects.filter(test=self.test_type))
+        LabTestCharge.objects.create(test=self.test_type, charge_amount=Decimal('900.00'), charge_unit=self.unit)
+
+        items = self.client.get(reverse('invoice-detail', args=[invoice_id])).data['detailed_items']
+        self.assertEqual([item['item_id'] for item in items], [lab_test.lab_test_id for lab_test in self.lab_tests])
+        self.assertEqual({item['description'] for item in items}, {'CBC (Lab A)'})
+        self.assertEqual({item['amount'] for item in items}, {Decimal('400.00')})
+
+        # Billing the same tests again is refused
+        again = self.client.post(self.url, {
+            'patient_id': self.patient.patient_id, 'lab_test_ids': [self.lab_tests[1].lab_test_id]
+        }, format='json')
+        self.assertEqual(again.status_code, 400)
+        self.assertEqual(Invoice.objects.count(), 1)
+
+    def test_non_numeric_ids_are_rejected(self):
+        response = self.client.post(self.url, {
+            'patient_id': self.patient.patient_id, 'lab_test_ids': ['12', 'abc']
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Invoice.objects.exists())
+
+
+class BillingRunTests(TestCase):
+    def setUp(self):
+        self.appointment = _appointment()
+        self.patient = self.appointment.patient
+        self.lab, self.test_type = _lab_fixtures()
+        self.unit = Unit.objects.create(unit_name='INR', unit_symbol='₹')
+        InvoiceType.objects.create(invoice_type_name='appointment')
+        InvoiceType.objects.create(invoice_type_name='lab_test')
+        LabTestCharge.objects.create(
+            test=self.test_type, charge_amount=Decimal('400.00'), charge_unit=self.unit,
+            effective_from=timezone.now() - timedelta(days=30)
+        )
+        self.appointment.charge = AppointmentCharge.objects.create(
+            doctor=self.appointment.staff, charge_amount=Decimal('300.00'), charge_unit=self.unit
+        )
+        self.appointment.tran = _payment(self.patient, self.unit, Decimal('315.00'))
+        self.appointment.save()
+        payment = _payment(self.patient, self.unit, Decimal('840.00'))
+        self.lab_tests = [
+            LabTest.objects.create(
+                lab=self.lab, test_type=self.test_type, appointment=self.appointment, tran=payment,
+                test_datetime=timezone.now(), status=LabTest.Status.PAID
+            )
+            for _ in range(2)
+        ]
+        self.client = _admin_client()
+        self.url = reverse('billing-run')
+
+    def test_already_billed_items_are_skipped(self):
+        # One lab test is invoiced by hand before the run
+        response = self.client.post(reverse('generate-multiple-lab-tests-invoice'), {
+            'patient_id': self.patient.patient_id, 'lab_test_ids': [self.lab_tests[0].lab_test_id]
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+
+        first = self.client.post(self.url, {}, format='json')
+        self.assertEqual(first.status_code, 201, first.data)
+        self.assertEqual((first.data['invoices'], first.data['appointments'], first.data['lab_tests']), (2, 1, 1))
+        self.assertEqual(first.data['totals'], {'₹': {'subtotal': '700.00', 'tax': '35.00', 'total': '735.00'}})
+        self.assertEqual(InvoiceLineItem.objects.filter(appointment=self.appointment).count(), 1)
+        for lab_test in self.lab_tests:
+            self.assertEqual(InvoiceLineItem.objects.filter(lab_test=lab_test).count(), 1)
+
+        # Running again bills nothing twice
+        second = self.client.post(self.url, {}, format='json')
+        self.assertEqual(second.data['invoices'], 0)
+        self.assertEqual(Invoice.objects.count(), 3)
+
+    def test_dry_run_writes_nothing(self):
+        response = self.client.post(self.url, {'dry_run': True}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['invoices'], 3)
+        self.assertFalse(Invoice.objects.exists())
+
+    def test_payments_after_the_day_are_left_for_later(self):
+        summary = billing_run.run(day=timezone.localdate() - timedelta(days=1))
+        self.assertEqual(summary['invoices'], 0)
+        self.assertFalse(InvoiceLineItem.objects.exists())
+
+
+class ReconciliationTests(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.statement = os.path.join(directory, 'statement.csv')
+        self.report = os.path.join(directory, 'report.csv')
+        patient, _, unit = _invoice_fixtures()
+        self.pending = _payment(patient, unit, Decimal('100.00'), transaction_reference='REF-1', transaction_status='pending')
+        self.completed = _payment(patient, unit, Decimal('200.00'), transaction_reference='REF-2')
+        self.unsettled = _payment(patient, unit, Decimal('300.00'), transaction_reference='REF-3')
+        self.period = (timezone.now() - timedelta(days=1), timezone.now() + timedelta(days=1))
+
+    def _write_statement(self, rows):
+        with open(self.statement, 'w', newline='', encoding='utf-8') as handle:
+            writer = csv.writer(handle)
+            writer.writerow(['reference', 'amount', 'status'])
+            writer.writerows(rows)
+
+    def _reconcile(self, **kwargs):
+        start, end = self.period
+        return reconciliation.reconcile(self.statement, report_path=self.report, start=start, end=end, **kwargs)
+
+    def test_rows_are_matched_by_reference(self):
+        self._write_statement([
+            ['REF-1', '100.00', 'settled'],
+            ['REF-2', '250.00', 'settled'],
+            ['REF-1', '100.00', 'settled'],
+            ['REF-UNKNOWN', '50.00', 'settled'],
+            ['', '10.00', 'settled'],
+            ['REF-4', 'abc', 'settled'],
+        ])
+        counts = self._reconcile()
+        self.assertEqual(
+            {issue: counts[issue] for issue in ('rows', 'matched', 'unknown_reference', 'amount_mismatch',
+                                                'duplicate', 'invalid', 'missing_in_statement', 'status_updates')},
+            {'rows': 6, 'matched': 1, 'unknown_reference': 1, 'amount_mismatch': 1,
+             'duplicate': 1, 'invalid': 2, 'missing_in_statement': 1, 'status_updates': 1}
+        )
+        self.pending.refresh_from_db()
+        self.assertEqual(self.pending.transaction_status, 'completed')
+
+        with open(self.report, newline='', encoding='utf-8') as handle:
+            issues = {row['issue']: row for row in csv.DictReader(handle)}
+        self.assertEqual(issues['amount_mismatch']['transaction_id'], str(self.completed.transaction_id))
+        self.assertEqual(
+            (issues['amount_mismatch']['ledger_amount'], issues['amount_mismatch']['statement_amount']),
+            ('200.00', '250.00')
+        )
+        self.assertEqual(issues['missing_in_statement']['reference'], 'REF-3')
+        self.assertEqual(issues['duplicate']['line'], '4')
+
+    def test_dry_run_leaves_statuses_alone(self):
+        self._write_statement([['REF-1', '100.00', 'settled'], ['REF-2', '200.00', 'refunded']])
+        counts = self._reconcile(dry_run=True)
+        self.assertEqual((counts['matched'], counts['status_updates']), (2, 2))
+        self.assertEqual(
+            dict(Transaction.objects.values_list('transaction_reference', 'transaction_status')),
+            {'REF-1': 'pending', 'REF-2': 'completed', 'REF-3': 'completed'}
+        )
+
+    def test_statement_without_required_columns_is_rejected(self):
+        with open(self.statement, 'w', encoding='utf-8') as handle:
+            handle.write('reference,status\nREF-1,settled\n')
+        with self.assertRaises(ReconciliationError):
+            self._reconcile()
+
+
+class InvoicePDFTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        # Render in-process and count renders; the caching is under test, not WeasyPrint
+        mock.patch.object(invoice_pdfs, 'workers', 0).start()
+        self.render = mock.patch.object(pdf_worker, 'render_pdf', return_value=b'%PDF-1.4 test').start()
+        self.addCleanup(mock.patch.stopall)
+
+        self.invoice = _invoice(*_invoice_fixtures())
+        self.invoice.save()
+        self.client = _admin_client()
+        self.url = reverse('generate-invoice-pdf', args=[self.invoice.invoice_id])
+
+    def test_pdf_is_rendered_once_per_version(self):
+        first = self.client.get(self.url)
+        self.assertEqual(first.status_code, 200)
+        self.assertTrue(b''.join(first.streaming_content).startswith(b'%PDF'))
+        etag = first['ETag']
+
+        self.assertEqual(self.client.get(self.url, headers={'if-none-match': etag}).status_code, 304)
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.assertEqual(self.render.call_count, 1)
+
+        # A changed invoice is a new document with a new ETag; the old file is removed
+        self.invoice.invoice_status = 'paid'
+        self.invoice.save()
+        changed = self.client.get(self.url, headers={'if-none-match': etag})
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], etag)
+        self.assertEqual(self.render.call_count, 2)
+        _, files = default_storage.listdir(f'invoice_pdfs/{self.invoice.invoice_id}')
+        self.assertEqual(files, [f"{changed['ETag'].strip(chr(34))}.pdf"])
+
+    def test_if_none_match_compares_whole_etags(self):
+        etag = self.client.get(self.url)['ETag']
+        self.assertEqual(self.client.get(self.url, headers={'if-none-match': f'W/{etag}'}).status_code, 304)
+        self.assertEqual(self.client.get(self.url, headers={'if-none-match': f'"{etag.strip(chr(34))}0"'}).status_code, 200)
@@ -8,7 +8,9 @@ urlpatterns = [
     path('invoices/<int:invoice_id>/status/', views.UpdateInvoiceStatusView.as_view(), name='update-invoice-status'),
     path('invoices/<int:invoice_id>/pdf/', views.GenerateInvoicePDFView.as_view(), name='generate-invoice-pdf'),
     path('patients/<int:patient_id>/invoices/', views.PatientInvoicesView.as_view(), name='patient-invoices'),
+    path('patients/<int:patient_id>/ledger/', views.PatientLedgerView.as_view(), name='patient-ledger'),
     path('appointments/<int:appointment_id>/generate-invoice/', views.GenerateAppointmentInvoiceView.as_view(), name='generate-appointment-invoice'),
     path('lab-tests/<int:lab_test_id>/generate-invoice/', views.GenerateLabTestInvoiceView.as_view(), name='generate-lab-test-invoice'),
     path('lab-tests/generate-multiple-invoice/', views.GenerateMultipleLabTestsInvoiceView.as_view(), name='generate-multiple-lab-tests-invoice'),
+    path('billing-runs/', views.BillingRunView.as_view(), name='billing-run'),
 ]
@@ -5,10 +5,14 @@ from rest_framework import status
 from accounts.authentication import JWTAuthentication
 from rest_framework.permissions import IsAuthenticated
 from hospital.permissions import IsAdminStaff
-from .models import Invoice, InvoiceType, Transaction, Unit
-from .serializers import InvoiceSerializer
+from .models import Invoice, InvoiceLineItem, InvoiceType, PatientLedger, Transaction, Unit
+from .serializers import InvoiceSerializer, PatientLedgerSerializer
 from django.shortcuts import get_object_or_404
+from django.db import transaction as db_transaction
 from hospital.models import Appointment, LabTest, Patient
+from hospital.price_book_service import price_book
+from .billing_run_service import billing_run
+from datetime import datetime
 import decimal
 
 class InvoiceListView(APIView):
@@ -43,7 +47,9 @@ class InvoiceDetailView(APIView):
     permission_classes = [IsAuthenticated]
     
     def get(self, request, invoice_id):
-        invoice = get_object_or_404(Invoice, invoice_id=invoice_id)
+        invoice = get_object_or_404(
+            Invoice.objects.select_related('invoice_type', 'patient', 'invoice_unit'), invoice_id=invoice_id
+        )
         
         # Check permissions
         if hasattr(request.user, 'patient_id'):
@@ -61,33 +67,8 @@ class InvoiceDetailView(APIView):
             
         serializer = InvoiceSerializer(invoice)
         
-        # Get detailed information about invoice items
-        detailed_items = []
-        for item_id in invoice.invoice_items:
-            if invoice.invoice_type.invoice_type_name == 'appointment':
-                try:
-                    appointment = Appointment.objects.get(appointment_id=item_id)
-                    detailed_items.append({
-                        "item_id": item_id,
-                        "item_type": "appointment",
-                        "doctor_name": appointment.staff.staff_name,
-                        "appointment_date": appointment.created_at.strftime('%Y-%m-%d'),
-                        "slot_time": appointment.slot.slot_start_time.strftime('%H:%M')
-                    })
-                except Appointment.DoesNotExist:
-                    detailed_items.append({"item_id": item_id, "item_type": "appointment", "status": "not found"})
-            elif invoice.invoice_type.invoice_type_name == 'lab_test':
-                try:
-                    lab_test = LabTest.objects.get(lab_test_id=item_id)
-                    detailed_items.append({
-                        "item_id": item_id,
-                        "item_type": "lab_test",
-                        "test_name": lab_test.test_type.test_name,
-                        "lab_name": lab_test.lab.lab_name,
-                        "test_date": lab_test.test_datetime.strftime('%Y-%m-%d')
-                    })
-                except LabTest.DoesNotExist:
-                    detailed_items.append({"item_id": item_id, "item_type": "lab_test", "status": "not found"})
+        # Line items carry everything shown, as billed
+        detailed_items = [item.as_detail() for item in invoice.line_items.select_related('unit')]
         
         # Add detailed items to the response
         response_data = serializer.data
@@ -100,13 +81,13 @@ class GenerateAppointmentInvoiceView(APIView):
     permission_classes = [IsAdminStaff]
     
     def post(self, request, appointment_id):
-        appointment = get_object_or_404(Appointment, appointment_id=appointment_id)
+        appointment = get_object_or_404(
+            Appointment.objects.select_related('staff', 'slot', 'charge__charge_unit', 'tran', 'patient'),
+            appointment_id=appointment_id
+        )
         
         # Check if invoice already exists for this appointment
-        if Invoice.objects.filter(
-            invoice_type__invoice_type_name='appointment',
-            invoice_items__contains=[appointment_id]
-        ).exists():
+        if InvoiceLineItem.objects.filter(appointment_id=appointment_id).exists():
             return Response({"error": "Invoice already exists for this appointment"}, status=400)
             
         # Check if transaction exists
@@ -130,18 +111,20 @@ class GenerateAppointmentInvoiceView(APIView):
         total = subtotal + tax
         
         # Create invoice
-        invoice = Invoice.objects.create(
-            tran=appointment.tran,
-            invoice_type=invoice_type,
-            patient=appointment.patient,
-            invoice_items=[appointment.appointment_id],
-            invoice_subtotal=subtotal,
-            invoice_tax=tax,
-            invoice_total=total,
-            invoice_unit=appointment.charge.charge_unit,
-            invoice_status='paid' if appointment.tran.transaction_status == 'completed' else 'pending',
-            invoice_remark=f"Invoice for appointment on {appointment.created_at.strftime('%Y-%m-%d')}"
-        )
+        with db_transaction.atomic():
+            invoice = Invoice.objects.create(
+                tran=appointment.tran,
+                invoice_type=invoice_type,
+                patient=appointment.patient,
+                invoice_items=[appointment.appointment_id],
+                invoice_subtotal=subtotal,
+                invoice_tax=tax,
+                invoice_total=total,
+                invoice_unit=appointment.charge.charge_unit,
+                invoice_status='paid' if appointment.tran.transaction_status == 'completed' else 'pending',
+                invoice_remark=f"Invoice for appointment on {appointment.created_at.strftime('%Y-%m-%d')}"
+            )
+            InvoiceLineItem.for_appointment(appointment, appointment.charge, invoice=invoice).save()
         
         serializer = InvoiceSerializer(invoice)
         return Response(serializer.data, status=201)
@@ -151,13 +134,13 @@ class GenerateLabTestInvoiceView(APIView):
     permission_classes = [IsAdminStaff]
     
     def post(self, request, lab_test_id):
-        lab_test = get_object_or_404(LabTest, lab_test_id=lab_test_id)
+        lab_test = get_object_or_404(
+            LabTest.objects.select_related('test_type', 'lab', 'tran', 'appointment__patient'),
+            lab_test_id=lab_test_id
+        )
         
         # Check if invoice already exists for this lab test
-        if Invoice.objects.filter(
-            invoice_type__invoice_type_name='lab_test',
-            invoice_items__contains=[lab_test_id]
-        ).exists():
+        if InvoiceLineItem.objects.filter(lab_test_id=lab_test_id).exists():
             return Response({"error": "Invoice already exists for this lab test"}, status=400)
             
         # Check if transaction exists
@@ -170,11 +153,9 @@ class GenerateLabTestInvoiceView(APIView):
         except InvoiceType.DoesNotExist:
             return Response({"error": "Lab test invoice type not found"}, status=400)
             
-        # Get test charge
-        from hospital.models import LabTestCharge
-        try:
-            charge = LabTestCharge.objects.get(test=lab_test.test_type, is_active=True)
-        except LabTestCharge.DoesNotExist:
+        # Get test charge as it was when the test was paid
+        charge = price_book.lab_test_charge(lab_test.test_type_id, at=lab_test.tran.transaction_datetime)
+        if charge is None:
             return Response({"error": "No charge information found for this lab test"}, status=400)
             
         # Calculate tax (assuming 5% tax)
@@ -184,18 +165,20 @@ class GenerateLabTestInvoiceView(APIView):
         total = subtotal + tax
         
         # Create invoice
-        invoice = Invoice.objects.create(
-            tran=lab_test.tran,
-            invoice_type=invoice_type,
-            patient=lab_test.appointment.patient,
-            invoice_items=[lab_test.lab_test_id],
-            invoice_subtotal=subtotal,
-            invoice_tax=tax,
-            invoice_total=total,
-            invoice_unit=charge.charge_unit,
-            invoice_status='paid' if lab_test.tran.transaction_status == 'completed' else 'pending',
-            invoice_remark=f"Invoice for {lab_test.test_type.test_name} on {lab_test.test_datetime.strftime('%Y-%m-%d')}"
-        )
+        with db_transaction.atomic():
+            invoice = Invoice.objects.create(
+                tran=lab_test.tran,
+                invoice_type=invoice_type,
+                patient=lab_test.appointment.patient,
+                invoice_items=[lab_test.lab_test_id],
+                invoice_subtotal=subtotal,
+                invoice_tax=tax,
+                invoice_total=total,
+                invoice_unit=charge.charge_unit,
+                invoice_status='paid' if lab_test.tran.transaction_status == 'completed' else 'pending',
+                invoice_remark=f"Invoice for {lab_test.test_type.test_name} on {lab_test.test_datetime.strftime('%Y-%m-%d')}"
+            )
+            InvoiceLineItem.for_lab_test(lab_test, charge, invoice=invoice).save()
         
         serializer = InvoiceSerializer(invoice)
         return Response(serializer.data, status=201)
@@ -210,6 +193,14 @@ class GenerateMultipleLabTestsInvoiceView(APIView):
         
         if not lab_test_ids:
             return Response({"error": "No lab test IDs provided"}, status=400)
+
+        # in_bulk keys are ints; JSON clients may send the ids as strings
+        try:
+            if not isinstance(lab_test_ids, (list, tuple)):
+                raise TypeError
+            lab_test_ids = [int(test_id) for test_id in lab_test_ids]
+        except (TypeError, ValueError):
+            return Response({"error": "lab_test_ids must be a list of integer IDs"}, status=400)
             
         if not patient_id:
             return Response({"error": "Patient ID is required"}, status=400)
@@ -221,25 +212,26 @@ class GenerateMultipleLabTestsInvoiceView(APIView):
             return Response({"error": f"Patient with ID {patient_id} not found"}, status=400)
             
         # Check if all lab tests exist and belong to the patient
+        tests_by_id = LabTest.objects.select_related(
+            'appointment', 'tran', 'test_type', 'lab'
+        ).in_bulk(lab_test_ids)
         lab_tests = []
         for test_id in lab_test_ids:
-            try:
-                test = LabTest.objects.get(lab_test_id=test_id)
-                if test.appointment.patient.patient_id != patient.patient_id:
-                    return Response({"error": f"Lab test {test_id} does not belong to this patient"}, status=400)
-                if not test.tran:
-                    return Response({"error": f"Lab test {test_id} has no transaction"}, status=400)
-                lab_tests.append(test)
-            except LabTest.DoesNotExist:
+            test = tests_by_id.get(test_id)
+            if test is None:
                 return Response({"error": f"Lab test with ID {test_id} not found"}, status=400)
+            if test.appointment.patient_id != patient.patient_id:
+                return Response({"error": f"Lab test {test_id} does not belong to this patient"}, status=400)
+            if not test.tran:
+                return Response({"error": f"Lab test {test_id} has no transaction"}, status=400)
+            lab_tests.append(test)
                 
         # Check if any of these tests already have invoices
-        for test in lab_tests:
-            if Invoice.objects.filter(
-                invoice_type__invoice_type_name='lab_test',
-                invoice_items__contains=[test.lab_test_id]
-            ).exists():
-                return Response({"error": f"Invoice already exists for lab test {test.lab_test_id}"}, status=400)
+        invoiced = InvoiceLineItem.objects.filter(
+            lab_test_id__in=[test.lab_test_id for test in lab_tests]
+        ).values_list('lab_test_id', flat=True).first()
+        if invoiced is not None:
+            return Response({"error": f"Invoice already exists for lab test {invoiced}"}, status=400)
                 
         # Get invoice type
         try:
@@ -247,21 +239,20 @@ class GenerateMultipleLabTestsInvoiceView(APIView):
         except InvoiceType.DoesNotExist:
             return Response({"error": "Lab test invoice type not found"}, status=400)
             
-        # Calculate totals
-        from hospital.models import LabTestCharge
+        # Calculate totals, pricing each test as it was when it was paid
+        charges = price_book.charges_for_lab_tests(lab_tests)
         subtotal = decimal.Decimal('0.00')
         unit = None
         
         for test in lab_tests:
-            try:
-                charge = LabTestCharge.objects.get(test=test.test_type, is_active=True)
-                subtotal += charge.charge_amount
-                if unit is None:
-                    unit = charge.charge_unit
-                elif unit.unit_id != charge.charge_unit.unit_id:
-                    return Response({"error": "Cannot create invoice with different currency units"}, status=400)
-            except LabTestCharge.DoesNotExist:
+            charge = charges.get(test.lab_test_id)
+            if charge is None:
                 return Response({"error": f"No charge information found for lab test {test.lab_test_id}"}, status=400)
+            subtotal += charge.charge_amount
+            if unit is None:
+                unit = charge.charge_unit
+            elif unit.unit_id != charge.charge_unit.unit_id:
+                return Response({"error": "Cannot create invoice with different currency units"}, status=400)
                 
         # Calculate tax (assuming 5% tax)
         tax_rate = decimal.Decimal('0.05')
@@ -269,22 +260,44 @@ class GenerateMultipleLabTestsInvoiceView(APIView):
         total = subtotal + tax
         
         # Create invoice
-        invoice = Invoice.objects.create(
-            tran=lab_tests[0].tran,  # Use the first test's transaction
-            invoice_type=invoice_type,
-            patient=patient,
-            invoice_items=[test.lab_test_id for test in lab_tests],
-            invoice_subtotal=subtotal,
-            invoice_tax=tax,
-            invoice_total=total,
-            invoice_unit=unit,
-            invoice_status='paid',
-            invoice_remark=f"Invoice for multiple lab tests on {lab_tests[0].test_datetime.strftime('%Y-%m-%d')}"
-        )
+        with db_transaction.atomic():
+            invoice = Invoice.objects.create(
+                tran=lab_tests[0].tran,  # Use the first test's transaction
+                invoice_type=invoice_type,
+                patient=patient,
+                invoice_items=[test.lab_test_id for test in lab_tests],
+                invoice_subtotal=subtotal,
+                invoice_tax=tax,
+                invoice_total=total,
+                invoice_unit=unit,
+                invoice_status='paid',
+                invoice_remark=f"Invoice for multiple lab tests on {lab_tests[0].test_datetime.strftime('%Y-%m-%d')}"
+            )
+            InvoiceLineItem.objects.bulk_create([
+                InvoiceLineItem.for_lab_test(test, charges[test.lab_test_id], position=position, invoice=invoice)
+                for position, test in enumerate(lab_tests)
+            ])
         
         serializer = InvoiceSerializer(invoice)
         return Response(serializer.data, status=201)
 
+class BillingRunView(APIView):
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAdminStaff]
+
+    def post(self, request):
+        """Invoice every paid appointment and lab test without an invoice, up to the end of `date`"""
+        day = None
+        if request.data.get('date'):
+            try:
+                day = datetime.strptime(request.data['date'], '%Y-%m-%d').date()
+            except (TypeError, ValueError):
+                return Response({"error": "Invalid date format. Use YYYY-MM-DD"}, status=400)
+        dry_run = str(request.data.get('dry_run', False)).lower() in ('true', '1')
+
+        summary = billing_run.run(day=day, dry_run=dry_run)
+        return Response(summary, status=200 if dry_run else 201)
+
 class UpdateInvoiceStatusView(APIView):
     authentication_classes = [JWTAuthentication]
     permission_classes = [IsAdminStaff]
@@ -329,17 +342,42 @@ class PatientInvoicesView(APIView):
         serializer = InvoiceSerializer(invoices, many=True)
         return Response(serializer.data, status=200)
 
-from django.http import HttpResponse
-from django.template.loader import render_to_string
-from weasyprint import HTML
-import tempfile
+class PatientLedgerView(APIView):
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, patient_id):
+        """Outstanding, paid and refunded totals of a patient, one row per currency"""
+        if hasattr(request.user, 'patient_id'):
+            if int(patient_id) != request.user.patient_id:
+                return Response({"error": "Not authorized to view this ledger"}, status=403)
+        elif hasattr(request.user, 'staff_id'):
+            try:
+                is_admin = request.user.role.role_permissions.get('is_admin', False)
+            except AttributeError:
+                is_admin = False
+            if not is_admin:
+                return Response({"error": "Not authorized to view this ledger"}, status=403)
+        else:
+            return Response({"error": "Invalid user"}, status=403)
+
+        entries = PatientLedger.objects.filter(patient_id=patient_id).select_related('unit').order_by('unit_id')
+        return Response({
+            "patient_id": int(patient_id),
+            "balances": PatientLedgerSerializer(entries, many=True).data
+        }, status=200)
+
+from django.http import FileResponse, HttpResponse
+from django.utils.http import parse_etags
+from django.core.files.storage import default_storage
+from .invoice_pdf_service import invoice_pdfs
 
 class GenerateInvoicePDFView(APIView):
     authentication_classes = [JWTAuthentication]
     permission_classes = [IsAuthenticated]
     
     def get(self, request, invoice_id):
-        invoice = get_object_or_404(Invoice, invoice_id=invoice_id)
+        invoice = get_object_or_404(invoice_pdfs.with_line_items(Invoice.objects.all()), invoice_id=invoice_id)
         
         # Check permissions
         if hasattr(request.user, 'patient_id'):
@@ -355,59 +393,19 @@ class GenerateInvoicePDFView(APIView):
         else:
             return Response({"error": "Invalid user"}, status=403)
             
-        # Get detailed information about invoice items
-        detailed_items = []
-        for item_id in invoice.invoice_items:
-            if invoice.invoice_type.invoice_type_name == 'appointment':
-                try:
-                    appointment = Appointment.objects.get(appointment_id=item_id)
-                    detailed_items.append({
-                        "item_id": item_id,
-                        "item_type": "appointment",
-                        "doctor_name": appointment.staff.staff_name,
-                        "appointment_date": appointment.created_at.strftime('%Y-%m-%d'),
-                        "slot_time": appointment.slot.slot_start_time.strftime('%H:%M'),
-                        "amount": appointment.charge.charge_amount
-                    })
-                except Appointment.DoesNotExist:
-                    pass
-            elif invoice.invoice_type.invoice_type_name == 'lab_test':
-                try:
-                    lab_test = LabTest.objects.get(lab_test_id=item_id)
-                    from hospital.models import LabTestCharge
-                    charge = LabTestCharge.objects.get(test=lab_test.test_type, is_active=True)
-                    detailed_items.append({
-                        "item_id": item_id,
-                        "item_type": "lab_test",
-                        "test_name": lab_test.test_type.test_name,
-                        "lab_name": lab_test.lab.lab_name,
-                        "test_date": lab_test.test_datetime.strftime('%Y-%m-%d'),
-                        "amount": charge.charge_amount
-                    })
-                except (LabTest.DoesNotExist, LabTestCharge.DoesNotExist):
-                    pass
-        
-        # Prepare context for the template
-        context = {
-            'invoice': invoice,
-            'detailed_items': detailed_items,
-            'hospital_name': 'Your Hospital Name',
-            'hospital_address': 'Your Hospital Address',
-            'hospital_phone': 'Your Hospital Phone',
-            'hospital_email': 'your@hospital.com'
-        }
-        
-        # Render HTML
-        html_string = render_to_string('invoice_template.html', context)
-        
-        # Generate PDF
-        response = HttpResponse(content_type='application/pdf')
-        response['Content-Disposition'] = f'attachment; filename="invoice_{invoice.invoice_number}.pdf"'
-        
-        with tempfile.NamedTemporaryFile(suffix='.html') as temp:
-            temp.write(html_string.encode('utf-8'))
-            temp.flush()
-            HTML(filename=temp.name).write_pdf(response)
-            
+        # Rendered once per version of the invoice, then streamed from storage
+        path = invoice_pdfs.pdf_path(invoice)
+        etag = invoice_pdfs.etag(path)
+        if_none_match = parse_etags(request.headers.get('If-None-Match', ''))
+        if '*' in if_none_match or etag in {tag.removeprefix('W/') for tag in if_none_match}:
+            response = HttpResponse(status=304)
+        else:
+            response = FileResponse(
+                default_storage.open(path, 'rb'),
+                as_attachment=True,
+                filename=f"invoice_{invoice.invoice_number}.pdf",
+                content_type='application/pdf'
+            )
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
         return response
-